@@ -0,0 +1,39 @@
+"""add returned_quantity to order lines
+
+Revision ID: a7d4e2b9c613
+Revises: f3a9c1d27e58
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7d4e2b9c613'
+down_revision: Union[str, None] = 'f3a9c1d27e58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+LINE_TABLES = ('order_items', 'order_joints', 'order_glues')
+LINE_QUANTITY = {'order_items': 'quantity', 'order_joints': 'joint_quantity', 'order_glues': 'quantity'}
+
+
+def upgrade() -> None:
+    for table in LINE_TABLES:
+        op.add_column(table, sa.Column('returned_quantity', sa.Integer(), server_default='0', nullable=False))
+        # Полностью возвращенные ранее заказы считаем возвращенными по всем строкам
+        op.execute(f"""
+            UPDATE {table} l
+            SET returned_quantity = l.{LINE_QUANTITY[table]}
+            FROM order_completions c
+            WHERE c.order_id = l.order_id AND c.status = 'returned'
+        """)
+
+
+def downgrade() -> None:
+    for table in LINE_TABLES:
+        op.drop_column(table, 'returned_quantity')
@@ -0,0 +1,28 @@
+"""add indexes for keyset pagination of order lists
+
+Revision ID: b2e8d4f61a37
+Revises: a7d4e2b9c613
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b2e8d4f61a37'
+down_revision: Union[str, None] = 'a7d4e2b9c613'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_orders_status_created_at_id', 'orders', ['status', 'created_at', 'id'], unique=False)
+    op.create_index('ix_order_completions_status_completed_at', 'order_completions',
+                    ['status', 'completed_at', 'order_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_order_completions_status_completed_at', table_name='order_completions')
+    op.drop_index('ix_orders_status_created_at_id', table_name='orders')
@@ -0,0 +1,37 @@
+"""add defect_reports table for batch defect write-offs
+
+Revision ID: b5e2f8a4c731
+Revises: a3d9e5f1b264
+Create Date: 2026-10-19 23:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5e2f8a4c731'
+down_revision: Union[str, None] = 'a3d9e5f1b264'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'defect_reports',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('line_count', sa.Integer(), nullable=False),
+        sa.Column('note', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_defect_reports_created_at', 'defect_reports', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_defect_reports_created_at', table_name='defect_reports')
+    op.drop_table('defect_reports')
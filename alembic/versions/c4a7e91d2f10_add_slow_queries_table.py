@@ -0,0 +1,39 @@
+"""add slow_queries table and merge heads
+
+Revision ID: c4a7e91d2f10
+Revises: afc12345def6, b1d8f0a7e2c3
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4a7e91d2f10'
+# Объединяем две головы: ветку статусов completed_orders и ветку RESERVED
+down_revision: Union[str, Sequence[str], None] = ('afc12345def6', 'b1d8f0a7e2c3')
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'slow_queries',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('captured_at', sa.DateTime(), nullable=False),
+        sa.Column('duration_ms', sa.Float(), nullable=False),
+        sa.Column('statement', sa.Text(), nullable=False),
+        sa.Column('parameters', sa.Text(), nullable=True),
+        sa.Column('handler', sa.String(length=255), nullable=True),
+        sa.Column('explain', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_slow_queries_captured_at'), 'slow_queries', ['captured_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_slow_queries_captured_at'), table_name='slow_queries')
+    op.drop_table('slow_queries')
@@ -0,0 +1,124 @@
+"""store thickness as smallint hundredths of mm and film length as integer millimetres
+
+Revision ID: c7f3a1d9e586
+Revises: b5e2f8a4c731
+Create Date: 2026-10-19 23:30:00.000000
+
+"""
+import re
+from typing import Optional, Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7f3a1d9e586'
+down_revision: Union[str, None] = 'b5e2f8a4c731'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Толщина: models.Thickness (сотые доли мм)
+THICKNESS_COLUMNS = [
+    ('panels', 'thickness'),
+    ('joints', 'thickness'),
+    ('finished_products', 'thickness'),
+    ('production_orders', 'panel_thickness'),
+    ('order_joints', 'joint_thickness'),
+    ('order_items', 'thickness'),
+]
+# Длина пленки: models.FilmLength (мм)
+FILM_LENGTH_COLUMNS = ['panel_consumption', 'meters_per_roll', 'total_remaining']
+
+# Представления совместимости из f3a9c1d27e58 читают толщину из order_items/order_joints:
+# тип колонки под представлением менять нельзя, и отдавать они должны по-прежнему миллиметры
+VIEW_QUERY = {
+    'completed_order_items': """
+        SELECT i.id, i.order_id, i.quantity, i.color, {thickness} AS thickness
+        FROM order_items i
+        JOIN order_completions c ON c.order_id = i.order_id
+    """,
+    'completed_order_joints': """
+        SELECT j.id, j.order_id, j.joint_type, j.joint_color, j.joint_quantity AS quantity,
+               {joint_thickness} AS joint_thickness
+        FROM order_joints j
+        JOIN order_completions c ON c.order_id = j.order_id
+    """,
+}
+
+# Должно совпадать с models.POSSIBLE_PANELS_SQL
+POSSIBLE_PANELS_SQL = "CASE WHEN panel_consumption > 0 THEN total_remaining / panel_consumption ELSE 0 END"
+OLD_POSSIBLE_PANELS_SQL = (
+    "CASE WHEN panel_consumption > 0 THEN CAST(trunc(total_remaining / panel_consumption) AS integer) ELSE 0 END"
+)
+
+
+def _drop_views():
+    for name in VIEW_QUERY:
+        op.execute(f"DROP VIEW IF EXISTS {name}")
+
+
+def _create_views(thickness: str, joint_thickness: str):
+    for name, query in VIEW_QUERY.items():
+        op.execute(f"CREATE VIEW {name} AS {query.format(thickness=thickness, joint_thickness=joint_thickness)}")
+
+
+def _server_default(table: str, column: str) -> Optional[float]:
+    """Текущее значение по умолчанию колонки (если задано) как число."""
+    for info in sa.inspect(op.get_bind()).get_columns(table):
+        if info['name'] == column and info.get('default'):
+            match = re.search(r"-?\d+(?:\.\d+)?", info['default'])
+            return float(match.group()) if match else None
+    return None
+
+
+def _alter_scaled(table: str, column: str, type_, using: str, factor: float):
+    """Меняет тип колонки; значение по умолчанию, если оно было, пересчитывается тем же множителем.
+
+    Без этого PostgreSQL привел бы старое значение (0.5) к новому типу как есть.
+    """
+    default = _server_default(table, column)
+    if default is not None:
+        op.alter_column(table, column, server_default=None)
+    op.alter_column(table, column, type_=type_, existing_nullable=False, postgresql_using=using)
+    if default is not None:
+        scaled = default * factor
+        op.alter_column(table, column, server_default=str(int(round(scaled)) if factor > 1 else scaled))
+
+
+def _drop_possible_panels():
+    # Тип колонок, от которых зависит генерируемая колонка, менять нельзя
+    op.drop_index('ix_films_code_available', table_name='films')
+    op.drop_column('films', 'possible_panels')
+
+
+def _add_possible_panels(expression: str):
+    op.add_column('films', sa.Column('possible_panels', sa.Integer(),
+                                     sa.Computed(expression, persisted=True), nullable=True))
+    op.create_index('ix_films_code_available', 'films', ['code'], unique=False,
+                    postgresql_where=sa.text('possible_panels > 0'))
+
+
+def upgrade() -> None:
+    _drop_views()
+    for table, column in THICKNESS_COLUMNS:
+        _alter_scaled(table, column, sa.SmallInteger(), f'round({column} * 100)::smallint', 100)
+    _create_views('i.thickness / 100.0', 'j.joint_thickness / 100.0')
+
+    _drop_possible_panels()
+    for column in FILM_LENGTH_COLUMNS:
+        _alter_scaled('films', column, sa.Integer(), f'round({column} * 1000)::integer', 1000)
+    _add_possible_panels(POSSIBLE_PANELS_SQL)
+
+
+def downgrade() -> None:
+    _drop_possible_panels()
+    for column in FILM_LENGTH_COLUMNS:
+        _alter_scaled('films', column, sa.Float(), f'{column} / 1000.0', 0.001)
+    _add_possible_panels(OLD_POSSIBLE_PANELS_SQL)
+
+    _drop_views()
+    for table, column in THICKNESS_COLUMNS:
+        _alter_scaled(table, column, sa.Float(), f'{column} / 100.0', 0.01)
+    _create_views('i.thickness', 'j.joint_thickness')
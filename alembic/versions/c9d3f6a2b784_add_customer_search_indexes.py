@@ -0,0 +1,42 @@
+"""add normalized customer phone and trigram search indexes to orders
+
+Revision ID: c9d3f6a2b784
+Revises: b2e8d4f61a37
+Create Date: 2026-10-19 17:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c9d3f6a2b784'
+down_revision: Union[str, None] = 'b2e8d4f61a37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Должно совпадать с models.PHONE_NORMALIZED_SQL
+PHONE_NORMALIZED_SQL = r"regexp_replace(regexp_replace(customer_phone, '\D', '', 'g'), '^8(\d{10})$', '7\1')"
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # Генерируемая колонка заполняется для существующих заказов при добавлении
+    op.add_column('orders', sa.Column('customer_phone_normalized', sa.String(),
+                                      sa.Computed(PHONE_NORMALIZED_SQL, persisted=True), nullable=True))
+    op.create_index('ix_orders_customer_phone_normalized', 'orders',
+                    ['customer_phone_normalized', 'created_at'], unique=False)
+    op.create_index('ix_orders_customer_phone_trgm', 'orders', ['customer_phone_normalized'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'customer_phone_normalized': 'gin_trgm_ops'})
+    op.create_index('ix_orders_delivery_address_trgm', 'orders', ['delivery_address'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'delivery_address': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_orders_delivery_address_trgm', table_name='orders')
+    op.drop_index('ix_orders_customer_phone_trgm', table_name='orders')
+    op.drop_index('ix_orders_customer_phone_normalized', table_name='orders')
+    op.drop_column('orders', 'customer_phone_normalized')
@@ -0,0 +1,34 @@
+"""backfill orders.created_at and make it not null
+
+Revision ID: d4a8e2c6b913
+Revises: c7f3a1d9e586
+Create Date: 2026-10-20 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4a8e2c6b913'
+down_revision: Union[str, None] = 'c7f3a1d9e586'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Keyset-курсор строится по (created_at, id), NULL в нем не выразить. Заказы без даты
+    # (перенесенные из completed_orders) получают дату последнего изменения или завершения.
+    op.execute(
+        "UPDATE orders SET created_at = COALESCE(updated_at, completed_at, TIMESTAMPTZ '1970-01-01 00:00:00+00') "
+        "WHERE created_at IS NULL"
+    )
+    op.alter_column('orders', 'created_at', existing_type=sa.DateTime(timezone=True), nullable=False,
+                    existing_server_default=sa.text('now()'))
+
+
+def downgrade() -> None:
+    op.alter_column('orders', 'created_at', existing_type=sa.DateTime(timezone=True), nullable=True,
+                    existing_server_default=sa.text('now()'))
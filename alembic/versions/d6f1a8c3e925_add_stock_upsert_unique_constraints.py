@@ -0,0 +1,71 @@
+"""add unique keys to panels and joints for INSERT ... ON CONFLICT imports
+
+Revision ID: d6f1a8c3e925
+Revises: c9d3f6a2b784
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd6f1a8c3e925'
+down_revision: Union[str, None] = 'c9d3f6a2b784'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Дубликаты сливаются в строку с наименьшим id: остатки суммируются,
+    # резервы стыков переносятся на оставшуюся строку.
+    op.execute("""
+        CREATE TEMP TABLE joint_duplicates ON COMMIT DROP AS
+        SELECT j.id, MIN(j.id) OVER (PARTITION BY j.type, j.color, j.thickness) AS keep_id
+        FROM joints j
+    """)
+    op.execute("""
+        UPDATE joints k
+        SET quantity = totals.quantity
+        FROM (
+            SELECT d.keep_id, SUM(COALESCE(j.quantity, 0)) AS quantity
+            FROM joint_duplicates d JOIN joints j ON j.id = d.id
+            GROUP BY d.keep_id
+            HAVING COUNT(*) > 1
+        ) totals
+        WHERE k.id = totals.keep_id
+    """)
+    op.execute("""
+        UPDATE stock_reservations r
+        SET sku_id = d.keep_id
+        FROM joint_duplicates d
+        WHERE r.sku_type = 'joint' AND r.sku_id = d.id AND d.id <> d.keep_id
+    """)
+    op.execute("DELETE FROM joints j USING joint_duplicates d WHERE j.id = d.id AND d.id <> d.keep_id")
+
+    op.execute("""
+        UPDATE panels k
+        SET quantity = totals.quantity
+        FROM (
+            SELECT MIN(id) AS keep_id, SUM(COALESCE(quantity, 0)) AS quantity
+            FROM panels
+            GROUP BY thickness
+            HAVING COUNT(*) > 1
+        ) totals
+        WHERE k.id = totals.keep_id
+    """)
+    op.execute("""
+        DELETE FROM panels p
+        USING panels k
+        WHERE p.thickness = k.thickness AND p.id > k.id
+    """)
+
+    op.create_unique_constraint('uq_panels_thickness', 'panels', ['thickness'])
+    op.create_unique_constraint('uq_joints_type_color_thickness', 'joints', ['type', 'color', 'thickness'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_joints_type_color_thickness', 'joints', type_='unique')
+    op.drop_constraint('uq_panels_thickness', 'panels', type_='unique')
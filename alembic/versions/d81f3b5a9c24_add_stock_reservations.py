@@ -0,0 +1,98 @@
+"""add stock_reservations ledger
+
+Revision ID: d81f3b5a9c24
+Revises: c4a7e91d2f10
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd81f3b5a9c24'
+down_revision: Union[str, None] = 'c4a7e91d2f10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'stock_reservations',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('sku_type', sa.String(length=20), nullable=False),
+        sa.Column('sku_id', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['order_id'], ['orders.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('order_id', 'sku_type', 'sku_id', name='uq_stock_reservations_order_sku')
+    )
+    op.create_index(
+        'ix_stock_reservations_sku', 'stock_reservations', ['sku_type', 'sku_id'],
+        unique=False, postgresql_include=['quantity']
+    )
+
+    # Уже забронированные заказы были списаны со склада напрямую.
+    # Переносим их в резерв и возвращаем количество на склад.
+    op.execute("""
+        INSERT INTO stock_reservations (order_id, sku_type, sku_id, quantity, created_at)
+        SELECT oi.order_id, 'finished_product', fp.id, SUM(oi.quantity), now()
+        FROM order_items oi
+        JOIN orders o ON o.id = oi.order_id AND o.status = 'RESERVED'
+        JOIN films f ON f.code = oi.color
+        JOIN LATERAL (
+            SELECT id FROM finished_products
+            WHERE film_id = f.id AND thickness = oi.thickness
+            ORDER BY id LIMIT 1
+        ) fp ON true
+        GROUP BY oi.order_id, fp.id
+    """)
+    op.execute("""
+        INSERT INTO stock_reservations (order_id, sku_type, sku_id, quantity, created_at)
+        SELECT oj.order_id, 'joint', j.id, SUM(oj.joint_quantity), now()
+        FROM order_joints oj
+        JOIN orders o ON o.id = oj.order_id AND o.status = 'RESERVED'
+        JOIN LATERAL (
+            SELECT id FROM joints
+            WHERE type = oj.joint_type AND color = oj.joint_color AND thickness = oj.joint_thickness
+            ORDER BY id LIMIT 1
+        ) j ON true
+        GROUP BY oj.order_id, j.id
+    """)
+    op.execute("""
+        INSERT INTO stock_reservations (order_id, sku_type, sku_id, quantity, created_at)
+        SELECT og.order_id, 'glue', (SELECT id FROM glue ORDER BY id LIMIT 1), SUM(og.quantity), now()
+        FROM order_glues og
+        JOIN orders o ON o.id = og.order_id AND o.status = 'RESERVED'
+        WHERE EXISTS (SELECT 1 FROM glue)
+        GROUP BY og.order_id
+        HAVING SUM(og.quantity) > 0
+    """)
+    for table, sku_type in (('finished_products', 'finished_product'), ('joints', 'joint'), ('glue', 'glue')):
+        op.execute(f"""
+            UPDATE {table} t SET quantity = t.quantity + r.total
+            FROM (
+                SELECT sku_id, SUM(quantity) AS total FROM stock_reservations
+                WHERE sku_type = '{sku_type}' GROUP BY sku_id
+            ) r
+            WHERE t.id = r.sku_id
+        """)
+
+
+def downgrade() -> None:
+    # Возвращаемся к прямому списанию: вычитаем резервы из остатков
+    for table, sku_type in (('finished_products', 'finished_product'), ('joints', 'joint'), ('glue', 'glue')):
+        op.execute(f"""
+            UPDATE {table} t SET quantity = t.quantity - r.total
+            FROM (
+                SELECT sku_id, SUM(quantity) AS total FROM stock_reservations
+                WHERE sku_type = '{sku_type}' GROUP BY sku_id
+            ) r
+            WHERE t.id = r.sku_id
+        """)
+    op.drop_index('ix_stock_reservations_sku', table_name='stock_reservations')
+    op.drop_table('stock_reservations')
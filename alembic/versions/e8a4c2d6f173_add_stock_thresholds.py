@@ -0,0 +1,34 @@
+"""add stock_thresholds table for low-stock alerts
+
+Revision ID: e8a4c2d6f173
+Revises: d6f1a8c3e925
+Create Date: 2026-10-19 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8a4c2d6f173'
+down_revision: Union[str, None] = 'd6f1a8c3e925'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'stock_thresholds',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('sku', sa.String(length=120), nullable=False),
+        sa.Column('threshold', sa.Float(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('sku')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('stock_thresholds')
@@ -0,0 +1,37 @@
+"""add generated possible_panels column and film keyboard index to films
+
+Revision ID: f1c7b3e9a482
+Revises: e8a4c2d6f173
+Create Date: 2026-10-19 21:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1c7b3e9a482'
+down_revision: Union[str, None] = 'e8a4c2d6f173'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Должно совпадать с models.POSSIBLE_PANELS_SQL
+POSSIBLE_PANELS_SQL = (
+    "CASE WHEN panel_consumption > 0 THEN CAST(trunc(total_remaining / panel_consumption) AS integer) ELSE 0 END"
+)
+
+
+def upgrade() -> None:
+    # Генерируемая колонка заполняется для существующих пленок при добавлении
+    op.add_column('films', sa.Column('possible_panels', sa.Integer(),
+                                     sa.Computed(POSSIBLE_PANELS_SQL, persisted=True), nullable=True))
+    op.create_index('ix_films_code_available', 'films', ['code'], unique=False,
+                    postgresql_where=sa.text('possible_panels > 0'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_films_code_available', table_name='films')
+    op.drop_column('films', 'possible_panels')
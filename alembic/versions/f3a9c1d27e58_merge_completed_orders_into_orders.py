@@ -0,0 +1,210 @@
+"""merge completed_* tables into orders with order_completions
+
+Revision ID: f3a9c1d27e58
+Revises: e5b2f7c81a46
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a9c1d27e58'
+down_revision: Union[str, None] = 'e5b2f7c81a46'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+COMPATIBILITY_VIEWS = {
+    'completed_orders': """
+        SELECT o.id, o.id AS order_id, o.manager_id, c.warehouse_user_id, o.installation_required,
+               o.customer_phone, o.delivery_address, o.shipment_date, o.payment_method,
+               c.completed_at, c.status, c.updated_at
+        FROM orders o
+        JOIN order_completions c ON c.order_id = o.id
+    """,
+    'completed_order_items': """
+        SELECT i.id, i.order_id, i.quantity, i.color, i.thickness
+        FROM order_items i
+        JOIN order_completions c ON c.order_id = i.order_id
+    """,
+    'completed_order_joints': """
+        SELECT j.id, j.order_id, j.joint_type, j.joint_color, j.joint_quantity AS quantity, j.joint_thickness
+        FROM order_joints j
+        JOIN order_completions c ON c.order_id = j.order_id
+    """,
+    'completed_order_glues': """
+        SELECT g.id, g.order_id, g.quantity
+        FROM order_glues g
+        JOIN order_completions c ON c.order_id = g.order_id
+    """,
+}
+
+
+def upgrade() -> None:
+    op.create_table(
+        'order_completions',
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('warehouse_user_id', sa.Integer(), nullable=False),
+        sa.Column('completed_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('status', sa.String(length=50), server_default='completed', nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['order_id'], ['orders.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['warehouse_user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('order_id')
+    )
+    op.create_index('ix_order_completions_completed_at', 'order_completions', ['completed_at'], unique=False)
+    op.create_index('ix_order_completions_status', 'order_completions', ['status'], unique=False)
+
+    # Заказы, отгруженные через confirm_shipment, были удалены из orders после копирования.
+    # Восстанавливаем их под исходными номерами вместе с позициями.
+    op.execute("""
+        CREATE TEMP TABLE restored_orders ON COMMIT DROP AS
+        SELECT co.id AS completed_id, co.order_id
+        FROM completed_orders co
+        WHERE NOT EXISTS (SELECT 1 FROM orders o WHERE o.id = co.order_id)
+    """)
+    op.execute("""
+        INSERT INTO orders (id, manager_id, installation_required, customer_phone, delivery_address,
+                            shipment_date, payment_method, status, created_at, completed_at)
+        SELECT co.order_id, co.manager_id, co.installation_required, co.customer_phone, co.delivery_address,
+               co.shipment_date, co.payment_method, 'COMPLETED', co.completed_at, co.completed_at
+        FROM completed_orders co
+        JOIN restored_orders r ON r.completed_id = co.id
+    """)
+    op.execute("""
+        INSERT INTO order_items (order_id, quantity, color, thickness)
+        SELECT r.order_id, ci.quantity, ci.color, ci.thickness
+        FROM completed_order_items ci
+        JOIN restored_orders r ON r.completed_id = ci.order_id
+    """)
+    op.execute("""
+        INSERT INTO order_joints (order_id, joint_type, joint_color, joint_quantity, joint_thickness)
+        SELECT r.order_id, cj.joint_type, cj.joint_color, cj.quantity, cj.joint_thickness
+        FROM completed_order_joints cj
+        JOIN restored_orders r ON r.completed_id = cj.order_id
+    """)
+    op.execute("""
+        INSERT INTO order_glues (order_id, quantity)
+        SELECT r.order_id, cg.quantity
+        FROM completed_order_glues cg
+        JOIN restored_orders r ON r.completed_id = cg.order_id
+    """)
+    op.execute("""
+        SELECT setval(pg_get_serial_sequence('orders', 'id'), GREATEST((SELECT MAX(id) FROM orders), 1))
+    """)
+
+    # Заказы, отгруженные через process_order_shipment, уже есть в orders со своими позициями
+    op.execute("""
+        UPDATE orders o
+        SET status = 'COMPLETED', completed_at = COALESCE(o.completed_at, co.completed_at)
+        FROM completed_orders co
+        WHERE o.id = co.order_id
+    """)
+    op.execute("""
+        INSERT INTO order_completions (order_id, warehouse_user_id, completed_at, status, updated_at)
+        SELECT order_id, warehouse_user_id, COALESCE(completed_at, now()), status, updated_at
+        FROM completed_orders
+        ON CONFLICT (order_id) DO NOTHING
+    """)
+
+    op.drop_table('completed_order_items')
+    op.drop_table('completed_order_joints')
+    op.drop_table('completed_order_glues')
+    op.drop_table('completed_orders')
+
+    # Представления со старыми именами для отчетов и скриптов, читающих completed_*
+    for name, query in COMPATIBILITY_VIEWS.items():
+        op.execute(f"CREATE VIEW {name} AS {query}")
+
+
+def downgrade() -> None:
+    for name in COMPATIBILITY_VIEWS:
+        op.execute(f"DROP VIEW IF EXISTS {name}")
+
+    op.create_table(
+        'completed_orders',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('manager_id', sa.Integer(), nullable=False),
+        sa.Column('warehouse_user_id', sa.Integer(), nullable=False),
+        sa.Column('installation_required', sa.Boolean(), nullable=True),
+        sa.Column('customer_phone', sa.String(), nullable=False),
+        sa.Column('delivery_address', sa.String(), nullable=False),
+        sa.Column('shipment_date', sa.Date(), nullable=True),
+        sa.Column('payment_method', sa.String(), nullable=True),
+        sa.Column('completed_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.Column('status', sa.String(length=50), server_default='completed', nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['manager_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['warehouse_user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('order_id')
+    )
+    op.create_table(
+        'completed_order_items',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('color', sa.String(), nullable=False),
+        sa.Column('thickness', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['order_id'], ['completed_orders.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'completed_order_joints',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('joint_type', postgresql.ENUM(name='jointtype', create_type=False), nullable=False),
+        sa.Column('joint_color', sa.String(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('joint_thickness', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['order_id'], ['completed_orders.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'completed_order_glues',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['order_id'], ['completed_orders.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+    # Копии строк создаются под тем же номером, что и заказ; сами заказы остаются в orders
+    op.execute("""
+        INSERT INTO completed_orders (id, order_id, manager_id, warehouse_user_id, installation_required,
+                                      customer_phone, delivery_address, shipment_date, payment_method,
+                                      completed_at, status, updated_at)
+        SELECT o.id, o.id, o.manager_id, c.warehouse_user_id, o.installation_required,
+               COALESCE(o.customer_phone, 'Не указан'), COALESCE(o.delivery_address, 'Не указан'),
+               o.shipment_date, o.payment_method, c.completed_at, c.status, c.updated_at
+        FROM orders o
+        JOIN order_completions c ON c.order_id = o.id
+    """)
+    op.execute("""
+        INSERT INTO completed_order_items (order_id, quantity, color, thickness)
+        SELECT i.order_id, i.quantity, i.color, i.thickness
+        FROM order_items i JOIN order_completions c ON c.order_id = i.order_id
+    """)
+    op.execute("""
+        INSERT INTO completed_order_joints (order_id, joint_type, joint_color, quantity, joint_thickness)
+        SELECT j.order_id, j.joint_type, j.joint_color, j.joint_quantity, j.joint_thickness
+        FROM order_joints j JOIN order_completions c ON c.order_id = j.order_id
+    """)
+    op.execute("""
+        INSERT INTO completed_order_glues (order_id, quantity)
+        SELECT g.order_id, g.quantity
+        FROM order_glues g JOIN order_completions c ON c.order_id = g.order_id
+    """)
+    op.execute("""
+        SELECT setval(pg_get_serial_sequence('completed_orders', 'id'), GREATEST((SELECT MAX(id) FROM completed_orders), 1))
+    """)
+
+    op.drop_index('ix_order_completions_status', table_name='order_completions')
+    op.drop_index('ix_order_completions_completed_at', table_name='order_completions')
+    op.drop_table('order_completions')
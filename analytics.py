@@ -0,0 +1,326 @@
+"""Аналитика продаж и производства для супер-админа.
+
+Строки выполненных заказов, операции производства и брака загружаются
+несколькими пакетными запросами в таблицы pandas, после чего все разрезы
+считаются векторными группировками: топ цветов, соотношение толщин, объем
+по менеджерам, понедельная динамика и доля брака. Отчет хранится для каждого
+периода до изменения склада (версия stock_cache), но не дольше
+ANALYTICS_CACHE_SECONDS.
+
+Цен в заказах нет, поэтому результат менеджера — объем отгрузки в штуках.
+"""
+import html
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import stock_cache
+from database import get_db
+from models import Film, Operation, Order, OrderItem, OrderJoint, OrderGlue, OrderStatus, User
+
+# pandas загружается при первом расчете отчета, а не при старте бота
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Сколько секунд отчет за период используется повторно
+ANALYTICS_CACHE_SECONDS = int(os.getenv("ANALYTICS_CACHE_SECONDS", "600"))
+PERIODS = (7, 30, 90)
+TOP_COLORS = 10
+MAX_MANAGERS = 15
+MAX_WEEKS = 8
+
+PRODUCTION_TYPES = ("production", "PRODUCTION")
+DEFECT_MATERIALS = {
+    "panel_defect_subtract": "Панели",
+    "film_defect": "Пленка",
+    "joint_defect": "Стыки",
+    "glue_defect": "Клей",
+}
+
+
+# Типы колонок задаются явно: из пустой выборки pandas строит колонки object,
+# и группировки (nlargest, sum) на них падают
+FRAME_DTYPES = (
+    {"order_id": "int64", "manager_id": "int64", "thickness": float, "panels": float},  # sales
+    {"manager_id": "int64", "amount": float},  # joints
+    {"manager_id": "int64", "amount": float},  # glue
+    {"thickness": float, "panels": float, "film_meters": float},  # production
+    {"amount": float},  # defects
+)
+
+
+class Frames(NamedTuple):
+    sales: "pd.DataFrame"  # order_id, manager_id, day, color, thickness, panels
+    joints: "pd.DataFrame"  # manager_id, day, amount
+    glue: "pd.DataFrame"  # manager_id, day, amount
+    production: "pd.DataFrame"  # day, color, thickness, panels, film_meters
+    defects: "pd.DataFrame"  # day, material, amount
+
+
+class AnalyticsReport(NamedTuple):
+    period_days: int
+    built_at: datetime
+    top_colors: "pd.DataFrame"  # color, panels, share
+    thickness_mix: "pd.DataFrame"  # thickness, sold, sold_share, produced, produced_share
+    managers: "pd.DataFrame"  # manager_id, orders, panels, joints, glue
+    trend: "pd.DataFrame"  # week_start, sold, produced, sold_change
+    defects: "pd.DataFrame"  # material, used, defect, rate
+    manager_names: Dict[int, str]
+
+
+def _utc(series: "pd.Series") -> "pd.Series":
+    import pandas as pd
+
+    # Время операций хранится без часового пояса (UTC), время выполнения заказа — с поясом
+    return pd.to_datetime(series, utc=True)
+
+
+def _load_details(raw) -> dict:
+    try:
+        return json.loads(raw) if raw else {}
+    except (TypeError, ValueError):
+        return {}
+
+
+def split_operations(operations: "pd.DataFrame", film_consumption: Dict[str, float]) -> Tuple["pd.DataFrame", "pd.DataFrame"]:
+    """Операции -> (производство: day, color, thickness, panels, film_meters; брак: day, material, amount)."""
+    import pandas as pd
+
+    if operations.empty:
+        return (pd.DataFrame(columns=["day", "color", "thickness", "panels", "film_meters"]),
+                pd.DataFrame(columns=["day", "material", "amount"]))
+    details = pd.json_normalize(operations["details"].map(_load_details).tolist())
+    details.index = operations.index
+
+    def column(name: str) -> "pd.Series":
+        return details[name] if name in details else pd.Series(None, index=operations.index, dtype=object)
+
+    kind = operations["operation_type"]
+    quantity = operations["quantity"].astype(float)
+    is_production = kind.isin(PRODUCTION_TYPES)
+    color = column("film_color")
+    # У заказов на производство расход пленки не записан — считаем по норме расхода
+    meters = pd.to_numeric(column("film_consumption"), errors="coerce")
+    meters = meters.fillna(quantity * color.map(film_consumption).astype(float))
+    production = pd.DataFrame({
+        "day": operations["day"],
+        "color": color,
+        "thickness": pd.to_numeric(column("panel_thickness"), errors="coerce"),
+        "panels": quantity,
+        "film_meters": meters,
+    })[is_production]
+
+    is_defect = kind.isin(list(DEFECT_MATERIALS))
+    defects = pd.DataFrame({
+        "day": operations["day"], "material": kind.map(DEFECT_MATERIALS), "amount": quantity,
+    })[is_defect]
+    return production.reset_index(drop=True), defects.reset_index(drop=True)
+
+
+def load_frames(db, since: datetime) -> Tuple[Frames, Dict[int, str]]:
+    """Пять запросов: позиции, стыки и клей выполненных заказов, операции, справочники."""
+    import pandas as pd
+
+    completed = (Order.status == OrderStatus.COMPLETED, Order.completed_at >= since)
+    sales = pd.DataFrame(
+        db.query(Order.id, Order.manager_id, Order.completed_at, OrderItem.color, OrderItem.thickness,
+                 OrderItem.quantity - OrderItem.returned_quantity)
+        .join(Order, Order.id == OrderItem.order_id).filter(*completed).all(),
+        columns=["order_id", "manager_id", "day", "color", "thickness", "panels"],
+    )
+    joints = pd.DataFrame(
+        db.query(Order.manager_id, Order.completed_at, OrderJoint.joint_quantity - OrderJoint.returned_quantity)
+        .join(Order, Order.id == OrderJoint.order_id).filter(*completed).all(),
+        columns=["manager_id", "day", "amount"],
+    )
+    glue = pd.DataFrame(
+        db.query(Order.manager_id, Order.completed_at, OrderGlue.quantity - OrderGlue.returned_quantity)
+        .join(Order, Order.id == OrderGlue.order_id).filter(*completed).all(),
+        columns=["manager_id", "day", "amount"],
+    )
+    operations = pd.DataFrame(
+        db.query(Operation.timestamp, Operation.operation_type, Operation.quantity, Operation.details)
+        .filter(Operation.operation_type.in_(PRODUCTION_TYPES + tuple(DEFECT_MATERIALS)), Operation.timestamp >= since)
+        .all(),
+        columns=["day", "operation_type", "quantity", "details"],
+    )
+    film_consumption = dict(db.query(Film.code, Film.panel_consumption).all())
+    names = {user_id: username for user_id, username in db.query(User.id, User.username)}
+
+    production, defects = split_operations(operations, film_consumption)
+    return make_frames(sales, joints, glue, production, defects), names
+
+
+def make_frames(*frames: "pd.DataFrame") -> Frames:
+    """Приводит выборки к рабочим типам (FRAME_DTYPES), время — к UTC, цвет — к category."""
+    typed = []
+    for frame, dtypes in zip(frames, FRAME_DTYPES):
+        frame = frame.astype(dtypes)
+        frame["day"] = _utc(frame["day"])
+        typed.append(frame)
+    sales = typed[0]
+    sales["color"] = sales["color"].astype("category")
+    return Frames(*typed)
+
+
+def _share(values: "pd.Series") -> "pd.Series":
+    total = values.sum()
+    return values / total if total else values * 0.0
+
+
+def trend_weeks(period_days: int) -> int:
+    return min(MAX_WEEKS, max(1, math.ceil(period_days / 7)))
+
+
+def compute(frames: Frames, now: datetime, period_days: int) -> AnalyticsReport:
+    """Все разрезы за период векторными группировками; динамика — по 7-дневным окнам до now."""
+    import pandas as pd
+
+    now = pd.Timestamp(now)
+    if now.tzinfo is None:
+        now = now.tz_localize("UTC")
+    since = now - pd.Timedelta(days=period_days)
+    sales = frames.sales[frames.sales["day"] >= since]
+    production = frames.production[frames.production["day"] >= since]
+
+    colors = sales.groupby("color", observed=True)["panels"].sum()
+    top = colors.nlargest(TOP_COLORS)
+    top_colors = pd.DataFrame({"color": top.index.astype(str), "panels": top.values,
+                               "share": (top / colors.sum()).values if colors.sum() else 0.0})
+
+    mix = pd.concat({
+        "sold": sales.groupby("thickness")["panels"].sum(),
+        "produced": production.groupby("thickness")["panels"].sum(),
+    }, axis=1).fillna(0.0)
+    mix["sold_share"] = _share(mix["sold"])
+    mix["produced_share"] = _share(mix["produced"])
+    thickness_mix = mix.rename_axis("thickness").reset_index().sort_values("thickness")
+
+    joints = frames.joints[frames.joints["day"] >= since]
+    glue = frames.glue[frames.glue["day"] >= since]
+    by_manager = sales.groupby("manager_id")
+    managers = pd.concat({
+        "orders": by_manager["order_id"].nunique(),
+        "panels": by_manager["panels"].sum(),
+        "joints": joints.groupby("manager_id")["amount"].sum(),
+        "glue": glue.groupby("manager_id")["amount"].sum(),
+    }, axis=1).fillna(0).astype(int)
+    managers = managers.sort_values(["panels", "orders"], ascending=False).rename_axis("manager_id").reset_index()
+
+    # Неделя 0 — последние 7 дней; берется на одну больше, чтобы у самой ранней было изменение
+    def week_of(days: "pd.Series") -> "pd.Series":
+        return ((now - days) // pd.Timedelta(days=7)).astype("int64")
+
+    week_index = range(trend_weeks(period_days) + 1)
+    sold = frames.sales.groupby(week_of(frames.sales["day"]))["panels"].sum().reindex(week_index, fill_value=0)
+    produced = frames.production.groupby(week_of(frames.production["day"]))["panels"].sum() \
+        .reindex(week_index, fill_value=0)
+    trend = pd.DataFrame({"sold": sold.astype(float), "produced": produced.astype(float)}).iloc[::-1]
+    trend["sold_change"] = trend["sold"].pct_change().replace([math.inf, -math.inf], math.nan)
+    trend["week_start"] = [now - pd.Timedelta(days=7 * (week + 1)) for week in trend.index]
+    trend = trend.iloc[1:].reset_index(drop=True)
+
+    defects = frames.defects[frames.defects["day"] >= since].groupby("material")["amount"].sum()
+    used = pd.Series({
+        "Панели": production["panels"].sum(),
+        "Пленка": production["film_meters"].sum(),
+        "Стыки": joints["amount"].sum(),
+        "Клей": glue["amount"].sum(),
+    }, dtype=float)
+    defect_table = pd.DataFrame({"used": used, "defect": defects.reindex(used.index, fill_value=0).astype(float)})
+    outflow = defect_table["used"] + defect_table["defect"]
+    defect_table["rate"] = (defect_table["defect"] / outflow.where(outflow > 0)).fillna(0.0)
+    defect_table = defect_table.rename_axis("material").reset_index()
+
+    return AnalyticsReport(period_days, now.to_pydatetime(), top_colors, thickness_mix, managers, trend,
+                           defect_table, {})
+
+
+def build_report(db, period_days: int, now: Optional[datetime] = None) -> AnalyticsReport:
+    now = now or datetime.utcnow()
+    since = now - timedelta(days=max(period_days, 7 * (trend_weeks(period_days) + 1)))
+    frames, names = load_frames(db, since)
+    return compute(frames, now, period_days)._replace(manager_names=names)
+
+
+_lock = threading.Lock()
+_cache: Dict[int, Tuple[int, float, AnalyticsReport]] = {}
+
+
+def get_report(period_days: int) -> AnalyticsReport:
+    """Отчет за период из кэша; пересчитывается после изменения склада или по TTL."""
+    version = stock_cache.version()
+    cached = _cache.get(period_days)
+    if cached and cached[0] == version and time.monotonic() - cached[1] < ANALYTICS_CACHE_SECONDS:
+        return cached[2]
+    with _lock:
+        cached = _cache.get(period_days)
+        if not cached or cached[0] != version or time.monotonic() - cached[1] >= ANALYTICS_CACHE_SECONDS:
+            db = next(get_db())
+            try:
+                cached = (version, time.monotonic(), build_report(db, period_days))
+            finally:
+                db.close()
+            _cache[period_days] = cached
+    return cached[2]
+
+
+def render_table(headers: Sequence[str], rows: List[Sequence[str]]) -> str:
+    """Таблица моноширинным шрифтом: первый столбец выровнен влево, остальные вправо."""
+    widths = [max(len(str(value)) for value in column) for column in zip(headers, *rows)]
+
+    def line(values):
+        cells = [str(value).ljust(widths[0]) if i == 0 else str(value).rjust(widths[i]) for i, value in enumerate(values)]
+        return "  ".join(cells).rstrip()
+
+    body = "\n".join([line(headers)] + [line(row) for row in rows])
+    return f"<pre>{html.escape(body)}</pre>"
+
+
+def _change(value: float) -> str:
+    import pandas as pd
+
+    if pd.isna(value):
+        return "—"
+    return f"{value * 100:+.0f}%"
+
+
+def format_report(report: AnalyticsReport) -> str:
+    """Отчет для Telegram (parse_mode HTML)."""
+    parts = [f"📊 <b>Аналитика за {report.period_days} дн.</b>"]
+
+    if report.top_colors.empty:
+        parts.append("Выполненных заказов за период нет.")
+    else:
+        parts.append("<b>Топ цветов</b> (панели)\n" + render_table(["Цвет", "Шт.", "Доля"], [
+            (row.color, f"{row.panels:.0f}", f"{row.share * 100:.0f}%") for row in report.top_colors.itertuples()
+        ]))
+
+    if not report.thickness_mix.empty:
+        parts.append("<b>Толщины</b>\n" + render_table(["мм", "Продано", "%", "Произв.", "%"], [
+            (f"{row.thickness:g}", f"{row.sold:.0f}", f"{row.sold_share * 100:.0f}", f"{row.produced:.0f}",
+             f"{row.produced_share * 100:.0f}")
+            for row in report.thickness_mix.itertuples()
+        ]))
+
+    if not report.managers.empty:
+        parts.append("<b>Менеджеры</b> (объем отгрузки)\n" + render_table(["Менеджер", "Зак.", "Пан.", "Стык", "Клей"], [
+            ((report.manager_names.get(row.manager_id) or f"#{row.manager_id}")[:16], row.orders, row.panels,
+             row.joints, row.glue)
+            for row in report.managers.head(MAX_MANAGERS).itertuples()
+        ]))
+
+    parts.append("<b>По неделям</b> (панели)\n" + render_table(["С", "Продано", "Δ", "Произв."], [
+        (row.week_start.strftime("%d.%m"), f"{row.sold:.0f}", _change(row.sold_change), f"{row.produced:.0f}")
+        for row in report.trend.itertuples()
+    ]))
+
+    parts.append("<b>Брак</b>\n" + render_table(["Материал", "Расход", "Брак", "Доля"], [
+        (row.material, f"{row.used:.0f}", f"{row.defect:.0f}", f"{row.rate * 100:.1f}%")
+        for row in report.defects.itertuples()
+    ]))
+    return "\n\n".join(parts)
@@ -0,0 +1,94 @@
+"""Замер скорости аналитики на синтетических данных без базы.
+
+Генерирует строки выполненных заказов, стыков, клея и операций производства и
+брака (с JSON в details, как в таблице operations), затем замеряет разбор
+операций и расчет всех разрезов analytics.compute за каждый период.
+
+Запуск: python bench_analytics.py --lines 1000000 --operations 200000
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import analytics
+
+
+def synthetic_frames(args, now: pd.Timestamp):
+    rng = np.random.default_rng(args.seed)
+    colors = np.array([f"C-{number:03d}" for number in range(args.colors)])
+    span = pd.Timedelta(days=args.days).value
+
+    def days(count):
+        return now - pd.to_timedelta(rng.integers(0, span, count), unit="ns")
+
+    # В среднем 3 строки на заказ, популярность цветов неравномерная
+    lines = args.lines
+    order_ids = np.sort(rng.integers(0, lines // 3 + 1, lines))
+    managers_of_order = rng.integers(1, args.managers + 1, lines // 3 + 1)
+    order_days = days(lines // 3 + 1)
+    sales = pd.DataFrame({
+        "order_id": order_ids,
+        "manager_id": managers_of_order[order_ids],
+        "day": order_days[order_ids],
+        "color": pd.Categorical(colors[np.minimum(rng.zipf(1.3, lines), args.colors) - 1]),
+        "thickness": rng.choice([0.5, 0.8], lines, p=[0.7, 0.3]),
+        "panels": rng.integers(1, 60, lines),
+    })
+    extra = lines // 3
+    joints = pd.DataFrame({"manager_id": rng.integers(1, args.managers + 1, extra), "day": days(extra),
+                           "amount": rng.integers(1, 40, extra)})
+    glue = pd.DataFrame({"manager_id": rng.integers(1, args.managers + 1, extra), "day": days(extra),
+                         "amount": rng.integers(1, 10, extra)})
+
+    count = args.operations
+    kinds = rng.choice(["production", "panel_defect_subtract", "film_defect", "joint_defect", "glue_defect"],
+                       count, p=[0.9, 0.04, 0.03, 0.02, 0.01])
+    quantity = rng.integers(1, 80, count)
+    op_colors = colors[rng.integers(0, args.colors, count)]
+    op_thickness = rng.choice([0.5, 0.8], count)
+    details = [
+        json.dumps({"film_color": color, "panel_thickness": thickness, "film_consumption": amount * 3.0})
+        if kind == "production" else json.dumps({"film_code": color})
+        for kind, color, thickness, amount in zip(kinds, op_colors, op_thickness, quantity)
+    ]
+    operations = pd.DataFrame({"day": days(count), "operation_type": kinds, "quantity": quantity, "details": details})
+    return sales, joints, glue, operations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер скорости аналитики на синтетических данных")
+    parser.add_argument("--lines", type=int, default=1_000_000, help="строк выполненных заказов")
+    parser.add_argument("--operations", type=int, default=200_000, help="операций производства и брака")
+    parser.add_argument("--colors", type=int, default=140, help="количество цветов пленки")
+    parser.add_argument("--managers", type=int, default=12, help="количество менеджеров")
+    parser.add_argument("--days", type=int, default=90, help="глубина истории в днях")
+    parser.add_argument("--seed", type=int, default=1, help="начальное значение генератора")
+    args = parser.parse_args()
+
+    now = pd.Timestamp(datetime.utcnow(), tz="UTC")
+    started = time.perf_counter()
+    sales, joints, glue, operations = synthetic_frames(args, now)
+    print(f"Генерация данных: {time.perf_counter() - started:.2f} с "
+          f"({len(sales)} строк заказов, {len(operations)} операций)")
+
+    started = time.perf_counter()
+    production, defects = analytics.split_operations(operations, {})
+    print(f"Разбор операций (JSON): {time.perf_counter() - started:.2f} с")
+    frames = analytics.Frames(sales, joints, glue, production, defects)
+
+    for period in analytics.PERIODS:
+        timings = []
+        for _ in range(3):
+            started = time.perf_counter()
+            report = analytics.compute(frames, now.to_pydatetime(), period)
+            timings.append(time.perf_counter() - started)
+        print(f"Разрезы за {period} дн.: лучшее {min(timings) * 1000:.0f} мс, "
+              f"топ-цвет {report.top_colors.iloc[0]['color']}, менеджеров {len(report.managers)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Поиск заказов клиента по телефону и адресу.
+
+Телефон сравнивается по orders.customer_phone_normalized — генерируемой колонке
+только с цифрами. Полный номер ищется по B-tree индексу, часть номера и часть
+адреса — по триграммным GIN-индексам (pg_trgm), поэтому запрос не сканирует
+всю историю заказов.
+"""
+import re
+
+from sqlalchemy.orm import joinedload
+
+from models import Order
+
+# Триграммный индекс работает с подстроками от трех символов
+MIN_QUERY_LENGTH = 3
+# С этого количества цифр номер считается полным и ищется на точное совпадение
+FULL_PHONE_DIGITS = 11
+
+_PHONE_QUERY = re.compile(r"^[\d\s()+\-]+$")
+
+
+def normalize_phone(phone: str) -> str:
+    """Оставляет только цифры и заменяет российскую 8 в начале на 7 (как PHONE_NORMALIZED_SQL)."""
+    digits = re.sub(r"\D", "", phone or "")
+    if len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    return digits
+
+
+def _escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def is_valid_query(text: str) -> bool:
+    text = (text or "").strip()
+    if _PHONE_QUERY.match(text):
+        return len(normalize_phone(text)) >= MIN_QUERY_LENGTH
+    return len(text) >= MIN_QUERY_LENGTH
+
+
+def search_orders_query(db, text: str):
+    """Запрос заказов по телефону (если введены только цифры и знаки номера) или по адресу."""
+    text = text.strip()
+    query = db.query(Order).options(
+        joinedload(Order.manager),
+        joinedload(Order.completion)
+    )
+    if _PHONE_QUERY.match(text):
+        digits = normalize_phone(text)
+        if len(digits) >= FULL_PHONE_DIGITS:
+            return query.filter(Order.customer_phone_normalized == digits)
+        return query.filter(Order.customer_phone_normalized.like(f"%{_escape_like(digits)}%", escape="\\"))
+    return query.filter(Order.delivery_address.ilike(f"%{_escape_like(text)}%", escape="\\"))
@@ -0,0 +1,308 @@
+"""Пакетный ввод брака: список разных материалов одним сообщением.
+
+Сообщение разбирается целиком: при ошибке в любой строке акт не составляется.
+Затем строки склада по всем позициям блокируются (SELECT ... FOR UPDATE) и
+проверяются по одному снимку остатков — с учетом нескольких строк по одной
+позиции и резерва заказов. Если хотя бы одна строка не проходит, ничего не
+списывается. Иначе все списания выполняются одной
+транзакцией: один UPDATE ... CASE на таблицу, запись акта в defect_reports и
+пакетная вставка операций брака с номером акта (для аналитики брака).
+"""
+import json
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func, insert
+
+import film_index
+import stock
+from models import DefectReport, Film, FinishedProduct, Glue, Joint, JointType, Operation, Panel
+from production_batch import ALLOWED_THICKNESSES
+
+MAX_DEFECT_LINES = 50
+
+PANEL = "panel"
+FILM = "film"
+JOINT = "joint"
+GLUE = "glue"
+PRODUCT = "finished_product"
+
+MATERIAL_ALIASES = {
+    "панель": PANEL, "панели": PANEL,
+    "пленка": FILM, "плёнка": FILM,
+    "стык": JOINT, "стыки": JOINT,
+    "клей": GLUE,
+    "продукция": PRODUCT, "готовая": PRODUCT,
+}
+JOINT_TYPE_ALIASES = {
+    "бабочка": JointType.BUTTERFLY, "простой": JointType.SIMPLE, "замыкающий": JointType.CLOSING,
+    **{joint_type.value: joint_type for joint_type in JointType},
+}
+# Типы операций — те же, что у пошагового ввода брака
+OPERATION_TYPES = {
+    PANEL: "panel_defect_subtract",
+    FILM: "film_defect",
+    JOINT: "joint_defect",
+    GLUE: "glue_defect",
+    PRODUCT: "finished_product_defect",
+}
+NOTE_PREFIX = "причина:"
+
+FORMAT_HELP = (
+    "панели 0.5 10\n"
+    "пленка R-101 12.5\n"
+    "стык простой R-101 0.5 20\n"
+    "клей 3\n"
+    "продукция 0.5 R-101 4\n"
+    "причина: повреждено при разгрузке"
+)
+
+
+class DefectLine(NamedTuple):
+    number: int
+    material: str
+    quantity: float
+    thickness: Optional[float] = None
+    code: Optional[str] = None  # код пленки или цвет стыка
+    joint_type: Optional[JointType] = None
+
+
+class LineResult(NamedTuple):
+    line: DefectLine
+    label: str
+    error: Optional[str] = None
+    new_quantity: float = 0.0
+
+
+def _number(text: str) -> float:
+    return float(text.replace(",", "."))
+
+
+def _parse_line(tokens: List[str]) -> Tuple[Optional[DefectLine], Optional[str]]:
+    material = MATERIAL_ALIASES.get(tokens[0].lower())
+    args = tokens[1:]
+    if material is None:
+        return None, f"неизвестный материал «{tokens[0]}»"
+    try:
+        if material == GLUE and len(args) == 1:
+            line = DefectLine(0, GLUE, _number(args[0]))
+        elif material == PANEL and len(args) == 2:
+            line = DefectLine(0, PANEL, _number(args[1]), thickness=_number(args[0]))
+        elif material == FILM and len(args) >= 2:
+            line = DefectLine(0, FILM, _number(args[-1]), code=" ".join(args[:-1]))
+        elif material == PRODUCT and len(args) >= 3:
+            line = DefectLine(0, PRODUCT, _number(args[-1]), thickness=_number(args[0]), code=" ".join(args[1:-1]))
+        elif material == JOINT and len(args) >= 4:
+            joint_type = JOINT_TYPE_ALIASES.get(args[0].lower())
+            if joint_type is None:
+                return None, f"неизвестный вид стыка «{args[0]}» (бабочка, простой, замыкающий)"
+            line = DefectLine(0, JOINT, _number(args[-1]), thickness=_number(args[-2]),
+                              code=" ".join(args[1:-2]), joint_type=joint_type)
+        else:
+            return None, "неверное число полей"
+    except ValueError:
+        return None, "толщина и количество должны быть числами"
+
+    if line.quantity <= 0:
+        return None, "количество должно быть положительным"
+    if line.material != FILM and line.quantity != int(line.quantity):
+        return None, "количество должно быть целым"
+    if line.thickness is not None and line.thickness not in ALLOWED_THICKNESSES:
+        return None, f"толщина {line.thickness} мм не поддерживается (0.5 или 0.8)"
+    if line.material != FILM:
+        line = line._replace(quantity=int(line.quantity))
+    return line, None
+
+
+def parse_defects(text: str) -> Tuple[List[DefectLine], Optional[str], List[str]]:
+    """Разбирает сообщение: (строки брака, причина, ошибки разбора)."""
+    lines, errors, note = [], [], None
+    for number, raw in enumerate((text or "").splitlines(), start=1):
+        raw = raw.strip()
+        if not raw:
+            continue
+        if raw.lower().startswith(NOTE_PREFIX):
+            note = raw[len(NOTE_PREFIX):].strip() or None
+            continue
+        line, error = _parse_line(raw.split())
+        if error:
+            errors.append(f"Строка {number}: «{raw}» — {error}")
+        else:
+            lines.append(line._replace(number=number))
+    if len(lines) > MAX_DEFECT_LINES:
+        errors.append(f"За раз можно списать не больше {MAX_DEFECT_LINES} строк")
+        lines = []
+    return lines, note, errors
+
+
+def line_label(line: DefectLine) -> str:
+    if line.material == PANEL:
+        return f"Панели {line.thickness} мм"
+    if line.material == FILM:
+        return f"Пленка {line.code}"
+    if line.material == JOINT:
+        return stock.joint_label(line.joint_type, line.code, line.thickness)
+    if line.material == GLUE:
+        return "Клей"
+    return f"Готовая продукция {stock.product_label(line.code, line.thickness)}"
+
+
+def _unit(line: DefectLine) -> str:
+    return "м" if line.material == FILM else "шт."
+
+
+def apply_defects(db, lines: List[DefectLine], user_id: int, note: Optional[str] = None
+                  ) -> Tuple[Optional[int], List[LineResult]]:
+    """Списывает брак одним актом; возвращает (номер акта или None, результаты по строкам).
+
+    Коммит выполняет вызывающий код (stock.run_with_retry). Если хотя бы одна
+    строка не проходит проверку, изменения не вносятся и номер акта — None.
+    """
+    index = film_index.get_index()
+    lines = [
+        line._replace(code=index.exact(line.code) or line.code) if line.material in (FILM, PRODUCT) else line
+        for line in lines
+    ]
+    stock.set_lock_timeout(db)
+
+    # Пленка и панели блокируются в том же порядке, что при производстве
+    codes = {line.code for line in lines if line.material in (FILM, PRODUCT)}
+    films = {
+        code: (film_id, remaining or 0)
+        for film_id, code, remaining in db.query(Film.id, Film.code, Film.total_remaining)
+        .filter(Film.code.in_(codes)).order_by(Film.id).with_for_update()
+    }
+    panels = {}
+    thicknesses = {line.thickness for line in lines if line.material == PANEL}
+    for panel_id, thickness, quantity in db.query(Panel.id, Panel.thickness, Panel.quantity) \
+            .filter(Panel.thickness.in_(thicknesses)).order_by(Panel.id).with_for_update():
+        panels.setdefault(thickness, (panel_id, quantity or 0))
+
+    # Резервируемые позиции: готовая продукция, стыки и клей — доступно = на складе − резерв
+    products = {}
+    film_ids = {films[line.code][0] for line in lines if line.material == PRODUCT and line.code in films}
+    for product_id, film_id, thickness in db.query(FinishedProduct.id, FinishedProduct.film_id, FinishedProduct.thickness) \
+            .filter(FinishedProduct.film_id.in_(film_ids)).order_by(FinishedProduct.id):
+        products.setdefault((film_id, thickness), product_id)
+    joints = {}
+    colors = {line.code.lower() for line in lines if line.material == JOINT}
+    for joint_id, joint_type, color, thickness in db.query(Joint.id, Joint.type, Joint.color, Joint.thickness) \
+            .filter(func.lower(Joint.color).in_(colors)).order_by(Joint.id):
+        joints.setdefault((joint_type, color.lower(), thickness), joint_id)
+    glue_id = db.query(Glue.id).order_by(Glue.id).scalar() if any(line.material == GLUE for line in lines) else None
+
+    def item_key(line: DefectLine):
+        if line.material == PANEL:
+            return (PANEL, panels[line.thickness][0]) if line.thickness in panels else None
+        if line.material == FILM:
+            return (FILM, films[line.code][0]) if line.code in films else None
+        if line.material == PRODUCT:
+            film = films.get(line.code)
+            product_id = products.get((film[0], line.thickness)) if film else None
+            return (stock.SKU_FINISHED_PRODUCT, product_id) if product_id else None
+        if line.material == JOINT:
+            joint_id = joints.get((line.joint_type, line.code.lower(), line.thickness))
+            return (stock.SKU_JOINT, joint_id) if joint_id else None
+        return (stock.SKU_GLUE, glue_id) if glue_id else None
+
+    keys = {line.number: item_key(line) for line in lines}
+    sku_keys = [key for key in keys.values() if key and key[0] in stock.SKU_MODELS]
+    stock.lock_stock(db, sku_keys)
+    # available — для проверки (за вычетом резерва), on_hand — остаток до и после списания
+    available: Dict[Tuple[str, int], float] = stock.available_quantities(db, sku_keys)
+    on_hand: Dict[Tuple[str, int], float] = stock.on_hand_quantities(db, sku_keys)
+    for kind, rows in ((FILM, films.values()), (PANEL, panels.values())):
+        for item_id, quantity in rows:
+            available[(kind, item_id)] = on_hand[(kind, item_id)] = quantity
+
+    results = []
+    for line in lines:
+        key = keys[line.number]
+        label = line_label(line)
+        if key is None:
+            results.append(LineResult(line, label, "позиция не найдена на складе"))
+            continue
+        if available[key] < line.quantity:
+            reserved_note = " с учетом резерва заказов" if key[0] in stock.SKU_MODELS else ""
+            results.append(LineResult(
+                line, label, f"доступно {available[key]:g} {_unit(line)}{reserved_note}, списывается {line.quantity:g}"
+            ))
+            continue
+        available[key] -= line.quantity
+        on_hand[key] -= line.quantity
+        results.append(LineResult(line, label, new_quantity=on_hand[key]))
+
+    if any(result.error for result in results) or not results:
+        return None, results
+
+    film_deltas, panel_deltas, sku_deltas = defaultdict(float), defaultdict(int), defaultdict(int)
+    for line in lines:
+        kind, item_id = keys[line.number]
+        if kind == FILM:
+            film_deltas[item_id] -= line.quantity
+        elif kind == PANEL:
+            panel_deltas[item_id] -= int(line.quantity)
+        else:
+            sku_deltas[(kind, item_id)] -= int(line.quantity)
+    stock.increment_column(db, Film, Film.total_remaining, film_deltas)
+    stock.increment_column(db, Panel, Panel.quantity, panel_deltas)
+    stock.apply_stock_deltas(db, sku_deltas)
+
+    now = datetime.utcnow()
+    report = DefectReport(user_id=user_id, created_at=now, line_count=len(lines), note=note)
+    db.add(report)
+    db.flush()
+
+    operations = []
+    for result in results:
+        line = result.line
+        details = {
+            "previous_quantity": result.new_quantity + line.quantity,
+            "new_quantity": result.new_quantity,
+            "is_defect": True,
+            "batch": True,
+            "defect_report_id": report.id,
+        }
+        if line.material == PANEL:
+            details["panel_thickness"] = line.thickness
+        elif line.material == FILM:
+            details.update(film_code=line.code, meters=line.quantity)
+        elif line.material == JOINT:
+            details.update(joint_type=line.joint_type.value, joint_color=line.code, joint_thickness=line.thickness)
+        elif line.material == PRODUCT:
+            details.update(film_code=line.code, panel_thickness=line.thickness)
+        operations.append({
+            "user_id": user_id,
+            "operation_type": OPERATION_TYPES[line.material],
+            "quantity": line.quantity,
+            "timestamp": now,
+            "details": json.dumps(details),
+        })
+    db.execute(insert(Operation), operations)
+    return report.id, results
+
+
+def format_parse_errors(parse_errors: List[str]) -> str:
+    """Ответ на сообщение с нераспознанными строками: акт не составляется, пока ошибки не исправлены."""
+    if not parse_errors:
+        return "Сообщение не содержит позиций. Отправьте список брака, по одной позиции в строке."
+    return "Брак не списан, исправьте строки и отправьте список снова:\n\n" + "\n".join(
+        f"❌ {error}" for error in parse_errors
+    )
+
+
+def format_report(report_id: Optional[int], results: List[LineResult], note: Optional[str] = None) -> str:
+    """Итог пакетного списания: акт со строками или список ошибок."""
+    if report_id is None:
+        errors = [f"❌ {result.line.number}. {result.label} — {result.error}" for result in results if result.error]
+        return "Брак не списан, исправьте строки и отправьте список снова:\n\n" + "\n".join(errors)
+
+    lines = [f"✅ Брак списан, акт №{report_id}: {len(results)} строк"]
+    if note:
+        lines.append(f"Причина: {note}")
+    lines.append("")
+    for result in results:
+        unit = _unit(result.line)
+        lines.append(f"- {result.label}: {result.line.quantity:g} {unit} (остаток {result.new_quantity:g} {unit})")
+    return "\n".join(lines)
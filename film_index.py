@@ -0,0 +1,204 @@
+"""Индекс кодов пленки в памяти для свободного ввода цвета.
+
+Коды загружаются из БД одним запросом и хранятся в префиксном дереве
+(автодополнение) и в инвертированном индексе триграмм (подсказка «возможно,
+вы имели в виду» при опечатке). Индекс перестраивается после flush, который
+добавил, удалил или переименовал пленку, и не реже раза в FILM_INDEX_TTL_SECONDS
+(на случай изменений из других процессов); поиск по нему не обращается к БД.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from database import get_db
+from models import Film
+
+FILM_INDEX_TTL_SECONDS = int(os.getenv("FILM_INDEX_TTL_SECONDS", "300"))
+# Минимальная похожесть по триграммам, как pg_trgm.similarity_threshold по умолчанию
+SIMILARITY_THRESHOLD = 0.3
+# Для коротких кодов триграмм мало, поэтому опечатку дополнительно ловим по расстоянию редактирования
+EDIT_SIMILARITY_THRESHOLD = 0.6
+MAX_SUGGESTIONS = 6
+
+
+def normalize_code(text: str) -> str:
+    """Ключ сравнения: без учета регистра и лишних пробелов."""
+    return " ".join((text or "").split()).casefold()
+
+
+def compact_code(text: str) -> str:
+    """Ключ префиксного поиска: только буквы и цифры («r10» находит «R-101»)."""
+    return "".join(re.findall(r"\w+", normalize_code(text)))
+
+
+def edit_similarity(a: str, b: str) -> float:
+    """1 - расстояние Левенштейна / длина большей строки."""
+    if not a or not b:
+        return 0.0
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return 1 - previous[-1] / max(len(a), len(b))
+
+
+def trigrams(text: str) -> Set[str]:
+    """Триграммы в духе pg_trgm: по словам, с двумя пробелами в начале и одним в конце."""
+    result = set()
+    for word in re.findall(r"\w+", normalize_code(text)):
+        padded = f"  {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class FilmCodeIndex:
+    """Неизменяемый снимок кодов пленки: дерево префиксов и индекс триграмм."""
+
+    def __init__(self, codes: Iterable[str]):
+        self._codes: Dict[str, str] = {}
+        self._trie: Dict = {}
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._code_trigrams: Dict[str, Set[str]] = {}
+        self._compact: Dict[str, str] = {}
+        for code in codes:
+            key = normalize_code(code)
+            if not key or key in self._codes:
+                continue
+            self._codes[key] = code
+            self._compact[code] = compact_code(code)
+            node = self._trie
+            for char in self._compact[code]:
+                node = node.setdefault(char, {})
+                node.setdefault("", set()).add(code)
+            code_trigrams = trigrams(code)
+            self._code_trigrams[code] = code_trigrams
+            for trigram in code_trigrams:
+                self._trigrams.setdefault(trigram, set()).add(code)
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def exact(self, text: str) -> Optional[str]:
+        """Код пленки, совпадающий с вводом без учета регистра и пробелов."""
+        return self._codes.get(normalize_code(text))
+
+    def complete(self, prefix: str, limit: int = MAX_SUGGESTIONS) -> List[str]:
+        """Коды, начинающиеся с prefix: сначала короткие."""
+        prefix = compact_code(prefix)
+        if not prefix:
+            return []
+        node = self._trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        return sorted(node.get("", ()), key=lambda code: (len(code), code))[:limit]
+
+    def similar(self, text: str, limit: int = MAX_SUGGESTIONS) -> List[Tuple[str, float]]:
+        """Похожие коды по убыванию похожести.
+
+        Кандидаты — коды с общей триграммой; подходят те, у кого похожесть по
+        триграммам не ниже SIMILARITY_THRESHOLD или по редактированию не ниже
+        EDIT_SIMILARITY_THRESHOLD.
+        """
+        query = trigrams(text)
+        if not query:
+            return []
+        shared: Dict[str, int] = {}
+        for trigram in query:
+            for code in self._trigrams.get(trigram, ()):
+                shared[code] = shared.get(code, 0) + 1
+        compact = compact_code(text)
+        scored = []
+        for code, common in shared.items():
+            trigram_score = common / len(query | self._code_trigrams[code])
+            edit_score = edit_similarity(compact, self._compact[code])
+            if trigram_score >= SIMILARITY_THRESHOLD or edit_score >= EDIT_SIMILARITY_THRESHOLD:
+                scored.append((code, max(trigram_score, edit_score)))
+        scored.sort(key=lambda item: (-item[1], len(item[0]), item[0]))
+        return scored[:limit]
+
+    def suggest(self, text: str, limit: int = MAX_SUGGESTIONS, allowed: Optional[Iterable[str]] = None) -> List[str]:
+        """Кандидаты для ввода: продолжения префикса, затем похожие по триграммам.
+
+        allowed ограничивает выдачу подмножеством кодов (например, пленками с остатком).
+        """
+        allowed = set(allowed) if allowed is not None else None
+        result: List[str] = []
+        for code in chain(self.complete(text, limit=len(self._codes)), (code for code, _ in self.similar(text, limit=len(self._codes)))):
+            if code in result or (allowed is not None and code not in allowed):
+                continue
+            result.append(code)
+            if len(result) >= limit:
+                break
+        return result
+
+
+_lock = threading.Lock()
+_index: Optional[FilmCodeIndex] = None
+_loaded_at = 0.0
+_stale = True
+
+
+def invalidate():
+    """Помечает индекс устаревшим; он перестроится при следующем обращении."""
+    global _stale
+    _stale = True
+
+
+def get_index() -> FilmCodeIndex:
+    """Текущий индекс; при необходимости перестраивается одним запросом к БД."""
+    global _index, _loaded_at, _stale
+    if _index is not None and not _stale and time.monotonic() - _loaded_at < FILM_INDEX_TTL_SECONDS:
+        return _index
+    with _lock:
+        if _index is None or _stale or time.monotonic() - _loaded_at >= FILM_INDEX_TTL_SECONDS:
+            # Сбрасываем флаг до запроса: изменение во время загрузки снова пометит индекс
+            _stale = False
+            db = next(get_db())
+            try:
+                codes = [code for (code,) in db.query(Film.code).all()]
+            finally:
+                db.close()
+            _index = FilmCodeIndex(codes)
+            _loaded_at = time.monotonic()
+            logging.debug(f"Индекс кодов пленки перестроен: {len(_index)} кодов")
+    return _index
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_on_film_change(session, flush_context):
+    for obj in chain(session.new, session.deleted):
+        if isinstance(obj, Film):
+            invalidate()
+            return
+    for obj in session.dirty:
+        if isinstance(obj, Film) and inspect(obj).attrs.code.history.has_changes():
+            invalidate()
+            return
+
+
+def suggestion_keyboard(codes: Iterable[str], extra: Optional[List[str]] = None) -> ReplyKeyboardMarkup:
+    """Клавиатура с кандидатами (по два в ряд), дополнительными кнопками и «Назад»."""
+    buttons = [KeyboardButton(text=code) for code in codes]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.extend([KeyboardButton(text=text)] for text in extra or [])
+    rows.append([KeyboardButton(text="◀️ Назад")])
+    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
+
+
+def not_found_text(text: str, candidates: List[str]) -> str:
+    """Сообщение о ненайденном коде с подсказкой, если есть кандидаты."""
+    if not candidates:
+        return f"Пленка с кодом {text} не найдена. Пожалуйста, введите корректный код."
+    return f"Пленка с кодом {text} не найдена. Возможно, вы имели в виду: {', '.join(candidates)}?"
@@ -5,7 +5,6 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from models import User, UserRole, Film, Panel, Operation, FinishedProduct, Joint, Glue
 from database import get_db
-import pandas as pd
 from datetime import datetime, timedelta
 import json
 
@@ -0,0 +1,136 @@
+"""Справка по остаткам в inline-режиме: «@бот <код пленки или цвет стыка>» в любом чате.
+
+Ответ строится из снимка stock_cache без запросов к складским таблицам.
+Результаты зависят от роли (складу — на складе и в резерве, продажам — только
+доступное количество), а посторонним не выдаются вовсе, поэтому ответ всегда
+is_personal: общий кэш Telegram отдал бы чужие результаты любому пользователю.
+"""
+import logging
+import os
+from datetime import datetime
+from typing import List, Optional
+
+from aiogram import Router
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent
+
+import film_index
+import stock_cache
+from database import get_db
+from models import User, UserRole
+
+router = Router()
+
+# Сколько секунд Telegram может отдавать сохраненный ответ на тот же запрос
+INLINE_STOCK_CACHE_TIME = int(os.getenv("INLINE_STOCK_CACHE_TIME", "10"))
+MAX_RESULTS = 20
+
+# Роли с полной картиной склада: на складе, в резерве, пленка и панели
+DETAILED_ROLES = {UserRole.SUPER_ADMIN, UserRole.WAREHOUSE, UserRole.PRODUCTION}
+# Менеджерам по продажам нужно только доступное к заказу количество
+AVAILABLE_ROLES = {UserRole.SALES_MANAGER}
+
+GLUE_KEYWORDS = ("клей", "glue")
+PANEL_KEYWORDS = ("панел", "panel")
+
+
+def _quantity(on_hand: int, reserved: int, available: int, detailed: bool) -> str:
+    if not detailed:
+        return f"{available} шт."
+    if reserved:
+        return f"{on_hand} шт. (резерв {reserved}, доступно {available})"
+    return f"{on_hand} шт."
+
+
+def code_lines(snapshot: stock_cache.StockSnapshot, code: str, detailed: bool) -> List[str]:
+    """Остатки по коду пленки (он же цвет стыков): продукция, пленка, стыки."""
+    lines = []
+    for product in snapshot.products.get(code, []):
+        lines.append(f"🎨 Панели {product.thickness} мм: "
+                     f"{_quantity(product.on_hand, product.reserved, product.available, detailed)}")
+    film = snapshot.films.get(code)
+    if film:
+        if detailed:
+            lines.append(f"🎞 Пленка: {film.meters:.2f} м (≈{film.possible_panels} панелей)")
+        else:
+            lines.append(f"🎞 Пленка: хватит на ≈{film.possible_panels} панелей")
+    for joint in snapshot.joints.get(code, []):
+        type_name = stock_cache.JOINT_TYPE_NAMES.get(joint.type, str(joint.type))
+        lines.append(f"🔄 Стык {type_name} {joint.thickness} мм: "
+                     f"{_quantity(joint.on_hand, joint.reserved, joint.available, detailed)}")
+    return lines
+
+
+def glue_lines(snapshot: stock_cache.StockSnapshot, detailed: bool) -> List[str]:
+    glue = snapshot.glue
+    return [f"🧴 Клей: {_quantity(glue.on_hand, glue.reserved, glue.available, detailed)}"]
+
+
+def panel_lines(snapshot: stock_cache.StockSnapshot) -> List[str]:
+    return [f"⬜ Пустые панели {panel.thickness} мм: {panel.quantity} шт." for panel in snapshot.panels]
+
+
+def match_codes(snapshot: stock_cache.StockSnapshot, query: str) -> List[str]:
+    """Коды пленки и цвета стыков, подходящие под запрос: по префиксу, затем похожие."""
+    known = set(snapshot.products) | set(snapshot.films) | set(snapshot.joints)
+    result = film_index.get_index().suggest(query, limit=MAX_RESULTS, allowed=known)
+    # Цвета стыков без пленки с таким кодом в индекс кодов не попадают
+    needle = film_index.normalize_code(query)
+    for color in sorted(set(snapshot.joints) - set(snapshot.films)):
+        if len(result) >= MAX_RESULTS:
+            break
+        if needle in film_index.normalize_code(color) and color not in result:
+            result.append(color)
+    return result
+
+
+def _article(result_id: str, title: str, lines: List[str], footer: str) -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        id=result_id,
+        title=title,
+        description="\n".join(lines),
+        input_message_content=InputTextMessageContent(message_text="\n".join([f"📦 {title}", *lines, "", footer])),
+    )
+
+
+def build_results(snapshot: stock_cache.StockSnapshot, query: str, detailed: bool) -> List[InlineQueryResultArticle]:
+    footer = f"Остатки на {datetime.fromtimestamp(snapshot.built_at).strftime('%d.%m.%Y %H:%M')}"
+    needle = film_index.normalize_code(query)
+    results = []
+
+    for i, code in enumerate(match_codes(snapshot, query) if needle else []):
+        lines = code_lines(snapshot, code, detailed)
+        if lines:
+            results.append(_article(f"code:{i}", code, lines, footer))
+
+    if not needle or needle.startswith(GLUE_KEYWORDS):
+        results.append(_article("glue", "Клей", glue_lines(snapshot, detailed), footer))
+    if detailed and snapshot.panels and (not needle or needle.startswith(PANEL_KEYWORDS)):
+        results.append(_article("panels", "Пустые панели", panel_lines(snapshot), footer))
+    return results[:MAX_RESULTS]
+
+
+def _user_role(telegram_id: int) -> Optional[UserRole]:
+    db = next(get_db())
+    try:
+        row = db.query(User.role).filter(User.telegram_id == telegram_id).first()
+        return row[0] if row else None
+    finally:
+        db.close()
+
+
+@router.inline_query()
+async def inline_stock_lookup(inline_query: InlineQuery):
+    """Остатки по коду пленки или цвету стыка из снимка склада."""
+    role = _user_role(inline_query.from_user.id)
+    if role not in DETAILED_ROLES and role not in AVAILABLE_ROLES:
+        await inline_query.answer([], cache_time=INLINE_STOCK_CACHE_TIME, is_personal=True)
+        return
+
+    try:
+        snapshot = stock_cache.get_snapshot()
+        results = build_results(snapshot, inline_query.query or "", role in DETAILED_ROLES)
+    except Exception as e:
+        logging.error(f"Ошибка inline-запроса остатков: {e}")
+        results = []
+
+    await inline_query.answer(results, cache_time=INLINE_STOCK_CACHE_TIME, is_personal=True)
@@ -1,6 +1,7 @@
 import json
 import logging
-from typing import List, Dict, Any, Optional, Union, Tuple
+import time
+from typing import List, Dict, Any, NamedTuple, Optional, Union, Tuple
 from datetime import datetime
 
 from aiogram import Router, F
@@ -15,11 +16,23 @@ from database import get_db
 from navigation import MenuState, get_menu_keyboard, go_back, get_back_keyboard, get_cancel_keyboard
 from states import ProductionStates
 from utils import check_production_access, get_role_menu_keyboard
+import film_index
+import defect_batch
+import income_import
+import production_batch
+import stock
+import stock_cache
 
 logging.basicConfig(level=logging.INFO)
 
 router = Router()
 
+BATCH_PRODUCTION_BUTTON = "📋 Пакетный ввод"
+DEFECT_BATCH_BUTTON = "📋 Пакетный брак"
+IMPORT_INCOME_BUTTON = "📄 Импорт из файла"
+# Bot API отдает ботам файлы размером до 20 МБ
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+
 async def check_production_access(message: Message) -> bool:
     db = next(get_db())
     try:
@@ -31,6 +44,49 @@ async def check_production_access(message: Message) -> bool:
     finally:
         db.close()
 
+class FilmChoice(NamedTuple):
+    keyboard: ReplyKeyboardMarkup
+    text: str
+    count: int  # сколько пленок хватает хотя бы на одну панель
+
+# (версия склада, момент построения, клавиатура) — до изменения склада или истечения TTL
+_film_choice_cache: Optional[Tuple[int, float, FilmChoice]] = None
+
+def load_film_choice(db) -> FilmChoice:
+    """Клавиатура и текст выбора пленки: только коды, которых хватает хотя бы на одну панель."""
+    films = db.query(Film.code, Film.total_remaining, Film.possible_panels) \
+        .filter(Film.possible_panels > 0).order_by(Film.code).all()
+
+    keyboard_rows = [[KeyboardButton(text=code)] for code, _, _ in films]
+    keyboard_rows.append([KeyboardButton(text="◀️ Назад")])
+    keyboard = ReplyKeyboardMarkup(keyboard=keyboard_rows, resize_keyboard=True)
+
+    # Ограничиваем количество информации в сообщении
+    if len(films) <= 10:
+        film_info_text = "\n".join(
+            f"- {code}: {remaining:.2f}м (≈{possible_panels} панелей)" for code, remaining, possible_panels in films
+        )
+        text = f"Выберите цвет пленки для производства:\n\nДоступные пленки:\n{film_info_text}"
+    else:
+        codes_text = ", ".join(code for code, _, _ in films[:5])
+        text = (
+            f"Выберите цвет пленки для производства:\n\n"
+            f"Доступно {len(films)} цветов пленки, например: {codes_text} и другие.\n"
+            f"Можно ввести начало кода или код с опечаткой — бот предложит подходящие варианты."
+        )
+    return FilmChoice(keyboard, text, len(films))
+
+def get_film_choice(db) -> FilmChoice:
+    """Выбор пленки из кэша; перестраивается после изменения склада (версия stock_cache)."""
+    global _film_choice_cache
+    version = stock_cache.version()
+    cached = _film_choice_cache
+    if cached and cached[0] == version and time.monotonic() - cached[1] < stock_cache.STOCK_CACHE_TTL_SECONDS:
+        return cached[2]
+    choice = load_film_choice(db)
+    _film_choice_cache = (version, time.monotonic(), choice)
+    return choice
+
 def get_joint_type_keyboard():
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -296,28 +352,26 @@ async def process_defect_film_color(message: Message, state: FSMContext):
     db = next(get_db())
     try:
         # Ищем пленку по коду
-        film = db.query(Film).filter(Film.code == message.text).first()
-        
-        if not film:
-            # Проверяем, может быть пользователь ввел не код, а описание 
-            # или часть кода, пытаемся найти подходящую пленку
-            films = db.query(Film).filter(Film.code.ilike(f"%{message.text}%")).all()
-            
-            if not films:
-                await message.answer(
-                    "Пленка с таким кодом не найдена. Пожалуйста, введите корректный код из списка."
-                )
-                return
-                
-            if len(films) > 1:
-                films_list = [f"- {film.code} (остаток: {film.total_remaining} м)" for film in films]
-                films_text = "\n".join(films_list)
+        index = film_index.get_index()
+        film_code = index.exact(message.text)
+        if not film_code:
+            # Пользователь ввел часть кода или код с опечаткой — подбираем кандидатов по индексу
+            candidates = index.suggest(message.text)
+            if len(candidates) != 1:
                 await message.answer(
-                    f"Найдено несколько вариантов пленки, уточните код:\n\n{films_text}"
+                    film_index.not_found_text(message.text.strip(), candidates)
+                    + ("\nУточните код." if candidates else ""),
+                    reply_markup=film_index.suggestion_keyboard(candidates)
                 )
                 return
-                
-            film = films[0]  # Если нашли ровно одну подходящую пленку
+            film_code = candidates[0]  # Если нашли ровно одну подходящую пленку
+        
+        film = db.query(Film).filter(Film.code == film_code).first()
+        if not film:
+            await message.answer(
+                "Пленка с таким кодом не найдена. Пожалуйста, введите корректный код из списка."
+            )
+            return
         
         # Проверяем, что есть остаток пленки
         if film.total_remaining <= 0:
@@ -938,6 +992,70 @@ async def process_joint_quantity(message: Message, state: FSMContext):
         await message.answer("Пожалуйста, введите целое число.")
         return
 
+# Импорт прихода из файла
+@router.message(F.text == IMPORT_INCOME_BUTTON)
+async def handle_income_import(message: Message, state: FSMContext):
+    if not await check_production_access(message):
+        return
+
+    await state.set_state(ProductionStates.waiting_for_income_file)
+    await message.answer(
+        "Отправьте файл .csv или .xlsx документом. Первая строка — заголовки столбцов:\n"
+        "материал; код; толщина; вид стыка; количество; метраж; расход\n\n"
+        "Материал: панель, пленка, стык или клей. Для пленки количество — число рулонов, "
+        "метраж и расход обязательны только для новых кодов. Цвет стыка указывается в столбце «код».\n\n"
+        "Если в файле есть ошибки, приход не проводится и бот перечислит строки для исправления.",
+        reply_markup=get_back_keyboard()
+    )
+
+@router.message(ProductionStates.waiting_for_income_file, F.document)
+async def process_income_file(message: Message, state: FSMContext):
+    document = message.document
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_SIZE:
+        await message.answer("Файл слишком большой: бот может скачать не больше 20 МБ.")
+        return
+
+    data = (await message.bot.download(document)).getvalue()
+    db = next(get_db())
+    try:
+        batch = income_import.parse_income(db, income_import.read_records(document.file_name, data))
+        if batch.errors:
+            await message.answer(
+                f"Приход не проведен, исправьте файл и отправьте снова:\n\n{income_import.format_errors(batch.errors)}"
+            )
+            return
+        if not batch.rows:
+            await message.answer("В файле нет строк с приходом.")
+            return
+
+        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+        await stock.run_with_retry(
+            db, lambda session: income_import.apply_income(session, batch, user.id, document.file_name)
+        )
+    except income_import.ImportFormatError as e:
+        await message.answer(str(e))
+        return
+    except Exception as e:
+        logging.error(f"Ошибка импорта прихода из файла {document.file_name}: {e}")
+        await message.answer("Не удалось провести приход из файла. Остатки не изменены.")
+        return
+    finally:
+        db.close()
+
+    # Новые коды пленки добавлены пакетной вставкой, мимо отслеживания flush
+    if any(film.is_new for film in batch.films.values()):
+        film_index.invalidate()
+
+    await state.set_state(MenuState.PRODUCTION_MATERIALS)
+    await message.answer(
+        income_import.format_summary(batch),
+        reply_markup=get_menu_keyboard(MenuState.PRODUCTION_MATERIALS)
+    )
+
+@router.message(ProductionStates.waiting_for_income_file)
+async def process_income_file_text(message: Message, state: FSMContext):
+    await message.answer("Отправьте файл .csv или .xlsx документом или нажмите «◀️ Назад».")
+
 # Обработка прихода клея
 @router.message(F.text == "🧴 Клей")
 async def handle_glue_button(message: Message, state: FSMContext):
@@ -1031,13 +1149,15 @@ async def handle_production(message: Message, state: FSMContext):
         keyboard=[
             [KeyboardButton(text="0.5")],
             [KeyboardButton(text="0.8")],
+            [KeyboardButton(text=BATCH_PRODUCTION_BUTTON)],
             [KeyboardButton(text="◀️ Назад")]
         ],
         resize_keyboard=True
     )
     
     await message.answer(
-        "Выберите толщину панелей для производства (мм):",
+        "Выберите толщину панелей для производства (мм) "
+        "или отправьте несколько позиций сразу через пакетный ввод:",
         reply_markup=keyboard
     )
     
@@ -1045,6 +1165,97 @@ async def handle_production(message: Message, state: FSMContext):
     await state.update_data(operation_type="production")
     await state.set_state(ProductionStates.waiting_for_production_panel_thickness)
 
+@router.message(ProductionStates.waiting_for_production_panel_thickness, F.text == BATCH_PRODUCTION_BUTTON)
+async def handle_production_batch(message: Message, state: FSMContext):
+    """Пакетный ввод: все позиции смены одним сообщением."""
+    await state.set_state(ProductionStates.waiting_for_production_batch)
+    await message.answer(
+        "Отправьте позиции одним сообщением, по одной в строке:\n"
+        "толщина код_пленки количество\n\n"
+        "Например:\n"
+        "0.5 WHITE-01 40\n"
+        "0.8 R-101 15\n\n"
+        f"Не больше {production_batch.MAX_BATCH_LINES} строк. Строки, на которые не хватает "
+        "материалов, будут пропущены, остальные проведутся одной операцией.",
+        reply_markup=get_back_keyboard()
+    )
+
+@router.message(ProductionStates.waiting_for_production_batch)
+async def process_production_batch(message: Message, state: FSMContext):
+    if message.text == "◀️ Назад":
+        await handle_production(message, state)
+        return
+
+    lines, parse_errors = production_batch.parse_batch(message.text)
+    if not lines:
+        errors_text = "\n".join(parse_errors) or "Сообщение не содержит позиций."
+        await message.answer(f"Не удалось разобрать ни одной строки:\n{errors_text}\n\nИсправьте и отправьте снова.")
+        return
+
+    db = next(get_db())
+    try:
+        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+        results = await stock.run_with_retry(
+            db, lambda session: production_batch.apply_batch(session, lines, user.id)
+        )
+    except Exception as e:
+        logging.error(f"Ошибка пакетного производства: {e}")
+        await message.answer("Не удалось провести производство. Остатки не изменены, попробуйте еще раз.")
+        return
+    finally:
+        db.close()
+
+    await state.set_state(MenuState.PRODUCTION_MAIN)
+    keyboard = await get_role_menu_keyboard(MenuState.PRODUCTION_MAIN, message, state)
+    await message.answer(production_batch.format_report(results, parse_errors), reply_markup=keyboard)
+
+@router.message(ProductionStates.waiting_for_defect_type, F.text == DEFECT_BATCH_BUTTON)
+async def handle_defect_batch(message: Message, state: FSMContext):
+    """Пакетный брак: разные материалы одним сообщением, одним актом."""
+    await state.set_state(ProductionStates.waiting_for_defect_batch)
+    await message.answer(
+        "Отправьте брак одним сообщением, по одной позиции в строке:\n\n"
+        f"{defect_batch.FORMAT_HELP}\n\n"
+        "Строка «причина» необязательна. Стыки: бабочка, простой или замыкающий. "
+        f"Не больше {defect_batch.MAX_DEFECT_LINES} строк. Списание проходит целиком: "
+        "если хотя бы одной позиции не хватает, ничего не списывается.",
+        reply_markup=get_back_keyboard()
+    )
+
+@router.message(ProductionStates.waiting_for_defect_batch)
+async def process_defect_batch(message: Message, state: FSMContext):
+    if message.text == "◀️ Назад":
+        await handle_defect(message, state)
+        return
+
+    lines, note, parse_errors = defect_batch.parse_defects(message.text)
+    # Акт списывается только целиком: опечатка в одной строке отклоняет все сообщение
+    if parse_errors or not lines:
+        await message.answer(defect_batch.format_parse_errors(parse_errors))
+        return
+
+    db = next(get_db())
+    try:
+        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+        report_id, results = await stock.run_with_retry(
+            db, lambda session: defect_batch.apply_defects(session, lines, user.id, note)
+        )
+    except Exception as e:
+        logging.error(f"Ошибка пакетного списания брака: {e}")
+        await message.answer("Не удалось списать брак. Остатки не изменены, попробуйте еще раз.")
+        return
+    finally:
+        db.close()
+
+    text = defect_batch.format_report(report_id, results, note)
+    if report_id is None:
+        # Остаемся в режиме пакетного брака, чтобы можно было сразу отправить исправленный список
+        await message.answer(text)
+        return
+    await state.set_state(MenuState.PRODUCTION_MAIN)
+    keyboard = await get_role_menu_keyboard(MenuState.PRODUCTION_MAIN, message, state)
+    await message.answer(text, reply_markup=keyboard)
+
 @router.message(ProductionStates.waiting_for_production_panel_thickness)
 async def process_production_panel_thickness(message: Message, state: FSMContext):
     if message.text == "◀️ Назад":
@@ -1084,69 +1295,16 @@ async def process_production_panel_thickness(message: Message, state: FSMContext
             # Сохраняем толщину панелей в состоянии
             await state.update_data(panel_thickness=thickness)
             
-            # Получаем список доступных пленок
-            films = db.query(Film).all()
-            
-            if not films:
-                await message.answer(
-                    "В базе нет пленок для производства.\n"
-                    "Сначала добавьте пленку через меню 'Приход сырья'.",
-                    reply_markup=get_menu_keyboard(MenuState.PRODUCTION_MAIN)
-                )
-                return
-                
-            # Формируем кнопки для выбора цвета пленки
-            available_films = []
-            keyboard_rows = []
-            for film in films:
-                # Рассчитываем, сколько панелей можно произвести из доступной пленки
-                possible_panels = film.calculate_possible_panels()
-                if possible_panels > 0:  # Показываем только те цвета, для которых хватает пленки
-                    keyboard_rows.append([KeyboardButton(text=film.code)])
-                    available_films.append(film)
-            
-            # Добавляем кнопку "Назад"
-            keyboard_rows.append([KeyboardButton(text="◀️ Назад")])
-            
-            keyboard = ReplyKeyboardMarkup(
-                keyboard=keyboard_rows,
-                resize_keyboard=True
-            )
-            
-            # Ограничиваем количество информации в сообщении
-            if len(available_films) == 0:
+            # Список пленок с остатком хотя бы на одну панель
+            choice = get_film_choice(db)
+            if not choice.count:
                 await message.answer(
                     "Недостаточно пленки для производства. Добавьте пленку через меню 'Приход сырья'.",
                     reply_markup=get_menu_keyboard(MenuState.PRODUCTION_MAIN)
                 )
                 return
-                
-            if len(available_films) <= 10:
-                # Если фильмов не много, показываем подробную информацию
-                film_info = []
-                for film in available_films:
-                    possible_panels = film.calculate_possible_panels()
-                    film_info.append(
-                        f"- {film.code}: {film.total_remaining:.2f}м (≈{possible_panels} панелей)"
-                    )
-            
-                film_info_text = "\n".join(film_info)
-            
-                await message.answer(
-                    f"Выберите цвет пленки для производства:\n\n"
-                    f"Доступные пленки:\n{film_info_text}",
-                    reply_markup=keyboard
-                )
-            else:
-                # Если фильмов много, показываем только количество и несколько примеров
-                film_codes = [film.code for film in available_films[:5]]
-                codes_text = ", ".join(film_codes)
-                
-                await message.answer(
-                    f"Выберите цвет пленки для производства:\n\n"
-                    f"Доступно {len(available_films)} цветов пленки, например: {codes_text} и другие.",
-                    reply_markup=keyboard
-                )
+
+            await message.answer(choice.text, reply_markup=choice.keyboard)
             
             await state.set_state(ProductionStates.waiting_for_production_film_color)
             
@@ -1177,7 +1335,9 @@ async def process_production_film_color(message: Message, state: FSMContext):
         await state.set_state(ProductionStates.waiting_for_production_panel_thickness)
         return
     
-    film_color = message.text.strip()
+    # Код сверяется с индексом в памяти без учета регистра; при опечатке предлагаем похожие
+    index = film_index.get_index()
+    film_color = index.exact(message.text) or message.text.strip()
     
     # Проверяем, что такая пленка существует
     db = next(get_db())
@@ -1185,13 +1345,11 @@ async def process_production_film_color(message: Message, state: FSMContext):
         film = db.query(Film).filter(Film.code == film_color).first()
         
         if not film:
+            candidates = index.suggest(film_color)
             await message.answer(
-                f"Пленка с кодом {film_color} не найдена в базе данных.\n"
+                film_index.not_found_text(film_color, candidates) + "\n"
                 f"Пожалуйста, выберите из списка доступных цветов.",
-                reply_markup=ReplyKeyboardMarkup(
-                    keyboard=[[KeyboardButton(text="◀️ Назад")]],
-                    resize_keyboard=True
-                )
+                reply_markup=film_index.suggestion_keyboard(candidates)
             )
             return
         
@@ -1248,54 +1406,8 @@ async def process_production_quantity(message: Message, state: FSMContext):
         # Возвращаемся к выбору цвета пленки
         db = next(get_db())
         try:
-            # Получаем список доступных пленок
-            films = db.query(Film).all()
-            
-            # Формируем кнопки для выбора цвета пленки
-            available_films = []
-            keyboard_rows = []
-            for film in films:
-                # Рассчитываем, сколько панелей можно произвести из доступной пленки
-                possible_panels = film.calculate_possible_panels()
-                if possible_panels > 0:  # Показываем только те цвета, для которых хватает пленки
-                    keyboard_rows.append([KeyboardButton(text=film.code)])
-                    available_films.append(film)
-            
-            # Добавляем кнопку "Назад"
-            keyboard_rows.append([KeyboardButton(text="◀️ Назад")])
-            
-            keyboard = ReplyKeyboardMarkup(
-                keyboard=keyboard_rows,
-                resize_keyboard=True
-            )
-            
-            # Ограничиваем количество информации в сообщении
-            if len(available_films) <= 10:
-                # Если фильмов не много, показываем подробную информацию
-                film_info = []
-                for film in available_films:
-                    possible_panels = film.calculate_possible_panels()
-                    film_info.append(
-                        f"- {film.code}: {film.total_remaining:.2f}м (≈{possible_panels} панелей)"
-                    )
-            
-                film_info_text = "\n".join(film_info)
-            
-                await message.answer(
-                    f"Выберите цвет пленки для производства:\n\n"
-                    f"Доступные пленки:\n{film_info_text}",
-                    reply_markup=keyboard
-                )
-            else:
-                # Если фильмов много, показываем только количество и несколько примеров
-                film_codes = [film.code for film in available_films[:5]]
-                codes_text = ", ".join(film_codes)
-                
-                await message.answer(
-                    f"Выберите цвет пленки для производства:\n\n"
-                    f"Доступно {len(available_films)} цветов пленки, например: {codes_text} и другие.",
-                    reply_markup=keyboard
-                )
+            choice = get_film_choice(db)
+            await message.answer(choice.text, reply_markup=choice.keyboard)
         finally:
             db.close()
             
@@ -1493,10 +1605,29 @@ async def process_film_code(message: Message, state: FSMContext):
         return
     
     film_code = message.text.strip()
+    # Кнопка «➕ код» подтверждает добавление нового кода после подсказки
+    confirmed_new = film_code.startswith("➕ ")
+    if confirmed_new:
+        film_code = film_code[len("➕ "):].strip()
     if not film_code:
         await message.answer("Код пленки не может быть пустым. Попробуйте снова.")
         return
 
+    # Опечатка в коде не должна молча создавать новый цвет пленки
+    index = film_index.get_index()
+    existing_code = index.exact(film_code)
+    if existing_code:
+        film_code = existing_code
+    elif not confirmed_new:
+        candidates = index.suggest(film_code)
+        if candidates:
+            await message.answer(
+                f"Пленки с кодом {film_code} еще нет. Возможно, вы имели в виду: {', '.join(candidates)}?\n"
+                f"Выберите существующий код или добавьте новый.",
+                reply_markup=film_index.suggestion_keyboard(candidates, extra=[f"➕ {film_code}"])
+            )
+            return
+
     db = next(get_db())
     try:
         film = db.query(Film).filter(Film.code == film_code).first()
@@ -2419,6 +2550,9 @@ async def process_defect_finished_product_film(message: Message, state: FSMConte
     else:
         film_code = film_text
     
+    # Код, введенный в другом регистре или с лишними пробелами, приводим к коду из справочника
+    film_code = film_index.get_index().exact(film_code) or film_code
+    
     # Сохраняем выбранный код пленки в состоянии
     await state.update_data(film_code=film_code)
     
@@ -2435,10 +2569,16 @@ async def process_defect_finished_product_film(message: Message, state: FSMConte
         ).first()
         
         if not product:
-            await message.answer(
-                f"Не найдена готовая продукция с кодом {film_code} и толщиной {thickness} мм или ее количество равно нулю.",
-                reply_markup=get_menu_keyboard(MenuState.PRODUCTION_DEFECT)
-            )
+            # Подсказываем похожие коды среди пленок, по которым есть продукция этой толщины
+            in_stock = [code for (code,) in db.query(Film.code).join(FinishedProduct).filter(
+                FinishedProduct.thickness == thickness,
+                FinishedProduct.quantity > 0
+            ).all()]
+            candidates = film_index.get_index().suggest(film_code, allowed=in_stock)
+            text = f"Не найдена готовая продукция с кодом {film_code} и толщиной {thickness} мм или ее количество равно нулю."
+            if candidates:
+                text += f"\nВозможно, вы имели в виду: {', '.join(candidates)}?"
+            await message.answer(text, reply_markup=film_index.suggestion_keyboard(candidates))
             return
         
         # Запрашиваем количество бракованной продукции
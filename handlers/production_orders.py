@@ -1,5 +1,5 @@
 from aiogram import Router, F
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -9,9 +9,14 @@ import logging
 from datetime import datetime
 from navigation import MenuState, get_menu_keyboard
 import json
+import idempotency
+import production_planner
+import stock
 
 router = Router()
 
+PLAN_BUTTON = "🗓 План выполнения"
+
 class ProductionOrderStates(StatesGroup):
     waiting_for_panel_thickness = State()
     waiting_for_panel_quantity = State()
@@ -177,6 +182,20 @@ async def process_film_color(message: Message, state: FSMContext):
         # Получаем менеджера
         user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
         
+        # Повторная отправка того же черновика возвращает уже созданный заказ
+        idempotency_key = idempotency.make_key(idempotency.SCOPE_PRODUCTION_ORDER, message.chat.id, {
+            "manager_id": user.id,
+            "panel_quantity": data["panel_quantity"],
+            "panel_thickness": data["panel_thickness"],
+            "film_color": message.text,
+        })
+        existing_order_id = idempotency.claim(db, idempotency.SCOPE_PRODUCTION_ORDER, idempotency_key)
+        if existing_order_id is not None:
+            db.rollback()
+            await message.answer(f"ℹ️ Заказ на производство #{existing_order_id} уже создан.")
+            await state.clear()
+            return
+        
         # Создаем заказ
         order = ProductionOrder(
             manager_id=user.id,
@@ -186,6 +205,8 @@ async def process_film_color(message: Message, state: FSMContext):
             status="new"
         )
         db.add(order)
+        db.flush()
+        idempotency.bind(db, idempotency_key, order.id)
         db.commit()
         
         # Уведомляем производство
@@ -236,6 +257,7 @@ async def handle_my_orders(message: Message, state: FSMContext):
         keyboard = []
         for order in orders:
             keyboard.append([KeyboardButton(text=f"✅ Заказ #{order.id} готов")])
+        keyboard.append([KeyboardButton(text=PLAN_BUTTON)])
         keyboard.append([KeyboardButton(text="◀️ Назад")])
         
         # Формируем сообщение со списком заказов
@@ -383,4 +405,92 @@ async def handle_order_completed(message: Message, state: FSMContext):
             logging.error(f"Ошибка при обработке заказа #{order.id}: {str(e)}")
             await message.answer(f"Произошла ошибка при обработке заказа: {str(e)}", parse_mode="Markdown")
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+def has_production_role(user) -> bool:
+    return user is not None and user.role in (UserRole.PRODUCTION, UserRole.SUPER_ADMIN)
+
+@router.message(F.text == PLAN_BUTTON)
+async def handle_production_plan(message: Message, state: FSMContext):
+    """План выполнения всех открытых заказов по текущим остаткам пленки и панелей."""
+    db = next(get_db())
+    try:
+        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+        if not has_production_role(user):
+            await message.answer("У вас нет прав для просмотра заказов на производство.")
+            return
+        plan = production_planner.plan_open_orders(db)
+    finally:
+        db.close()
+
+    planned_ids = [demand.order_id for demand in plan.planned]
+    await state.update_data(production_plan_ids=planned_ids)
+    keyboard = None
+    if planned_ids:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text=f"✅ Выполнить план ({len(planned_ids)})", callback_data="prodplan:complete")
+        ]])
+    await message.answer(production_planner.format_plan(plan), reply_markup=keyboard)
+
+@router.callback_query(F.data == "prodplan:complete")
+async def process_complete_plan(callback_query: CallbackQuery, state: FSMContext):
+    """Проводит все заказы плана одной транзакцией."""
+    data = await state.get_data()
+    planned_ids = data.get("production_plan_ids") or []
+    if not planned_ids:
+        await callback_query.answer("План устарел, откройте его заново", show_alert=True)
+        return
+
+    db = next(get_db())
+    try:
+        user = db.query(User).filter(User.telegram_id == callback_query.from_user.id).first()
+        if not has_production_role(user):
+            await callback_query.answer("У вас нет прав для подтверждения выполнения заказов.", show_alert=True)
+            return
+        plan = await stock.run_with_retry(
+            db, lambda session: production_planner.complete_planned(session, planned_ids, user.id)
+        )
+        managers = {
+            manager.id: manager.telegram_id
+            for manager in db.query(User).filter(User.id.in_({demand.manager_id for demand in plan.planned}))
+        }
+    except Exception as e:
+        logging.error(f"Ошибка выполнения плана производства: {e}")
+        await callback_query.answer("Не удалось выполнить план, остатки не изменены", show_alert=True)
+        return
+    finally:
+        db.close()
+
+    await state.update_data(production_plan_ids=[])
+    await callback_query.answer()
+    completed = "\n".join(
+        f"#{demand.order_id}: {demand.quantity} шт. {demand.thickness} мм, {demand.film_code}"
+        for demand in plan.planned
+    ) or "нет"
+    skipped = "\n".join(f"#{demand.order_id}: {reason}" for demand, reason in plan.blocked)
+    await callback_query.message.edit_text(
+        f"✅ Выполнено заказов: {len(plan.planned)}\n{completed}\n\n"
+        f"Готовая продукция добавлена на склад."
+        + (f"\n\n⛔ Пропущены, так как склад изменился:\n{skipped}" if skipped else "")
+    )
+
+    # Одно уведомление каждому менеджеру со всеми его заказами
+    by_manager = {}
+    for demand in plan.planned:
+        by_manager.setdefault(demand.manager_id, []).append(demand)
+    for manager_id, demands in by_manager.items():
+        telegram_id = managers.get(manager_id)
+        if not telegram_id:
+            continue
+        lines = "\n".join(
+            f"#{demand.order_id}: {demand.quantity} шт. {demand.thickness} мм, пленка {demand.film_code}"
+            for demand in demands
+        )
+        try:
+            await callback_query.bot.send_message(
+                telegram_id,
+                f"✅ Заказы на производство выполнены:\n{lines}\n\nГотовые товары добавлены на склад."
+            )
+        except Exception as e:
+            logging.error(f"Ошибка отправки уведомления менеджеру: {e}")
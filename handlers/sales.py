@@ -3,7 +3,7 @@ from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKe
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from models import User, UserRole, Film, Panel, Joint, Glue, FinishedProduct, Operation, JointType, Order, ProductionOrder, OrderStatus, OrderJoint, OrderGlue, OperationType, OrderItem, CompletedOrder, CompletedOrderStatus
+from models import User, UserRole, Film, Panel, Joint, Glue, FinishedProduct, Operation, JointType, Order, ProductionOrder, OrderStatus, OrderJoint, OrderGlue, OperationType, OrderItem, CompletedOrder, RETURNABLE_COMPLETED_STATUSES
 from database import get_db
 import json
 import logging
@@ -15,6 +15,11 @@ from sqlalchemy import select, desc
 from datetime import datetime, date
 from sqlalchemy.orm import joinedload
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+import customer_search
+import film_index
+import idempotency
+import pagination
+import stock
 
 router = Router()
 
@@ -213,6 +218,9 @@ async def process_selecting_products(message: Message, state: FSMContext):
     else:
         film_code = film_text
     
+    # Код, введенный в другом регистре или с лишними пробелами, приводим к коду из справочника
+    film_code = film_index.get_index().exact(film_code) or film_code
+    
     # Сохраняем выбранный код пленки
     await state.update_data(current_film_code=film_code)
     
@@ -230,18 +238,22 @@ async def process_selecting_products(message: Message, state: FSMContext):
         ).first()
         
         if not product:
-            await message.answer(
-                f"Продукт с кодом {film_code} и толщиной {thickness} мм не найден или закончился на складе.",
-                reply_markup=ReplyKeyboardMarkup(
-                    keyboard=[[KeyboardButton(text="◀️ Назад")]],
-                    resize_keyboard=True
-                )
-            )
+            # Подсказываем похожие коды среди пленок, по которым есть продукция этой толщины
+            in_stock = [code for (code,) in db.query(Film.code).join(FinishedProduct).filter(
+                FinishedProduct.thickness == thickness,
+                FinishedProduct.quantity > 0
+            ).all()]
+            candidates = film_index.get_index().suggest(film_code, allowed=in_stock)
+            text = f"Продукт с кодом {film_code} и толщиной {thickness} мм не найден или закончился на складе."
+            if candidates:
+                text += f"\nВозможно, вы имели в виду: {', '.join(candidates)}?"
+            await message.answer(text, reply_markup=film_index.suggestion_keyboard(candidates))
             return
         
-        # Запрашиваем количество
+        # Запрашиваем количество: забронированная продукция другим заказам недоступна
+        available = stock.available_quantity(db, (stock.SKU_FINISHED_PRODUCT, product.id))
         await message.answer(
-            f"Введите количество панелей (доступно: {product.quantity} шт.):",
+            f"Введите количество панелей (доступно: {available} шт.):",
             reply_markup=ReplyKeyboardMarkup(
                 keyboard=[[KeyboardButton(text="◀️ Назад")]],
                 resize_keyboard=True
@@ -323,8 +335,8 @@ async def process_product_quantity(message: Message, state: FSMContext):
                 FinishedProduct.thickness == thickness
             ).first()
             
-            if not product or product.quantity < quantity:
-                available = product.quantity if product else 0
+            available = stock.available_quantity(db, (stock.SKU_FINISHED_PRODUCT, product.id)) if product else 0
+            if available < quantity:
                 await message.answer(
                     f"Недостаточное количество продукта (запрошено: {quantity} шт., доступно: {available} шт.)",
                     reply_markup=ReplyKeyboardMarkup(
@@ -472,7 +484,7 @@ async def process_add_more_products(message: Message, state: FSMContext):
                 FinishedProduct.thickness == thickness
             ).first()
             
-            available = product.quantity if product else 0
+            available = stock.available_quantity(db, (stock.SKU_FINISHED_PRODUCT, product.id)) if product else 0
             
             await message.answer(
                 f"Введите количество панелей (доступно: {available} шт.):",
@@ -894,6 +906,29 @@ async def process_order_confirmation(message: Message, state: FSMContext):
                 except ValueError:
                     logging.warning(f"Неверный формат даты: {shipment_date_str}")
         
+        # Повторное нажатие или повторная доставка апдейта с тем же черновиком не создает второй заказ
+        idempotency_key = idempotency.make_key(idempotency.SCOPE_ORDER, message.chat.id, {
+            "manager_id": user.id,
+            "products": selected_products,
+            "joints": selected_joints,
+            "glue_quantity": glue_quantity,
+            "installation_required": installation_required,
+            "customer_phone": customer_phone,
+            "delivery_address": delivery_address,
+            "payment_method": payment_method,
+            "shipment_date": shipment_date,
+        })
+        existing_order_id = idempotency.claim(db, idempotency.SCOPE_ORDER, idempotency_key)
+        if existing_order_id is not None:
+            db.rollback()
+            await message.answer(
+                f"ℹ️ Заказ #{existing_order_id} уже оформлен.",
+                reply_markup=get_menu_keyboard(MenuState.SALES_MAIN)
+            )
+            await state.clear()
+            await state.set_state(MenuState.SALES_MAIN)
+            return
+        
         # Создаем новый заказ
         new_order = Order(
             manager_id=user.id,
@@ -944,6 +979,8 @@ async def process_order_confirmation(message: Message, state: FSMContext):
             )
             db.add(order_glue)
         
+        idempotency.bind(db, idempotency_key, new_order.id)
+        
         # Сохраняем все изменения
         db.commit()
         
@@ -1004,8 +1041,10 @@ async def process_need_glue(message: Message, state: FSMContext):
         db = next(get_db())
         try:
             glue = db.query(Glue).filter(Glue.quantity > 0).first()
+            # Клей в резерве других заказов не предлагаем
+            available = stock.available_quantity(db, (stock.SKU_GLUE, glue.id)) if glue else 0
             
-            if not glue:
+            if available <= 0:
                 logging.warning(f"DEBUG: No glue available in database for user {message.from_user.id}")
                 await message.answer(
                     "❌ К сожалению, клей отсутствует на складе.",
@@ -1018,9 +1057,9 @@ async def process_need_glue(message: Message, state: FSMContext):
                 )
                 return
             
-            logging.info(f"DEBUG: Asking user {message.from_user.id} for glue quantity. Available: {glue.quantity}")
+            logging.info(f"DEBUG: Asking user {message.from_user.id} for glue quantity. Available: {available}")
             await message.answer(
-                f"Введите количество тюбиков клея (доступно: {glue.quantity} шт.):",
+                f"Введите количество тюбиков клея (доступно: {available} шт.):",
                 reply_markup=ReplyKeyboardMarkup(
                     keyboard=[
                         [KeyboardButton(text="◀️ Назад")]
@@ -1172,8 +1211,10 @@ async def process_order_glue_needed(message: Message, state: FSMContext):
         db = next(get_db())
         try:
             glue = db.query(Glue).filter(Glue.quantity > 0).first()
+            # Клей в резерве других заказов не предлагаем
+            available = stock.available_quantity(db, (stock.SKU_GLUE, glue.id)) if glue else 0
             
-            if not glue:
+            if available <= 0:
                 logging.warning(f"DEBUG: No glue available in database for user {message.from_user.id}")
                 await message.answer(
                     "❌ К сожалению, клей отсутствует на складе.",
@@ -1186,9 +1227,9 @@ async def process_order_glue_needed(message: Message, state: FSMContext):
                 )
                 return
             
-            logging.info(f"DEBUG: Asking user {message.from_user.id} for glue quantity. Available: {glue.quantity}")
+            logging.info(f"DEBUG: Asking user {message.from_user.id} for glue quantity. Available: {available}")
             await message.answer(
-                f"Введите количество тюбиков клея (доступно: {glue.quantity} шт.):",
+                f"Введите количество тюбиков клея (доступно: {available} шт.):",
                 reply_markup=ReplyKeyboardMarkup(
                     keyboard=[
                         [KeyboardButton(text="◀️ Назад")]
@@ -1585,8 +1626,8 @@ async def process_order_joint_quantity(message: Message, state: FSMContext):
                 Joint.color == color
             ).first()
             
-            if not joint or joint.quantity < quantity:
-                max_quantity = joint.quantity if joint else 0
+            max_quantity = stock.available_quantity(db, (stock.SKU_JOINT, joint.id)) if joint else 0
+            if max_quantity < quantity:
                 await message.answer(
                     f"К сожалению, недостаточно стыков. Доступно: {max_quantity} шт.",
                     reply_markup=ReplyKeyboardMarkup(
@@ -1929,9 +1970,14 @@ async def process_film_color(message: Message, state: FSMContext):
         data = await state.get_data()
         panel_thickness = data.get("panel_thickness", 0.5)  # По умолчанию 0.5 если не указано
         
-        film = db.query(Film).filter(Film.code == message.text.strip()).first()
+        index = film_index.get_index()
+        film = db.query(Film).filter(Film.code == (index.exact(message.text) or message.text.strip())).first()
         if not film:
-            await message.answer("❌ Пленка с таким кодом не найдена. Пожалуйста, выберите из списка:")
+            candidates = index.suggest(message.text)
+            await message.answer(
+                "❌ " + film_index.not_found_text(message.text.strip(), candidates),
+                reply_markup=film_index.suggestion_keyboard(candidates)
+            )
             return
             
         # Сохраняем код пленки
@@ -2082,9 +2128,14 @@ async def process_film_code(message: Message, state: FSMContext):
     """Обработка ввода кода пленки"""
     db = next(get_db())
     try:
-        film = db.query(Film).filter(Film.code == message.text.strip()).first()
+        index = film_index.get_index()
+        film = db.query(Film).filter(Film.code == (index.exact(message.text) or message.text.strip())).first()
         if not film:
-            await message.answer("❌ Пленка с таким кодом не найдена. Пожалуйста, выберите из списка:")
+            candidates = index.suggest(message.text)
+            await message.answer(
+                "❌ " + film_index.not_found_text(message.text.strip(), candidates),
+                reply_markup=film_index.suggestion_keyboard(candidates)
+            )
             return
             
         # Сохраняем код пленки
@@ -2257,8 +2308,8 @@ async def process_order_joint_quantity(message: Message, state: FSMContext):
                 Joint.color == color
             ).first()
             
-            if not joint or joint.quantity < quantity:
-                max_quantity = joint.quantity if joint else 0
+            max_quantity = stock.available_quantity(db, (stock.SKU_JOINT, joint.id)) if joint else 0
+            if max_quantity < quantity:
                 await message.answer(
                     f"К сожалению, недостаточно стыков. Доступно: {max_quantity} шт.",
                     reply_markup=ReplyKeyboardMarkup(
@@ -2535,13 +2586,13 @@ async def handle_completed_orders_sales(message: Message, state: FSMContext):
         response = "✅ Завершенные заказы (последние 20):\n\n"
         for order in completed_orders:
             response += f"---\n"
-            response += f"Заказ #{order.order_id} (Завершен ID: {order.id})\n"
+            response += f"Заказ #{order.id}\n"
             response += f"Дата завершения: {order.completed_at.strftime('%Y-%m-%d %H:%M')}\n"
             response += f"Статус: {order.status}\n"
             response += f"Менеджер: {order.manager.username if order.manager else 'N/A'}\n"
             response += f"\n"
             
-        response += "\nВведите ID завершенного заказа (из поля 'Завершен ID: ...') для просмотра деталей и опций."
+        response += "\nВведите номер завершенного заказа для просмотра деталей и опций."
         
         if len(response) > 4000:
             response = response[:4000] + "\n... (список слишком длинный)"
@@ -2587,7 +2638,7 @@ async def view_completed_order_sales(message: Message, state: FSMContext):
             return
 
         # Format order details (same as warehouse view)
-        response = f"Детали завершенного заказа ID: {order.id} (Исходный: #{order.order_id})\n"
+        response = f"Детали завершенного заказа #{order.id}\n"
         response += f"Статус: {order.status}\n"
         response += f"Дата завершения: {order.completed_at.strftime('%Y-%m-%d %H:%M')}\n"
         response += f"Клиент: {order.customer_phone}\n"
@@ -2619,7 +2670,7 @@ async def view_completed_order_sales(message: Message, state: FSMContext):
 
         # Create inline keyboard (same callback as warehouse)
         keyboard_buttons = []
-        if order.status == CompletedOrderStatus.COMPLETED.value:
+        if order.status in RETURNABLE_COMPLETED_STATUSES:
              keyboard_buttons.append([
                  InlineKeyboardButton(text="♻️ Запрос на возврат", callback_data=f"request_return:{order.id}")
              ])
@@ -2711,6 +2762,13 @@ async def view_reserved_order_sales(message: Message, state: FSMContext):
         )
         return
     
+    await show_reserved_order_sales(message, state, order_id)
+
+async def show_reserved_order_sales(message: Message, state: FSMContext, order_id: int):
+    """Отправляет детали забронированного заказа с кнопками оформления и отмены"""
+    state_data = await state.get_data()
+    is_admin_context = state_data.get("is_admin_context", False)
+    
     db = next(get_db())
     try:
         order = db.query(Order).options(
@@ -2805,124 +2863,72 @@ async def process_confirm_reserved_order(callback_query: CallbackQuery, state: F
     # Сохраняем контекст администратора для следующего состояния
     await state.update_data(is_admin_context=is_admin_context)
     
-    db = next(get_db())
-    try:
-        # Получаем заказ
-        order = db.query(Order).filter(
-            Order.id == order_id
-        ).first()
-        
-        if not order:
-            await callback_query.message.answer(
-                f"❌ Заказ #{order_id} не найден.",
-                reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-            )
-            await state.set_state(MenuState.SALES_MAIN)
-            return
+    def confirm(db):
+        """Снимает резерв и отправляет заказ в производство; возвращает (текст ошибки или None, роль пользователя).
+
+        Выполняется через stock.run_with_retry: блокировка заказа снимается коммитом до ответа пользователю.
+        """
+        user = db.query(User).filter(User.telegram_id == callback_query.from_user.id).first()
+        role = user.role if user else None
+        # Блокируем заказ, чтобы подтверждение и отмена не выполнялись параллельно
+        if not stock.lock_order(db, order_id):
+            return f"❌ Заказ #{order_id} не найден.", role
+        order = db.query(Order).filter(Order.id == order_id).first()
         
         # Проверяем права доступа
-        user = db.query(User).filter(User.telegram_id == callback_query.from_user.id).first()
         if not user or (order.manager_id != user.id and user.role != UserRole.SUPER_ADMIN.value):
-            await callback_query.message.answer(
-                "У вас нет прав для управления этим заказом.",
-                reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-            )
-            await state.set_state(MenuState.SALES_MAIN)
-            return
+            db.rollback()
+            return "У вас нет прав для управления этим заказом.", role
         
-        # Возвращаем товары на склад
-        if order.products:
-            for product in order.products:
-                # Находим соответствующий товар на складе
-                finished_product = db.query(FinishedProduct).join(
-                    Film, FinishedProduct.film_id == Film.id
-                ).filter(
-                    Film.code == product.color,
-                    FinishedProduct.thickness == product.thickness
-                ).first()
-                
-                if finished_product:
-                    # Увеличиваем количество на складе
-                    finished_product.quantity += product.quantity
-                else:
-                    # Если такого товара нет, создаем новую запись
-                    film = db.query(Film).filter(Film.code == product.color).first()
-                    if film:
-                        new_product = FinishedProduct(
-                            film_id=film.id,
-                            quantity=product.quantity,
-                            thickness=product.thickness
-                        )
-                        db.add(new_product)
-        
-        # Возвращаем стыки на склад
-        if order.joints:
-            for joint in order.joints:
-                joint_item = db.query(Joint).filter(
-                    Joint.type == joint.joint_type,
-                    Joint.color == joint.joint_color,
-                    Joint.thickness == joint.joint_thickness
-                ).first()
-                
-                if joint_item:
-                    # Увеличиваем количество стыков
-                    joint_item.quantity += joint.quantity
-                else:
-                    # Если таких стыков нет, создаем новую запись
-                    new_joint = Joint(
-                        type=joint.joint_type,
-                        color=joint.joint_color,
-                        thickness=joint.joint_thickness,
-                        quantity=joint.quantity
-                    )
-                    db.add(new_joint)
+        # Отмена могла завершиться, пока заказ ждал блокировки
+        if order.status != OrderStatus.RESERVED:
+            db.rollback()
+            return f"⚠️ Заказ #{order_id} не может быть подтвержден, так как его статус: {order.status}", role
         
-        # Возвращаем клей на склад
-        if order.glues:
-            total_glue = sum(glue.quantity for glue in order.glues)
-            if total_glue > 0:
-                glue_item = db.query(Glue).first()
-                if glue_item:
-                    glue_item.quantity += total_glue
-                else:
-                    new_glue = Glue(quantity=total_glue)
-                    db.add(new_glue)
+        # Снимаем резерв заказа одним запросом — остатки на складе не менялись
+        stock.release_order(db, order.id)
         
         # Меняем статус заказа на PENDING
         order.status = OrderStatus.PENDING.value
-        db.commit()
-        
+        return None, role
+    
+    def menu_for(role) -> MenuState:
         # Убедимся, что используется правильный тип меню в зависимости от роли пользователя
-        menu_state = MenuState.SALES_MAIN
-        if user.role == UserRole.WAREHOUSE.value and not is_admin_context:
-            menu_state = MenuState.WAREHOUSE_MAIN
-        elif user.role == UserRole.PRODUCTION.value and not is_admin_context:
-            menu_state = MenuState.PRODUCTION_MAIN
-            
-        await callback_query.message.answer(
-            f"✅ Заказ #{order_id} подтвержден и отправлен в производство. Материалы возвращены на склад.",
-            reply_markup=get_menu_keyboard(menu_state, is_admin_context=is_admin_context)
-        )
-        await state.set_state(menu_state)
-        
+        if role == UserRole.WAREHOUSE.value and not is_admin_context:
+            return MenuState.WAREHOUSE_MAIN
+        if role == UserRole.PRODUCTION.value and not is_admin_context:
+            return MenuState.PRODUCTION_MAIN
+        return MenuState.SALES_MAIN
+    
+    db = next(get_db())
+    try:
+        error_text, role = await stock.run_with_retry(db, confirm)
     except Exception as e:
         db.rollback()
         logging.error(f"Ошибка при подтверждении забронированного заказа {order_id}: {e}", exc_info=True)
-        
-        # Определяем правильное состояние меню
-        menu_state = MenuState.SALES_MAIN
-        if user and user.role == UserRole.WAREHOUSE.value and not is_admin_context:
-            menu_state = MenuState.WAREHOUSE_MAIN
-        elif user and user.role == UserRole.PRODUCTION.value and not is_admin_context:
-            menu_state = MenuState.PRODUCTION_MAIN
-            
         await callback_query.message.answer(
             f"❌ Произошла ошибка при подтверждении заказа: {str(e)}",
-            reply_markup=get_menu_keyboard(menu_state, is_admin_context=is_admin_context)
+            reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
         )
-        await state.set_state(menu_state)
+        await state.set_state(MenuState.SALES_MAIN)
+        return
     finally:
         db.close()
+    
+    if error_text:
+        await callback_query.message.answer(
+            error_text,
+            reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
+        )
+        await state.set_state(MenuState.SALES_MAIN)
+        return
+    
+    menu_state = menu_for(role)
+    await callback_query.message.answer(
+        f"✅ Заказ #{order_id} подтвержден и отправлен в производство. Резерв снят.",
+        reply_markup=get_menu_keyboard(menu_state, is_admin_context=is_admin_context)
+    )
+    await state.set_state(menu_state)
 
 @router.callback_query(lambda c: c.data.startswith("cancel_reserved:"))
 async def process_cancel_reserved_order(callback_query: CallbackQuery, state: FSMContext):
@@ -2935,115 +2941,48 @@ async def process_cancel_reserved_order(callback_query: CallbackQuery, state: FS
     # Сохраняем контекст администратора для следующего состояния
     await state.update_data(is_admin_context=is_admin_context)
     
-    db = next(get_db())
-    try:
-        # Получаем заказ по ID
+    def cancel(db):
+        """Снимает резерв и отменяет заказ; возвращает текст ошибки или None.
+
+        Выполняется через stock.run_with_retry: блокировка заказа снимается коммитом до ответа пользователю.
+        """
+        # Блокируем заказ, чтобы подтверждение и отмена не выполнялись параллельно
+        if not stock.lock_order(db, order_id):
+            return f"❌ Заказ #{order_id} не найден."
         order = db.query(Order).filter(Order.id == order_id).first()
         
-        if not order:
-            await callback_query.message.answer(
-                f"❌ Заказ #{order_id} не найден.",
-                reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-            )
-            await state.set_state(MenuState.SALES_MAIN)
-            return
-        
         # Проверяем статус заказа
-        if order.status != OrderStatus.RESERVED.value:
-            await callback_query.message.answer(
-                f"⚠️ Заказ #{order_id} не может быть отменен, так как его статус: {order.status}",
-                reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-            )
-            await state.set_state(MenuState.SALES_MAIN)
-            return
+        if order.status != OrderStatus.RESERVED:
+            db.rollback()
+            return f"⚠️ Заказ #{order_id} не может быть отменен, так как его статус: {order.status}"
         
         # Проверяем права доступа
         user = db.query(User).filter(User.telegram_id == callback_query.from_user.id).first()
         if not user or (order.manager_id != user.id and user.role != UserRole.SUPER_ADMIN.value):
-            await callback_query.message.answer(
-                "У вас нет прав для управления этим заказом.",
-                reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-            )
-            await state.set_state(MenuState.SALES_MAIN)
-            return
+            db.rollback()
+            return "У вас нет прав для управления этим заказом."
         
-        # Возвращаем товары на склад
-        if order.products:
-            for product in order.products:
-                # Находим соответствующий товар на складе
-                finished_product = db.query(FinishedProduct).join(
-                    Film, FinishedProduct.film_id == Film.id
-                ).filter(
-                    Film.code == product.color,
-                    FinishedProduct.thickness == product.thickness
-                ).first()
-                
-                if finished_product:
-                    # Увеличиваем количество на складе
-                    finished_product.quantity += product.quantity
-                else:
-                    # Если такого товара нет, создаем новую запись
-                    film = db.query(Film).filter(Film.code == product.color).first()
-                    if film:
-                        new_product = FinishedProduct(
-                            film_id=film.id,
-                            quantity=product.quantity,
-                            thickness=product.thickness
-                        )
-                        db.add(new_product)
-        
-        # Возвращаем стыки на склад
-        if order.joints:
-            for joint in order.joints:
-                joint_item = db.query(Joint).filter(
-                    Joint.type == joint.joint_type,
-                    Joint.color == joint.joint_color,
-                    Joint.thickness == joint.joint_thickness
-                ).first()
-                
-                if joint_item:
-                    # Увеличиваем количество стыков
-                    joint_item.quantity += joint.quantity
-                else:
-                    # Если таких стыков нет, создаем новую запись
-                    new_joint = Joint(
-                        type=joint.joint_type,
-                        color=joint.joint_color,
-                        thickness=joint.joint_thickness,
-                        quantity=joint.quantity
-                    )
-                    db.add(new_joint)
-        
-        # Возвращаем клей на склад
-        if order.glues:
-            total_glue = sum(glue.quantity for glue in order.glues)
-            if total_glue > 0:
-                glue_item = db.query(Glue).first()
-                if glue_item:
-                    glue_item.quantity += total_glue
-                else:
-                    new_glue = Glue(quantity=total_glue)
-                    db.add(new_glue)
+        # Снимаем резерв заказа одним запросом — остатки на складе не менялись
+        stock.release_order(db, order.id)
         
         # Меняем статус заказа на CANCELLED
         order.status = OrderStatus.CANCELLED.value
-        db.commit()
-        
-        await callback_query.message.answer(
-            f"❌ Заказ #{order_id} отменен. Товары возвращены на склад.",
-            reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-        )
-        await state.set_state(MenuState.SALES_MAIN)
-        
+        return None
+    
+    db = next(get_db())
+    try:
+        error_text = await stock.run_with_retry(db, cancel)
     except Exception as e:
         db.rollback()
-        await callback_query.message.answer(
-            f"❌ Произошла ошибка при отмене заказа: {str(e)}",
-            reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-        )
-        await state.set_state(MenuState.SALES_MAIN)
+        error_text = f"❌ Произошла ошибка при отмене заказа: {str(e)}"
     finally:
         db.close()
+    
+    await callback_query.message.answer(
+        error_text or f"❌ Заказ #{order_id} отменен. Резерв снят, позиции снова доступны.",
+        reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
+    )
+    await state.set_state(MenuState.SALES_MAIN)
 
 @router.message(F.text == "🔖 Бронь", StateFilter(MenuState.SALES_MAIN))
 async def handle_booking(message: Message, state: FSMContext):
@@ -3267,120 +3206,25 @@ async def confirm_booking(message: Message, state: FSMContext):
         await state.set_state(MenuState.SALES_MAIN)
         return
     
-    db = next(get_db())
-    try:
-        # Получаем заказ
-        order = db.query(Order).filter(
-            Order.id == order_id
-        ).first()
+    def book(db):
+        """Бронирует заказ; возвращает текст ошибки или None. Повторяется целиком при конфликте блокировок."""
+        # Блокируем заказ, чтобы его не забронировали дважды параллельно
+        if not stock.lock_order(db, order_id):
+            return f"❌ Заказ #{order_id} не найден."
+        order = db.query(Order).filter(Order.id == order_id).first()
         
-        if not order:
-            await message.answer(
-                f"❌ Заказ #{order_id} не найден.",
-                reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
+        status = order.status.value if hasattr(order.status, 'value') else order.status
+        if status != "NEW":
+            return (
+                f"⚠️ Заказ #{order_id} не может быть забронирован, так как его статус: {status}. "
+                f"Бронировать можно только заказы со статусом NEW."
             )
-            await state.set_state(MenuState.SALES_MAIN)
-            return
         
-        if hasattr(order.status, 'value'):
-            # Если order.status - это enum, сравниваем его значение
-            if order.status.value != "NEW":
-                await message.answer(
-                    f"⚠️ Заказ #{order_id} не может быть забронирован, так как его статус: {order.status.value}. Бронировать можно только заказы со статусом NEW.",
-                    reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-                )
-                await state.set_state(MenuState.SALES_MAIN)
-                return
-        else:
-            # Если order.status - это строка, сравниваем её напрямую
-            if order.status != "NEW":
-                await message.answer(
-                    f"⚠️ Заказ #{order_id} не может быть забронирован, так как его статус: {order.status}. Бронировать можно только заказы со статусом NEW.",
-                    reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-                )
-                await state.set_state(MenuState.SALES_MAIN)
-                return
-        
-        # Вычитаем товары со склада
-        if order.products:
-            for product in order.products:
-                # Проверяем наличие товара на складе
-                finished_product = db.query(FinishedProduct).join(
-                    Film, FinishedProduct.film_id == Film.id
-                ).filter(
-                    Film.code == product.color,
-                    FinishedProduct.thickness == product.thickness
-                ).first()
-                
-                if finished_product:
-                    if finished_product.quantity >= product.quantity:
-                        # Уменьшаем количество на складе
-                        finished_product.quantity -= product.quantity
-                    else:
-                        await message.answer(
-                            f"⚠️ Недостаточно товара на складе: {product.color}, {product.thickness}мм (требуется: {product.quantity}, доступно: {finished_product.quantity}).",
-                            reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-                        )
-                        await state.set_state(MenuState.SALES_MAIN)
-                        return
-                else:
-                    await message.answer(
-                        f"⚠️ Товар не найден на складе: {product.color}, {product.thickness}мм.",
-                        reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-                    )
-                    await state.set_state(MenuState.SALES_MAIN)
-                    return
-        
-        # Если есть стыки, проверяем и уменьшаем их количество
-        if order.joints:
-            for joint in order.joints:
-                joint_item = db.query(Joint).filter(
-                    Joint.type == joint.joint_type,
-                    Joint.color == joint.joint_color,
-                    Joint.thickness == joint.joint_thickness
-                ).first()
-                
-                if joint_item:
-                    if joint_item.quantity >= joint.quantity:
-                        # Уменьшаем количество стыков
-                        joint_item.quantity -= joint.quantity
-                    else:
-                        await message.answer(
-                            f"⚠️ Недостаточно стыков на складе: {joint.joint_type.value}, {joint.joint_color}, {joint.joint_thickness}мм (требуется: {joint.quantity}, доступно: {joint_item.quantity}).",
-                            reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-                        )
-                        await state.set_state(MenuState.SALES_MAIN)
-                        return
-                else:
-                    await message.answer(
-                        f"⚠️ Стыки не найдены на складе: {joint.joint_type.value}, {joint.joint_color}, {joint.joint_thickness}мм.",
-                        reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-                    )
-                    await state.set_state(MenuState.SALES_MAIN)
-                    return
-        
-        # Если есть клей, уменьшаем его количество
-        if order.glues:
-            total_glue = sum(glue.quantity for glue in order.glues)
-            if total_glue > 0:
-                glue_item = db.query(Glue).first()
-                if glue_item:
-                    if glue_item.quantity >= total_glue:
-                        glue_item.quantity -= total_glue
-                    else:
-                        await message.answer(
-                            f"⚠️ Недостаточно клея на складе (требуется: {total_glue}, доступно: {glue_item.quantity}).",
-                            reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-                        )
-                        await state.set_state(MenuState.SALES_MAIN)
-                        return
-                else:
-                    await message.answer(
-                        "⚠️ Клей не найден на складе.",
-                        reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
-                    )
-                    await state.set_state(MenuState.SALES_MAIN)
-                    return
+        # Резервируем позиции заказа под блокировкой строк склада: остаток не меняется, растет резерв
+        shortages = stock.reserve_order(db, order)
+        if shortages:
+            db.rollback()
+            return f"⚠️ Недостаточно товаров для бронирования заказа #{order_id}:\n" + "\n".join(shortages)
         
         # Используем строковое значение напрямую для совместимости с базой данных
         order.status = "RESERVED"
@@ -3388,9 +3232,18 @@ async def confirm_booking(message: Message, state: FSMContext):
         # Записываем, кто забронировал заказ
         user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
         order.manager_id = user.id
-        
-        # Сохраняем изменения
-        db.commit()
+        return None
+    
+    db = next(get_db())
+    try:
+        error_text = await stock.run_with_retry(db, book)
+        if error_text:
+            await message.answer(
+                error_text,
+                reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
+            )
+            await state.set_state(MenuState.SALES_MAIN)
+            return
         
         # Сохраняем контекст администратора для следующего состояния
         await state.update_data(is_admin_context=is_admin_context)
@@ -3439,6 +3292,41 @@ async def invalid_booking_confirmation_input(message: Message, state: FSMContext
         "Пожалуйста, используйте кнопки для подтверждения или отмены бронирования."
     )
 
+def render_reserved_orders_page(db, user, cursor=None, direction=pagination.FORWARD):
+    """Текст и inline-клавиатура страницы забронированных заказов (None, если страница пуста)"""
+    query = db.query(Order).filter(Order.status == "RESERVED").options(joinedload(Order.manager))
+    
+    # Для обычных менеджеров показываем только их заказы, для админов - все
+    if user.role != UserRole.SUPER_ADMIN.value:
+        query = query.filter(Order.manager_id == user.id)
+    
+    page = pagination.fetch_page(query, Order.created_at, Order.id, cursor, direction)
+    if not page.rows:
+        return None, None
+    
+    response = "🔖 Забронированные заказы:\n\n"
+    for order in page.rows:
+        response += f"Заказ #{order.id}\n"
+        response += f"Дата создания: {order.created_at.strftime('%Y-%m-%d %H:%M')}\n"
+        
+        # Добавляем информацию о менеджере для админов
+        if user.role == UserRole.SUPER_ADMIN.value and order.manager:
+            manager = order.manager
+            response += f"Менеджер: {manager.username or manager.full_name or 'ID: ' + str(manager.id)}\n"
+                
+        if order.customer_phone:
+            response += f"Клиент: {order.customer_phone}\n"
+        if order.delivery_address:
+            response += f"Адрес: {order.delivery_address}\n"
+        response += "\n---\n"
+    
+    keyboard = pagination.page_keyboard(
+        "sres", page,
+        lambda order: InlineKeyboardButton(text=f"Заказ #{order.id}", callback_data=f"sres:open:{order.id}"),
+        per_row=3
+    )
+    return response, keyboard
+
 @router.message(F.text == "🔖 Забронированные заказы", StateFilter(MenuState.SALES_MAIN))
 async def handle_reserved_orders(message: Message, state: FSMContext):
     """Обработчик просмотра забронированных заказов"""
@@ -3461,66 +3349,27 @@ async def handle_reserved_orders(message: Message, state: FSMContext):
             )
             return
         
-        # Получаем забронированные заказы
-        query = db.query(Order).filter(Order.status == "RESERVED")
-        
-        # Для обычных менеджеров показываем только их заказы, для админов - все
-        if user.role != UserRole.SUPER_ADMIN.value:
-            query = query.filter(Order.manager_id == user.id)
+        # Получаем первую страницу забронированных заказов
+        response, keyboard = render_reserved_orders_page(db, user)
         
-        reserved_orders = query.order_by(desc(Order.created_at)).all()
-        
-        if not reserved_orders:
+        if not response:
             await message.answer(
                 "ℹ️ У вас нет забронированных заказов.",
                 reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
             )
             return
         
-        response = "🔖 Забронированные заказы:\n\n"
-        for order in reserved_orders:
-            response += f"Заказ #{order.id}\n"
-            response += f"Дата создания: {order.created_at.strftime('%Y-%m-%d %H:%M')}\n"
-            
-            # Добавляем информацию о менеджере для админов
-            if user.role == UserRole.SUPER_ADMIN.value and order.manager_id:
-                manager = db.query(User).filter(User.id == order.manager_id).first()
-                if manager:
-                    response += f"Менеджер: {manager.username or manager.full_name or 'ID: ' + str(manager.id)}\n"
-                    
-            if order.customer_phone:
-                response += f"Клиент: {order.customer_phone}\n"
-            if order.delivery_address:
-                response += f"Адрес: {order.delivery_address}\n"
-            response += "\n---\n"
-                
-        response += "\nВыберите ID заказа для просмотра деталей и управления."
-        
-        if len(response) > 4000:
-            response = response[:4000] + "\n... (список слишком длинный)"
-        
-        # Создаем клавиатуру с кнопками для каждого забронированного заказа
-        keyboard_rows = []
-        current_row = []
-        for i, order in enumerate(reserved_orders):
-            current_row.append(KeyboardButton(text=str(order.id)))
-            # По 3 кнопки в ряд
-            if len(current_row) == 3 or i == len(reserved_orders) - 1:
-                keyboard_rows.append(current_row)
-                current_row = []
-                
-        keyboard_rows.append([KeyboardButton(text="◀️ Назад")])
-        
         # Сохраняем контекст администратора при переходе в новое состояние
         await state.update_data(is_admin_context=is_admin_context)
         
         await message.answer(
-            response,
+            "Выберите заказ в списке ниже или введите его ID для просмотра деталей и управления.",
             reply_markup=ReplyKeyboardMarkup(
-                keyboard=keyboard_rows,
+                keyboard=[[KeyboardButton(text="◀️ Назад")]],
                 resize_keyboard=True
             )
         )
+        await message.answer(response, reply_markup=keyboard)
         
     except Exception as e:
         logging.error(f"Ошибка при получении списка забронированных заказов: {e}")
@@ -3531,6 +3380,30 @@ async def handle_reserved_orders(message: Message, state: FSMContext):
     finally:
         db.close()
 
+@router.callback_query(F.data.startswith("sres:"))
+async def process_reserved_orders_callback(callback_query: CallbackQuery, state: FSMContext):
+    """Листание списка забронированных заказов и открытие заказа из списка"""
+    if not await check_sales_access(callback_query):
+        return
+    
+    if callback_query.data.startswith("sres:open:"):
+        await callback_query.answer()
+        await show_reserved_order_sales(callback_query.message, state, int(callback_query.data.split(":")[2]))
+        return
+    
+    cursor, direction = pagination.parse_page_callback(callback_query.data)
+    db = next(get_db())
+    try:
+        user = db.query(User).filter(User.telegram_id == callback_query.from_user.id).first()
+        response, keyboard = render_reserved_orders_page(db, user, cursor, direction)
+        if not response:
+            # Заказы на этой странице уже оформлены или отменены — показываем первую
+            response, keyboard = render_reserved_orders_page(db, user)
+        await callback_query.answer()
+        await pagination.edit_page(callback_query.message, response or "ℹ️ У вас нет забронированных заказов.", keyboard)
+    finally:
+        db.close()
+
 @router.message(StateFilter(SalesStates.waiting_for_reserved_order_selection), F.text == "◀️ Назад")
 async def reserved_orders_back_to_main(message: Message, state: FSMContext):
     """Возврат из выбора забронированного заказа в главное меню"""
@@ -3556,3 +3429,148 @@ async def completed_orders_back_to_main(message: Message, state: FSMContext):
         "Выберите действие:",
         reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
     )
+
+# --- Поиск заказов клиента ---
+
+def render_search_page(db, query_text: str, cursor=None, direction=pagination.FORWARD):
+    """Текст и inline-клавиатура страницы результатов поиска (None, если ничего не найдено)"""
+    query = customer_search.search_orders_query(db, query_text)
+    page = pagination.fetch_page(query, Order.created_at, Order.id, cursor, direction)
+    if not page.rows:
+        return None, None
+    
+    response = f"🔍 Заказы по запросу «{query_text}»:\n\n"
+    for order in page.rows:
+        status = order.status.value if order.status else "—"
+        if order.completion:
+            status += f" ({order.completion.status})"
+        response += f"Заказ #{order.id} от {order.created_at.strftime('%d.%m.%Y')}, {status}\n"
+        response += f"📱 {order.customer_phone or 'Не указан'}, 🏠 {order.delivery_address or 'Не указан'}\n"
+        response += f"Менеджер: {order.manager.username if order.manager else 'N/A'}\n\n"
+    
+    keyboard = pagination.page_keyboard(
+        "srch", page,
+        lambda order: InlineKeyboardButton(text=f"Заказ #{order.id}", callback_data=f"srch:open:{order.id}"),
+        per_row=3
+    )
+    return response, keyboard
+
+async def send_search_results(message: Message, state: FSMContext, query_text: str):
+    """Отправляет первую страницу результатов и запоминает запрос для листания"""
+    if not customer_search.is_valid_query(query_text):
+        await message.answer(
+            f"Введите не меньше {customer_search.MIN_QUERY_LENGTH} символов телефона или адреса."
+        )
+        return
+    
+    await state.update_data(search_query=query_text.strip())
+    db = next(get_db())
+    try:
+        response, keyboard = render_search_page(db, query_text.strip())
+        if not response:
+            await message.answer(f"По запросу «{query_text.strip()}» заказов не найдено.")
+            return
+        await message.answer(response, reply_markup=keyboard)
+    except Exception as e:
+        logging.error(f"Ошибка при поиске заказов по запросу {query_text!r}: {e}", exc_info=True)
+        await message.answer("Произошла ошибка при поиске заказов.")
+    finally:
+        db.close()
+
+@router.message(Command("search"))
+async def cmd_search_orders(message: Message, state: FSMContext):
+    """Поиск заказов командой /search <телефон или адрес>"""
+    if not await check_sales_access(message):
+        return
+    
+    parts = (message.text or "").split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer("Использование: /search <телефон или часть адреса>")
+        return
+    await send_search_results(message, state, parts[1])
+
+@router.message(F.text == "🔍 Поиск заказов", StateFilter(MenuState.SALES_MAIN))
+async def handle_search_orders(message: Message, state: FSMContext):
+    """Запрашивает телефон или адрес клиента для поиска заказов"""
+    if not await check_sales_access(message):
+        return
+    
+    await state.set_state(SalesStates.waiting_for_search_query)
+    await message.answer(
+        "Введите телефон клиента (полностью или часть номера) или часть адреса доставки:",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="◀️ Назад")]],
+            resize_keyboard=True
+        )
+    )
+
+@router.message(StateFilter(SalesStates.waiting_for_search_query))
+async def process_search_query(message: Message, state: FSMContext):
+    """Ищет заказы по введенному телефону или адресу; можно искать повторно"""
+    if message.text == "◀️ Назад":
+        state_data = await state.get_data()
+        is_admin_context = state_data.get("is_admin_context", False)
+        await state.set_state(MenuState.SALES_MAIN)
+        await message.answer(
+            "Выберите действие:",
+            reply_markup=get_menu_keyboard(MenuState.SALES_MAIN, is_admin_context=is_admin_context)
+        )
+        return
+    
+    await send_search_results(message, state, message.text or "")
+
+@router.callback_query(F.data.startswith("srch:"))
+async def process_search_callback(callback_query: CallbackQuery, state: FSMContext):
+    """Листание результатов поиска и просмотр найденного заказа"""
+    if not await check_sales_access(callback_query):
+        return
+    
+    db = next(get_db())
+    try:
+        if callback_query.data.startswith("srch:open:"):
+            order_id = int(callback_query.data.split(":")[2])
+            order = db.query(Order).options(
+                joinedload(Order.products),
+                joinedload(Order.joints),
+                joinedload(Order.glues),
+                joinedload(Order.completion)
+            ).filter(Order.id == order_id).first()
+            await callback_query.answer()
+            if not order:
+                await callback_query.message.answer(f"Заказ #{order_id} не найден.")
+                return
+            
+            details = f"📝 Заказ #{order.id}\n"
+            details += f"Статус: {order.status.value if order.status else '—'}\n"
+            if order.completion:
+                details += f"Выполнен: {order.completion.completed_at.strftime('%d.%m.%Y %H:%M')}, статус возврата: {order.completion.status}\n"
+            details += f"📅 Создан: {order.created_at.strftime('%d.%m.%Y %H:%M')}\n"
+            details += f"📱 Телефон клиента: {order.customer_phone or 'Не указан'}\n"
+            details += f"🏠 Адрес доставки: {order.delivery_address or 'Не указан'}\n"
+            if order.shipment_date:
+                details += f"🚚 Дата отгрузки: {order.shipment_date.strftime('%d.%m.%Y')}\n"
+            if order.payment_method:
+                details += f"💳 Способ оплаты: {order.payment_method}\n"
+            details += "\n📋 Позиции:\n"
+            for item in order.products:
+                details += f"- {stock.product_label(item.color, item.thickness)}: {item.quantity} шт.\n"
+            for joint in order.joints:
+                details += f"- {stock.joint_label(joint.joint_type, joint.joint_color, joint.joint_thickness)}: {joint.joint_quantity} шт.\n"
+            if order.glues:
+                details += f"- Клей: {sum(glue.quantity for glue in order.glues)} шт.\n"
+            await callback_query.message.answer(details)
+            return
+        
+        state_data = await state.get_data()
+        query_text = state_data.get("search_query")
+        if not query_text:
+            await callback_query.answer("Поиск устарел, повторите запрос.", show_alert=True)
+            return
+        cursor, direction = pagination.parse_page_callback(callback_query.data)
+        response, keyboard = render_search_page(db, query_text, cursor, direction)
+        if not response:
+            response, keyboard = render_search_page(db, query_text)
+        await callback_query.answer()
+        await pagination.edit_page(callback_query.message, response or f"По запросу «{query_text}» заказов не найдено.", keyboard)
+    finally:
+        db.close()
@@ -1,10 +1,12 @@
 from aiogram import Router, F
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from models import User, UserRole, Operation, Order, CompletedOrder, Film, Joint, Glue, ProductionOrder, OrderStatus, Panel, FinishedProduct, OperationType, JointType
+from models import User, UserRole, Operation, Order, CompletedOrder, Joint, ProductionOrder, OrderStatus, FinishedProduct, OperationType, JointType, SlowQuery, StockThreshold, ReportSubscription
 from database import get_db
+import asyncio
 import json
 from datetime import datetime, timedelta
 from navigation import MenuState, get_menu_keyboard, go_back
@@ -13,8 +15,15 @@ import re
 from handlers.warehouse import handle_stock
 from sqlalchemy import func
 from sqlalchemy.orm import joinedload
-import pandas as pd
 import io
+import metrics
+import slow_query_log
+import profiler
+import reorder_forecast
+import analytics
+import report_scheduler
+import stock_monitor
+import film_index
 
 router = Router()
 
@@ -179,46 +188,291 @@ async def handle_china_order_check(message: Message, state: FSMContext):
     if not await check_super_admin_access(message):
         return
     
-    db = next(get_db())
-    shortages = []
-    
     try:
-        # Проверка пленки
-        low_films = db.query(Film).filter(Film.total_remaining < 30).all()
-        for film in low_films:
-            shortages.append(f"- {film.code} пленка (осталось {film.total_remaining:.0f} метров)")
-            
-        # Проверка панелей
-        low_panels = db.query(Panel).filter(Panel.quantity < 150).all()
-        for panel in low_panels:
-            shortages.append(f"- Панели {panel.thickness} мм (осталось {panel.quantity} штук)")
-            
-        # Проверка стыков
-        low_joints = db.query(Joint).filter(Joint.quantity < 100).all()
-        for joint in low_joints:
-             # Убираем '_thickness' из названия типа стыка, если оно там есть
-            joint_type_name = joint.type.name.replace('_thickness', '').capitalize()
-            shortages.append(f"- Стык {joint_type_name} {joint.color} {joint.thickness} мм (осталось {joint.quantity} штук)")
-            
-        # Проверка клея
-        glue = db.query(Glue).filter(Glue.quantity < 100).first()
-        if glue:
-            shortages.append(f"- Клей (осталось {glue.quantity} штук)")
-            
-        if not shortages:
-            response = "✅ Всех материалов достаточно. Заказ в Китай не требуется."
-        else:
-            response = "🇨🇳 Недостающие материалы для заказа в Китай:\n\n"
-            response += "\n".join(shortages)
-            
-        await message.answer(response, reply_markup=get_menu_keyboard(MenuState.SUPER_ADMIN_MAIN))
-            
+        # Промах кеша — запросы истории и группировка pandas, поэтому не в цикле событий
+        forecast = await asyncio.to_thread(reorder_forecast.get_forecast)
     except Exception as e:
         logging.error(f"Ошибка при проверке заказа в Китай: {e}", exc_info=True)
         await message.answer("Произошла ошибка при проверке остатков.")
+        return
+
+    shortages = [reorder_forecast.format_row(row) for row in forecast.rows if row.needs_reorder]
+    if not shortages:
+        response = "✅ Всех материалов достаточно. Заказ в Китай не требуется."
+    else:
+        response = (
+            f"🇨🇳 Заказ в Китай (расход за {forecast.history_days} дн., поставка "
+            f"{reorder_forecast.CHINA_LEAD_TIME_DAYS} дн. + запас {reorder_forecast.SAFETY_STOCK_DAYS} дн.):\n\n"
+        )
+        response += "\n".join(shortages)
+
+    # Ограничение Telegram на длину сообщения
+    if len(response) > 4000:
+        response = response[:4000] + "\n…"
+
+    await message.answer(response, reply_markup=get_menu_keyboard(MenuState.SUPER_ADMIN_MAIN))
+
+@router.message(F.text == "📈 Производительность")
+async def handle_performance(message: Message, state: FSMContext):
+    """Показывает самые медленные обработчики и самые тяжелые запросы за последний час"""
+    if not await check_super_admin_access(message):
+        return
+
+    handlers_stats = metrics.slowest_handlers()
+    queries_stats = metrics.heaviest_queries()
+
+    response = "📈 Производительность за последний час\n\n"
+    if handlers_stats:
+        response += "🐢 Самые медленные обработчики (p95):\n"
+        for item in handlers_stats:
+            response += (
+                f"- {item['handler']}\n"
+                f"  вызовов: {item['count']}, p95: {item['p95'] * 1000:.0f} мс, "
+                f"макс: {item['max'] * 1000:.0f} мс, SQL/апдейт: {item['avg_sql']:.1f}\n"
+            )
+    else:
+        response += "Нет данных об обработчиках.\n"
+
+    response += "\n"
+    if queries_stats:
+        response += "🗄 Самые тяжелые запросы (суммарное время):\n"
+        for item in queries_stats:
+            statement = item['statement'][:150]
+            response += (
+                f"- {statement}\n"
+                f"  выполнений: {item['count']}, всего: {item['total'] * 1000:.0f} мс, "
+                f"макс: {item['max'] * 1000:.0f} мс, строк: {item['rows']}\n"
+            )
+    else:
+        response += "Нет данных о запросах.\n"
+
+    # Ограничение Telegram на длину сообщения
+    if len(response) > 4000:
+        response = response[:4000] + "\n…"
+
+    await message.answer(response, reply_markup=get_menu_keyboard(MenuState.SUPER_ADMIN_MAIN))
+
+@router.message(Command("slow_queries"))
+async def cmd_slow_queries(message: Message, state: FSMContext):
+    """Список последних медленных запросов: /slow_queries [количество]"""
+    if not await check_super_admin_access(message):
+        return
+
+    parts = message.text.split()
+    limit = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10
+    limit = max(1, min(limit, 30))
+
+    db = next(get_db())
+    try:
+        captures = db.query(SlowQuery).order_by(SlowQuery.captured_at.desc()).limit(limit).all()
+        rows = [
+            (capture.id, capture.captured_at, capture.duration_ms, capture.handler, capture.statement, capture.explain)
+            for capture in captures
+        ]
+    except Exception as e:
+        logging.error(f"Ошибка чтения журнала медленных запросов: {e}", exc_info=True)
+        # Если таблица недоступна, показываем то, что есть в памяти
+        rows = [
+            (None, item["captured_at"], item["duration_ms"], item["handler"], item["statement"], item["explain"])
+            for item in slow_query_log.recent_captures(limit)
+        ]
     finally:
         db.close()
 
+    if not rows:
+        await message.answer(
+            f"Медленных запросов (дольше {slow_query_log.SLOW_QUERY_THRESHOLD_MS:.0f} мс) не зафиксировано."
+        )
+        return
+
+    response = f"🐢 Последние медленные запросы (порог {slow_query_log.SLOW_QUERY_THRESHOLD_MS:.0f} мс):\n\n"
+    for capture_id, captured_at, duration_ms, handler_name, statement, explain in rows:
+        header = f"#{capture_id} " if capture_id else ""
+        response += (
+            f"{header}{captured_at.strftime('%d.%m.%Y %H:%M:%S')} — {duration_ms:.0f} мс"
+            f"{' (есть EXPLAIN)' if explain else ''}\n"
+            f"Обработчик: {handler_name or 'неизвестен'}\n"
+            f"{metrics.normalize_statement(statement, 200)}\n\n"
+        )
+    response += "Подробности: /slow_query <номер>"
+
+    if len(response) > 4000:
+        response = response[:4000] + "\n…"
+    await message.answer(response)
+
+@router.message(Command("slow_query"))
+async def cmd_slow_query_details(message: Message, state: FSMContext):
+    """Подробности медленного запроса, включая параметры и EXPLAIN: /slow_query <номер>"""
+    if not await check_super_admin_access(message):
+        return
+
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer("Укажите номер запроса: /slow_query <номер>")
+        return
+
+    db = next(get_db())
+    try:
+        capture = db.query(SlowQuery).filter(SlowQuery.id == int(parts[1])).first()
+        if not capture:
+            await message.answer("Запрос с таким номером не найден.")
+            return
+
+        response = (
+            f"🐢 Медленный запрос #{capture.id}\n"
+            f"Время: {capture.captured_at.strftime('%d.%m.%Y %H:%M:%S')}\n"
+            f"Длительность: {capture.duration_ms:.0f} мс\n"
+            f"Обработчик: {capture.handler or 'неизвестен'}\n\n"
+            f"{capture.statement}\n\n"
+            f"Параметры: {capture.parameters or '-'}\n"
+        )
+        if capture.explain:
+            response += f"\nEXPLAIN:\n{capture.explain}"
+
+        if len(response) > 4000:
+            response = response[:4000] + "\n…"
+        await message.answer(response)
+    finally:
+        db.close()
+
+@router.message(Command("profile"))
+async def cmd_profile(message: Message, state: FSMContext):
+    """Профилирует следующие N апдейтов: /profile <N> [user <telegram_id> | handler <имя>]"""
+    if not await check_super_admin_access(message):
+        return
+
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit() or int(parts[1]) < 1:
+        await message.answer(
+            "Использование:\n"
+            "/profile <N> — следующие N апдейтов любого пользователя\n"
+            "/profile <N> user <telegram_id> — апдейты указанного пользователя\n"
+            "/profile <N> handler <часть имени> — апдейты указанного обработчика, "
+            "например handler process_order_shipment\n"
+            "/profile_stop — остановить и получить отчет"
+        )
+        return
+
+    count = int(parts[1])
+    user_id = None
+    handler_filter = None
+    if len(parts) >= 4 and parts[2] == "user" and parts[3].isdigit():
+        user_id = int(parts[3])
+    elif len(parts) >= 4 and parts[2] == "handler":
+        handler_filter = parts[3]
+    elif len(parts) > 2:
+        await message.answer("Неверный формат. Укажите user <telegram_id> или handler <имя>.")
+        return
+
+    session = profiler.start_session(message.from_user.id, count, user_id, handler_filter)
+    await message.answer(
+        f"🔬 Профилирование запущено: {session.remaining} апдейт(ов), цель: {session.describe()}.\n"
+        f"Отчет придет документом после завершения."
+    )
+
+@router.message(Command("profile_stop"))
+async def cmd_profile_stop(message: Message, state: FSMContext):
+    """Останавливает профилирование и отправляет частичный отчет"""
+    if not await check_super_admin_access(message):
+        return
+
+    session = profiler.stop_session()
+    if session is None:
+        await message.answer("Профилирование не запущено.")
+        return
+    await profiler.send_report(message.bot, session)
+
+THRESHOLD_USAGE = (
+    "Пороги низкого остатка:\n"
+    "/threshold film <код пленки> <метры>\n"
+    "/threshold panel <толщина> <штуки>\n"
+    "/threshold joint <butterfly|simple|closing> <цвет> <толщина> <штуки>\n"
+    "/threshold glue <штуки>\n"
+    "Вместо кода, толщины или цвета можно указать * — порог для всех позиций материала.\n"
+    "Вместо значения укажите off, чтобы удалить порог."
+)
+
+def parse_threshold_sku(db, args):
+    """Ключ позиции из аргументов команды /threshold; возвращает (sku, ошибка)."""
+    material, keys = args[0].lower(), args[1:]
+    if material == reorder_forecast.MATERIAL_GLUE and not keys:
+        return reorder_forecast.MATERIAL_GLUE, None
+    if keys == ["*"] and material in reorder_forecast.MIN_STOCK:
+        return stock_monitor.default_sku(material), None
+    if material == reorder_forecast.MATERIAL_FILM and len(keys) == 1:
+        code = film_index.get_index().exact(keys[0])
+        if not code:
+            return None, f"Пленка {keys[0]} не найдена."
+        return reorder_forecast.film_sku(code), None
+    try:
+        if material == reorder_forecast.MATERIAL_PANEL and len(keys) == 1:
+            return reorder_forecast.panel_sku(float(keys[0].replace(",", "."))), None
+        if material == reorder_forecast.MATERIAL_JOINT and len(keys) == 3:
+            joint_type = JointType(keys[0].lower())
+            thickness = float(keys[2].replace(",", "."))
+            # Цвет сверяется без учета регистра, в ключ идет написание из справочника стыков
+            color = db.query(Joint.color).filter(func.lower(Joint.color) == keys[1].lower()).first()
+            if not color:
+                return None, f"Стыки цвета {keys[1]} не найдены."
+            return reorder_forecast.joint_sku(joint_type, color[0], thickness), None
+    except ValueError:
+        return None, "Неверная толщина или вид стыка."
+    return None, "Неверный формат команды."
+
+@router.message(Command("threshold"))
+async def cmd_threshold(message: Message, state: FSMContext):
+    """Настройка порогов низкого остатка: /threshold <материал> <позиция> <значение>"""
+    if not await check_super_admin_access(message):
+        return
+
+    parts = message.text.split()[1:]
+    db = next(get_db())
+    try:
+        if not parts:
+            thresholds = db.query(StockThreshold).order_by(StockThreshold.sku).all()
+            response = THRESHOLD_USAGE + "\n\n"
+            if thresholds:
+                response += "Заданные пороги:\n" + "\n".join(
+                    f"- {item.sku}: {item.threshold:g}" for item in thresholds
+                )
+            else:
+                response += "Своих порогов нет, действуют пороги по умолчанию: " + ", ".join(
+                    f"{material} {value}" for material, value in reorder_forecast.MIN_STOCK.items()
+                )
+            await message.answer(response[:4000])
+            return
+
+        sku, error = parse_threshold_sku(db, parts[:-1]) if len(parts) >= 2 else (None, "Неверный формат команды.")
+        if error:
+            await message.answer(f"{error}\n\n{THRESHOLD_USAGE}")
+            return
+
+        existing = db.query(StockThreshold).filter(StockThreshold.sku == sku).first()
+        if parts[-1].lower() == "off":
+            if existing:
+                db.delete(existing)
+                db.commit()
+            response = f"Порог для {sku} удален."
+        else:
+            try:
+                value = float(parts[-1].replace(",", "."))
+            except ValueError:
+                value = -1
+            if value < 0:
+                await message.answer("Порог должен быть неотрицательным числом.")
+                return
+            if existing:
+                existing.threshold = value
+            else:
+                db.add(StockThreshold(sku=sku, threshold=value))
+            db.commit()
+            response = f"Порог для {sku}: {value:g}."
+    finally:
+        db.close()
+
+    stock_monitor.monitor.reload_thresholds()
+    await message.answer(response)
+
 @router.message(F.text == "◀️ Назад")
 async def handle_back(message: Message, state: FSMContext):
     """Обработчик кнопки Назад для супер-админа"""
@@ -333,6 +587,136 @@ async def handle_materials_report(message: Message, state: FSMContext):
     # Перенаправляем запрос к новой функции категорий инвентаря
     await handle_stock(message, state)
 
+def analytics_period_keyboard(current: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=f"{'• ' if days == current else ''}{days} дн.", callback_data=f"analytics:{days}")
+            for days in analytics.PERIODS
+        ],
+        [InlineKeyboardButton(text="🔄 Пересчитать", callback_data=f"analytics:{current}:refresh")],
+    ])
+
+def stored_note(prepared_at) -> str:
+    return f"\n\n<i>Подготовлено {prepared_at.strftime('%d.%m.%Y %H:%M')} UTC</i>" if prepared_at else ""
+
+async def build_analytics_text(period_days: int, refresh: bool = False) -> str:
+    # Отчет готовит планировщик; здесь — сохраненная версия или пересчет в отдельном потоке
+    key = report_scheduler.analytics_key(period_days)
+    if refresh:
+        content, prepared_at = await asyncio.to_thread(report_scheduler.run_job, key)
+    else:
+        content, prepared_at = await asyncio.to_thread(report_scheduler.get_stored, key)
+    return content + stored_note(prepared_at)
+
+@router.message(F.text == "📊 Общая статистика")
+async def handle_analytics(message: Message, state: FSMContext):
+    """Аналитика продаж и производства за 30 дней с выбором периода"""
+    if not await check_super_admin_access(message):
+        return
+
+    try:
+        text = await build_analytics_text(30)
+    except Exception as e:
+        logging.error(f"Ошибка построения аналитики: {e}", exc_info=True)
+        await message.answer("Не удалось построить отчет.")
+        return
+    await message.answer(text, parse_mode="HTML", reply_markup=analytics_period_keyboard(30))
+
+@router.callback_query(F.data.startswith("analytics:"))
+async def process_analytics_period(callback_query: CallbackQuery, state: FSMContext):
+    db = next(get_db())
+    try:
+        user = db.query(User).filter(User.telegram_id == callback_query.from_user.id).first()
+        is_admin = user is not None and user.role == UserRole.SUPER_ADMIN
+    finally:
+        db.close()
+    parts = callback_query.data.split(":")
+    period_days = int(parts[1]) if parts[1].isdigit() else 0
+    if not is_admin or period_days not in analytics.PERIODS:
+        await callback_query.answer("Отчет недоступен", show_alert=True)
+        return
+
+    try:
+        text = await build_analytics_text(period_days, refresh=parts[-1] == "refresh")
+    except Exception as e:
+        logging.error(f"Ошибка построения аналитики: {e}", exc_info=True)
+        await callback_query.answer("Не удалось построить отчет.", show_alert=True)
+        return
+    try:
+        await callback_query.message.edit_text(
+            text, parse_mode="HTML", reply_markup=analytics_period_keyboard(period_days)
+        )
+    except TelegramBadRequest as e:
+        # Повторное нажатие того же периода дает тот же отчет — это не ошибка
+        if "message is not modified" not in str(e):
+            raise
+    await callback_query.answer()
+
+async def send_stored_digests(message: Message, sections):
+    """Разделы сохраненных сводок за сутки и неделю — без пересчета истории."""
+    try:
+        texts = []
+        for key in (report_scheduler.DAILY_DIGEST, report_scheduler.WEEKLY_DIGEST):
+            content, prepared_at = await asyncio.to_thread(report_scheduler.get_stored, key)
+            texts.append(report_scheduler.render_digest(key, content, prepared_at, sections))
+    except Exception as e:
+        logging.error(f"Ошибка чтения сводок: {e}", exc_info=True)
+        await message.answer("Не удалось получить отчет.")
+        return
+    await message.answer(
+        "\n\n".join(texts), parse_mode="HTML", reply_markup=get_menu_keyboard(MenuState.SUPER_ADMIN_REPORTS)
+    )
+
+@router.message(F.text == "📈 Отчет по продажам")
+async def handle_sales_digest(message: Message, state: FSMContext):
+    """Продажи и возвраты из сводок, подготовленных планировщиком"""
+    if not await check_super_admin_access(message):
+        return
+    await send_stored_digests(message, ("sales", "returns"))
+
+@router.message(F.text == "🏭 Отчет по производству")
+async def handle_production_digest(message: Message, state: FSMContext):
+    """Производство и брак из сводок, подготовленных планировщиком"""
+    if not await check_super_admin_access(message):
+        return
+    await send_stored_digests(message, ("production", "defects"))
+
+@router.message(Command("digest"))
+async def cmd_digest(message: Message, state: FSMContext):
+    """Подписка на рассылку сводок: /digest daily | weekly — включить или выключить"""
+    if not await check_super_admin_access(message):
+        return
+
+    keys = {"daily": report_scheduler.DAILY_DIGEST, "weekly": report_scheduler.WEEKLY_DIGEST}
+    parts = message.text.split()
+    db = next(get_db())
+    try:
+        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+        if len(parts) > 1 and parts[1].lower() in keys:
+            key = keys[parts[1].lower()]
+            subscription = db.query(ReportSubscription).filter(
+                ReportSubscription.user_id == user.id, ReportSubscription.report_key == key
+            ).first()
+            if subscription:
+                db.delete(subscription)
+            else:
+                db.add(ReportSubscription(user_id=user.id, report_key=key))
+            db.commit()
+        subscribed = {
+            key for (key,) in db.query(ReportSubscription.report_key).filter(ReportSubscription.user_id == user.id)
+        }
+    finally:
+        db.close()
+
+    status = "\n".join(
+        f"{'✅' if key in subscribed else '—'} {report_scheduler.DIGEST_TITLES[key]} (/digest {name})"
+        for name, key in keys.items()
+    )
+    await message.answer(
+        f"Рассылка сводок (готовятся в {report_scheduler.REPORT_HOUR_UTC}:00 UTC):\n{status}\n\n"
+        f"Команда с названием сводки включает или выключает подписку."
+    )
+
 @router.message(F.text == "💰 Статистика продаж")
 async def handle_sales_report(message: Message, state: FSMContext):
     db = next(get_db())
@@ -3,15 +3,17 @@ from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKey
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from models import User, UserRole, Film, Panel, Joint, Glue, Operation, FinishedProduct, Order, CompletedOrder, OrderStatus, JointType, CompletedOrderJoint, CompletedOrderItem, CompletedOrderGlue, CompletedOrderStatus
+from models import User, UserRole, Film, Panel, Joint, Glue, Operation, FinishedProduct, Order, CompletedOrder, OrderStatus, JointType, CompletedOrderStatus, RETURNABLE_COMPLETED_STATUSES
 from database import get_db
 import json
 import logging
 from navigation import MenuState, get_menu_keyboard, go_back
 from datetime import datetime, timedelta
 from sqlalchemy.orm import joinedload, selectinload
-from sqlalchemy import desc
 import re
+import idempotency
+import pagination
+import stock
 
 router = Router()
 
@@ -31,6 +33,7 @@ class WarehouseStates(StatesGroup):
     waiting_for_order_id = State()
     waiting_for_confirmation = State()
     confirming_shipment = State()
+    waiting_for_partial_return = State()
 
 @router.message(Command("stock"))
 async def cmd_stock(message: Message, state: FSMContext):
@@ -152,21 +155,93 @@ async def cmd_confirm_order(message: Message, state: FSMContext):
         
     await display_active_orders(message, state)
 
+# Карточки активных заказов подробные, поэтому страница меньше, чтобы уложиться в лимит сообщения
+ACTIVE_ORDERS_PAGE_SIZE = 5
+
+def render_active_orders_page(db, selected, cursor=None, direction=pagination.FORWARD):
+    """Страница активных заказов с inline-выбором для пакетной отгрузки.
+
+    Возвращает (текст, клавиатура, id заказов страницы); текст None, если страница пуста.
+    """
+    query = db.query(Order).filter(
+        Order.status.in_([OrderStatus.NEW, OrderStatus.IN_PROGRESS])
+    ).options(
+        selectinload(Order.products),
+        selectinload(Order.joints),
+        selectinload(Order.glues),
+        joinedload(Order.manager) # Load manager
+    )
+    page = pagination.fetch_page(
+        query, Order.created_at, Order.id, cursor, direction,
+        descending=False, page_size=ACTIVE_ORDERS_PAGE_SIZE
+    )
+    if not page.rows:
+        return None, None, []
+
+    response = "📦 Активные заказы для отгрузки:\n\n"
+    for order in page.rows:
+        response += f"---\n"
+        response += f"📝 Заказ #{order.id}\n"
+        # Используем order.manager т.к. загрузили его через joinedload
+        response += f"👤 Менеджер: {order.manager.username if order.manager else 'Неизвестно'}\n"
+        response += f"Статус: {order.status.value}\n"
+        response += f"Клиент: {order.customer_phone}\n"
+        response += f"Адрес: {order.delivery_address}\n"
+        # Добавляем дату отгрузки и способ оплаты
+        shipment_date_str = order.shipment_date.strftime('%d.%m.%Y') if order.shipment_date else 'Не указана'
+        payment_method_str = order.payment_method if order.payment_method else 'Не указан'
+        response += f"🗓 Дата отгрузки: {shipment_date_str}\n"
+        response += f"💳 Способ оплаты: {payment_method_str}\n"
+        response += f"🔧 Монтаж: {'Да' if order.installation_required else 'Нет'}\n"
+
+        # Продукция
+        response += "\n🎨 Продукция:\n"
+        if order.products:
+             for item in order.products:
+                 response += f"- {item.color} ({item.thickness} мм): {item.quantity} шт.\n"
+        else:
+             response += "- нет\n"
+
+        # Стыки
+        response += "\n🔗 Стыки:\n"
+        if order.joints:
+             for joint in order.joints:
+                 joint_type_str = joint.joint_type.name.capitalize() if joint.joint_type else "Неизвестно"
+                 response += f"- {joint_type_str} ({joint.joint_thickness} мм, {joint.joint_color}): {joint.joint_quantity} шт.\n"
+        else:
+             response += "- нет\n"
+
+        # Клей
+        response += "\n🧴 Клей:\n"
+        glue_total = sum(g.quantity for g in order.glues) if order.glues else 0
+        if glue_total > 0:
+            response += f"- {glue_total} шт.\n"
+        else:
+             response += "- нет\n"
+
+        response += f"\n"
+
+    keyboard = pagination.page_keyboard(
+        "batch_ship", page,
+        lambda order: InlineKeyboardButton(
+            text=f"{'☑️' if order.id in selected else '⬜'} #{order.id}",
+            callback_data=f"batch_ship:toggle:{order.id}"
+        ),
+        per_row=3,
+        extra_rows=[[
+            InlineKeyboardButton(text="Выбрать все", callback_data="batch_ship:all"),
+            InlineKeyboardButton(text=f"🚚 Отгрузить выбранные ({len(selected)})", callback_data="batch_ship:go"),
+        ]]
+    )
+    return response, keyboard, [order.id for order in page.rows]
+
 async def display_active_orders(message: Message, state: FSMContext):
-    """Отображает список активных заказов для подтверждения отгрузки"""
+    """Отображает первую страницу активных заказов для подтверждения отгрузки"""
     db = next(get_db())
     try:
-        # Получаем все активные заказы со статусом NEW или IN_PROGRESS (из handle_my_orders)
-        orders_to_ship = db.query(Order).filter(
-            Order.status.in_([OrderStatus.NEW, OrderStatus.IN_PROGRESS])
-        ).options(
-            joinedload(Order.products),
-            joinedload(Order.joints),
-            joinedload(Order.glues),
-            joinedload(Order.manager) # Load manager
-        ).order_by(Order.created_at).all() # Added order_by
+        response, keyboard, order_ids = render_active_orders_page(db, set())
 
-        if not orders_to_ship:
+        if not response:
             await message.answer(
                 "📦 Нет активных заказов для отгрузки.",
                 # Используем главное меню склада, а не меню заказов, т.к. заказов нет
@@ -174,67 +249,126 @@ async def display_active_orders(message: Message, state: FSMContext):
             )
             return
 
-        response = "📦 Активные заказы для отгрузки:\n\n"
-        keyboard_buttons = [] # For reply keyboard buttons
-        for order in orders_to_ship:
-            response += f"---\n"
-            response += f"📝 Заказ #{order.id}\n"
-            # Используем order.manager т.к. загрузили его через joinedload
-            response += f"👤 Менеджер: {order.manager.username if order.manager else 'Неизвестно'}\n"
-            response += f"Статус: {order.status.value}\n"
-            response += f"Клиент: {order.customer_phone}\n"
-            response += f"Адрес: {order.delivery_address}\n"
-            # Добавляем дату отгрузки и способ оплаты
-            shipment_date_str = order.shipment_date.strftime('%d.%m.%Y') if order.shipment_date else 'Не указана'
-            payment_method_str = order.payment_method if order.payment_method else 'Не указан'
-            response += f"🗓 Дата отгрузки: {shipment_date_str}\n"
-            response += f"💳 Способ оплаты: {payment_method_str}\n"
-            response += f"🔧 Монтаж: {'Да' if order.installation_required else 'Нет'}\n"
-
-            # Продукция
-            response += "\n🎨 Продукция:\n"
-            if order.products:
-                 for item in order.products:
-                     # Changed formatting slightly to match handle_my_orders
-                     response += f"- {item.color} ({item.thickness} мм): {item.quantity} шт.\n"
-            else:
-                 response += "- нет\n"
-
-            # Стыки
-            response += "\n🔗 Стыки:\n"
-            if order.joints:
-                 for joint in order.joints:
-                     joint_type_str = joint.joint_type.name.capitalize() if joint.joint_type else "Неизвестно"
-                     # Changed formatting slightly
-                     response += f"- {joint_type_str} ({joint.joint_thickness} мм, {joint.joint_color}): {joint.joint_quantity} шт.\n"
-            else:
-                 response += "- нет\n"
-
-            # Клей
-            response += "\n🧴 Клей:\n"
-            glue_total = sum(g.quantity for g in order.glues) if order.glues else 0
-            if glue_total > 0:
-                response += f"- {glue_total} шт.\n"
-            else:
-                 response += "- нет\n"
+        await message.answer(
+            "🚚 Отметьте заказы в списке и нажмите «Отгрузить выбранные» "
+            "или отправьте «✅ Отгрузить заказ #номер».",
+            reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="◀️ Назад")]], resize_keyboard=True)
+        )
+        await message.answer(response, reply_markup=keyboard)
+        await state.set_state(WarehouseStates.confirming_shipment) # Set state for button handler
 
-            response += f"\n"
-            # Добавляем кнопку для подтверждения отгрузки
-            keyboard_buttons.append([KeyboardButton(text=f"✅ Отгрузить заказ #{order.id}")])
+        # Выбор сохраняется при листании; страница запоминается, чтобы перерисовать ее при выборе
+        await state.update_data(
+            batch_shipment_order_ids=order_ids,
+            batch_shipment_selected=[],
+            batch_shipment_page=[None, pagination.FORWARD]
+        )
 
-        # Добавляем кнопку "Назад"
-        keyboard_buttons.append([KeyboardButton(text="◀️ Назад")])
+    finally:
+        db.close()
 
-        reply_markup = ReplyKeyboardMarkup(
-            keyboard=keyboard_buttons,
-            resize_keyboard=True
+@router.callback_query(F.data.startswith("batch_ship:"))
+async def process_batch_shipment_callback(callback_query: CallbackQuery, state: FSMContext):
+    """Выбор заказов для пакетной отгрузки, листание списка и запуск отгрузки"""
+    # Проверка доступа отвечает на callback сообщением об отказе
+    if not await check_warehouse_access(callback_query):
+        return
+    
+    data = await state.get_data()
+    order_ids = data.get("batch_shipment_order_ids", [])
+    selected = set(data.get("batch_shipment_selected", []))
+    cursor, direction = data.get("batch_shipment_page", [None, pagination.FORWARD])
+    action = callback_query.data.split(":")
+    
+    if action[1] in ("toggle", "all", "page"):
+        if action[1] == "all":
+            selected |= set(order_ids)
+        elif action[1] == "toggle":
+            order_id = int(action[2])
+            selected ^= {order_id}
+        else:
+            cursor, direction = pagination.parse_page_callback(callback_query.data)
+        
+        db = next(get_db())
+        try:
+            response, keyboard, order_ids = render_active_orders_page(db, selected, cursor, direction)
+            if not response:
+                # Заказы на этой странице уже отгружены — показываем первую
+                cursor, direction = None, pagination.FORWARD
+                response, keyboard, order_ids = render_active_orders_page(db, selected)
+        finally:
+            db.close()
+        
+        await state.update_data(
+            batch_shipment_order_ids=order_ids,
+            batch_shipment_selected=sorted(selected),
+            batch_shipment_page=[cursor, direction]
         )
+        await callback_query.answer()
+        await pagination.edit_page(callback_query.message, response or "📦 Нет активных заказов для отгрузки.", keyboard)
+        return
+    
+    if not selected:
+        await callback_query.answer("Не выбрано ни одного заказа.", show_alert=True)
+        return
+    
+    await callback_query.answer("Отгружаем выбранные заказы...")
+    await state.update_data(batch_shipment_order_ids=[], batch_shipment_selected=[])
+    await callback_query.message.edit_reply_markup(reply_markup=None)
+    await ship_orders_batch(callback_query.message, callback_query.from_user.id, sorted(selected))
+    await state.set_state(MenuState.WAREHOUSE_MAIN)
 
-        await message.answer(response, reply_markup=reply_markup)
-        await state.set_state(WarehouseStates.confirming_shipment) # Set state for button handler
+async def ship_orders_batch(message: Message, telegram_id: int, order_ids):
+    """Отгружает несколько заказов одной транзакцией и присылает сводку одним сообщением.
 
+    Остатки списываются одним UPDATE на таблицу по суммам позиций всех заказов,
+    записи о выполнении и их позиции вставляются пакетно.
+    """
+    def ship(db):
+        warehouse_user = db.query(User).filter(User.telegram_id == telegram_id).first()
+        if not warehouse_user:
+            raise ValueError("пользователь склада не найден")
+        
+        # Блокируем заказы в порядке id, чтобы они не были отгружены параллельно
+        locked_ids = stock.lock_orders(db, order_ids)
+        orders = db.query(Order).filter(
+            Order.id.in_(locked_ids),
+            Order.status.in_([OrderStatus.NEW, OrderStatus.IN_PROGRESS])
+        ).options(
+            selectinload(Order.products),
+            selectinload(Order.joints),
+            selectinload(Order.glues)
+        ).order_by(Order.created_at, Order.id).all()
+        skipped = sorted(set(order_ids) - {order.id for order in orders})
+        
+        shipped_ids, rejected = stock.ship_orders(db, orders)
+        # Выполнение — смена статуса и строка метаданных, позиции заказов остаются на месте
+        stock.complete_orders(db, shipped_ids, warehouse_user.id)
+        return shipped_ids, rejected, skipped
+    
+    db = next(get_db())
+    try:
+        shipped_ids, rejected, skipped = await stock.run_with_retry(db, ship)
+    except Exception as e:
+        db.rollback()
+        logging.error(f"Ошибка пакетной отгрузки заказов {order_ids}: {e}", exc_info=True)
+        await message.answer(
+            f"❌ Произошла ошибка при пакетной отгрузке: {e}",
+            reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
+        )
+        return
     finally:
         db.close()
+    
+    logging.info(f"Пакетная отгрузка: отгружены {shipped_ids}, отклонены {list(rejected)}, пропущены {skipped}")
+    lines = ["🚚 Результаты пакетной отгрузки:\n"]
+    if shipped_ids:
+        lines.append("✅ Отгружены: " + ", ".join(f"#{order_id}" for order_id in shipped_ids))
+    for order_id, shortages in rejected.items():
+        lines.append(f"\n❌ Заказ #{order_id} не отгружен, не хватает:\n" + "\n".join(shortages))
+    if skipped:
+        lines.append("\n⚠️ Не найдены или уже отгружены: " + ", ".join(f"#{order_id}" for order_id in skipped))
+    await message.answer("\n".join(lines), reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN))
 
 @router.message(F.text == "📦 Мои заказы")
 async def handle_orders(message: Message, state: FSMContext):
@@ -258,6 +392,12 @@ async def handle_stock(message: Message, state: FSMContext):
         reply_markup=keyboard
     )
 
+def format_stock(on_hand: int, reserved: int) -> str:
+    """Остаток позиции: на складе и, если есть резерв заказов, сколько из него свободно."""
+    if reserved:
+        return f"{on_hand} шт. (в резерве {reserved}, доступно {on_hand - reserved})"
+    return f"{on_hand} шт."
+
 @router.message(F.text == "📊 Все остатки")
 async def handle_all_stock(message: Message, state: FSMContext):
     """Показывает все остатки на складе"""
@@ -273,6 +413,12 @@ async def handle_all_stock(message: Message, state: FSMContext):
         panels = db.query(Panel).all()
         joints = db.query(Joint).all()
         glue = db.query(Glue).first()
+        # Бронь не списывает остаток, а резервирует его — показываем и резерв
+        reserved = stock.reserved_quantities(db, [
+            *((stock.SKU_FINISHED_PRODUCT, product.id) for product in finished_products),
+            *((stock.SKU_JOINT, joint.id) for joint in joints),
+            *([(stock.SKU_GLUE, glue.id)] if glue else []),
+        ])
         
         response = "📦 Все остатки на складе:\n\n"
         
@@ -280,7 +426,8 @@ async def handle_all_stock(message: Message, state: FSMContext):
         if finished_products:
             for product in finished_products:
                  if product.quantity > 0:
-                    response += f"- {product.film.code} ({product.thickness} мм): {product.quantity} шт.\n"
+                    response += f"- {product.film.code} ({product.thickness} мм): " \
+                                f"{format_stock(product.quantity, reserved.get((stock.SKU_FINISHED_PRODUCT, product.id), 0))}\n"
         if not any(p.quantity > 0 for p in finished_products):
              response += "- Нет\n"
             
@@ -304,13 +451,14 @@ async def handle_all_stock(message: Message, state: FSMContext):
         if joints:
             for j in joints:
                  if j.quantity > 0:
-                    response += f"- {j.type.name.capitalize()} ({j.thickness} мм, {j.color}): {j.quantity} шт.\n"
+                    response += f"- {j.type.name.capitalize()} ({j.thickness} мм, {j.color}): " \
+                                f"{format_stock(j.quantity, reserved.get((stock.SKU_JOINT, j.id), 0))}\n"
         if not any(j.quantity > 0 for j in joints):
              response += "- Нет\n"
             
         response += "\n🧪 Клей:\n"
         if glue and glue.quantity > 0:
-            response += f"- {glue.quantity} шт.\n"
+            response += f"- {format_stock(glue.quantity, reserved.get((stock.SKU_GLUE, glue.id), 0))}\n"
         else:
             response += "- Нет\n"
             
@@ -326,10 +474,12 @@ async def handle_finished_products(message: Message, state: FSMContext):
     db = next(get_db())
     try:
         finished_products = db.query(FinishedProduct).join(Film).filter(FinishedProduct.quantity > 0).all()
+        reserved = stock.reserved_quantities(db, [(stock.SKU_FINISHED_PRODUCT, product.id) for product in finished_products])
         response = "✅ Готовая продукция на складе:\n\n"
         if finished_products:
             for product in finished_products:
-                response += f"- {product.film.code} (толщина {product.thickness} мм): {product.quantity} шт.\n"
+                response += f"- {product.film.code} (толщина {product.thickness} мм): " \
+                            f"{format_stock(product.quantity, reserved.get((stock.SKU_FINISHED_PRODUCT, product.id), 0))}\n"
         else:
             response += "Нет в наличии\n"
         keyboard = get_menu_keyboard(MenuState.INVENTORY_FINISHED_PRODUCTS)
@@ -383,10 +533,12 @@ async def handle_joints(message: Message, state: FSMContext):
     db = next(get_db())
     try:
         joints = db.query(Joint).filter(Joint.quantity > 0).all()
+        reserved = stock.reserved_quantities(db, [(stock.SKU_JOINT, joint.id) for joint in joints])
         response = "🔄 Стыки на складе:\n\n"
         if joints:
             for joint in joints:
-                response += f"- {joint.type.name.capitalize()} ({joint.thickness} мм, {joint.color}): {joint.quantity} шт.\n"
+                response += f"- {joint.type.name.capitalize()} ({joint.thickness} мм, {joint.color}): " \
+                            f"{format_stock(joint.quantity, reserved.get((stock.SKU_JOINT, joint.id), 0))}\n"
         else:
             response += "Нет в наличии\n"
         keyboard = get_menu_keyboard(MenuState.INVENTORY_JOINTS)
@@ -404,7 +556,8 @@ async def handle_glue(message: Message, state: FSMContext):
         glue = db.query(Glue).filter(Glue.quantity > 0).first()
         response = "🧪 Клей на складе:\n\n"
         if glue:
-            response += f"Количество: {glue.quantity} шт.\n"
+            reserved = stock.reserved_quantities(db, [(stock.SKU_GLUE, glue.id)])
+            response += f"Количество: {format_stock(glue.quantity, reserved.get((stock.SKU_GLUE, glue.id), 0))}\n"
         else:
             response += "Нет в наличии\n"
         keyboard = get_menu_keyboard(MenuState.INVENTORY_GLUE)
@@ -423,8 +576,15 @@ async def confirm_shipment(message: Message, state: FSMContext):
         await message.answer("Некорректный формат команды.")
         return
         
-    db = next(get_db())
-    try:
+    def ship(db):
+        """Отгружает заказ; возвращает текст ошибки или None. Повторяется целиком при конфликте блокировок."""
+        # Блокируем заказ, чтобы его не отгрузили дважды параллельно
+        stock.lock_order(db, order_id)
+        # Повторное нажатие кнопки отгрузки не отгружает заказ второй раз
+        idempotency_key = idempotency.make_key(idempotency.SCOPE_SHIPMENT, message.chat.id, {"order_id": order_id})
+        if idempotency.claim(db, idempotency.SCOPE_SHIPMENT, idempotency_key) is not None:
+            db.rollback()
+            return f"ℹ️ Заказ #{order_id} уже отгружен."
         # Находим заказ для отгрузки
         order = db.query(Order).filter(
             Order.id == order_id,
@@ -432,189 +592,93 @@ async def confirm_shipment(message: Message, state: FSMContext):
         ).options(
             joinedload(Order.products),
             joinedload(Order.joints),
-            joinedload(Order.glues),
-            joinedload(Order.manager) # Загружаем менеджера
+            joinedload(Order.glues)
         ).first()
-        
         if not order:
-            await message.answer(f"Заказ #{order_id} не найден или уже отгружен.")
-            return
+            db.rollback()
+            return f"Заказ #{order_id} не найден или уже отгружен."
             
         # Получаем пользователя-складовщика
         warehouse_user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
         if not warehouse_user:
-            await message.answer("Ошибка: пользователь склада не найден.")
-            return
+            db.rollback()
+            return "Ошибка: пользователь склада не найден."
             
-        # Проверяем наличие всех компонентов
-        # 1. Продукция
-        insufficient_items = []
-        for item in order.products:
-            finished_product = db.query(FinishedProduct).join(Film).filter(
-                Film.code == item.color,
-                FinishedProduct.thickness == item.thickness
-            ).first()
-            if not finished_product or finished_product.quantity < item.quantity:
-                available = finished_product.quantity if finished_product else 0
-                insufficient_items.append(f"- {item.color} ({item.thickness} мм): нужно {item.quantity}, доступно {available}")
-        
-        # 2. Стыки
-        for joint_item in order.joints:
-            joint = db.query(Joint).filter(
-                Joint.type == joint_item.joint_type,
-                Joint.thickness == joint_item.joint_thickness,
-                Joint.color == joint_item.joint_color
-            ).first()
-            if not joint or joint.quantity < joint_item.joint_quantity:
-                available = joint.quantity if joint else 0
-                insufficient_items.append(f"- Стык {joint_item.joint_type.name.capitalize()} ({joint_item.joint_thickness} мм, {joint_item.joint_color}): нужно {joint_item.joint_quantity}, доступно {available}")
-                
-        # 3. Клей
-        for glue_item in order.glues:
-            glue = db.query(Glue).first()
-            if not glue or glue.quantity < glue_item.quantity:
-                available = glue.quantity if glue else 0
-                insufficient_items.append(f"- Клей: нужно {glue_item.quantity}, доступно {available}")
-                
-        # Если чего-то не хватает
+        # Списываем позиции заказа пакетно; при нехватке ничего не меняется
+        insufficient_items = stock.ship_order(db, order)
         if insufficient_items:
-            await message.answer(
+            db.rollback()
+            return (
                 f"❌ Невозможно отгрузить заказ #{order_id}. Не хватает следующих позиций:\n"
-                + "\n".join(insufficient_items),
-                reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN) # Возвращаем в главное меню склада
-            )
-            await state.set_state(MenuState.WAREHOUSE_MAIN)
-            return
-            
-        # Если всего хватает, списываем со склада и переносим в completed_orders
-        # 1. Списываем продукцию
-        for item in order.products:
-            finished_product = db.query(FinishedProduct).join(Film).filter(
-                Film.code == item.color,
-                FinishedProduct.thickness == item.thickness
-            ).first()
-            finished_product.quantity -= item.quantity
-            
-        # 2. Списываем стыки
-        for joint_item in order.joints:
-            joint = db.query(Joint).filter(
-                Joint.type == joint_item.joint_type,
-                Joint.thickness == joint_item.joint_thickness,
-                Joint.color == joint_item.joint_color
-            ).first()
-            joint.quantity -= joint_item.joint_quantity
-            
-        # 3. Списываем клей
-        for glue_item in order.glues:
-            glue = db.query(Glue).first()
-            glue.quantity -= glue_item.quantity
-            
-        # Создаем запись в completed_orders, копируя новые поля
-        completed_order = CompletedOrder(
-            order_id=order.id,
-            manager_id=order.manager_id,
-            warehouse_user_id=warehouse_user.id,
-            installation_required=order.installation_required,
-            customer_phone=order.customer_phone,
-            delivery_address=order.delivery_address,
-            shipment_date=order.shipment_date, # Копируем дату отгрузки
-            payment_method=order.payment_method, # Копируем способ оплаты
-            completed_at=datetime.utcnow()
-        )
-        db.add(completed_order)
-        db.flush() # Получаем ID для completed_order
-        
-        # Копируем связанные объекты (items, joints, glues)
-        for item in order.products:
-            comp_item = CompletedOrderItem(
-                order_id=completed_order.id,
-                quantity=item.quantity,
-                color=item.color,
-                thickness=item.thickness
-            )
-            db.add(comp_item)
-            
-        for joint_item in order.joints:
-            comp_joint = CompletedOrderJoint(
-                order_id=completed_order.id,
-                joint_type=joint_item.joint_type,
-                joint_color=joint_item.joint_color,
-                quantity=joint_item.joint_quantity,
-                joint_thickness=joint_item.joint_thickness
-            )
-            db.add(comp_joint)
-            
-        for glue_item in order.glues:
-            comp_glue = CompletedOrderGlue(
-                order_id=completed_order.id,
-                quantity=glue_item.quantity
+                + "\n".join(insufficient_items)
             )
-            db.add(comp_glue)
             
-        # Удаляем исходный заказ из таблицы orders
-        db.delete(order)
-        
-        db.commit()
-        
-        await message.answer(
-            f"✅ Заказ #{order_id} успешно отгружен и перемещен в завершенные.",
-            reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
-        )
-        
-        # Переводим обратно в главное меню склада
-        await state.set_state(MenuState.WAREHOUSE_MAIN)
-        
+        # Отмечаем заказ выполненным: статус COMPLETED и строка order_completions
+        stock.complete_orders(db, [order.id], warehouse_user.id)
+        idempotency.bind(db, idempotency_key, order.id)
+        return None
+    
+    # Блокировка заказа снимается коммитом или откатом внутри run_with_retry — до ответа пользователю
+    db = next(get_db())
+    try:
+        error_text = await stock.run_with_retry(db, ship)
     except Exception as e:
         db.rollback()
         logging.error(f"Ошибка при отгрузке заказа #{order_id}: {e}", exc_info=True)
         await message.answer(f"Произошла ошибка при отгрузке заказа: {e}")
+        return
     finally:
         db.close()
+    
+    await message.answer(
+        error_text or f"✅ Заказ #{order_id} успешно отгружен и отмечен как выполненный.",
+        reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
+    )
+    # Переводим обратно в главное меню склада
+    await state.set_state(MenuState.WAREHOUSE_MAIN)
+
+def render_completed_orders_page(db, cursor=None, direction=pagination.FORWARD):
+    """Текст и inline-клавиатура страницы завершенных заказов (None, если страница пуста)"""
+    query = db.query(CompletedOrder).options(
+        joinedload(CompletedOrder.manager)
+    )
+    page = pagination.fetch_page(query, CompletedOrder.completed_at, CompletedOrder.id, cursor, direction)
+    if not page.rows:
+        return None, None
+
+    response = "✅ Завершенные заказы:\n\n"
+    for order in page.rows:
+        response += f"Заказ #{order.id} — {order.completed_at.strftime('%Y-%m-%d %H:%M')}, статус: {order.status}\n"
+
+    keyboard = pagination.page_keyboard(
+        "whc", page,
+        lambda order: InlineKeyboardButton(text=f"Заказ #{order.id}", callback_data=f"whc:open:{order.id}")
+    )
+    return response, keyboard
 
 @router.message(F.text == "✅ Завершенные заказы")
 async def handle_completed_orders(message: Message, state: FSMContext):
-    """Отображает список завершенных заказов и предлагает ввести ID для деталей."""
+    """Отображает первую страницу завершенных заказов и предлагает ввести ID для деталей."""
     if not await check_warehouse_access(message):
         return
     
     await state.set_state(MenuState.WAREHOUSE_COMPLETED_ORDERS)
     db = next(get_db())
     try:
-        # Получаем последние 20 завершенных заказов
-        completed_orders = db.query(CompletedOrder).options(
-            # Eager load related data if needed for the list view, otherwise remove
-            # joinedload(CompletedOrder.items), 
-            # joinedload(CompletedOrder.joints),
-            # joinedload(CompletedOrder.glues),
-            joinedload(CompletedOrder.manager),
-            joinedload(CompletedOrder.warehouse_user)
-        ).order_by(desc(CompletedOrder.completed_at)).limit(20).all()
-        
-        if not completed_orders:
+        response, keyboard = render_completed_orders_page(db)
+        if not response:
             await message.answer(
                 "Нет завершенных заказов.",
                 reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_COMPLETED_ORDERS)
             )
             return
-            
-        response = "✅ Завершенные заказы (последние 20):\n\n"
-        for order in completed_orders:
-            response += f"---\n"
-            response += f"Заказ #{order.order_id} (Завершен ID: {order.id})\n"
-            response += f"Дата завершения: {order.completed_at.strftime('%Y-%m-%d %H:%M')}\n"
-            response += f"Статус: {order.status}\n"
-            # Removed the prompt to enter ID here as the next handler handles it
         
-        response += f"\nВведите ID завершенного заказа (из поля 'Завершен ID: ...') для просмотра деталей и опций.\n" 
-        
-        # Ограничиваем длину сообщения, если оно слишком большое
-        if len(response) > 4000: # Telegram limit is 4096
-            response = response[:4000] + "\n... (список слишком длинный)"
-            
+        # Reply-клавиатура с кнопкой «Назад» и отдельное сообщение со страницей списка
         await message.answer(
-            response,
+            "Введите номер заказа или выберите его в списке ниже.",
             reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_COMPLETED_ORDERS)
         )
+        await message.answer(response, reply_markup=keyboard)
             
     except Exception as e:
         logging.error(f"Ошибка при получении завершенных заказов: {e}", exc_info=True)
@@ -625,6 +689,29 @@ async def handle_completed_orders(message: Message, state: FSMContext):
     finally:
         db.close()
 
+@router.callback_query(F.data.startswith("whc:"))
+async def process_completed_orders_callback(callback_query: CallbackQuery, state: FSMContext):
+    """Листание списка завершенных заказов и открытие заказа из списка"""
+    if not await check_warehouse_access(callback_query):
+        return
+    
+    if callback_query.data.startswith("whc:open:"):
+        await callback_query.answer()
+        await show_completed_order(callback_query.message, state, int(callback_query.data.split(":")[2]))
+        return
+    
+    cursor, direction = pagination.parse_page_callback(callback_query.data)
+    db = next(get_db())
+    try:
+        response, keyboard = render_completed_orders_page(db, cursor, direction)
+        if not response:
+            # Список изменился так, что страница опустела — показываем первую
+            response, keyboard = render_completed_orders_page(db)
+        await callback_query.answer()
+        await pagination.edit_page(callback_query.message, response or "Нет завершенных заказов.", keyboard)
+    finally:
+        db.close()
+
 @router.message(StateFilter(MenuState.WAREHOUSE_COMPLETED_ORDERS), F.text.regexp(r'^\d+$'))
 async def view_completed_order(message: Message, state: FSMContext):
     """Отображает детали одного завершенного заказа и кнопку запроса на возврат."""
@@ -637,6 +724,10 @@ async def view_completed_order(message: Message, state: FSMContext):
         await message.answer("Пожалуйста, введите корректный числовой ID.", reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_COMPLETED_ORDERS))
         return
 
+    await show_completed_order(message, state, completed_order_id)
+
+async def show_completed_order(message: Message, state: FSMContext, completed_order_id: int):
+    """Отправляет детали завершенного заказа с кнопкой запроса на возврат"""
     db = next(get_db())
     try:
         order = db.query(CompletedOrder).options(
@@ -652,7 +743,7 @@ async def view_completed_order(message: Message, state: FSMContext):
             return
 
         # Format order details
-        response = f"Детали завершенного заказа ID: {order.id} (Исходный: #{order.order_id})\n"
+        response = f"Детали завершенного заказа #{order.id}\n"
         response += f"Статус: {order.status}\n"
         response += f"Дата завершения: {order.completed_at.strftime('%Y-%m-%d %H:%M')}\n"
         response += f"Клиент: {order.customer_phone}\n"
@@ -688,7 +779,7 @@ async def view_completed_order(message: Message, state: FSMContext):
 
         # Create inline keyboard
         keyboard_buttons = []
-        if order.status == CompletedOrderStatus.COMPLETED.value:
+        if order.status in RETURNABLE_COMPLETED_STATUSES:
              keyboard_buttons.append([
                  InlineKeyboardButton(text="♻️ Запрос на возврат", callback_data=f"request_return:{order.id}")
              ])
@@ -733,19 +824,20 @@ async def process_return_request(callback_query: CallbackQuery, state: FSMContex
                  logging.error(f"Failed to edit message on order not found: {edit_err}")
             return
 
-        if order.status != CompletedOrderStatus.COMPLETED.value:
+        if order.status not in RETURNABLE_COMPLETED_STATUSES:
             await callback_query.answer(f"Нельзя запросить возврат для заказа со статусом '{order.status}'.", show_alert=True)
             return
 
         # --- Start DB Transaction Logic ---
         try: # Inner try for the actual DB update + commit/rollback
+            previous_status = order.status
             order.status = CompletedOrderStatus.RETURN_REQUESTED.value
             db.commit()
             logging.info(f"User {user_id} requested return for completed order {completed_order_id}")
             
             await callback_query.answer("✅ Запрос на возврат создан.", show_alert=False)
             
-            new_text = message.text.replace(f"Статус: {CompletedOrderStatus.COMPLETED.value}", f"Статус: {CompletedOrderStatus.RETURN_REQUESTED.value}")
+            new_text = message.text.replace(f"Статус: {previous_status}", f"Статус: {CompletedOrderStatus.RETURN_REQUESTED.value}")
             await message.edit_text(new_text, reply_markup=None)
             
         except Exception as db_exc:
@@ -760,6 +852,13 @@ async def process_return_request(callback_query: CallbackQuery, state: FSMContex
     finally:
         db.close()
 
+# Регистрируется раньше общего handle_back, иначе «Назад» уходит в go_back
+@router.message(StateFilter(WarehouseStates.waiting_for_partial_return), F.text == "◀️ Назад")
+async def cancel_partial_return(message: Message, state: FSMContext):
+    """Возвращает из ввода частичного возврата к списку запросов на возврат"""
+    await state.set_state(MenuState.WAREHOUSE_RETURN_REQUESTS)
+    await send_return_requests(message, state, message.from_user.id)
+
 @router.message(F.text == "◀️ Назад")
 async def handle_back(message: Message, state: FSMContext):
     db = next(get_db())
@@ -796,367 +895,86 @@ async def confirm_specific_order(message: Message, state: FSMContext):
 
 async def process_order_shipment(message: Message, order_id: int):
     """Обрабатывает отгрузку заказа"""
-    db = next(get_db())
-    try:
+    def ship(db):
+        """Отгружает заказ; возвращает (текст ошибки или None, telegram_id менеджера заказа)."""
+        # Блокируем заказ, чтобы его не отгрузили дважды параллельно
+        stock.lock_order(db, order_id)
+        # Повторное нажатие кнопки отгрузки не отгружает заказ второй раз
+        idempotency_key = idempotency.make_key(idempotency.SCOPE_SHIPMENT, message.chat.id, {"order_id": order_id})
+        if idempotency.claim(db, idempotency.SCOPE_SHIPMENT, idempotency_key) is not None:
+            db.rollback()
+            return f"ℹ️ Заказ #{order_id} уже отгружен.", None
         # Получаем заказ по ID
-        order = db.query(Order).filter(Order.id == order_id).first()
+        order = db.query(Order).filter(Order.id == order_id).options(
+            joinedload(Order.products),
+            joinedload(Order.joints),
+            joinedload(Order.glues)
+        ).first()
         if not order:
-            await message.answer(
-                f"❌ Заказ #{order_id} не найден.",
-                reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
-            )
-            return
+            db.rollback()
+            return f"❌ Заказ #{order_id} не найден.", None
             
         # Проверяем статус заказа
-        if order.status == OrderStatus.COMPLETED.value:
-            await message.answer(
-                f"❌ Заказ #{order_id} уже выполнен.",
-                reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
-            )
-            return
+        if order.status == OrderStatus.COMPLETED:
+            db.rollback()
+            return f"❌ Заказ #{order_id} уже выполнен.", None
         
         # Получаем пользователя склада
         warehouse_user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
         if not warehouse_user:
-            await message.answer(
-                "❌ Ваша учетная запись не найдена. Обратитесь к администратору.",
-                reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
-            )
-            return
-        
-        try:
-            # Подготавливаем данные для CompletedOrder с учетом обязательных полей
-            completed_order_data = {
-                'order_id': order.id,
-                'manager_id': order.manager_id,
-                'warehouse_user_id': warehouse_user.id,
-                'installation_required': getattr(order, 'installation_required', False),
-                'customer_phone': getattr(order, 'customer_phone', "") or "Не указан",
-                'delivery_address': getattr(order, 'delivery_address', "") or "Не указан"
-            }
-            
-            # Обходим все поля CompletedOrder для проверки
-            valid_fields = {}
-            for column in CompletedOrder.__table__.columns:
-                valid_fields[column.name] = True
-            
-            # Удаляем неверные поля, если они были добавлены по ошибке
-            for field in list(completed_order_data.keys()):
-                if field not in valid_fields:
-                    logging.warning(f"Удаляем недопустимое поле {field} из данных CompletedOrder")
-                    del completed_order_data[field]
-            
-            # Проверяем, что все обязательные поля включены
-            for column in CompletedOrder.__table__.columns:
-                if not column.nullable and column.name not in ['id', 'completed_at'] and column.name not in completed_order_data and not column.default:
-                    if column.name == 'customer_phone':
-                        completed_order_data[column.name] = "Не указан"
-                    elif column.name == 'delivery_address':
-                        completed_order_data[column.name] = "Не указан"
-                    else:
-                        logging.warning(f"Добавляем пустое значение для обязательного поля {column.name}")
-                        completed_order_data[column.name] = None
-            
-            # Создаем запись о выполненном заказе
-            logging.info(f"Создаем CompletedOrder с данными: {completed_order_data}")
-            completed_order = CompletedOrder(**completed_order_data)
-            db.add(completed_order)
-            db.flush()  # Получаем ID созданного заказа
-            
-            # Добавляем информацию о продуктах в выполненный заказ
-            if hasattr(order, 'products') and order.products:
-                for product in order.products:
-                    try:
-                        # Определяем необходимые атрибуты для CompletedOrderItem
-                        item_data = {
-                            'order_id': completed_order.id,
-                            'quantity': getattr(product, 'quantity', 0),
-                            'color': getattr(product, 'color', "Неизвестно"),
-                            'thickness': getattr(product, 'thickness', 0.5)
-                        }
-                        
-                        # Вместо поиска по film_id, ищем Film по коду пленки (color) и затем FinishedProduct
-                        color = getattr(product, 'color', None)
-                        thickness = getattr(product, 'thickness', 0.5)
-                        
-                        if color and item_data['quantity'] > 0:
-                            # Создаем запись о выполненном товаре
-                            completed_item = CompletedOrderItem(**item_data)
-                            db.add(completed_item)
-                            logging.info(f"Добавлен товар в completed_order_items: {item_data}")
-                            
-                            # Ищем пленку по коду
-                            film = db.query(Film).filter(Film.code == color).first()
-                            if film:
-                                # Ищем готовую продукцию по film_id и толщине
-                                finished_product = db.query(FinishedProduct).filter(
-                                    FinishedProduct.film_id == film.id,
-                                    FinishedProduct.thickness == thickness
-                                ).first()
-                                
-                                if finished_product:
-                                    old_quantity = finished_product.quantity
-                                    new_quantity = old_quantity - item_data['quantity']
-                                    logging.info(f"Списываем продукцию со склада: film_code={color}, film_id={film.id}, thickness={thickness}, было={old_quantity}, станет={new_quantity}")
-                                    
-                                    finished_product.quantity = new_quantity
-                                    db.flush()  # Фиксируем изменения в памяти
-                                    
-                                    # Проверяем, что изменения применились
-                                    updated_product = db.query(FinishedProduct).filter(
-                                        FinishedProduct.film_id == film.id,
-                                        FinishedProduct.thickness == thickness
-                                    ).first()
-                                    
-                                    if updated_product and updated_product.quantity == new_quantity:
-                                        logging.info(f"Успешно списана продукция. Новое количество в базе: {updated_product.quantity}")
-                                    else:
-                                        logging.error(f"Ошибка списания продукции! Текущее количество в базе: {updated_product.quantity if updated_product else 'не найдено'}")
-                                else:
-                                    logging.error(f"Готовая продукция не найдена для film_id={film.id}, thickness={thickness}")
-                            else:
-                                logging.error(f"Пленка с кодом {color} не найдена")
-                    except Exception as e:
-                        logging.error(f"Ошибка при добавлении продукта в выполненный заказ: {str(e)}")
-            else:
-                # Для поддержки старой структуры
-                try:
-                    if hasattr(order, 'film_code') and order.film_code:
-                        # Находим пленку по коду
-                        film = db.query(Film).filter(Film.code == order.film_code).first()
-                        
-                        # Создаем запись о выполненном товаре
-                        item_data = {
-                            'order_id': completed_order.id,
-                            'color': order.film_code,
-                            'thickness': getattr(order, 'panel_thickness', 0.5),
-                            'quantity': getattr(order, 'panel_quantity', 0)
-                        }
-                        
-                        completed_item = CompletedOrderItem(**item_data)
-                        db.add(completed_item)
-                        logging.info(f"Добавлен товар из старой структуры в completed_order_items: {item_data}")
-                        
-                        # Списываем со склада
-                        if film:
-                            finished_product = db.query(FinishedProduct).filter(
-                                FinishedProduct.film_id == film.id,
-                                FinishedProduct.thickness == item_data['thickness']
-                            ).first()
-                            
-                            if finished_product:
-                                old_quantity = finished_product.quantity
-                                new_quantity = old_quantity - item_data['quantity']
-                                logging.info(f"Списываем продукцию из старой структуры: film_id={film.id}, thickness={item_data['thickness']}, было={old_quantity}, станет={new_quantity}")
-                                
-                                finished_product.quantity = new_quantity
-                                db.flush()
-                                
-                                # Проверяем, что изменения применились
-                                updated_product = db.query(FinishedProduct).filter(
-                                    FinishedProduct.film_id == film.id,
-                                    FinishedProduct.thickness == item_data['thickness']
-                                ).first()
-                                
-                                if updated_product and updated_product.quantity == new_quantity:
-                                    logging.info(f"Успешно списана продукция из старой структуры. Новое количество в базе: {updated_product.quantity}")
-                                else:
-                                    logging.error(f"Ошибка списания продукции из старой структуры! Текущее количество в базе: {updated_product.quantity if updated_product else 'не найдено'}")
-                            else:
-                                logging.error(f"Готовая продукция не найдена для film_id={film.id}, thickness={item_data['thickness']}")
-                        else:
-                            logging.error(f"Пленка с кодом {order.film_code} не найдена")
-                except Exception as e:
-                    logging.error(f"Ошибка при добавлении продукта из старой структуры: {str(e)}")
-            
-            # Добавляем информацию о стыках в выполненный заказ
-            if hasattr(order, 'joints') and order.joints:
-                for joint_item in order.joints:
-                    try:
-                        joint_type = getattr(joint_item, 'joint_type', None)
-                        joint_color = getattr(joint_item, 'joint_color', None)
-                        thickness = getattr(joint_item, 'joint_thickness', 0.5)
-                        quantity = getattr(joint_item, 'quantity', getattr(joint_item, 'joint_quantity', 0))
-                        
-                        if joint_type and joint_color and quantity > 0:
-                            # Создаем запись о выполненном стыке
-                            joint_data = {
-                                'order_id': completed_order.id,
-                                'joint_type': joint_type,
-                                'joint_color': joint_color,
-                                'quantity': quantity,
-                                'joint_thickness': thickness  # Используем правильное имя поля
-                            }
-                            
-                            completed_joint = CompletedOrderJoint(**joint_data)
-                            db.add(completed_joint)
-                            logging.info(f"Добавлен стык в completed_order_joints: {joint_data}")
-                            
-                            # Списываем со склада
-                            joint_db = db.query(Joint).filter(
-                                Joint.type == joint_type,
-                                Joint.color == joint_color,
-                                Joint.thickness == thickness
-                            ).first()
-                            
-                            if joint_db:
-                                old_quantity = joint_db.quantity
-                                new_quantity = old_quantity - quantity
-                                logging.info(f"Списываем стык со склада: type={joint_type}, color={joint_color}, thickness={thickness}, было={old_quantity}, станет={new_quantity}")
-                                
-                                joint_db.quantity = new_quantity
-                                db.flush()
-                                
-                                # Проверяем, что изменения применились
-                                updated_joint = db.query(Joint).filter(
-                                    Joint.type == joint_type,
-                                    Joint.color == joint_color,
-                                    Joint.thickness == thickness
-                                ).first()
-                                
-                                if updated_joint and updated_joint.quantity == new_quantity:
-                                    logging.info(f"Успешно списан стык. Новое количество в базе: {updated_joint.quantity}")
-                                else:
-                                    logging.error(f"Ошибка списания стыка! Текущее количество в базе: {updated_joint.quantity if updated_joint else 'не найдено'}")
-                    except Exception as e:
-                        logging.error(f"Ошибка при добавлении стыка в выполненный заказ: {str(e)}")
-            else:
-                # Для поддержки старой структуры
-                try:
-                    # Получаем информацию о стыке из старой структуры
-                    joint_type = getattr(order, 'joint_type', None)
-                    joint_color = getattr(order, 'joint_color', None)
-                    joint_quantity = getattr(order, 'joint_quantity', 0)
-                    
-                    if joint_type and joint_color and joint_quantity > 0:
-                        # Создаем запись о выполненном стыке
-                        joint_data = {
-                            'order_id': completed_order.id,
-                            'joint_type': joint_type,
-                            'joint_color': joint_color,
-                            'quantity': joint_quantity,
-                            'joint_thickness': getattr(order, 'panel_thickness', 0.5)  # Используем правильное имя поля
-                        }
-                        
-                        completed_joint = CompletedOrderJoint(**joint_data)
-                        db.add(completed_joint)
-                        logging.info(f"Добавлен стык из старой структуры в completed_order_joints: {joint_data}")
-                        
-                        # Списываем со склада
-                        joint_thickness = getattr(order, 'panel_thickness', 0.5)
-                        joint_db = db.query(Joint).filter(
-                            Joint.type == joint_type,
-                            Joint.color == joint_color,
-                            Joint.thickness == joint_thickness
-                        ).first()
-                        
-                        if joint_db:
-                            old_quantity = joint_db.quantity
-                            new_quantity = old_quantity - joint_quantity
-                            logging.info(f"Списываем стык из старой структуры: type={joint_type}, color={joint_color}, thickness={joint_thickness}, было={old_quantity}, станет={new_quantity}")
-                            
-                            joint_db.quantity = new_quantity
-                            db.flush()
-                            
-                            # Проверяем, что изменения применились
-                            updated_joint = db.query(Joint).filter(
-                                Joint.type == joint_type,
-                                Joint.color == joint_color,
-                                Joint.thickness == joint_thickness
-                            ).first()
-                            
-                            if updated_joint and updated_joint.quantity == new_quantity:
-                                logging.info(f"Успешно списан стык из старой структуры. Новое количество в базе: {updated_joint.quantity}")
-                            else:
-                                logging.error(f"Ошибка списания стыка из старой структуры! Текущее количество в базе: {updated_joint.quantity if updated_joint else 'не найдено'}")
-                except Exception as e:
-                    logging.error(f"Ошибка при добавлении стыка из старой структуры: {str(e)}")
-            
-            # Добавляем информацию о клее в выполненный заказ
-            glue_quantity = 0
-            if hasattr(order, 'glues') and order.glues:
-                try:
-                    glue_quantity = sum(getattr(glue, 'quantity', 0) for glue in order.glues)
-                except Exception as e:
-                    logging.error(f"Ошибка при извлечении данных о клее: {str(e)}")
-            else:
-                # Если нет glues, пробуем получить атрибуты напрямую из заказа (старая структура)
-                glue_quantity = getattr(order, 'glue_quantity', 0)
-                
-            if glue_quantity > 0:
-                try:
-                    # Создаем запись о выполненном клее
-                    glue_data = {
-                        'order_id': completed_order.id,
-                        'quantity': glue_quantity
-                    }
-                    
-                    completed_glue = CompletedOrderGlue(**glue_data)
-                    db.add(completed_glue)
-                    logging.info(f"Добавлен клей в completed_order_glues: {glue_data}")
-                    
-                    # Списываем клей со склада
-                    glue = db.query(Glue).first()
-                    if glue:
-                        old_quantity = glue.quantity
-                        new_quantity = old_quantity - glue_quantity
-                        logging.info(f"Списываем клей со склада: было={old_quantity}, станет={new_quantity}")
-                        
-                        glue.quantity = new_quantity
-                        db.flush()
-                        
-                        # Проверяем, что изменения применились
-                        updated_glue = db.query(Glue).first()
-                        if updated_glue and updated_glue.quantity == new_quantity:
-                            logging.info(f"Успешно списан клей. Новое количество в базе: {updated_glue.quantity}")
-                        else:
-                            logging.error(f"Ошибка списания клея! Текущее количество в базе: {updated_glue.quantity if updated_glue else 'не найдено'}")
-                except Exception as e:
-                    logging.error(f"Ошибка при добавлении клея в выполненный заказ: {str(e)}")
-            
-            # Меняем статус заказа на выполненный
-            order.status = OrderStatus.COMPLETED.value
-            order.completed_at = datetime.utcnow()
-            
-            # Сохраняем изменения в базе данных
-            logging.info(f"Применяем все изменения в БД через commit для заказа #{order.id}")
-            db.commit()
-            logging.info(f"Изменения успешно сохранены в БД для заказа #{order.id}")
-            
-            # Отправляем сообщение менеджеру о выполнении заказа
-            manager = db.query(User).filter(User.id == order.manager_id).first()
-            if manager and manager.telegram_id:
-                try:
-                    await message.bot.send_message(
-                        manager.telegram_id,
-                        f"✅ Заказ #{order.id} выполнен и отправлен клиенту."
-                    )
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке уведомления менеджеру: {str(e)}")
-            
-            # Отправляем подтверждение складу
-            await message.answer(
-                f"✅ Заказ #{order.id} успешно обработан и отмечен как выполненный.",
-                reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
-            )
+            db.rollback()
+            return "❌ Ваша учетная запись не найдена. Обратитесь к администратору.", None
         
-        except Exception as e:
+        # Списываем позиции заказа пакетно и снимаем его резерв, если он был
+        shortages = stock.ship_order(db, order)
+        if shortages:
             db.rollback()
-            logging.error(f"Ошибка при создании CompletedOrder: {str(e)}")
-            await message.answer(
-                f"❌ Произошла ошибка при обработке заказа: {str(e)}",
-                reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
-            )
-            return
+            return (
+                f"❌ Невозможно отгрузить заказ #{order_id}. Не хватает следующих позиций:\n"
+                + "\n".join(shortages)
+            ), None
         
+        # Отмечаем заказ выполненным: статус COMPLETED и строка order_completions
+        stock.complete_orders(db, [order.id], warehouse_user.id)
+        idempotency.bind(db, idempotency_key, order.id)
+        manager_telegram_id = db.query(User.telegram_id).filter(User.id == order.manager_id).scalar()
+        return None, manager_telegram_id
+    
+    # Блокировка заказа снимается коммитом или откатом внутри run_with_retry — до ответа пользователю
+    db = next(get_db())
+    try:
+        error_text, manager_telegram_id = await stock.run_with_retry(db, ship)
     except Exception as e:
-        logging.error(f"Ошибка при подтверждении отгрузки заказа #{order_id}: {str(e)}")
+        db.rollback()
+        logging.error(f"Ошибка при отгрузке заказа #{order_id}: {str(e)}")
         await message.answer(
             f"❌ Произошла ошибка при обработке заказа: {str(e)}",
             reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
         )
+        return
     finally:
         db.close()
+    
+    if error_text:
+        await message.answer(error_text, reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN))
+        return
+    logging.info(f"Заказ #{order_id} отгружен")
+    
+    # Отправляем сообщение менеджеру о выполнении заказа
+    if manager_telegram_id:
+        try:
+            await message.bot.send_message(
+                manager_telegram_id,
+                f"✅ Заказ #{order_id} выполнен и отправлен клиенту."
+            )
+        except Exception as e:
+            logging.error(f"Ошибка при отправке уведомления менеджеру: {str(e)}")
+    
+    # Отправляем подтверждение складу
+    await message.answer(
+        f"✅ Заказ #{order_id} успешно обработан и отмечен как выполненный.",
+        reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
+    )
 
 @router.message(F.text == "🔙 Назад в админку")
 async def handle_back_to_admin(message: Message, state: FSMContext):
@@ -1195,28 +1013,55 @@ async def check_warehouse_access(message: Message) -> bool:
 
 # --- NEW HANDLERS FOR RETURN PROCESSING ---
 
+def render_return_requests_page(db, cursor=None, direction=pagination.FORWARD):
+    """Текст и inline-клавиатура страницы запросов на возврат (None, если страница пуста)"""
+    query = db.query(CompletedOrder).filter(
+        CompletedOrder.status == CompletedOrderStatus.RETURN_REQUESTED.value
+    ).options(
+        joinedload(CompletedOrder.manager)
+    )
+    page = pagination.fetch_page(query, CompletedOrder.completed_at, CompletedOrder.id, cursor, direction)
+    if not page.rows:
+        return None, None
+
+    response = "♻️ Запросы на возврат:\n\n"
+    for req in page.rows:
+        response += f"---\n"
+        response += f"Запрос на возврат ID: {req.id} (Исходный заказ #{req.order_id})\n"
+        response += f"Дата запроса (примерно): {req.updated_at.strftime('%Y-%m-%d %H:%M') if req.updated_at else 'Неизвестно'}\n"
+        response += f"Менеджер: {req.manager.username if req.manager else 'N/A'}\n"
+
+    keyboard = pagination.page_keyboard(
+        "whr", page,
+        lambda req: InlineKeyboardButton(text=f"Запрос #{req.id}", callback_data=f"whr:open:{req.id}")
+    )
+    return response, keyboard
+
 @router.message(StateFilter(MenuState.WAREHOUSE_MAIN), F.text == "♻️ Запросы на возврат")
 async def handle_return_requests(message: Message, state: FSMContext):
     """Displays a list of orders awaiting return confirmation."""
     if not await check_warehouse_access(message):
         return
-        
+    
+    await send_return_requests(message, state, message.from_user.id)
+
+async def send_return_requests(message: Message, state: FSMContext, telegram_id: int):
+    """Отправляет первую страницу запросов на возврат пользователю telegram_id.
+
+    Вызывается и из callback-обработчиков, где message — сообщение бота.
+    """
     # Получим роль пользователя для определения правильного состояния для возврата
     db = next(get_db())
     try:
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+        user = db.query(User).filter(User.telegram_id == telegram_id).first()
         user_role = user.role if user else UserRole.NONE
         return_menu_state = MenuState.WAREHOUSE_MAIN  # По умолчанию для склада
         
         # Установим текущее состояние на просмотр запросов
         await state.set_state(MenuState.WAREHOUSE_RETURN_REQUESTS)
         
-        # Запрашиваем запросы на возврат
-        return_requests = db.query(CompletedOrder).filter(
-            CompletedOrder.status == CompletedOrderStatus.RETURN_REQUESTED.value
-        ).options(
-            joinedload(CompletedOrder.manager)
-        ).order_by(desc(CompletedOrder.completed_at)).limit(30).all() # Limit to 30 requests
+        # Запрашиваем первую страницу запросов на возврат
+        response, keyboard = render_return_requests_page(db)
 
         # Определим состояние для возврата в зависимости от роли
         if user_role == UserRole.SALES_MANAGER:
@@ -1231,7 +1076,7 @@ async def handle_return_requests(message: Message, state: FSMContext):
             else:
                 return_menu_state = MenuState.SUPER_ADMIN_MAIN
 
-        if not return_requests:
+        if not response:
             # Если нет запросов, вернемся в соответствующее меню роли
             await message.answer(
                 "Нет активных запросов на возврат.",
@@ -1240,25 +1085,14 @@ async def handle_return_requests(message: Message, state: FSMContext):
             await state.set_state(return_menu_state)
             return
 
-        response = "♻️ Запросы на возврат (последние 30):\n\n"
-        for req in return_requests:
-            response += f"---\n"
-            response += f"Запрос на возврат ID: {req.id} (Исходный заказ #{req.order_id})\n"
-            response += f"Дата запроса (примерно): {req.updated_at.strftime('%Y-%m-%d %H:%M') if req.updated_at else 'Неизвестно'}\n"
-            response += f"Менеджер: {req.manager.username if req.manager else 'N/A'}\n"
-
-        response += f"\nВведите ID запроса на возврат для просмотра деталей и подтверждения/отклонения.\n"
-
-        if len(response) > 4000:
-            response = response[:4000] + "\n... (список слишком длинный)"
-
         # Сохраним состояние возврата для использования в последующих обработчиках
         await state.update_data(return_menu_state=return_menu_state)
 
         await message.answer(
-            response,
+            "Введите ID запроса на возврат или выберите его в списке ниже для подтверждения/отклонения.",
             reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_RETURN_REQUESTS) # Keyboard with Back button
         )
+        await message.answer(response, reply_markup=keyboard)
 
     except Exception as e:
         logging.error(f"Ошибка при получении запросов на возврат: {e}", exc_info=True)
@@ -1270,6 +1104,29 @@ async def handle_return_requests(message: Message, state: FSMContext):
     finally:
         db.close()
 
+@router.callback_query(F.data.startswith("whr:"))
+async def process_return_requests_callback(callback_query: CallbackQuery, state: FSMContext):
+    """Листание списка запросов на возврат и открытие запроса из списка"""
+    if not await check_warehouse_access(callback_query):
+        return
+    
+    if callback_query.data.startswith("whr:open:"):
+        await callback_query.answer()
+        await show_return_request(callback_query.message, state, int(callback_query.data.split(":")[2]))
+        return
+    
+    cursor, direction = pagination.parse_page_callback(callback_query.data)
+    db = next(get_db())
+    try:
+        response, keyboard = render_return_requests_page(db, cursor, direction)
+        if not response:
+            # Запросы на этой странице уже обработаны — показываем первую
+            response, keyboard = render_return_requests_page(db)
+        await callback_query.answer()
+        await pagination.edit_page(callback_query.message, response or "Нет активных запросов на возврат.", keyboard)
+    finally:
+        db.close()
+
 @router.message(StateFilter(MenuState.WAREHOUSE_RETURN_REQUESTS), F.text.regexp(r'^\d+$'))
 async def view_return_request_details(message: Message, state: FSMContext):
     """Displays details of a specific return request with confirmation buttons."""
@@ -1282,6 +1139,10 @@ async def view_return_request_details(message: Message, state: FSMContext):
         await message.answer("Пожалуйста, введите корректный числовой ID.", reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_RETURN_REQUESTS))
         return
 
+    await show_return_request(message, state, completed_order_id)
+
+async def show_return_request(message: Message, state: FSMContext, completed_order_id: int):
+    """Отправляет детали запроса на возврат с кнопками подтверждения"""
     db = next(get_db())
     try:
         order = db.query(CompletedOrder).options(
@@ -1313,30 +1174,18 @@ async def view_return_request_details(message: Message, state: FSMContext):
         response += f"Менеджер: {order.manager.username if order.manager else 'N/A'}\n"
         response += f"Склад (отгрузил): {order.warehouse_user.username if order.warehouse_user else 'N/A'}\n"
 
-        response += "\nВозвращаемая продукция:\n"
-        if order.items:
-            for item in order.items:
-                response += f"- {item.color} ({item.thickness} мм): {item.quantity} шт.\n"
-        else: response += "- нет\n"
-
-        response += "\nВозвращаемые стыки:\n"
-        if order.joints:
-            for joint in order.joints:
-                response += f"- {joint.joint_type.name.capitalize()} ({joint.joint_thickness} мм, {joint.joint_color}): {joint.quantity} шт.\n"
-        else: response += "- нет\n"
-
-        response += "\nВозвращаемый клей:\n"
-        if order.glues:
-            for glue_item in order.glues:
-                response += f"- {glue_item.quantity} шт.\n"
-        else: response += "- нет\n"
+        response += "\nПозиции к возврату:\n"
+        response += format_return_lines(order)
 
         # Create inline keyboard for confirmation/rejection
         keyboard_buttons = [
             InlineKeyboardButton(text="✅ Подтвердить возврат", callback_data=f"confirm_return:{order.id}"),
             InlineKeyboardButton(text="❌ Отклонить возврат", callback_data=f"reject_return:{order.id}")
         ]
-        inline_keyboard = InlineKeyboardMarkup(inline_keyboard=[keyboard_buttons])
+        inline_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            keyboard_buttons,
+            [InlineKeyboardButton(text="✏️ Частичный возврат", callback_data=f"partial_return:{order.id}")]
+        ])
 
         # Set state for potential further actions on this order
         await state.set_state(MenuState.VIEW_RETURN_REQUEST)
@@ -1352,16 +1201,49 @@ async def view_return_request_details(message: Message, state: FSMContext):
     finally:
         db.close()
 
-@router.callback_query(F.data.startswith("confirm_return:"))
-async def process_confirm_return(callback_query: CallbackQuery, state: FSMContext):
-    """Handles the confirmation of a return request."""
+def format_return_lines(order) -> str:
+    """Нумерованный список строк заказа с количеством, которое еще можно вернуть"""
+    text = ""
+    for number, (kind, line) in enumerate(stock.order_lines(order), start=1):
+        text += f"{number}. {stock.line_label(kind, line)}: {stock.returnable_quantity(line)} шт."
+        if line.returned_quantity:
+            text += f" (уже возвращено {line.returned_quantity})"
+        text += "\n"
+    return text or "- нет\n"
+
+def apply_return(db, order, warehouse_user, quantities=None):
+    """Возвращает позиции заказа на склад пакетно и обновляет статус возврата.
+
+    Без quantities возвращается весь еще не возвращенный остаток заказа.
+    """
+    stock_update_details, fully_returned = stock.return_order_lines(db, order, quantities)
+
+    order.status = CompletedOrderStatus.RETURNED.value if fully_returned else CompletedOrderStatus.PARTIALLY_RETURNED.value
+    order.updated_at = datetime.utcnow() # Explicitly update timestamp
+
+    operation_details = {
+        "completed_order_id": order.id,
+        "original_order_id": order.order_id,
+        "confirmed_by": warehouse_user.id,
+        "partial": not fully_returned,
+        "stock_updates": stock_update_details
+    }
+    db.add(Operation(
+        user_id=warehouse_user.id,
+        operation_type="order_return_confirmed",
+        quantity=1, # Represents one order return
+        details=json.dumps(operation_details)
+    ))
+    return stock_update_details
+
+@router.callback_query(F.data.startswith("partial_return:"))
+async def process_partial_return_request(callback_query: CallbackQuery, state: FSMContext):
+    """Запрашивает количества для частичного возврата"""
     completed_order_id = int(callback_query.data.split(":")[1])
-    user_id = callback_query.from_user.id
-    message = callback_query.message
 
     db = next(get_db())
     try:
-        warehouse_user = db.query(User).filter(User.telegram_id == user_id).first()
+        warehouse_user = db.query(User).filter(User.telegram_id == callback_query.from_user.id).first()
         if not warehouse_user or warehouse_user.role not in [UserRole.WAREHOUSE, UserRole.SUPER_ADMIN, UserRole.SALES_MANAGER]:
             await callback_query.answer("У вас нет прав для этого действия.", show_alert=True)
             return
@@ -1369,138 +1251,196 @@ async def process_confirm_return(callback_query: CallbackQuery, state: FSMContex
         order = db.query(CompletedOrder).options(
             selectinload(CompletedOrder.items),
             selectinload(CompletedOrder.joints),
-            selectinload(CompletedOrder.glues),
-            joinedload(CompletedOrder.manager) # Load manager for notification
+            selectinload(CompletedOrder.glues)
         ).filter(CompletedOrder.id == completed_order_id).first()
+        if not order or order.status != CompletedOrderStatus.RETURN_REQUESTED.value:
+            await callback_query.answer("Запрос на возврат не найден или уже обработан.", show_alert=True)
+            return
 
-        if not order:
-            await callback_query.answer("Запрос на возврат не найден.", show_alert=True)
-            return
+        await callback_query.answer()
+        await state.set_state(WarehouseStates.waiting_for_partial_return)
+        await state.update_data(partial_return_order_id=order.id)
+        await callback_query.message.answer(
+            f"✏️ Частичный возврат по заказу #{order.id}\n\n"
+            f"{format_return_lines(order)}\n"
+            f"Введите номера позиций и возвращаемое количество в формате «номер=количество» "
+            f"через запятую, например: 1=5, 3=2",
+            reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="◀️ Назад")]], resize_keyboard=True)
+        )
+    finally:
+        db.close()
 
-        if order.status != CompletedOrderStatus.RETURN_REQUESTED.value:
-            await callback_query.answer(f"Запрос уже обработан (статус: {order.status}).", show_alert=True)
-            return
+@router.message(WarehouseStates.waiting_for_partial_return)
+async def process_partial_return_quantities(message: Message, state: FSMContext):
+    """Проводит частичный возврат по введенным количествам"""
+    pairs = re.findall(r"(\d+)\s*=\s*(\d+)", message.text or "")
+    if not pairs:
+        await message.answer("Не удалось разобрать ввод. Используйте формат «номер=количество», например: 1=5, 3=2")
+        return
 
-        # --- Start DB Transaction --- Add items back to stock
-        try:
-            logging.info(f"Confirming return for CompletedOrder ID: {order.id}. User: {user_id}")
-            stock_update_details = []
+    data = await state.get_data()
+    completed_order_id = data.get("partial_return_order_id")
 
-            # 1. Return Finished Products
-            for item in order.items:
-                film = db.query(Film).filter(Film.code == item.color).first()
-                if film:
-                    finished_product = db.query(FinishedProduct).filter(
-                        FinishedProduct.film_id == film.id,
-                        FinishedProduct.thickness == item.thickness
-                    ).first()
-                    if finished_product:
-                        old_qty = finished_product.quantity
-                        finished_product.quantity += item.quantity
-                        stock_update_details.append(f"Продукт {item.color} ({item.thickness}мм): +{item.quantity} (было {old_qty})")
-                    else:
-                        # If product didn't exist, create it (shouldn't happen often)
-                        finished_product = FinishedProduct(film_id=film.id, thickness=item.thickness, quantity=item.quantity)
-                        db.add(finished_product)
-                        stock_update_details.append(f"Продукт {item.color} ({item.thickness}мм): +{item.quantity} (создан)")
-                else:
-                     logging.warning(f"Film {item.color} not found during return confirmation for order {order.id}")
-
-            # 2. Return Joints
-            for joint_item in order.joints:
-                joint = db.query(Joint).filter(
-                    Joint.type == joint_item.joint_type,
-                    Joint.thickness == joint_item.joint_thickness,
-                    Joint.color == joint_item.joint_color
-                ).first()
-                if joint:
-                    old_qty = joint.quantity
-                    joint.quantity += joint_item.quantity
-                    stock_update_details.append(f"Стык {joint_item.joint_type.name} ({joint_item.joint_thickness}мм, {joint_item.joint_color}): +{joint_item.quantity} (было {old_qty})")
-                else:
-                    # Create if doesn't exist
-                    joint = Joint(type=joint_item.joint_type, thickness=joint_item.joint_thickness, color=joint_item.joint_color, quantity=joint_item.quantity)
-                    db.add(joint)
-                    stock_update_details.append(f"Стык {joint_item.joint_type.name} ({joint_item.joint_thickness}мм, {joint_item.joint_color}): +{joint_item.quantity} (создан)")
-
-            # 3. Return Glue
-            for glue_item in order.glues:
-                glue = db.query(Glue).first()
-                if glue:
-                    old_qty = glue.quantity
-                    glue.quantity += glue_item.quantity
-                    stock_update_details.append(f"Клей: +{glue_item.quantity} (было {old_qty})")
-                else:
-                    glue = Glue(quantity=glue_item.quantity)
-                    db.add(glue)
-                    stock_update_details.append(f"Клей: +{glue_item.quantity} (создан)")
-
-            # Update order status
-            order.status = CompletedOrderStatus.RETURNED.value
-            order.updated_at = datetime.utcnow() # Explicitly update timestamp
-
-            # Log operation (optional but recommended)
-            # TODO: Consider adding a specific 'return' operation type?
-            operation_details = {
-                "completed_order_id": order.id,
-                "original_order_id": order.order_id,
-                "confirmed_by": warehouse_user.id,
-                "stock_updates": stock_update_details
-            }
-            op = Operation(
-                user_id=warehouse_user.id,
-                operation_type="order_return_confirmed", 
-                quantity=1, # Represents one order return
-                details=json.dumps(operation_details)
-            )
-            db.add(op)
+    def partial_return(db):
+        """Проводит возврат; возвращает None, если запрос уже обработан, текст ошибки ввода
+        или (номер заказа, статус, telegram_id менеджера, строки итога)."""
+        warehouse_user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+        # Блокируем заказ, чтобы возврат не был проведен дважды параллельно
+        stock.lock_order(db, completed_order_id)
+        order = db.query(CompletedOrder).options(
+            selectinload(CompletedOrder.items),
+            selectinload(CompletedOrder.joints),
+            selectinload(CompletedOrder.glues),
+            joinedload(CompletedOrder.manager)
+        ).filter(CompletedOrder.id == completed_order_id).first()
+        if not warehouse_user or not order or order.status != CompletedOrderStatus.RETURN_REQUESTED.value:
+            db.rollback()
+            return None
+
+        lines = stock.order_lines(order)
+        quantities = {}
+        errors = []
+        for number_text, quantity_text in pairs:
+            number, quantity = int(number_text), int(quantity_text)
+            if not 1 <= number <= len(lines):
+                errors.append(f"Позиции {number} нет в заказе")
+                continue
+            kind, line = lines[number - 1]
+            if quantity > stock.returnable_quantity(line):
+                errors.append(f"По позиции {number} можно вернуть не больше {stock.returnable_quantity(line)} шт.")
+                continue
+            quantities[(kind, line.id)] = quantities.get((kind, line.id), 0) + quantity
+        if errors or not any(quantities.values()):
+            db.rollback()
+            return "❌ " + "\n".join(errors or ["Не указано ни одной позиции для возврата"])
 
-            db.commit()
-            logging.info(f"Return confirmed and stock updated for CompletedOrder ID: {order.id}")
+        stock_update_details = apply_return(db, order, warehouse_user, quantities)
+        manager_telegram_id = order.manager.telegram_id if order.manager else None
+        return order.id, order.status, manager_telegram_id, stock_update_details
 
-            await callback_query.answer("✅ Возврат подтвержден, остатки обновлены.", show_alert=False)
+    # Блокировка заказа снимается коммитом или откатом внутри run_with_retry — до ответа пользователю
+    db = next(get_db())
+    try:
+        result = await stock.run_with_retry(db, partial_return)
+    except Exception as e:
+        db.rollback()
+        logging.error(f"Ошибка частичного возврата заказа {completed_order_id}: {e}", exc_info=True)
+        await message.answer("❌ Ошибка базы данных при обновлении остатков.")
+        return
+    finally:
+        db.close()
 
-            # Notify manager
-            if order.manager and order.manager.telegram_id:
-                try:
-                    await message.bot.send_message(
-                        order.manager.telegram_id,
-                        f"♻️ Возврат по заказу #{order.order_id} (Запрос ID: {order.id}) был подтвержден складом."
-                    )
-                except Exception as e:
-                    logging.error(f"Failed to send return confirmation notification to manager {order.manager.telegram_id}: {e}")
+    if result is None:
+        await message.answer(
+            "Запрос на возврат не найден или уже обработан.",
+            reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
+        )
+        await state.set_state(MenuState.WAREHOUSE_MAIN)
+        return
+    if isinstance(result, str):
+        await message.answer(result)
+        return
 
-            # Update message text
-            new_text = message.text.replace(f"Статус: {CompletedOrderStatus.RETURN_REQUESTED.value}", f"Статус: {CompletedOrderStatus.RETURNED.value}")
-            new_text += "\n\n✅ Возврат подтвержден складом."
-            await message.edit_text(new_text, reply_markup=None)
-            
-            # Return to the list of return requests or appropriate menu based on user role
-            state_data = await state.get_data()
-            return_menu_state = state_data.get("return_menu_state", MenuState.WAREHOUSE_MAIN)
+    order_id, order_status, manager_telegram_id, stock_update_details = result
+    logging.info(f"Partial return confirmed for CompletedOrder ID: {order_id}: {stock_update_details}")
+    if manager_telegram_id:
+        try:
+            await message.bot.send_message(
+                manager_telegram_id,
+                f"♻️ По заказу #{order_id} склад подтвердил частичный возврат:\n" + "\n".join(stock_update_details)
+            )
+        except Exception as e:
+            logging.error(f"Failed to send partial return notification to manager {manager_telegram_id}: {e}")
 
-            # If returning to main menu of role, go directly there
-            if return_menu_state in [MenuState.WAREHOUSE_MAIN, MenuState.SALES_MAIN, MenuState.SUPER_ADMIN_MAIN]:
-                await state.set_state(return_menu_state)
-                await message.answer("Возврат подтвержден. Возвращаемся в главное меню.", 
-                                     reply_markup=get_menu_keyboard(return_menu_state))
-            else:
-                # Otherwise return to the list of return requests
-                await state.set_state(MenuState.WAREHOUSE_RETURN_REQUESTS)
-                await handle_return_requests(message, state)
+    await message.answer(
+        f"✅ Частичный возврат по заказу #{order_id} проведен:\n" + "\n".join(stock_update_details)
+        + f"\n\nСтатус заказа: {order_status}",
+        reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
+    )
+    await state.set_state(MenuState.WAREHOUSE_MAIN)
 
-        except Exception as db_exc:
+@router.callback_query(F.data.startswith("confirm_return:"))
+async def process_confirm_return(callback_query: CallbackQuery, state: FSMContext):
+    """Handles the confirmation of a return request."""
+    completed_order_id = int(callback_query.data.split(":")[1])
+    user_id = callback_query.from_user.id
+    message = callback_query.message
+
+    def confirm(db):
+        """Проводит возврат; возвращает (текст ошибки или None, (номер заказа, статус, telegram_id менеджера))."""
+        # Блокируем заказ, чтобы возврат не был проведен дважды параллельно
+        stock.lock_order(db, completed_order_id)
+        order = db.query(CompletedOrder).options(
+            selectinload(CompletedOrder.items),
+            selectinload(CompletedOrder.joints),
+            selectinload(CompletedOrder.glues),
+            joinedload(CompletedOrder.manager) # Load manager for notification
+        ).filter(CompletedOrder.id == completed_order_id).first()
+        if not order:
             db.rollback()
-            logging.error(f"DB Error during return confirmation for order {order.id}: {db_exc}", exc_info=True)
-            await callback_query.answer("❌ Ошибка базы данных при обновлении остатков.", show_alert=True)
-        # --- End DB Transaction ---
+            return "Запрос на возврат не найден.", None
+        if order.status != CompletedOrderStatus.RETURN_REQUESTED.value:
+            db.rollback()
+            return f"Запрос уже обработан (статус: {order.status}).", None
 
-    except Exception as outer_exc:
-        logging.error(f"Outer error during return confirmation processing for order {completed_order_id}: {outer_exc}", exc_info=True)
-        await callback_query.answer("❌ Произошла общая ошибка.", show_alert=True)
+        logging.info(f"Confirming return for CompletedOrder ID: {order.id}. User: {user_id}")
+        apply_return(db, order, warehouse_user)
+        manager_telegram_id = order.manager.telegram_id if order.manager else None
+        return None, (order.order_id, order.status, manager_telegram_id)
+
+    db = next(get_db())
+    try:
+        warehouse_user = db.query(User).filter(User.telegram_id == user_id).first()
+        if not warehouse_user or warehouse_user.role not in [UserRole.WAREHOUSE, UserRole.SUPER_ADMIN, UserRole.SALES_MANAGER]:
+            await callback_query.answer("У вас нет прав для этого действия.", show_alert=True)
+            return
+        # Блокировка заказа снимается коммитом или откатом внутри run_with_retry — до ответа пользователю
+        error_text, result = await stock.run_with_retry(db, confirm)
+    except Exception as db_exc:
+        db.rollback()
+        logging.error(f"DB Error during return confirmation for order {completed_order_id}: {db_exc}", exc_info=True)
+        await callback_query.answer("❌ Ошибка базы данных при обновлении остатков.", show_alert=True)
+        return
     finally:
         db.close()
 
+    if error_text:
+        await callback_query.answer(error_text, show_alert=True)
+        return
+
+    order_id, order_status, manager_telegram_id = result
+    logging.info(f"Return confirmed and stock updated for CompletedOrder ID: {completed_order_id}")
+    await callback_query.answer("✅ Возврат подтвержден, остатки обновлены.", show_alert=False)
+
+    # Notify manager
+    if manager_telegram_id:
+        try:
+            await message.bot.send_message(
+                manager_telegram_id,
+                f"♻️ Возврат по заказу #{order_id} (Запрос ID: {completed_order_id}) был подтвержден складом."
+            )
+        except Exception as e:
+            logging.error(f"Failed to send return confirmation notification to manager {manager_telegram_id}: {e}")
+
+    # Update message text
+    new_text = message.text.replace(f"Статус: {CompletedOrderStatus.RETURN_REQUESTED.value}", f"Статус: {order_status}")
+    new_text += "\n\n✅ Возврат подтвержден складом."
+    await message.edit_text(new_text, reply_markup=None)
+
+    # Return to the list of return requests or appropriate menu based on user role
+    state_data = await state.get_data()
+    return_menu_state = state_data.get("return_menu_state", MenuState.WAREHOUSE_MAIN)
+
+    # If returning to main menu of role, go directly there
+    if return_menu_state in [MenuState.WAREHOUSE_MAIN, MenuState.SALES_MAIN, MenuState.SUPER_ADMIN_MAIN]:
+        await state.set_state(return_menu_state)
+        await message.answer("Возврат подтвержден. Возвращаемся в главное меню.", 
+                             reply_markup=get_menu_keyboard(return_menu_state))
+    else:
+        # Otherwise return to the list of return requests
+        await state.set_state(MenuState.WAREHOUSE_RETURN_REQUESTS)
+        await send_return_requests(message, state, callback_query.from_user.id)
+
 @router.callback_query(F.data.startswith("reject_return:"))
 async def process_reject_return(callback_query: CallbackQuery, state: FSMContext):
     """Handles the rejection of a return request."""
@@ -1580,7 +1520,7 @@ async def process_reject_return(callback_query: CallbackQuery, state: FSMContext
             else:
                 # Otherwise return to the list of return requests
                 await state.set_state(MenuState.WAREHOUSE_RETURN_REQUESTS)
-                await handle_return_requests(message, state)
+                await send_return_requests(message, state, callback_query.from_user.id)
 
         except Exception as db_exc:
             db.rollback()
@@ -1594,6 +1534,46 @@ async def process_reject_return(callback_query: CallbackQuery, state: FSMContext
     finally:
         db.close() 
 
+def render_reserved_orders_warehouse_page(db, cursor=None, direction=pagination.FORWARD):
+    """Текст и inline-клавиатура страницы забронированных заказов (None, если страница пуста)"""
+    query = db.query(Order).filter(
+        Order.status == OrderStatus.RESERVED.value
+    ).options(
+        selectinload(Order.products),
+        selectinload(Order.joints),
+        selectinload(Order.glues),
+        joinedload(Order.manager)
+    )
+    page = pagination.fetch_page(query, Order.created_at, Order.id, cursor, direction)
+    if not page.rows:
+        return None, None
+
+    response = "🔖 Забронированные заказы:\n\n"
+    for order in page.rows:
+        response += f"---\n"
+        response += f"Заказ #{order.id}\n"
+        response += f"Дата создания: {order.created_at.strftime('%Y-%m-%d %H:%M')}\n"
+        response += f"Менеджер: {order.manager.username if order.manager else 'Неизвестно'}\n"
+        response += f"Клиент: {order.customer_phone}\n"
+        response += f"Адрес: {order.delivery_address}\n"
+        shipment_date_str = order.shipment_date.strftime('%d.%m.%Y') if order.shipment_date else 'Не указана'
+        response += f"🗓 Дата отгрузки: {shipment_date_str}\n"
+        
+        # Добавляем строку с продукцией (кратко)
+        products_count = len(order.products) if order.products else 0
+        joints_count = len(order.joints) if order.joints else 0
+        glue_count = sum(g.quantity for g in order.glues) if order.glues else 0
+        
+        response += f"📦 Продукция: {products_count} позиций, "
+        response += f"🔗 Стыки: {joints_count} позиций, "
+        response += f"🧴 Клей: {glue_count} шт.\n\n"
+
+    keyboard = pagination.page_keyboard(
+        "whres", page,
+        lambda order: InlineKeyboardButton(text=f"🔖 Заказ #{order.id}", callback_data=f"whres:open:{order.id}")
+    )
+    return response, keyboard
+
 @router.message(F.text == "🔖 Забронированные заказы", StateFilter(MenuState.WAREHOUSE_MAIN))
 async def handle_reserved_orders_warehouse(message: Message, state: FSMContext):
     """Отображает список забронированных заказов для складского работника"""
@@ -1602,56 +1582,19 @@ async def handle_reserved_orders_warehouse(message: Message, state: FSMContext):
     
     db = next(get_db())
     try:
-        # Получаем все забронированные заказы со статусом RESERVED
-        reserved_orders = db.query(Order).filter(
-            Order.status == OrderStatus.RESERVED.value
-        ).options(
-            joinedload(Order.products),
-            joinedload(Order.joints),
-            joinedload(Order.glues),
-            joinedload(Order.manager)
-        ).order_by(desc(Order.created_at)).all()
+        response, keyboard = render_reserved_orders_warehouse_page(db)
         
-        if not reserved_orders:
+        if not response:
             await message.answer(
                 "🔖 Нет забронированных заказов.",
                 reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
             )
             return
         
-        response = "🔖 Забронированные заказы:\n\n"
-        keyboard_buttons = []
-        
-        for order in reserved_orders:
-            response += f"---\n"
-            response += f"Заказ #{order.id}\n"
-            response += f"Дата создания: {order.created_at.strftime('%Y-%m-%d %H:%M')}\n"
-            response += f"Менеджер: {order.manager.username if order.manager else 'Неизвестно'}\n"
-            response += f"Клиент: {order.customer_phone}\n"
-            response += f"Адрес: {order.delivery_address}\n"
-            shipment_date_str = order.shipment_date.strftime('%d.%m.%Y') if order.shipment_date else 'Не указана'
-            response += f"🗓 Дата отгрузки: {shipment_date_str}\n"
-            
-            # Добавляем строку с продукцией (кратко)
-            products_count = len(order.products) if order.products else 0
-            joints_count = len(order.joints) if order.joints else 0
-            glue_count = sum(g.quantity for g in order.glues) if order.glues else 0
-            
-            response += f"📦 Продукция: {products_count} позиций, "
-            response += f"🔗 Стыки: {joints_count} позиций, "
-            response += f"🧴 Клей: {glue_count} шт.\n\n"
-            
-            # Добавляем кнопку для просмотра деталей заказа
-            keyboard_buttons.append([KeyboardButton(text=f"🔖 Заказ #{order.id}")])
-        
-        # Добавляем кнопку "Назад"
-        keyboard_buttons.append([KeyboardButton(text="◀️ Назад")])
-        
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=keyboard_buttons,
-            resize_keyboard=True
+        await message.answer(
+            "Выберите заказ в списке ниже или отправьте «🔖 Заказ #номер».",
+            reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="◀️ Назад")]], resize_keyboard=True)
         )
-        
         await message.answer(response, reply_markup=keyboard)
         await state.set_state(MenuState.WAREHOUSE_RESERVED_ORDERS)
         
@@ -1664,6 +1607,29 @@ async def handle_reserved_orders_warehouse(message: Message, state: FSMContext):
     finally:
         db.close()
 
+@router.callback_query(F.data.startswith("whres:"))
+async def process_reserved_orders_warehouse_callback(callback_query: CallbackQuery, state: FSMContext):
+    """Листание списка забронированных заказов и открытие заказа из списка"""
+    if not await check_warehouse_access(callback_query):
+        return
+    
+    if callback_query.data.startswith("whres:open:"):
+        await callback_query.answer()
+        await show_reserved_order_warehouse(callback_query.message, state, int(callback_query.data.split(":")[2]))
+        return
+    
+    cursor, direction = pagination.parse_page_callback(callback_query.data)
+    db = next(get_db())
+    try:
+        response, keyboard = render_reserved_orders_warehouse_page(db, cursor, direction)
+        if not response:
+            # Заказы на этой странице уже обработаны — показываем первую
+            response, keyboard = render_reserved_orders_warehouse_page(db)
+        await callback_query.answer()
+        await pagination.edit_page(callback_query.message, response or "🔖 Нет забронированных заказов.", keyboard)
+    finally:
+        db.close()
+
 @router.message(StateFilter(MenuState.WAREHOUSE_RESERVED_ORDERS), F.text.regexp(r"^🔖 Заказ #(\d+)$"))
 async def view_reserved_order_warehouse(message: Message, state: FSMContext):
     """Отображает детали забронированного заказа и предлагает подтвердить его"""
@@ -1681,94 +1647,122 @@ async def view_reserved_order_warehouse(message: Message, state: FSMContext):
             return
         
         order_id = int(order_id_match.group(1))
+    except ValueError:
+        await message.answer(
+            "Неверный формат ID заказа.",
+            reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_RESERVED_ORDERS)
+        )
+        return
+    
+    await show_reserved_order_warehouse(message, state, order_id)
+
+async def show_reserved_order_warehouse(message: Message, state: FSMContext, order_id: int):
+    """Отправляет детали забронированного заказа с кнопками подтверждения"""
+    db = next(get_db())
+    try:
+        # Получаем заказ
+        order = db.query(Order).options(
+            joinedload(Order.products),
+            joinedload(Order.joints),
+            joinedload(Order.glues),
+            joinedload(Order.manager)
+        ).filter(
+            Order.id == order_id,
+            Order.status == OrderStatus.RESERVED.value
+        ).first()
         
-        db = next(get_db())
-        try:
-            # Получаем заказ
-            order = db.query(Order).options(
-                joinedload(Order.products),
-                joinedload(Order.joints),
-                joinedload(Order.glues),
-                joinedload(Order.manager)
-            ).filter(
-                Order.id == order_id,
-                Order.status == OrderStatus.RESERVED.value
-            ).first()
-            
-            if not order:
-                await message.answer(
-                    f"Забронированный заказ с ID {order_id} не найден или уже не имеет статус 'Забронирован'.",
-                    reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_RESERVED_ORDERS)
-                )
-                return
-            
-            # Формируем детальный ответ с информацией о заказе
-            response = f"🔖 Детали забронированного заказа #{order.id}\n\n"
-            response += f"Дата создания: {order.created_at.strftime('%Y-%m-%d %H:%M')}\n"
-            response += f"Менеджер: {order.manager.username if order.manager else 'Неизвестно'}\n"
-            response += f"Клиент: {order.customer_phone}\n"
-            response += f"Адрес: {order.delivery_address}\n"
-            shipment_date_str = order.shipment_date.strftime('%d.%m.%Y') if order.shipment_date else 'Не указана'
-            payment_method_str = order.payment_method if order.payment_method else 'Не указан'
-            response += f"🗓 Дата отгрузки: {shipment_date_str}\n"
-            response += f"💳 Способ оплаты: {payment_method_str}\n"
-            response += f"Монтаж: {'Да' if order.installation_required else 'Нет'}\n\n"
-            
-            response += "📦 Продукция:\n"
-            if order.products:
-                for item in order.products:
-                    response += f"- {item.color} ({item.thickness} мм): {item.quantity} шт.\n"
-            else:
-                response += "- нет\n"
-            
-            response += "\n🔗 Стыки:\n"
-            if order.joints:
-                for joint in order.joints:
-                    joint_type_name = "Другой"
-                    if joint.joint_type == JointType.SIMPLE.value:
-                        joint_type_name = "Простой"
-                    elif joint.joint_type == JointType.BUTTERFLY.value:
-                        joint_type_name = "Бабочка"
-                    elif joint.joint_type == JointType.CLOSING.value:
-                        joint_type_name = "Замыкающий"
-                    
-                    response += f"- {joint_type_name} ({joint.joint_thickness} мм, {joint.joint_color}): {joint.quantity} шт.\n"
-            else:
-                response += "- нет\n"
-            
-            response += "\n🧴 Клей:\n"
-            if order.glues:
-                for glue in order.glues:
-                    response += f"- {glue.quantity} шт.\n"
-            else:
-                response += "- нет\n"
-            
-            # Добавляем клавиатуру с кнопками для управления заказом
-            keyboard = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text=f"✅ Подтвердить заказ #{order.id}"), KeyboardButton(text=f"❌ Отклонить заказ #{order.id}")],
-                    [KeyboardButton(text="◀️ К списку забронированных")]
-                ],
-                resize_keyboard=True
-            )
-            
-            await message.answer(response, reply_markup=keyboard)
-            await state.set_state(MenuState.WAREHOUSE_VIEW_RESERVED_ORDER)
-            await state.update_data(viewed_reserved_order_id=order.id)
-            
-        except Exception as e:
-            logging.error(f"Ошибка при просмотре забронированного заказа {order_id}: {e}", exc_info=True)
+        if not order:
             await message.answer(
-                "Произошла ошибка при загрузке деталей заказа.",
+                f"Забронированный заказ с ID {order_id} не найден или уже не имеет статус 'Забронирован'.",
                 reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_RESERVED_ORDERS)
             )
-        finally:
-            db.close()
-    except ValueError:
+            return
+        
+        # Формируем детальный ответ с информацией о заказе
+        response = f"🔖 Детали забронированного заказа #{order.id}\n\n"
+        response += f"Дата создания: {order.created_at.strftime('%Y-%m-%d %H:%M')}\n"
+        response += f"Менеджер: {order.manager.username if order.manager else 'Неизвестно'}\n"
+        response += f"Клиент: {order.customer_phone}\n"
+        response += f"Адрес: {order.delivery_address}\n"
+        shipment_date_str = order.shipment_date.strftime('%d.%m.%Y') if order.shipment_date else 'Не указана'
+        payment_method_str = order.payment_method if order.payment_method else 'Не указан'
+        response += f"🗓 Дата отгрузки: {shipment_date_str}\n"
+        response += f"💳 Способ оплаты: {payment_method_str}\n"
+        response += f"Монтаж: {'Да' if order.installation_required else 'Нет'}\n\n"
+        
+        response += "📦 Продукция:\n"
+        if order.products:
+            for item in order.products:
+                response += f"- {item.color} ({item.thickness} мм): {item.quantity} шт.\n"
+        else:
+            response += "- нет\n"
+        
+        response += "\n🔗 Стыки:\n"
+        if order.joints:
+            for joint in order.joints:
+                joint_type_name = "Другой"
+                if joint.joint_type == JointType.SIMPLE.value:
+                    joint_type_name = "Простой"
+                elif joint.joint_type == JointType.BUTTERFLY.value:
+                    joint_type_name = "Бабочка"
+                elif joint.joint_type == JointType.CLOSING.value:
+                    joint_type_name = "Замыкающий"
+                
+                response += f"- {joint_type_name} ({joint.joint_thickness} мм, {joint.joint_color}): {joint.quantity} шт.\n"
+        else:
+            response += "- нет\n"
+        
+        response += "\n🧴 Клей:\n"
+        if order.glues:
+            for glue in order.glues:
+                response += f"- {glue.quantity} шт.\n"
+        else:
+            response += "- нет\n"
+        
+        # Добавляем клавиатуру с кнопками для управления заказом
+        keyboard = ReplyKeyboardMarkup(
+            keyboard=[
+                [KeyboardButton(text=f"✅ Подтвердить заказ #{order.id}"), KeyboardButton(text=f"❌ Отклонить заказ #{order.id}")],
+                [KeyboardButton(text="◀️ К списку забронированных")]
+            ],
+            resize_keyboard=True
+        )
+        
+        await message.answer(response, reply_markup=keyboard)
+        await state.set_state(MenuState.WAREHOUSE_VIEW_RESERVED_ORDER)
+        await state.update_data(viewed_reserved_order_id=order.id)
+        
+    except Exception as e:
+        logging.error(f"Ошибка при просмотре забронированного заказа {order_id}: {e}", exc_info=True)
         await message.answer(
-            "Неверный формат ID заказа.",
+            "Произошла ошибка при загрузке деталей заказа.",
             reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_RESERVED_ORDERS)
         )
+    finally:
+        db.close()
+
+def release_reserved_order(order_id: int, new_status: str):
+    """Операция для stock.run_with_retry: снимает резерв забронированного заказа и меняет его статус.
+
+    Возвращает (найден ли заказ в брони, telegram_id менеджера). Блокировка заказа
+    снимается коммитом в run_with_retry, до ответов в Telegram.
+    """
+    def operation(db):
+        # Блокируем заказ: статус проверяется уже после завершения параллельной операции
+        stock.lock_order(db, order_id)
+        order = db.query(Order).filter(
+            Order.id == order_id,
+            Order.status == OrderStatus.RESERVED.value
+        ).first()
+        if not order:
+            db.rollback()
+            return False, None
+        
+        # Снимаем резерв заказа одним запросом — остатки на складе не менялись
+        stock.release_order(db, order.id)
+        order.status = new_status
+        return True, db.query(User.telegram_id).filter(User.id == order.manager_id).scalar()
+    return operation
 
 @router.message(StateFilter(MenuState.WAREHOUSE_VIEW_RESERVED_ORDER), F.text.regexp(r"^✅ Подтвердить заказ #(\d+)$"))
 async def confirm_reserved_order_warehouse(message: Message, state: FSMContext):
@@ -1790,102 +1784,9 @@ async def confirm_reserved_order_warehouse(message: Message, state: FSMContext):
         
         db = next(get_db())
         try:
-            # Получаем заказ
-            order = db.query(Order).filter(
-                Order.id == order_id,
-                Order.status == OrderStatus.RESERVED.value
-            ).options(
-                joinedload(Order.products),
-                joinedload(Order.joints),
-                joinedload(Order.glues)
-            ).first()
-            
-            if not order:
-                await message.answer(
-                    f"Забронированный заказ с ID {order_id} не найден или уже не имеет статус 'Забронирован'.",
-                    reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_RESERVED_ORDERS)
-                )
-                return
-            
-            # Возвращаем товары на склад
-            if order.products:
-                for product in order.products:
-                    # Находим соответствующий товар на складе
-                    finished_product = db.query(FinishedProduct).join(
-                        Film, FinishedProduct.film_id == Film.id
-                    ).filter(
-                        Film.code == product.color,
-                        FinishedProduct.thickness == product.thickness
-                    ).first()
-                    
-                    if finished_product:
-                        # Увеличиваем количество на складе
-                        finished_product.quantity += product.quantity
-                    else:
-                        # Если такого товара нет, создаем новую запись
-                        film = db.query(Film).filter(Film.code == product.color).first()
-                        if film:
-                            new_product = FinishedProduct(
-                                film_id=film.id,
-                                quantity=product.quantity,
-                                thickness=product.thickness
-                            )
-                            db.add(new_product)
-            
-            # Возвращаем стыки на склад
-            if order.joints:
-                for joint in order.joints:
-                    joint_item = db.query(Joint).filter(
-                        Joint.type == joint.joint_type,
-                        Joint.color == joint.joint_color,
-                        Joint.thickness == joint.joint_thickness
-                    ).first()
-                    
-                    if joint_item:
-                        # Увеличиваем количество стыков
-                        joint_item.quantity += joint.quantity
-                    else:
-                        # Если таких стыков нет, создаем новую запись
-                        new_joint = Joint(
-                            type=joint.joint_type,
-                            color=joint.joint_color,
-                            thickness=joint.joint_thickness,
-                            quantity=joint.quantity
-                        )
-                        db.add(new_joint)
-            
-            # Возвращаем клей на склад
-            if order.glues:
-                total_glue = sum(glue.quantity for glue in order.glues)
-                if total_glue > 0:
-                    glue_item = db.query(Glue).first()
-                    if glue_item:
-                        glue_item.quantity += total_glue
-                    else:
-                        new_glue = Glue(quantity=total_glue)
-                        db.add(new_glue)
-            
-            # Меняем статус заказа на PENDING
-            order.status = OrderStatus.PENDING.value
-            db.commit()
-            
-            # Отправляем уведомление менеджеру
-            try:
-                manager = db.query(User).filter(User.id == order.manager_id).first()
-                if manager and manager.telegram_id:
-                    await message.bot.send_message(
-                        manager.telegram_id,
-                        f"✅ Ваш забронированный заказ #{order.id} подтвержден складом и переведен в статус ожидания. Материалы возвращены на склад."
-                    )
-            except Exception as notify_error:
-                logging.error(f"Ошибка при отправке уведомления менеджеру: {notify_error}")
-            
-            await message.answer(
-                f"✅ Заказ #{order_id} успешно подтвержден. Материалы возвращены на склад.",
-                reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
+            found, manager_telegram_id = await stock.run_with_retry(
+                db, release_reserved_order(order_id, OrderStatus.PENDING.value)
             )
-            await state.set_state(MenuState.WAREHOUSE_MAIN)
-            
         except Exception as e:
             db.rollback()
             logging.error(f"Ошибка при подтверждении забронированного заказа {order_id}: {e}", exc_info=True)
@@ -1894,8 +1795,32 @@ async def confirm_reserved_order_warehouse(message: Message, state: FSMContext):
                 reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
             )
             await state.set_state(MenuState.WAREHOUSE_MAIN)
+            return
         finally:
             db.close()
+        
+        if not found:
+            await message.answer(
+                f"Забронированный заказ с ID {order_id} не найден или уже не имеет статус 'Забронирован'.",
+                reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_RESERVED_ORDERS)
+            )
+            return
+        
+        # Отправляем уведомление менеджеру
+        if manager_telegram_id:
+            try:
+                await message.bot.send_message(
+                    manager_telegram_id,
+                    f"✅ Ваш забронированный заказ #{order_id} подтвержден складом и переведен в статус ожидания. Резерв снят."
+                )
+            except Exception as notify_error:
+                logging.error(f"Ошибка при отправке уведомления менеджеру: {notify_error}")
+        
+        await message.answer(
+            f"✅ Заказ #{order_id} успешно подтвержден. Резерв снят.",
+            reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
+        )
+        await state.set_state(MenuState.WAREHOUSE_MAIN)
     except ValueError:
         await message.answer(
             "Неверный формат ID заказа.",
@@ -1922,40 +1847,9 @@ async def reject_reserved_order_warehouse(message: Message, state: FSMContext):
         
         db = next(get_db())
         try:
-            # Получаем заказ
-            order = db.query(Order).filter(
-                Order.id == order_id,
-                Order.status == OrderStatus.RESERVED.value
-            ).first()
-            
-            if not order:
-                await message.answer(
-                    f"Забронированный заказ с ID {order_id} не найден или уже не имеет статус 'Забронирован'.",
-                    reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_RESERVED_ORDERS)
-                )
-                return
-            
-            # Меняем статус заказа на CANCELLED
-            order.status = OrderStatus.CANCELLED.value
-            db.commit()
-            
-            # Отправляем уведомление менеджеру
-            try:
-                manager = db.query(User).filter(User.id == order.manager_id).first()
-                if manager and manager.telegram_id:
-                    await message.bot.send_message(
-                        manager.telegram_id,
-                        f"❌ Ваш забронированный заказ #{order.id} был отклонен складом."
-                    )
-            except Exception as notify_error:
-                logging.error(f"Ошибка при отправке уведомления менеджеру: {notify_error}")
-            
-            await message.answer(
-                f"❌ Заказ #{order_id} отклонен.",
-                reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
+            found, manager_telegram_id = await stock.run_with_retry(
+                db, release_reserved_order(order_id, OrderStatus.CANCELLED.value)
             )
-            await state.set_state(MenuState.WAREHOUSE_MAIN)
-            
         except Exception as e:
             db.rollback()
             logging.error(f"Ошибка при отклонении забронированного заказа {order_id}: {e}", exc_info=True)
@@ -1964,8 +1858,32 @@ async def reject_reserved_order_warehouse(message: Message, state: FSMContext):
                 reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
             )
             await state.set_state(MenuState.WAREHOUSE_MAIN)
+            return
         finally:
             db.close()
+        
+        if not found:
+            await message.answer(
+                f"Забронированный заказ с ID {order_id} не найден или уже не имеет статус 'Забронирован'.",
+                reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_RESERVED_ORDERS)
+            )
+            return
+        
+        # Отправляем уведомление менеджеру
+        if manager_telegram_id:
+            try:
+                await message.bot.send_message(
+                    manager_telegram_id,
+                    f"❌ Ваш забронированный заказ #{order_id} был отклонен складом."
+                )
+            except Exception as notify_error:
+                logging.error(f"Ошибка при отправке уведомления менеджеру: {notify_error}")
+        
+        await message.answer(
+            f"❌ Заказ #{order_id} отклонен.",
+            reply_markup=get_menu_keyboard(MenuState.WAREHOUSE_MAIN)
+        )
+        await state.set_state(MenuState.WAREHOUSE_MAIN)
     except ValueError:
         await message.answer(
             "Неверный формат ID заказа.",
@@ -0,0 +1,56 @@
+"""Ключи идемпотентности для создания заказов.
+
+Двойное нажатие или повторная доставка апдейта Telegram приводят к повторному
+вызову обработчика с тем же черновиком в FSM. Ключ строится из области, чата
+и хэша черновика и вставляется в idempotency_keys с уникальным ограничением в той
+же транзакции, что и сама сущность: параллельный дубликат ждет коммита первой
+транзакции и получает ID уже созданной сущности.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from sqlalchemy.dialects.postgresql import insert
+
+from models import IdempotencyKey
+
+SCOPE_ORDER = "order"
+SCOPE_PRODUCTION_ORDER = "production_order"
+SCOPE_SHIPMENT = "shipment"
+
+# Сколько секунд ключ защищает от повторов; после этого такой же черновик считается новым заказом
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+
+
+def make_key(scope: str, chat_id: int, draft: Any) -> str:
+    """SHA-256 от области, чата и черновика (порядок ключей словаря не важен)."""
+    payload = json.dumps(draft, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(f"{scope}:{chat_id}:{payload}".encode("utf-8")).hexdigest()
+
+
+def claim(db, scope: str, key: str) -> Optional[int]:
+    """Занимает ключ в текущей транзакции.
+
+    Возвращает None, если ключ занят этим вызовом и сущность нужно создать,
+    иначе ID сущности, уже созданной с этим ключом. Ключ старше
+    IDEMPOTENCY_TTL_SECONDS перезанимается.
+    """
+    now = datetime.utcnow()
+    statement = insert(IdempotencyKey).values(key=key, scope=scope, created_at=now)
+    statement = statement.on_conflict_do_update(
+        index_elements=[IdempotencyKey.key],
+        set_={"created_at": now, "entity_id": None},
+        where=IdempotencyKey.created_at < now - timedelta(seconds=IDEMPOTENCY_TTL_SECONDS),
+    ).returning(IdempotencyKey.id)
+    if db.execute(statement).scalar() is not None:
+        return None
+    return db.query(IdempotencyKey.entity_id).filter(IdempotencyKey.key == key).scalar()
+
+
+def bind(db, key: str, entity_id: int):
+    """Связывает занятый ключ с созданной сущностью (до коммита той же транзакции)."""
+    db.query(IdempotencyKey).filter(IdempotencyKey.key == key).update(
+        {IdempotencyKey.entity_id: entity_id}, synchronize_session=False
+    )
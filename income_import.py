@@ -0,0 +1,369 @@
+"""Импорт прихода сырья из CSV/XLSX: панели, пленка, стыки и клей одним файлом.
+
+Файл читается построчно (csv.reader или openpyxl в режиме read_only), строки
+проверяются по справочникам пленки и стыков и суммируются по позициям склада.
+Если в файле есть ошибки, ничего не проводится. Иначе остатки обновляются
+пакетами INSERT ... ON CONFLICT DO UPDATE (по IMPORT_BATCH_SIZE позиций на
+запрос), а операции прихода записываются одной пакетной вставкой.
+"""
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+import film_index
+import stock
+from models import Film, Panel, Joint, Glue, Operation, JointType
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+MAX_REPORTED_ERRORS = 20
+
+MATERIAL_PANEL = "panel"
+MATERIAL_FILM = "film"
+MATERIAL_JOINT = "joint"
+MATERIAL_GLUE = "glue"
+
+MATERIAL_NAMES = {
+    "панель": MATERIAL_PANEL, "панели": MATERIAL_PANEL, "panel": MATERIAL_PANEL,
+    "пленка": MATERIAL_FILM, "плёнка": MATERIAL_FILM, "film": MATERIAL_FILM,
+    "стык": MATERIAL_JOINT, "стыки": MATERIAL_JOINT, "joint": MATERIAL_JOINT,
+    "клей": MATERIAL_GLUE, "glue": MATERIAL_GLUE,
+}
+
+JOINT_TYPE_NAMES = {
+    "бабочка": JointType.BUTTERFLY, "butterfly": JointType.BUTTERFLY,
+    "простой": JointType.SIMPLE, "простые": JointType.SIMPLE, "simple": JointType.SIMPLE,
+    "замыкающий": JointType.CLOSING, "замыкающие": JointType.CLOSING, "closing": JointType.CLOSING,
+}
+
+# Заголовки столбцов: каноническое имя и допустимые написания
+COLUMN_ALIASES = {
+    "material": ("материал", "тип", "material", "type"),
+    "code": ("код", "цвет", "код пленки", "code", "color"),
+    "thickness": ("толщина", "thickness"),
+    "joint_type": ("вид стыка", "тип стыка", "joint_type"),
+    "quantity": ("количество", "кол-во", "рулонов", "quantity", "qty"),
+    "meters_per_roll": ("метраж", "метраж рулона", "метров в рулоне", "meters_per_roll"),
+    "panel_consumption": ("расход", "расход на панель", "panel_consumption"),
+}
+REQUIRED_COLUMNS = ("material", "quantity")
+ALLOWED_THICKNESSES = (0.5, 0.8)
+
+
+class ImportFormatError(ValueError):
+    """Файл нельзя разобрать: неизвестный формат или нет обязательных столбцов."""
+
+
+class FilmIncome(NamedTuple):
+    code: str
+    rolls: float
+    total_meters: float
+    meters_per_roll: float
+    panel_consumption: float
+    is_new: bool
+
+
+class IncomeBatch(NamedTuple):
+    panels: Dict[float, int]
+    films: Dict[str, FilmIncome]
+    joints: Dict[Tuple[JointType, str, float], int]
+    glue: int
+    rows: int
+    errors: List[str]
+
+
+def _header_map(header: Iterable) -> Dict[str, int]:
+    aliases = {alias: key for key, names in COLUMN_ALIASES.items() for alias in names}
+    columns = {}
+    for position, title in enumerate(header):
+        key = aliases.get(" ".join(str(title or "").split()).casefold())
+        if key and key not in columns:
+            columns[key] = position
+    missing = [COLUMN_ALIASES[key][0] for key in REQUIRED_COLUMNS if key not in columns]
+    if missing:
+        raise ImportFormatError(f"В первой строке нет столбцов: {', '.join(missing)}")
+    return columns
+
+
+def _records(rows: Iterator[Iterable]) -> Iterator[Tuple[int, Dict[str, object]]]:
+    """Строки файла как словари по каноническим именам столбцов; номер строки — как в файле."""
+    header = next(rows, None)
+    if header is None:
+        raise ImportFormatError("Файл пуст")
+    columns = _header_map(header)
+    for number, row in enumerate(rows, start=2):
+        row = list(row)
+        record = {key: row[position] if position < len(row) else None for key, position in columns.items()}
+        if any(value not in (None, "") for value in record.values()):
+            yield number, record
+
+
+def _csv_rows(data: bytes) -> Iterator[List[str]]:
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        # Excel в русской локали сохраняет CSV в cp1251
+        text = data.decode("cp1251")
+    first_line = text.split("\n", 1)[0]
+    delimiter = max(";,\t", key=first_line.count)
+    return csv.reader(io.StringIO(text, newline=""), delimiter=delimiter)
+
+
+def _xlsx_rows(data: bytes) -> Iterator[tuple]:
+    try:
+        # openpyxl нужен только для импорта, поэтому импортируется по требованию
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportFormatError("Импорт XLSX недоступен: не установлен пакет openpyxl. Загрузите CSV.")
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def read_records(file_name: str, data: bytes) -> Iterator[Tuple[int, Dict[str, object]]]:
+    """Потоковое чтение строк CSV или XLSX по расширению файла."""
+    extension = os.path.splitext(file_name or "")[1].casefold()
+    if extension == ".csv":
+        return _records(iter(_csv_rows(data)))
+    if extension == ".xlsx":
+        return _records(_xlsx_rows(data))
+    raise ImportFormatError("Поддерживаются файлы .csv и .xlsx")
+
+
+def _text(value) -> str:
+    return " ".join(str(value if value is not None else "").split())
+
+
+def _number(value) -> Optional[float]:
+    if value is None or _text(value) == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    return float(_text(value).replace(",", ".").replace(" ", ""))
+
+
+def parse_income(db, records: Iterable[Tuple[int, Dict[str, object]]]) -> IncomeBatch:
+    """Проверяет строки по справочникам и суммирует приход по позициям склада."""
+    films = {
+        film_index.normalize_code(code): (code, meters_per_roll, panel_consumption)
+        for code, meters_per_roll, panel_consumption in db.query(Film.code, Film.meters_per_roll, Film.panel_consumption)
+    }
+    # Цвет стыка — код пленки или уже заведенный цвет стыка
+    joint_colors = {film_index.normalize_code(code): code for code, _, _ in films.values()}
+    for (color,) in db.query(Joint.color).distinct():
+        joint_colors.setdefault(film_index.normalize_code(color), color)
+
+    panels: Dict[float, int] = {}
+    film_income: Dict[str, FilmIncome] = {}
+    joints: Dict[Tuple[JointType, str, float], int] = {}
+    glue = 0
+    rows = 0
+    errors: List[str] = []
+
+    for number, record in records:
+        rows += 1
+        try:
+            material = MATERIAL_NAMES.get(_text(record.get("material")).casefold())
+            quantity = _number(record.get("quantity"))
+            thickness = _number(record.get("thickness"))
+        except ValueError:
+            errors.append(f"Строка {number}: количество и толщина должны быть числами")
+            continue
+        if material is None:
+            errors.append(f"Строка {number}: неизвестный материал «{_text(record.get('material'))}»")
+            continue
+        if quantity is None or quantity <= 0:
+            errors.append(f"Строка {number}: количество должно быть положительным")
+            continue
+        if material in (MATERIAL_PANEL, MATERIAL_JOINT) and thickness not in ALLOWED_THICKNESSES:
+            errors.append(f"Строка {number}: толщина должна быть 0.5 или 0.8")
+            continue
+        if material != MATERIAL_FILM and quantity != int(quantity):
+            errors.append(f"Строка {number}: количество должно быть целым")
+            continue
+
+        if material == MATERIAL_PANEL:
+            panels[thickness] = panels.get(thickness, 0) + int(quantity)
+        elif material == MATERIAL_GLUE:
+            glue += int(quantity)
+        elif material == MATERIAL_JOINT:
+            joint_type = JOINT_TYPE_NAMES.get(_text(record.get("joint_type")).casefold())
+            color = joint_colors.get(film_index.normalize_code(_text(record.get("code"))))
+            if joint_type is None:
+                errors.append(f"Строка {number}: вид стыка должен быть «бабочка», «простой» или «замыкающий»")
+            elif color is None:
+                errors.append(f"Строка {number}: цвет стыка «{_text(record.get('code'))}» не найден среди пленок и стыков")
+            else:
+                key = (joint_type, color, thickness)
+                joints[key] = joints.get(key, 0) + int(quantity)
+        else:
+            code_text = _text(record.get("code"))
+            known = films.get(film_index.normalize_code(code_text))
+            try:
+                meters_per_roll = _number(record.get("meters_per_roll"))
+                panel_consumption = _number(record.get("panel_consumption"))
+            except ValueError:
+                errors.append(f"Строка {number}: метраж и расход должны быть числами")
+                continue
+            if not code_text:
+                errors.append(f"Строка {number}: не указан код пленки")
+                continue
+            if known is None and (meters_per_roll is None or panel_consumption is None):
+                candidates = film_index.get_index().suggest(code_text)
+                hint = f" Возможно: {', '.join(candidates)}." if candidates else ""
+                errors.append(f"Строка {number}: пленка {code_text} не найдена — для новой пленки "
+                              f"укажите метраж рулона и расход.{hint}")
+                continue
+            code = known[0] if known else code_text
+            if meters_per_roll is None:
+                meters_per_roll = known[1]
+            if panel_consumption is None:
+                panel_consumption = known[2]
+            if meters_per_roll <= 0 or panel_consumption <= 0:
+                errors.append(f"Строка {number}: метраж и расход должны быть положительными")
+                continue
+            previous = film_income.get(code)
+            film_income[code] = FilmIncome(
+                code=code,
+                rolls=(previous.rolls if previous else 0) + quantity,
+                total_meters=(previous.total_meters if previous else 0) + quantity * meters_per_roll,
+                meters_per_roll=meters_per_roll,
+                panel_consumption=panel_consumption,
+                is_new=known is None,
+            )
+
+    return IncomeBatch(panels, film_income, joints, glue, rows, errors)
+
+
+def _chunks(items: List, size: int = IMPORT_BATCH_SIZE) -> Iterator[List]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _upsert(db, model, values: List[dict], index_elements: List, set_: Dict, returning: List) -> List[tuple]:
+    """INSERT ... ON CONFLICT DO UPDATE ... RETURNING пакетами по IMPORT_BATCH_SIZE строк."""
+    result = []
+    for chunk in _chunks(values):
+        statement = pg_insert(model).values(chunk)
+        statement = statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={key: value(statement.excluded) for key, value in set_.items()},
+        ).returning(*returning)
+        result.extend(db.execute(statement).all())
+    return result
+
+
+def apply_income(db, batch: IncomeBatch, user_id: int, source: str) -> int:
+    """Проводит приход; коммит выполняет вызывающий код. Возвращает число операций."""
+    now = datetime.utcnow()
+    operations = []
+
+    def operation(operation_type: str, quantity, details: dict):
+        operations.append({
+            "user_id": user_id,
+            "operation_type": operation_type,
+            "quantity": quantity,
+            "timestamp": now,
+            "details": json.dumps({**details, "source": source}, ensure_ascii=False),
+        })
+
+    if batch.films:
+        rows = _upsert(db, Film, [
+            {"code": film.code, "total_remaining": film.total_meters,
+             "meters_per_roll": film.meters_per_roll, "panel_consumption": film.panel_consumption}
+            for film in batch.films.values()
+        ], [Film.code], {
+            "total_remaining": lambda excluded: Film.total_remaining + excluded.total_remaining,
+            "meters_per_roll": lambda excluded: excluded.meters_per_roll,
+            "panel_consumption": lambda excluded: excluded.panel_consumption,
+            "updated_at": lambda excluded: func.now(),
+        }, [Film.code])
+        for (code,) in rows:
+            film = batch.films[code]
+            operation("film_income", film.rolls, {
+                "film_code": code,
+                "rolls": film.rolls,
+                "meters_per_roll": film.meters_per_roll,
+                "panel_consumption": film.panel_consumption,
+                "total_meters": film.total_meters,
+            })
+
+    if batch.panels:
+        rows = _upsert(db, Panel, [
+            {"thickness": thickness, "quantity": quantity} for thickness, quantity in batch.panels.items()
+        ], [Panel.thickness], {
+            "quantity": lambda excluded: func.coalesce(Panel.quantity, 0) + excluded.quantity,
+            "updated_at": lambda excluded: func.now(),
+        }, [Panel.thickness, Panel.quantity])
+        for thickness, new_quantity in rows:
+            added = batch.panels[thickness]
+            operation("panel_income", added, {
+                "panel_thickness": thickness,
+                "previous_quantity": new_quantity - added,
+                "new_quantity": new_quantity,
+            })
+
+    if batch.joints:
+        rows = _upsert(db, Joint, [
+            {"type": joint_type, "color": color, "thickness": thickness, "quantity": quantity}
+            for (joint_type, color, thickness), quantity in batch.joints.items()
+        ], [Joint.type, Joint.color, Joint.thickness], {
+            "quantity": lambda excluded: func.coalesce(Joint.quantity, 0) + excluded.quantity,
+            "updated_at": lambda excluded: func.now(),
+        }, [Joint.type, Joint.color, Joint.thickness, Joint.quantity])
+        for joint_type, color, thickness, new_quantity in rows:
+            added = batch.joints[(joint_type, color, thickness)]
+            operation("joint_income", added, {
+                "joint_type": joint_type.value,
+                "joint_color": color,
+                "joint_thickness": thickness,
+                "previous_quantity": new_quantity - added,
+                "new_quantity": new_quantity,
+            })
+
+    if batch.glue:
+        # Клей хранится одной строкой без естественного ключа — увеличиваем ее или создаем
+        glue = db.query(Glue.id, Glue.quantity).order_by(Glue.id).with_for_update().first()
+        if glue:
+            stock.increment_column(db, Glue, Glue.quantity, {glue.id: batch.glue})
+            previous_quantity = glue.quantity or 0
+        else:
+            db.execute(insert(Glue), [{"quantity": batch.glue}])
+            previous_quantity = 0
+        operation("glue_income", batch.glue, {"previous_quantity": previous_quantity})
+
+    if operations:
+        db.execute(insert(Operation), operations)
+    return len(operations)
+
+
+def format_errors(errors: List[str]) -> str:
+    shown = errors[:MAX_REPORTED_ERRORS]
+    text = "\n".join(f"❌ {error}" for error in shown)
+    if len(errors) > len(shown):
+        text += f"\n… и еще {len(errors) - len(shown)} ошибок"
+    return text
+
+
+def format_summary(batch: IncomeBatch) -> str:
+    """Итог импорта по материалам."""
+    lines = [f"✅ Приход из файла проведен: {batch.rows} строк"]
+    for thickness, quantity in sorted(batch.panels.items()):
+        lines.append(f"🪵 Панели {thickness} мм: +{quantity} шт.")
+    if batch.films:
+        new_codes = [film.code for film in batch.films.values() if film.is_new]
+        lines.append(f"🎨 Пленка: {len(batch.films)} кодов, +{sum(f.total_meters for f in batch.films.values()):.2f}м")
+        if new_codes:
+            lines.append(f"   новые коды: {', '.join(new_codes)}")
+    if batch.joints:
+        lines.append(f"⚙️ Стыки: {len(batch.joints)} позиций, +{sum(batch.joints.values())} шт.")
+    if batch.glue:
+        lines.append(f"🧴 Клей: +{batch.glue} шт.")
+    return "\n".join(lines)
@@ -0,0 +1,120 @@
+"""Контроль задержек цикла событий и поиск блокирующих вызовов.
+
+Синхронные сессии SQLAlchemy внутри асинхронных обработчиков блокируют цикл
+событий. Фоновая задача постоянно измеряет задержку цикла, а сторожевой поток
+при превышении порога снимает стек потока цикла, чтобы было видно, какая
+корутина его заблокировала.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from metrics import registry, LATENCY_BUCKETS
+
+# Интервал пробуждения фоновой задачи, секунды
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1"))
+# Задержка цикла, начиная с которой фиксируется блокировка, миллисекунды
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))
+
+MAX_STACK_FRAMES = 30
+
+loop_lag = registry.histogram(
+    "bot_event_loop_lag_seconds", "Задержка пробуждения фоновой задачи цикла событий", (), LATENCY_BUCKETS
+)
+loop_stalls = registry.histogram(
+    "bot_event_loop_stall_seconds", "Длительность блокировок цикла событий выше порога", ("blocker",), LATENCY_BUCKETS
+)
+
+
+class LoopMonitor:
+    """Фоновая задача измерения задержки и сторожевой поток."""
+
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL, threshold_ms: float = LOOP_LAG_THRESHOLD_MS):
+        self.interval = interval
+        self.threshold = threshold_ms / 1000
+        self.last_beat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        # Стек, снятый сторожевым потоком во время текущей блокировки
+        self.captured_stack: Optional[str] = None
+        self.captured_blocker: Optional[str] = None
+        self._stall_captured = False
+        self._stopped = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        watchdog = threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True)
+        watchdog.start()
+        logging.info(f"Контроль задержек цикла событий запущен (порог {self.threshold * 1000:.0f} мс)")
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while not self._stopped.is_set():
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.last_beat = now
+
+            with registry.lock:
+                loop_lag.observe(lag)
+            if lag >= self.threshold:
+                self._report_stall(lag)
+
+    def _report_stall(self, lag: float):
+        blocker = self.captured_blocker or "unknown"
+        with registry.lock:
+            loop_stalls.observe(lag, blocker)
+        if self.captured_stack:
+            logging.warning(
+                f"Цикл событий был заблокирован на {lag * 1000:.0f} мс, блокирующий код: {blocker}\n"
+                f"{self.captured_stack}"
+            )
+        else:
+            logging.warning(f"Цикл событий был заблокирован на {lag * 1000:.0f} мс")
+        self.captured_stack = None
+        self.captured_blocker = None
+        self._stall_captured = False
+
+    def _watchdog(self):
+        while not self._stopped.wait(self.threshold / 2):
+            blocked_for = time.monotonic() - self.last_beat - self.interval
+            if blocked_for < self.threshold or self._stall_captured:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)[-MAX_STACK_FRAMES:]
+            self.captured_blocker = _find_blocker(stack)
+            self.captured_stack = (
+                f"Стек потока цикла через {blocked_for * 1000:.0f} мс блокировки:\n"
+                + "".join(traceback.format_list(stack))
+            )
+            self._stall_captured = True
+
+
+def _find_blocker(stack) -> str:
+    """Самый глубокий кадр из кода бота — обычно это и есть блокирующая корутина."""
+    for frame in reversed(stack):
+        path = frame.filename.replace("\\", "/")
+        if "/handlers/" in path:
+            module = "handlers." + path.rsplit("/", 1)[-1][:-3]
+            return f"{module}.{frame.name}"
+    for frame in reversed(stack):
+        if "site-packages" not in frame.filename and "/lib/python" not in frame.filename:
+            return f"{frame.filename.rsplit('/', 1)[-1]}:{frame.name}"
+    return "unknown"
+
+
+monitor = LoopMonitor()
@@ -1,3 +1,7 @@
+import time
+# Момент старта процесса — от него считается отчет о запуске
+STARTUP_STARTED_AT = time.perf_counter()
+
 import asyncio
 import logging
 import os
@@ -19,15 +23,20 @@ from handlers import (
     super_admin,
     back_handler,
     warehouse_callbacks,
+    inline_stock,
 )
 from handlers.admin import cmd_users, cmd_report, cmd_assign_role
 from handlers.sales import handle_warehouse_order, handle_stock, handle_create_order
 from handlers.warehouse import cmd_stock, cmd_confirm_order, cmd_income_materials
 from navigation import get_role_keyboard, MenuState, go_back, get_menu_keyboard, get_main_menu_state_for_role
-import http.server
-import socketserver
 import threading
-from flask import Flask
+import metrics
+import slow_query_log
+import profiler
+import loop_monitor
+import stock_monitor
+import report_scheduler
+from startup import StartupTimer, schema_is_current
 
 # Load environment variables
 load_dotenv()
@@ -39,10 +48,20 @@ APP_URL = os.getenv("APP_URL", "")  # URL приложения Heroku, если
 # Enable logging
 logging.basicConfig(level=logging.INFO)
 
+startup_timer = StartupTimer(STARTUP_STARTED_AT)
+startup_timer.mark("Импорт модулей")
+
 # Initialize bot and dispatcher
 bot = Bot(token=TOKEN)
 dp = Dispatcher(storage=MemoryStorage())
 
+# Метрики производительности: время обработчиков, SQL и вызовы Telegram API
+metrics.setup_metrics(dp, bot, engine)
+# Журнал медленных запросов (порог и EXPLAIN настраиваются переменными окружения)
+slow_query_log.install(engine)
+# Профилирование апдейтов по команде /profile
+profiler.setup_profiler(dp)
+
 # Register all handlers
 dp.include_router(super_admin.router)
 dp.include_router(admin.router)
@@ -52,16 +71,28 @@ dp.include_router(warehouse.router)
 dp.include_router(production_orders.router)
 dp.include_router(orders.router)
 dp.include_router(warehouse_callbacks.router)
+dp.include_router(inline_stock.router)
 dp.include_router(back_handler.router)
 
-# Создаем Flask приложение
-app = Flask(__name__)
+startup_timer.mark("Регистрация роутеров и middleware")
+
+def create_web_app():
+    """Создает Flask-приложение. Flask импортируется только при запуске веб-сервера."""
+    from flask import Flask, Response
+
+    app = Flask(__name__)
+
+    @app.route('/')
+    def home():
+        return "Бот запущен и работает!"
 
-@app.route('/')
-def home():
-    return "Бот запущен и работает!"
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
 
-def run_flask():
+    return app
+
+def run_flask(app):
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
 
@@ -646,26 +677,64 @@ async def assign_role(message: Message, state: FSMContext, role: UserRole, role_
     finally:
         db.close()
 
+async def _timed_in_thread(func):
+    """Выполняет синхронную функцию в потоке и возвращает длительность ее работы."""
+    started_at = time.perf_counter()
+    await asyncio.to_thread(func)
+    return time.perf_counter() - started_at
+
+def _log_task_error(task: asyncio.Task):
+    """Пишет в лог ошибку фоновой задачи запуска, чтобы она не потерялась."""
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Ошибка фоновой задачи запуска: {task.exception()}", exc_info=task.exception())
+
+async def _log_startup_report(bootstrap):
+    try:
+        startup_timer.add("Создание админа (параллельно)", await bootstrap)
+    except Exception:
+        pass  # ошибку уже записал _log_task_error, отчет выводим без этой фазы
+    logging.info(startup_timer.report())
+
 # Основная функция запуска бота
 async def main():
+    # Контроль задержек цикла событий (метрики и стеки блокирующих вызовов)
+    loop_monitor.monitor.start()
+    # Уведомления о низких остатках супер-админам и производству
+    stock_monitor.monitor.start(bot)
+    # Подготовка отчетов в часы низкой нагрузки и рассылка сводок
+    report_scheduler.scheduler.start(bot)
+    # Создание дефолтного пользователя-админа идет параллельно с подключением к Telegram
+    bootstrap = asyncio.create_task(_timed_in_thread(create_default_user_if_not_exists))
+    bootstrap.add_done_callback(_log_task_error)
+    report_task = None
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
+        with startup_timer.phase("Сброс вебхука Telegram"):
+            await bot.delete_webhook(drop_pending_updates=True)
+        report_task = asyncio.create_task(_log_startup_report(bootstrap))
+        report_task.add_done_callback(_log_task_error)
         await dp.start_polling(bot)
     finally:
+        loop_monitor.monitor.stop()
+        stock_monitor.monitor.stop()
+        report_scheduler.scheduler.stop()
+        # Дожидаемся фоновых задач запуска (в том числе если сброс вебхука упал)
+        await asyncio.gather(report_task or bootstrap, return_exceptions=True)
         await bot.session.close()
 
 if __name__ == "__main__":
-    # Создание таблиц, если они не существуют
-    Base.metadata.create_all(engine)
-    
-    # Создание дефолтного пользователя-админа
-    create_default_user_if_not_exists()
+    # Создание таблиц нужно только если БД не на последней ревизии миграций
+    with startup_timer.phase("Проверка схемы БД"):
+        schema_current = schema_is_current(engine)
+    if not schema_current:
+        with startup_timer.phase("Создание таблиц (create_all)"):
+            Base.metadata.create_all(engine)
     
     # Запускаем Flask-сервер в отдельном потоке, если мы на Heroku
     if os.getenv("HEROKU", "0") == "1":
-        flask_thread = threading.Thread(target=run_flask)
-        flask_thread.daemon = True
-        flask_thread.start()
+        with startup_timer.phase("Запуск веб-сервера Flask"):
+            flask_thread = threading.Thread(target=run_flask, args=(create_web_app(),))
+            flask_thread.daemon = True
+            flask_thread.start()
         logging.info("Запущен веб-сервер Flask для Heroku")
     
     # Запускаем бота
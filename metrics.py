@@ -0,0 +1,346 @@
+"""Метрики производительности: время обработчиков, SQL-запросы и вызовы Telegram API.
+
+Данные хранятся в памяти процесса бота: накопительные гистограммы отдаются
+в формате Prometheus через Flask (`/metrics`), а окно последнего часа
+используется в меню супер-админа "📈 Производительность".
+"""
+import re
+import threading
+import time
+from collections import deque, defaultdict
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from sqlalchemy import event
+
+# Границы корзин гистограмм (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Границы корзин для количества SQL-запросов на один апдейт
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+WINDOW_SECONDS = 3600
+# Ограничение на количество хранимых сэмплов окна, чтобы не расти без предела
+MAX_WINDOW_SAMPLES = 20000
+
+UNHANDLED = "unhandled"
+
+
+class Histogram:
+    """Накопительная гистограмма с метками в стиле Prometheus."""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...], buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики корзин..., сумма, количество]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._values.get(labels)
+        if series is None:
+            series = [0] * len(self.buckets) + [0.0, 0]
+            self._values[labels] = series
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._values.items()):
+            base = _format_labels(self.label_names, labels)
+            for bound, count in zip(self.buckets, series):
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_join_labels(base, le)} {count}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_join_labels(base, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_wrap_labels(base)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{_wrap_labels(base)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    """Накопительный счетчик с метками в стиле Prometheus."""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, amount: float, *labels: str):
+        self._values[labels] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_wrap_labels(_format_labels(self.label_names, labels))} {value:g}")
+        return lines
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    return ",".join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values))
+
+
+def _join_labels(base: str, extra: str) -> str:
+    return "{" + (f"{base},{extra}" if base else extra) + "}"
+
+
+def _wrap_labels(base: str) -> str:
+    return "{" + base + "}" if base else ""
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса. Пишется из цикла событий, читается из потока Flask."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: List[Any] = []
+        self.handler_samples = deque(maxlen=MAX_WINDOW_SAMPLES)
+        self.query_samples = deque(maxlen=MAX_WINDOW_SAMPLES)
+
+    def histogram(self, name: str, documentation: str, label_names=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, tuple(label_names), buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names=()) -> Counter:
+        metric = Counter(name, documentation, tuple(label_names))
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        with self.lock:
+            lines = []
+            for metric in self.metrics:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+handler_duration = registry.histogram(
+    "bot_handler_duration_seconds", "Время обработки апдейта по обработчикам", ("handler",)
+)
+handler_sql_statements = registry.histogram(
+    "bot_handler_sql_statements", "Количество SQL-запросов на один апдейт", ("handler",), STATEMENT_BUCKETS
+)
+sql_duration = registry.histogram(
+    "bot_sql_query_duration_seconds", "Время выполнения SQL-запросов", ("operation",)
+)
+sql_statements_total = registry.counter(
+    "bot_sql_statements_total", "Количество выполненных SQL-запросов", ("operation",)
+)
+sql_rows_total = registry.counter(
+    "bot_sql_rows_total", "Количество строк, затронутых или возвращенных SQL-запросами", ("operation",)
+)
+telegram_request_duration = registry.histogram(
+    "bot_telegram_request_duration_seconds", "Время вызовов Telegram Bot API", ("method", "status")
+)
+
+
+class UpdateContext:
+    """Сведения о текущем апдейте, которые накапливаются по ходу обработки."""
+
+    __slots__ = ("handler", "started_at", "sql_statements", "sql_rows", "sql_time")
+
+    def __init__(self):
+        self.handler = UNHANDLED
+        self.started_at = time.perf_counter()
+        self.sql_statements = 0
+        self.sql_rows = 0
+        self.sql_time = 0.0
+
+
+_current_update: ContextVar[Optional[UpdateContext]] = ContextVar("current_update", default=None)
+
+
+def current_handler_name() -> Optional[str]:
+    """Имя обработчика, внутри которого выполняется текущий код (если известно)."""
+    context = _current_update.get()
+    return context.handler if context else None
+
+
+def handler_name(callback: Callable) -> str:
+    """Полное имя обработчика в виде модуль.функция."""
+    return f"{getattr(callback, '__module__', '?')}.{getattr(callback, '__qualname__', repr(callback))}"
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware: измеряет полное время обработки каждого апдейта."""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = UpdateContext()
+        token = _current_update.set(context)
+        try:
+            return await handler(event, data)
+        finally:
+            _current_update.reset(token)
+            duration = time.perf_counter() - context.started_at
+            with registry.lock:
+                handler_duration.observe(duration, context.handler)
+                handler_sql_statements.observe(context.sql_statements, context.handler)
+                registry.handler_samples.append(
+                    (time.time(), context.handler, duration, context.sql_statements, context.sql_rows)
+                )
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутренний middleware: запоминает имя обработчика, выбранного фильтрами."""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = _current_update.get()
+        handler_object = data.get("handler")
+        if context is not None and handler_object is not None:
+            context.handler = handler_name(handler_object.callback)
+        return await handler(event, data)
+
+
+class TelegramRequestMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: измеряет время вызовов Telegram API."""
+
+    async def __call__(self, make_request, bot, method):
+        started_at = time.perf_counter()
+        status = "ok"
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            duration = time.perf_counter() - started_at
+            with registry.lock:
+                telegram_request_duration.observe(duration, type(method).__name__, status)
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_statement(statement: str, limit: int = 300) -> str:
+    """Приводит текст запроса к одной строке для группировки."""
+    statement = _WHITESPACE_RE.sub(" ", statement).strip()
+    return statement if len(statement) <= limit else statement[:limit] + "…"
+
+
+def _statement_operation(statement: str) -> str:
+    parts = statement.lstrip().split(None, 1)
+    return parts[0].upper() if parts else "?"
+
+
+def install_sql_instrumentation(engine):
+    """Подписывается на события движка SQLAlchemy для подсчета запросов и строк."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("metrics_query_start")
+        if not starts:
+            return
+        duration = time.perf_counter() - starts.pop()
+        rows = max(cursor.rowcount or 0, 0)
+        operation = _statement_operation(statement)
+
+        update = _current_update.get()
+        if update is not None:
+            update.sql_statements += 1
+            update.sql_rows += rows
+            update.sql_time += duration
+
+        with registry.lock:
+            sql_duration.observe(duration, operation)
+            sql_statements_total.inc(1, operation)
+            sql_rows_total.inc(rows, operation)
+            registry.query_samples.append(
+                (time.time(), normalize_statement(statement), duration, rows,
+                 update.handler if update is not None else None)
+            )
+
+
+def setup_metrics(dp, bot, engine):
+    """Подключает все middleware и обработчики событий к боту и движку БД."""
+    install_sql_instrumentation(engine)
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    # Внутренние middleware диспетчера применяются и ко всем вложенным роутерам
+    dp.message.middleware(HandlerNameMiddleware())
+    dp.callback_query.middleware(HandlerNameMiddleware())
+    dp.inline_query.middleware(HandlerNameMiddleware())
+    bot.session.middleware(TelegramRequestMetricsMiddleware())
+
+
+def render_prometheus() -> str:
+    return registry.render()
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def slowest_handlers(window: int = WINDOW_SECONDS, limit: int = 10) -> List[Dict[str, Any]]:
+    """Самые медленные обработчики за окно (по 95-му перцентилю)."""
+    since = time.time() - window
+    grouped = defaultdict(list)
+    statements = defaultdict(int)
+    with registry.lock:
+        samples = [sample for sample in registry.handler_samples if sample[0] >= since]
+    for _, name, duration, sql_count, _ in samples:
+        grouped[name].append(duration)
+        statements[name] += sql_count
+
+    result = []
+    for name, durations in grouped.items():
+        result.append({
+            "handler": name,
+            "count": len(durations),
+            "avg": sum(durations) / len(durations),
+            "p95": _percentile(durations, 95),
+            "max": max(durations),
+            "avg_sql": statements[name] / len(durations),
+        })
+    result.sort(key=lambda item: item["p95"], reverse=True)
+    return result[:limit]
+
+
+def heaviest_queries(window: int = WINDOW_SECONDS, limit: int = 10) -> List[Dict[str, Any]]:
+    """Самые тяжелые запросы за окно (по суммарному времени)."""
+    since = time.time() - window
+    grouped: Dict[str, Dict[str, Any]] = {}
+    with registry.lock:
+        samples = [sample for sample in registry.query_samples if sample[0] >= since]
+    for _, statement, duration, rows, handler in samples:
+        item = grouped.get(statement)
+        if item is None:
+            item = grouped[statement] = {
+                "statement": statement, "count": 0, "total": 0.0, "max": 0.0, "rows": 0, "handlers": set()
+            }
+        item["count"] += 1
+        item["total"] += duration
+        item["max"] = max(item["max"], duration)
+        item["rows"] += rows
+        if handler:
+            item["handlers"].add(handler)
+
+    result = sorted(grouped.values(), key=lambda item: item["total"], reverse=True)
+    return result[:limit]
@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Enum as SQLEnum, BigInteger, Boolean, Date
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Enum as SQLEnum, BigInteger, SmallInteger, Boolean, Date, Text, UniqueConstraint, Index, Computed, DDL, event, join, text
+from sqlalchemy.orm import relationship, column_property, synonym
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from datetime import datetime
@@ -7,6 +8,38 @@ import enum
 
 Base = declarative_base()
 
+
+class Thickness(TypeDecorator):
+    """Толщина в мм; в БД — целое число сотых долей мм (0.5 -> 50, 0.8 -> 80).
+
+    Сравнение с 0.5 в запросе превращается в точное «= 50» по индексу, а не в
+    сравнение чисел с плавающей точкой. В коде по-прежнему float.
+    """
+    impl = SmallInteger
+    cache_ok = True
+    scale = 100
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else int(round(float(value) * self.scale))
+
+    def process_literal_param(self, value, dialect):
+        return str(self.process_bind_param(value, dialect))
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else value / self.scale
+
+    @property
+    def python_type(self):
+        return float
+
+
+class FilmLength(Thickness):
+    """Длина пленки в метрах; в БД — целое число миллиметров, суммы считаются без погрешности."""
+    impl = Integer
+    cache_ok = True
+    scale = 1000
+
+
 class UserRole(enum.Enum):
     NONE = "Ожидание роли"
     SUPER_ADMIN = "Супер-администратор"
@@ -40,14 +73,27 @@ class User(Base):
 
     operations = relationship("Operation", back_populates="user")
 
+# Сколько панелей хватит пленки (то же правило, что Film.calculate_possible_panels);
+# обе колонки в миллиметрах, целочисленное деление отбрасывает дробную часть
+POSSIBLE_PANELS_SQL = (
+    "CASE WHEN panel_consumption > 0 THEN total_remaining / panel_consumption ELSE 0 END"
+)
+
 class Film(Base):
     __tablename__ = "films"
+    __table_args__ = (
+        # Клавиатура выбора пленки: WHERE possible_panels > 0 ORDER BY code
+        Index('ix_films_code_available', 'code', postgresql_where=text('possible_panels > 0')),
+    )
     
     id = Column(Integer, primary_key=True)
     code = Column(String, unique=True, nullable=False)
-    panel_consumption = Column(Float, nullable=False, default=3.0)  # Расход на одну панель в метрах
-    meters_per_roll = Column(Float, nullable=False, default=50.0)  # Метров в одном рулоне
-    total_remaining = Column(Float, nullable=False, default=0)  # Общее количество оставшихся метров
+    panel_consumption = Column(FilmLength, nullable=False, default=3.0)  # Расход на одну панель в метрах
+    meters_per_roll = Column(FilmLength, nullable=False, default=50.0)  # Метров в одном рулоне
+    total_remaining = Column(FilmLength, nullable=False, default=0)  # Общее количество оставшихся метров
+    # Вычисляется в БД при каждом изменении остатка или расхода; у объекта, измененного в
+    # текущей сессии, значение обновится только после перечитывания — там calculate_possible_panels()
+    possible_panels = Column(Integer, Computed(POSSIBLE_PANELS_SQL, persisted=True))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -63,19 +109,26 @@ class Film(Base):
 
 class Panel(Base):
     __tablename__ = "panels"
+    __table_args__ = (
+        # Одна строка на толщину — ключ для INSERT ... ON CONFLICT при импорте прихода
+        UniqueConstraint('thickness', name='uq_panels_thickness'),
+    )
     
     id = Column(Integer, primary_key=True)
     quantity = Column(Integer, default=0)  # Количество панелей (каждая по 3 метра)
-    thickness = Column(Float, nullable=False, default=0.5)  # Толщина панели (0.5 или 0.8)
+    thickness = Column(Thickness, nullable=False, default=0.5)  # Толщина панели (0.5 или 0.8)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
 class Joint(Base):
     __tablename__ = "joints"
+    __table_args__ = (
+        UniqueConstraint('type', 'color', 'thickness', name='uq_joints_type_color_thickness'),
+    )
     
     id = Column(Integer, primary_key=True)
     type = Column(SQLEnum(JointType), nullable=False)  # Тип стыка
-    thickness = Column(Float, nullable=False)  # Толщина (0.5 или 0.8)
+    thickness = Column(Thickness, nullable=False)  # Толщина (0.5 или 0.8)
     color = Column(String, nullable=False)    # Цвет стыка
     quantity = Column(Integer, default=0)     # Количество
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -95,7 +148,7 @@ class FinishedProduct(Base):
     id = Column(Integer, primary_key=True)
     film_id = Column(Integer, ForeignKey('films.id'), nullable=False)
     quantity = Column(Integer, default=0)
-    thickness = Column(Float, nullable=False, default=0.5)  # Толщина панели (0.5 или 0.8)
+    thickness = Column(Thickness, nullable=False, default=0.5)  # Толщина панели (0.5 или 0.8)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
@@ -120,7 +173,7 @@ class ProductionOrder(Base):
     manager_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     panel_quantity = Column(Integer, nullable=False)
     film_color = Column(String, nullable=False)
-    panel_thickness = Column(Float, nullable=False, default=0.5)  # Толщина панели (0.5 или 0.8)
+    panel_thickness = Column(Thickness, nullable=False, default=0.5)  # Толщина панели (0.5 или 0.8)
     status = Column(String, default="new")  # new, in_progress, completed
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     completed_at = Column(DateTime(timezone=True), nullable=True)
@@ -144,7 +197,8 @@ class OrderJoint(Base):
     joint_type = Column(SQLEnum(JointType), nullable=False)
     joint_color = Column(String, nullable=False)
     joint_quantity = Column(Integer, nullable=False)
-    joint_thickness = Column(Float, nullable=False, default=0.5)  # Толщина стыка (0.5 или 0.8)
+    joint_thickness = Column(Thickness, nullable=False, default=0.5)  # Толщина стыка (0.5 или 0.8)
+    returned_quantity = Column(Integer, nullable=False, default=0, server_default='0')  # Возвращено на склад
     
     order = relationship("Order", back_populates="joints")
     
@@ -164,7 +218,8 @@ class OrderItem(Base):
     order_id = Column(Integer, ForeignKey('orders.id', ondelete='CASCADE'), nullable=False)
     quantity = Column(Integer, nullable=False)
     color = Column(String, nullable=False)
-    thickness = Column(Float, nullable=False, default=0.5)  # Толщина продукции (0.5 или 0.8)
+    thickness = Column(Thickness, nullable=False, default=0.5)  # Толщина продукции (0.5 или 0.8)
+    returned_quantity = Column(Integer, nullable=False, default=0, server_default='0')  # Возвращено на склад
     
     order = relationship("Order", back_populates="products")
 
@@ -174,21 +229,40 @@ class OrderGlue(Base):
     id = Column(Integer, primary_key=True)
     order_id = Column(Integer, ForeignKey('orders.id', ondelete='CASCADE'), nullable=False)
     quantity = Column(Integer, nullable=False)
+    returned_quantity = Column(Integer, nullable=False, default=0, server_default='0')  # Возвращено на склад
     
     order = relationship("Order", back_populates="glues")
 
+# Телефон без форматирования: только цифры, российская 8 в начале заменяется на 7
+# (то же правило, что customer_search.normalize_phone)
+PHONE_NORMALIZED_SQL = r"regexp_replace(regexp_replace(customer_phone, '\D', '', 'g'), '^8(\d{10})$', '7\1')"
+
+# Триграммные индексы поиска требуют расширения pg_trgm и при create_all
+event.listen(Base.metadata, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        # Keyset-пагинация списков заказов по статусу: (created_at, id) после курсора
+        Index('ix_orders_status_created_at_id', 'status', 'created_at', 'id'),
+        # Поиск заказов клиента: точный телефон, часть телефона и часть адреса (pg_trgm)
+        Index('ix_orders_customer_phone_normalized', 'customer_phone_normalized', 'created_at'),
+        Index('ix_orders_customer_phone_trgm', 'customer_phone_normalized',
+              postgresql_using='gin', postgresql_ops={'customer_phone_normalized': 'gin_trgm_ops'}),
+        Index('ix_orders_delivery_address_trgm', 'delivery_address',
+              postgresql_using='gin', postgresql_ops={'delivery_address': 'gin_trgm_ops'}),
+    )
     
     id = Column(Integer, primary_key=True)
     manager_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     installation_required = Column(Boolean, default=False)
     customer_phone = Column(String, nullable=True)
+    customer_phone_normalized = Column(String, Computed(PHONE_NORMALIZED_SQL, persisted=True))
     delivery_address = Column(String, nullable=True)
     shipment_date = Column(Date, nullable=True)
     payment_method = Column(String, nullable=True)
     status = Column(SQLEnum(OrderStatus), nullable=False, default=OrderStatus.NEW.value)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())  # ключ keyset-пагинации
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     completed_at = Column(DateTime(timezone=True), nullable=True)
     
@@ -197,6 +271,7 @@ class Order(Base):
     products = relationship("OrderItem", back_populates="order", cascade="all, delete-orphan")
     joints = relationship("OrderJoint", back_populates="order", cascade="all, delete-orphan")
     glues = relationship("OrderGlue", back_populates="order", cascade="all, delete-orphan")
+    completion = relationship("OrderCompletion", uselist=False, cascade="all, delete-orphan", passive_deletes=True)
 
     # Backward compatibility properties
     @property
@@ -249,61 +324,89 @@ class CompletedOrderStatus(enum.Enum):
     RETURN_REQUESTED = "return_requested"
     RETURNED = "returned"
     RETURN_REJECTED = "return_rejected"
+    PARTIALLY_RETURNED = "partially_returned"
 
-class CompletedOrderJoint(Base):
-    __tablename__ = "completed_order_joints"
-    
-    id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('completed_orders.id', ondelete='CASCADE'), nullable=False)
-    joint_type = Column(SQLEnum(JointType), nullable=False)
-    joint_color = Column(String, nullable=False)
-    quantity = Column(Integer, nullable=False)
-    joint_thickness = Column(Float, nullable=False, default=0.5)  # Толщина стыка (0.5 или 0.8)
-    
-    order = relationship("CompletedOrder", back_populates="joints")
+# Статусы, из которых можно запросить возврат (в том числе остатка после частичного возврата)
+RETURNABLE_COMPLETED_STATUSES = (CompletedOrderStatus.COMPLETED.value, CompletedOrderStatus.PARTIALLY_RETURNED.value)
 
-class CompletedOrderItem(Base):
-    __tablename__ = "completed_order_items"
-    
-    id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('completed_orders.id', ondelete='CASCADE'), nullable=False)
-    quantity = Column(Integer, nullable=False)
-    color = Column(String, nullable=False)
-    thickness = Column(Float, nullable=False, default=0.5)  # Толщина продукции (0.5 или 0.8)
-    
-    order = relationship("CompletedOrder", back_populates="items")
+class OrderCompletion(Base):
+    """Метаданные выполнения заказа: кто и когда отгрузил, статус возврата.
 
-class CompletedOrderGlue(Base):
-    __tablename__ = "completed_order_glues"
-    
-    id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('completed_orders.id', ondelete='CASCADE'), nullable=False)
-    quantity = Column(Integer, nullable=False)
-    
-    order = relationship("CompletedOrder", back_populates="glues")
+    Сам заказ и его позиции остаются в orders и order_*: выполнение заказа —
+    это смена статуса на COMPLETED и одна строка в этой таблице.
+    """
+    __tablename__ = "order_completions"
+    __table_args__ = (
+        Index('ix_order_completions_completed_at', 'completed_at'),
+        Index('ix_order_completions_status', 'status'),
+        Index('ix_order_completions_status_completed_at', 'status', 'completed_at', 'order_id'),
+    )
 
-class CompletedOrder(Base):
-    __tablename__ = "completed_orders"
-    
-    id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, unique=True, nullable=False)  # ID исходного заказа
-    manager_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    order_id = Column(Integer, ForeignKey('orders.id', ondelete='CASCADE'), primary_key=True)
     warehouse_user_id = Column(Integer, ForeignKey('users.id'), nullable=False)  # ID складовщика, выполнившего заказ
-    installation_required = Column(Boolean, default=False)
-    customer_phone = Column(String, nullable=False)
-    delivery_address = Column(String, nullable=False)
-    shipment_date = Column(Date, nullable=True)
-    payment_method = Column(String, nullable=True)
-    completed_at = Column(DateTime(timezone=True), server_default=func.now())
+    completed_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
     # Use String instead of SQLEnum
     status = Column(String(50), nullable=False, default=CompletedOrderStatus.COMPLETED.value, server_default=CompletedOrderStatus.COMPLETED.value)
     updated_at = Column(DateTime(timezone=True), nullable=True, onupdate=func.now())
-    
-    manager = relationship("User", foreign_keys=[manager_id])
-    warehouse_user = relationship("User", foreign_keys=[warehouse_user_id])
-    joints = relationship("CompletedOrderJoint", back_populates="order", cascade="all, delete-orphan")
-    items = relationship("CompletedOrderItem", back_populates="order", cascade="all, delete-orphan")
-    glues = relationship("CompletedOrderGlue", back_populates="order", cascade="all, delete-orphan")
+
+
+class CompletedOrder(Base):
+    """Выполненный заказ: orders JOIN order_completions.
+
+    Отдельных таблиц выполненных заказов больше нет: id совпадает с номером
+    исходного заказа, позиции берутся из order_items/order_joints/order_glues.
+    Изменение status пишет только в order_completions.
+    """
+    __table__ = join(Order.__table__, OrderCompletion.__table__)
+
+    id = column_property(Order.__table__.c.id, OrderCompletion.__table__.c.order_id)
+    order_id = synonym("id")  # Номер исходного заказа — тот же самый
+    status = OrderCompletion.__table__.c.status
+    completed_at = OrderCompletion.__table__.c.completed_at
+    updated_at = OrderCompletion.__table__.c.updated_at
+    order_status = column_property(Order.__table__.c.status)
+    order_completed_at = column_property(Order.__table__.c.completed_at)
+    order_updated_at = column_property(Order.__table__.c.updated_at)
+
+    manager = relationship("User", foreign_keys=[Order.__table__.c.manager_id], viewonly=True)
+    warehouse_user = relationship("User", foreign_keys=[OrderCompletion.__table__.c.warehouse_user_id], viewonly=True)
+    items = relationship(
+        "OrderItem", primaryjoin="OrderItem.order_id == CompletedOrder.id",
+        foreign_keys="OrderItem.order_id", viewonly=True
+    )
+    joints = relationship(
+        "OrderJoint", primaryjoin="OrderJoint.order_id == CompletedOrder.id",
+        foreign_keys="OrderJoint.order_id", viewonly=True
+    )
+    glues = relationship(
+        "OrderGlue", primaryjoin="OrderGlue.order_id == CompletedOrder.id",
+        foreign_keys="OrderGlue.order_id", viewonly=True
+    )
+
+    # Те же свойства, что и у Order, для отчетов
+    @property
+    def products(self):
+        return self.items
+
+    @property
+    def glue_quantity(self):
+        return sum([glue.quantity for glue in self.glues]) if self.glues else 0
+
+    @property
+    def joint_quantity(self):
+        return sum([joint.quantity for joint in self.joints]) if self.joints else 0
+
+    @property
+    def joint_color(self):
+        return self.joints[0].joint_color if self.joints and len(self.joints) > 0 else None
+
+    @property
+    def film_code(self):
+        return self.items[0].color if self.items and len(self.items) > 0 else None
+
+    @property
+    def panel_quantity(self):
+        return sum([item.quantity for item in self.items]) if self.items else 0
 
     def to_dict(self):
         joints_data = [{"type": joint.joint_type.value, "color": joint.joint_color, "quantity": joint.quantity, "thickness": joint.joint_thickness} for joint in self.joints] if self.joints else []
@@ -324,6 +427,18 @@ class CompletedOrder(Base):
             "status": self.status
         } 
 
+class SlowQuery(Base):
+    """Запрос, превысивший порог времени выполнения (журнал медленных запросов)"""
+    __tablename__ = "slow_queries"
+
+    id = Column(Integer, primary_key=True)
+    captured_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    duration_ms = Column(Float, nullable=False)
+    statement = Column(Text, nullable=False)
+    parameters = Column(Text)  # Параметры запроса (repr, обрезаны)
+    handler = Column(String(255))  # Обработчик, из которого выполнялся запрос
+    explain = Column(Text)  # Вывод EXPLAIN (ANALYZE, BUFFERS), если включен
+
 # Commented out because they reference a non-existent "products" table
 # and conflict with existing relationship between Order and OrderItem
 #class OrderProduct(Base):
@@ -340,15 +455,94 @@ class CompletedOrder(Base):
 #    product = relationship("Product")
 
 
-#class StockReservation(Base):
-#    __tablename__ = "stock_reservations"
-#
-#    id = Column(Integer, primary_key=True, index=True)
-#    order_id = Column(Integer, ForeignKey("orders.id", ondelete="CASCADE"))
-#    product_id = Column(Integer, ForeignKey("products.id"))
-#    quantity = Column(Integer)
-#    created_at = Column(DateTime, default=datetime.utcnow)
-#    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-#
-#    order = relationship("Order")
-#    product = relationship("Product") 
\ No newline at end of file
+class StockReservation(Base):
+    """Резерв позиции склада под забронированный заказ.
+
+    Остаток на складе при бронировании не меняется: доступно = на складе − сумма резервов.
+    """
+    __tablename__ = "stock_reservations"
+    __table_args__ = (
+        UniqueConstraint('order_id', 'sku_type', 'sku_id', name='uq_stock_reservations_order_sku'),
+        # Покрывающий индекс для агрегата SUM(quantity) по позиции склада
+        Index('ix_stock_reservations_sku', 'sku_type', 'sku_id', postgresql_include=['quantity']),
+    )
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=False)
+    sku_type = Column(String(20), nullable=False)  # finished_product, joint или glue
+    sku_id = Column(Integer, nullable=False)  # ID записи в соответствующей таблице склада
+    quantity = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    order = relationship("Order")
+
+
+class IdempotencyKey(Base):
+    """Ключ идемпотентности создания сущности (заказа, заказа на производство, отгрузки).
+
+    Повторная отправка с тем же ключом возвращает уже созданную сущность.
+    """
+    __tablename__ = "idempotency_keys"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String(64), unique=True, nullable=False)  # SHA-256 от области, чата и черновика
+    scope = Column(String(30), nullable=False)  # order, production_order или shipment
+    entity_id = Column(Integer, nullable=True)  # ID созданной сущности
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class StockThreshold(Base):
+    """Порог низкого остатка позиции склада для фонового контроля (stock_monitor).
+
+    sku — ключ позиции из reorder_forecast (film:<код>, panel:<толщина>,
+    joint:<вид>:<цвет>:<толщина>, glue) или <материал>:* — порог для всех
+    позиций материала, у которых нет своего.
+    """
+    __tablename__ = "stock_thresholds"
+
+    id = Column(Integer, primary_key=True)
+    sku = Column(String(120), unique=True, nullable=False)
+    threshold = Column(Float, nullable=False)  # метры для пленки, штуки для остального
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+class ScheduledReport(Base):
+    """Отчет, который планировщик (report_scheduler) готовит заранее.
+
+    next_run_at хранится в БД, поэтому расписание переживает перезапуск бота,
+    а пропущенный за время простоя запуск выполняется сразу после старта.
+    """
+    __tablename__ = "scheduled_reports"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String(50), unique=True, nullable=False)  # daily_digest, weekly_digest, analytics_30 и т.п.
+    next_run_at = Column(DateTime, nullable=False)  # UTC
+    last_run_at = Column(DateTime, nullable=True)  # UTC, момент последней успешной подготовки
+    content = Column(Text, nullable=True)  # Готовый отчет (для сводок — JSON с разделами)
+
+
+class ReportSubscription(Base):
+    """Подписка пользователя на рассылку сводки (/digest)."""
+    __tablename__ = "report_subscriptions"
+    __table_args__ = (
+        UniqueConstraint('user_id', 'report_key', name='uq_report_subscriptions_user_report'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    report_key = Column(String(50), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class DefectReport(Base):
+    """Пакетное списание брака (defect_batch): одна запись на сообщение со списком.
+
+    Строки списания — обычные операции брака в operations с details.defect_report_id.
+    """
+    __tablename__ = "defect_reports"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    line_count = Column(Integer, nullable=False)
+    note = Column(Text, nullable=True)  # Причина брака, если указана
@@ -155,6 +155,7 @@ def get_menu_keyboard(menu_state: MenuState, is_admin_context: bool = False) ->
             [KeyboardButton(text="🎨 Пленка")],
             [KeyboardButton(text="⚙️ Стык")],
             [KeyboardButton(text="🧴 Клей")],
+            [KeyboardButton(text="📄 Импорт из файла")],
             [KeyboardButton(text="◀️ Назад")]
         ],
         
@@ -164,6 +165,7 @@ def get_menu_keyboard(menu_state: MenuState, is_admin_context: bool = False) ->
             [KeyboardButton(text="⚙️ Стык")],
             [KeyboardButton(text="🧴 Клей")],
             [KeyboardButton(text="✅ Готовая панель")],
+            [KeyboardButton(text="📋 Пакетный брак")],
             [KeyboardButton(text="◀️ Назад")]
         ],
         
@@ -182,6 +184,7 @@ def get_menu_keyboard(menu_state: MenuState, is_admin_context: bool = False) ->
             [KeyboardButton(text="📝 Заказать")],
             [KeyboardButton(text="✅ Завершенные заказы")],
             [KeyboardButton(text="🔖 Забронированные заказы")],
+            [KeyboardButton(text="🔍 Поиск заказов")],
             [KeyboardButton(text="📦 Готовая продукция")],
             [KeyboardButton(text="🔖 Бронь")],
         ],
@@ -287,6 +290,7 @@ def get_menu_keyboard(menu_state: MenuState, is_admin_context: bool = False) ->
             [KeyboardButton(text="📦 Роль склада")],
             [KeyboardButton(text="🏭 Роль производства")],
             [KeyboardButton(text="Заказ в Китай")],
+            [KeyboardButton(text="📈 Производительность")],
         ],
         
         # Подменю супер-админа
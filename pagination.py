@@ -0,0 +1,120 @@
+"""Постраничный вывод списков заказов: keyset-курсоры и inline-клавиатуры.
+
+Страница выбирается условием (sort, id) < курсор с LIMIT, а не OFFSET, поэтому
+объем работы БД и размер сообщения не зависят от номера страницы и длины списка.
+Курсор (значение сортировки и id крайней строки) передается в callback_data
+кнопок «Назад»/«Далее», а страница перерисовывается через edit_message_text.
+"""
+import os
+from datetime import datetime, timezone, timedelta
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import tuple_
+
+# Количество заказов на одной странице списка
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "8"))
+
+FORWARD = "n"
+BACKWARD = "p"
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class Page(NamedTuple):
+    rows: List
+    has_prev: bool
+    has_next: bool
+    first_cursor: Optional[str]
+    last_cursor: Optional[str]
+
+
+def encode_cursor(sort_value: datetime, row_id: int) -> str:
+    """Курсор в виде «микросекунды.id» — укладывается в 64 байта callback_data."""
+    if sort_value.tzinfo is None:
+        sort_value = sort_value.replace(tzinfo=timezone.utc)
+    return f"{(sort_value - _EPOCH) // timedelta(microseconds=1)}.{row_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    micros, row_id = cursor.split(".")
+    return _EPOCH + timedelta(microseconds=int(micros)), int(row_id)
+
+
+def fetch_page(query, sort_column, id_column, cursor: Optional[str] = None, direction: str = FORWARD,
+               descending: bool = True, page_size: int = LIST_PAGE_SIZE) -> Page:
+    """Выбирает страницу после (FORWARD) или перед (BACKWARD) курсором.
+
+    Сортировка по (sort_column, id_column); descending=True — новые сверху.
+    Берется на одну строку больше, чтобы узнать, есть ли следующая страница.
+    """
+    key = tuple_(sort_column, id_column)
+    # Назад по списку — это обход в обратном порядке с последующим разворотом
+    reverse = direction == BACKWARD
+    walk_descending = descending != reverse
+    if cursor:
+        bound = tuple_(*decode_cursor(cursor))
+        query = query.filter(key < bound if walk_descending else key > bound)
+    if walk_descending:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(sort_column.asc(), id_column.asc())
+    rows = query.limit(page_size + 1).all()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if reverse:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor is not None, has_more
+
+    def row_cursor(row):
+        return encode_cursor(getattr(row, sort_column.key), getattr(row, id_column.key))
+
+    return Page(
+        rows=rows,
+        has_prev=has_prev,
+        has_next=has_next,
+        first_cursor=row_cursor(rows[0]) if rows else None,
+        last_cursor=row_cursor(rows[-1]) if rows else None,
+    )
+
+
+def navigation_row(prefix: str, page: Page) -> List[InlineKeyboardButton]:
+    """Кнопки перехода на соседние страницы; callback_data — «prefix:page:направление:курсор»."""
+    row = []
+    if page.has_prev:
+        row.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"{prefix}:page:{BACKWARD}:{page.first_cursor}"))
+    if page.has_next:
+        row.append(InlineKeyboardButton(text="Далее ▶️", callback_data=f"{prefix}:page:{FORWARD}:{page.last_cursor}"))
+    return row
+
+
+def page_keyboard(prefix: str, page: Page, item_button: Callable[[object], InlineKeyboardButton],
+                  per_row: int = 2, extra_rows: Optional[List[List[InlineKeyboardButton]]] = None) -> InlineKeyboardMarkup:
+    """Inline-клавиатура страницы: кнопки строк, дополнительные ряды и навигация."""
+    buttons = [item_button(row) for row in page.rows]
+    rows = [buttons[i:i + per_row] for i in range(0, len(buttons), per_row)]
+    rows.extend(extra_rows or [])
+    navigation = navigation_row(prefix, page)
+    if navigation:
+        rows.append(navigation)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def parse_page_callback(data: str) -> Tuple[Optional[str], str]:
+    """Разбирает «prefix:page:направление:курсор» в (курсор, направление)."""
+    parts = data.split(":")
+    return parts[3] or None, parts[2]
+
+
+async def edit_page(message, text: str, keyboard: Optional[InlineKeyboardMarkup]):
+    """Перерисовывает страницу в том же сообщении через edit_message_text."""
+    try:
+        await message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        # Повторное нажатие той же кнопки дает ту же страницу — это не ошибка
+        if "message is not modified" not in str(e):
+            raise
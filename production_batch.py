@@ -0,0 +1,163 @@
+"""Пакетный ввод производства: несколько строк «толщина код_пленки количество» за раз.
+
+Строки разбираются целиком, проверяются по одному снимку остатков пленки и
+панелей (строки склада блокируются SELECT ... FOR UPDATE) и проводятся одной
+транзакцией: пленка, панели и готовая продукция меняются агрегированными
+UPDATE ... CASE, операции записываются одной пакетной вставкой.
+"""
+import json
+import re
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import insert
+
+import film_index
+import stock
+from models import Film, Panel, Operation
+
+ALLOWED_THICKNESSES = (0.5, 0.8)
+MAX_BATCH_LINES = 50
+
+_LINE = re.compile(r"^\s*(\d+(?:[.,]\d+)?)\s+(.+?)\s+(\d+)\s*$")
+
+
+class BatchLine(NamedTuple):
+    number: int
+    thickness: float
+    film_code: str
+    quantity: int
+
+
+class LineResult(NamedTuple):
+    line: BatchLine
+    error: Optional[str] = None
+    film_used: float = 0.0
+
+
+def parse_batch(text: str) -> Tuple[List[BatchLine], List[str]]:
+    """Разбирает сообщение в строки производства; возвращает (строки, ошибки разбора)."""
+    lines, errors = [], []
+    for number, raw in enumerate((text or "").splitlines(), start=1):
+        if not raw.strip():
+            continue
+        match = _LINE.match(raw)
+        if not match:
+            errors.append(f"Строка {number}: «{raw.strip()}» — ожидается «толщина код количество»")
+            continue
+        thickness = float(match.group(1).replace(",", "."))
+        quantity = int(match.group(3))
+        if thickness not in ALLOWED_THICKNESSES:
+            errors.append(f"Строка {number}: толщина {thickness} мм не поддерживается (0.5 или 0.8)")
+        elif quantity <= 0:
+            errors.append(f"Строка {number}: количество должно быть положительным")
+        else:
+            lines.append(BatchLine(number, thickness, match.group(2).strip(), quantity))
+    if len(lines) > MAX_BATCH_LINES:
+        errors.append(f"За раз можно провести не больше {MAX_BATCH_LINES} строк")
+        lines = []
+    return lines, errors
+
+
+def apply_batch(db, lines: List[BatchLine], user_id: int) -> List[LineResult]:
+    """Проводит строки, которые укладываются в остатки, в порядке ввода.
+
+    Строки с неизвестной пленкой или нехваткой материалов пропускаются и
+    возвращаются с ошибкой. Коммит выполняет вызывающий код (stock.run_with_retry).
+    """
+    index = film_index.get_index()
+    codes = {line.number: index.exact(line.film_code) for line in lines}
+    stock.set_lock_timeout(db)
+    films = {
+        film.code: film
+        for film in db.query(Film).filter(Film.code.in_({code for code in codes.values() if code}))
+        .order_by(Film.id).with_for_update()
+    }
+    panels: Dict[float, Panel] = {}
+    for panel in db.query(Panel).filter(Panel.thickness.in_({line.thickness for line in lines})) \
+            .order_by(Panel.id).with_for_update():
+        panels.setdefault(panel.thickness, panel)
+
+    film_left = {code: film.total_remaining for code, film in films.items()}
+    panels_left = {thickness: panel.quantity or 0 for thickness, panel in panels.items()}
+    results = []
+    for line in lines:
+        film = films.get(codes[line.number])
+        panel = panels.get(line.thickness)
+        if not film:
+            results.append(LineResult(line, f"пленка {line.film_code} не найдена"))
+            continue
+        if not panel:
+            results.append(LineResult(line, f"нет панелей толщиной {line.thickness} мм"))
+            continue
+        required_film = line.quantity * film.panel_consumption
+        if panels_left[line.thickness] < line.quantity:
+            results.append(LineResult(line, f"недостаточно панелей {line.thickness} мм: доступно {panels_left[line.thickness]}"))
+            continue
+        if film_left[film.code] < required_film:
+            results.append(LineResult(line, f"недостаточно пленки: нужно {required_film:.2f}м, доступно {film_left[film.code]:.2f}м"))
+            continue
+        panels_left[line.thickness] -= line.quantity
+        film_left[film.code] -= required_film
+        results.append(LineResult(line._replace(film_code=film.code), film_used=required_film))
+
+    accepted = [result for result in results if not result.error]
+    if not accepted:
+        return results
+
+    film_deltas, panel_deltas = defaultdict(float), defaultdict(int)
+    produced = defaultdict(int)
+    for result in accepted:
+        film = films[result.line.film_code]
+        film_deltas[film.id] -= result.film_used
+        panel_deltas[panels[result.line.thickness].id] -= result.line.quantity
+        produced[(film.id, result.line.thickness)] += result.line.quantity
+
+    stock.increment_column(db, Film, Film.total_remaining, film_deltas)
+    stock.increment_column(db, Panel, Panel.quantity, panel_deltas)
+
+    previous = stock.add_finished_products(db, produced)
+
+    # Операции по строкам: остаток готовой продукции до и после каждой строки
+    running = dict(previous)
+    operations = []
+    now = datetime.utcnow()
+    for result in accepted:
+        key = (films[result.line.film_code].id, result.line.thickness)
+        previous_quantity = running[key]
+        running[key] += result.line.quantity
+        operations.append({
+            "user_id": user_id,
+            "operation_type": "production",
+            "quantity": result.line.quantity,
+            "timestamp": now,
+            "details": json.dumps({
+                "film_color": result.line.film_code,
+                "film_consumption": result.film_used,
+                "panel_thickness": result.line.thickness,
+                "previous_quantity": previous_quantity,
+                "new_quantity": running[key],
+                "batch": True,
+            }),
+        })
+    db.execute(insert(Operation), operations)
+    return results
+
+
+def format_report(results: List[LineResult], parse_errors: List[str]) -> str:
+    """Отчет по строкам: проведенные, отклоненные и нераспознанные."""
+    report = []
+    for result in results:
+        line = result.line
+        if result.error:
+            report.append(f"❌ {line.number}. {line.thickness} {line.film_code} {line.quantity} — {result.error}")
+        else:
+            report.append(f"✅ {line.number}. {line.thickness} мм, {line.film_code}: {line.quantity} шт. "
+                          f"(пленки {result.film_used:.2f}м)")
+    report.extend(f"❌ {error}" for error in parse_errors)
+
+    accepted = [result for result in results if not result.error]
+    total = sum(result.line.quantity for result in accepted)
+    header = f"Проведено строк: {len(accepted)} из {len(results) + len(parse_errors)}, панелей: {total} шт."
+    return "\n".join([header, ""] + report)
@@ -0,0 +1,275 @@
+"""План выполнения заказов на производство по остаткам пленки и панелей.
+
+Открытые заказы и остатки читаются тремя запросами. План выбирает набор
+заказов, которые можно выполнить одновременно, с максимальным числом
+заказов: сначала жадно (меньшие заказы вперед — оптимально для одного
+ресурса), затем, если заказов не больше PLANNER_EXACT_LIMIT, точным перебором
+с отсечениями. Для остальных заказов указывается, чего не хватает.
+Выбранный набор проводится одной транзакцией: один UPDATE на таблицу склада,
+пакетные вставки готовой продукции и операций.
+"""
+import json
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func, insert, update
+
+import stock
+from models import Film, Panel, ProductionOrder, Operation, OperationType, OrderStatus
+
+OPEN_STATUSES = ("new", "in_progress")
+# До скольких открытых заказов план ищется точным перебором
+PLANNER_EXACT_LIMIT = int(os.getenv("PLANNER_EXACT_LIMIT", "25"))
+# Предел числа шагов перебора, чтобы план строился за доли секунды
+PLANNER_MAX_NODES = int(os.getenv("PLANNER_MAX_NODES", "20000"))
+
+
+class OrderDemand(NamedTuple):
+    order_id: int
+    manager_id: int
+    thickness: float
+    film_code: str
+    quantity: int
+    film_meters: Optional[float]  # None — пленки с таким кодом нет
+    created_at: datetime
+
+
+class Plan(NamedTuple):
+    planned: List[OrderDemand]
+    blocked: List[Tuple[OrderDemand, str]]
+    panels_left: Dict[float, int]
+    film_left: Dict[str, float]
+
+
+def _fits(demand: OrderDemand, panels: Dict[float, int], film: Dict[str, float]) -> bool:
+    return (
+        demand.film_meters is not None
+        and panels.get(demand.thickness, 0) >= demand.quantity
+        and film.get(demand.film_code, 0) >= demand.film_meters
+    )
+
+
+def _take(demand: OrderDemand, panels: Dict[float, int], film: Dict[str, float], sign: int = 1):
+    panels[demand.thickness] = panels.get(demand.thickness, 0) - sign * demand.quantity
+    film[demand.film_code] = film.get(demand.film_code, 0) - sign * demand.film_meters
+
+
+def _greedy(demands: List[OrderDemand], panels: Dict[float, int], film: Dict[str, float]) -> List[OrderDemand]:
+    panels, film = dict(panels), dict(film)
+    chosen = []
+    for demand in sorted(demands, key=lambda d: (d.quantity, d.created_at, d.order_id)):
+        if _fits(demand, panels, film):
+            _take(demand, panels, film)
+            chosen.append(demand)
+    return chosen
+
+
+def _upper_bound(rest: List[OrderDemand], panels: Dict[float, int], film: Dict[str, float]) -> int:
+    """Сколько еще заказов можно взять, если бы ресурсы не зависели друг от друга.
+
+    Для каждого пула (панели одной толщины, пленка одного кода) берем самые
+    маленькие заказы, пока хватает остатка; реальный план не больше меньшей из сумм.
+    """
+    by_thickness, by_code = defaultdict(list), defaultdict(list)
+    for demand in rest:
+        if _fits(demand, panels, film):
+            by_thickness[demand.thickness].append(demand.quantity)
+            by_code[demand.film_code].append(demand.film_meters)
+
+    def count(pools, capacity) -> int:
+        total = 0
+        for key, needs in pools.items():
+            left = capacity.get(key, 0)
+            for need in sorted(needs):
+                if need > left:
+                    break
+                left -= need
+                total += 1
+        return total
+
+    return min(count(by_thickness, panels), count(by_code, film))
+
+
+def _exact(demands: List[OrderDemand], panels: Dict[float, int], film: Dict[str, float],
+           best: List[OrderDemand]) -> List[OrderDemand]:
+    """Перебор «взять/не взять» в порядке поступления; заменяет best только большим набором.
+
+    Перебор ограничен PLANNER_MAX_NODES узлами — при исчерпании остается лучший найденный план.
+    """
+    panels, film = dict(panels), dict(film)
+    best = list(best)
+    chosen: List[OrderDemand] = []
+    nodes = 0
+
+    def search(position: int):
+        nonlocal best, nodes
+        nodes += 1
+        if len(chosen) > len(best):
+            best = list(chosen)
+        if position >= len(demands) or nodes > PLANNER_MAX_NODES:
+            return
+        if len(chosen) + _upper_bound(demands[position:], panels, film) <= len(best):
+            return
+        demand = demands[position]
+        if _fits(demand, panels, film):
+            _take(demand, panels, film)
+            chosen.append(demand)
+            search(position + 1)
+            chosen.pop()
+            _take(demand, panels, film, sign=-1)
+        search(position + 1)
+
+    search(0)
+    return best
+
+
+def _blocker(demand: OrderDemand, panels: Dict[float, int], film: Dict[str, float],
+             panels_total: Dict[float, int], film_total: Dict[str, float]) -> str:
+    if demand.film_meters is None:
+        return f"пленка {demand.film_code} не заведена"
+    reasons = []
+    if panels_total.get(demand.thickness, 0) < demand.quantity:
+        reasons.append(f"панелей {demand.thickness} мм: нужно {demand.quantity}, на складе {panels_total.get(demand.thickness, 0)}")
+    elif panels.get(demand.thickness, 0) < demand.quantity:
+        reasons.append(f"панелей {demand.thickness} мм после плана останется {panels.get(demand.thickness, 0)}, нужно {demand.quantity}")
+    if film_total.get(demand.film_code, 0) < demand.film_meters:
+        reasons.append(f"пленки {demand.film_code}: нужно {demand.film_meters:.2f}м, на складе {film_total.get(demand.film_code, 0):.2f}м")
+    elif film.get(demand.film_code, 0) < demand.film_meters:
+        reasons.append(f"пленки {demand.film_code} после плана останется {film.get(demand.film_code, 0):.2f}м, нужно {demand.film_meters:.2f}м")
+    return "; ".join(reasons)
+
+
+def build_plan(demands: List[OrderDemand], panels: Dict[float, int], film: Dict[str, float]) -> Plan:
+    """Набор заказов с максимальным числом, выполнимый из указанных остатков."""
+    demands = sorted(demands, key=lambda d: (d.created_at, d.order_id))
+    chosen = _greedy(demands, panels, film)
+    if len(demands) <= PLANNER_EXACT_LIMIT:
+        chosen = _exact(demands, panels, film, chosen)
+
+    chosen_ids = {demand.order_id for demand in chosen}
+    panels_left, film_left = dict(panels), dict(film)
+    planned = [demand for demand in demands if demand.order_id in chosen_ids]
+    for demand in planned:
+        _take(demand, panels_left, film_left)
+    blocked = [
+        (demand, _blocker(demand, panels_left, film_left, panels, film))
+        for demand in demands if demand.order_id not in chosen_ids
+    ]
+    return Plan(planned, blocked, panels_left, film_left)
+
+
+def load_demands(db, order_ids: Optional[Iterable[int]] = None, lock: bool = False):
+    """Открытые заказы и остатки: (заказы, панели по толщине, метры пленки по коду, id пленок и панелей)."""
+    query = db.query(ProductionOrder).filter(ProductionOrder.status.in_(OPEN_STATUSES))
+    if order_ids is not None:
+        query = query.filter(ProductionOrder.id.in_(list(order_ids)))
+    if lock:
+        stock.set_lock_timeout(db)
+        query = query.order_by(ProductionOrder.id).with_for_update()
+    orders = query.all()
+
+    codes = {order.film_color for order in orders}
+    film_query = db.query(Film.id, Film.code, Film.total_remaining, Film.panel_consumption).filter(Film.code.in_(codes))
+    panel_query = db.query(Panel.id, Panel.thickness, Panel.quantity)
+    if lock:
+        film_query = film_query.order_by(Film.id).with_for_update()
+        panel_query = panel_query.order_by(Panel.id).with_for_update()
+    films = {code: (film_id, remaining or 0, consumption) for film_id, code, remaining, consumption in film_query}
+    panel_ids, panels = {}, defaultdict(int)
+    for panel_id, thickness, quantity in panel_query:
+        panel_ids.setdefault(thickness, panel_id)
+        panels[thickness] += quantity or 0
+
+    demands = [
+        OrderDemand(
+            order_id=order.id,
+            manager_id=order.manager_id,
+            thickness=order.panel_thickness,
+            film_code=order.film_color,
+            quantity=order.panel_quantity,
+            film_meters=order.panel_quantity * films[order.film_color][2] if order.film_color in films else None,
+            created_at=order.created_at or datetime.min,
+        )
+        for order in orders
+    ]
+    film_meters = {code: remaining for code, (_, remaining, _) in films.items()}
+    film_ids = {code: film_id for code, (film_id, _, _) in films.items()}
+    return demands, dict(panels), film_meters, film_ids, panel_ids
+
+
+def plan_open_orders(db) -> Plan:
+    demands, panels, film, _, _ = load_demands(db)
+    return build_plan(demands, panels, film)
+
+
+def complete_planned(db, order_ids: Iterable[int], user_id: int) -> Plan:
+    """Проводит заказы из плана, которые все еще выполнимы; коммит — у вызывающего кода.
+
+    Заказы и остатки блокируются и план пересчитывается: между показом плана
+    и подтверждением склад или заказы могли измениться.
+    """
+    demands, panels, film, film_ids, panel_ids = load_demands(db, order_ids, lock=True)
+    plan = build_plan(demands, panels, film)
+    if not plan.planned:
+        return plan
+
+    film_deltas, panel_deltas, produced = defaultdict(float), defaultdict(int), defaultdict(int)
+    for demand in plan.planned:
+        film_deltas[film_ids[demand.film_code]] -= demand.film_meters
+        panel_deltas[panel_ids[demand.thickness]] -= demand.quantity
+        produced[(film_ids[demand.film_code], demand.thickness)] += demand.quantity
+    stock.increment_column(db, Film, Film.total_remaining, film_deltas)
+    stock.increment_column(db, Panel, Panel.quantity, panel_deltas)
+    stock.add_finished_products(db, produced)
+
+    db.execute(
+        update(ProductionOrder)
+        .where(ProductionOrder.id.in_([demand.order_id for demand in plan.planned]))
+        .values(status=OrderStatus.COMPLETED.value, completed_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+    now = datetime.utcnow()
+    db.execute(insert(Operation), [
+        {
+            "user_id": user_id,
+            "operation_type": OperationType.PRODUCTION.value,
+            "quantity": demand.quantity,
+            "timestamp": now,
+            "details": json.dumps({
+                "order_id": demand.order_id,
+                "film_color": demand.film_code,
+                "panel_thickness": demand.thickness,
+                "film_consumption": demand.film_meters,
+                "planned": True,
+            }),
+        }
+        for demand in plan.planned
+    ])
+    return plan
+
+
+def format_plan(plan: Plan) -> str:
+    """Текст плана: выполнимые заказы, блокеры и остатки после плана."""
+    if not plan.planned and not plan.blocked:
+        return "Нет активных заказов на производство."
+    lines = [f"🗓 План выполнения: {len(plan.planned)} из {len(plan.planned) + len(plan.blocked)} заказов", ""]
+    if plan.planned:
+        lines.append("✅ Можно выполнить:")
+        for demand in plan.planned:
+            lines.append(f"#{demand.order_id}: {demand.quantity} шт. {demand.thickness} мм, "
+                         f"{demand.film_code} ({demand.film_meters:.2f}м)")
+        lines.append("")
+    if plan.blocked:
+        lines.append("⛔ Не хватает материалов:")
+        for demand, reason in plan.blocked:
+            lines.append(f"#{demand.order_id}: {demand.quantity} шт. {demand.thickness} мм, {demand.film_code} — {reason}")
+        lines.append("")
+    if plan.planned:
+        lines.append("Останется после плана:")
+        for thickness in sorted({demand.thickness for demand in plan.planned}):
+            lines.append(f"- панелей {thickness} мм: {plan.panels_left.get(thickness, 0)} шт.")
+        for code in sorted({demand.film_code for demand in plan.planned}):
+            lines.append(f"- пленки {code}: {plan.film_left.get(code, 0):.2f}м")
+    return "\n".join(lines).strip()
@@ -0,0 +1,197 @@
+"""Профилирование апдейтов по запросу супер-админа (cProfile + tracemalloc).
+
+Сессия профилирования охватывает следующие N апдейтов выбранного пользователя
+или обработчика. По завершении отчет отправляется документом тому, кто ее запустил.
+"""
+import cProfile
+import io
+import logging
+import pstats
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import BufferedInputFile
+
+from metrics import handler_name
+
+MAX_PROFILED_UPDATES = 50
+TRACEMALLOC_FRAMES = 10
+
+# Категории для сводки: по фрагменту пути файла функции
+TIME_CATEGORIES = (
+    ("SQLAlchemy (ORM/Core)", ("sqlalchemy",)),
+    ("Драйвер PostgreSQL", ("psycopg2",)),
+    ("Telegram I/O (aiogram/aiohttp)", ("aiogram", "aiohttp")),
+    ("Ожидание в цикле событий", ("asyncio", "selectors")),
+    ("Обработчики бота", ("handlers",)),
+)
+
+
+class ProfileSession:
+    """Активная сессия профилирования."""
+
+    def __init__(self, requested_by: int, count: int, user_id: Optional[int] = None, handler_filter: Optional[str] = None):
+        self.requested_by = requested_by
+        self.remaining = count
+        self.user_id = user_id
+        self.handler_filter = handler_filter
+        self.profile = cProfile.Profile()
+        self.updates: List[Dict[str, Any]] = []
+        self.started_at = datetime.now()
+        self.busy = False
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.baseline = tracemalloc.take_snapshot()
+
+    def matches(self, user_id: Optional[int], name: str) -> bool:
+        if self.user_id is not None and user_id != self.user_id:
+            return False
+        if self.handler_filter and self.handler_filter not in name:
+            return False
+        return True
+
+    def describe(self) -> str:
+        target = []
+        if self.user_id is not None:
+            target.append(f"пользователь {self.user_id}")
+        if self.handler_filter:
+            target.append(f"обработчик {self.handler_filter}")
+        return ", ".join(target) if target else "все апдейты"
+
+
+_session: Optional[ProfileSession] = None
+
+
+def start_session(requested_by: int, count: int, user_id: Optional[int] = None, handler_filter: Optional[str] = None) -> ProfileSession:
+    """Запускает новую сессию, заменяя предыдущую."""
+    global _session
+    if _session is not None:
+        _finish_tracemalloc(_session)
+    _session = ProfileSession(requested_by, min(count, MAX_PROFILED_UPDATES), user_id, handler_filter)
+    return _session
+
+
+def stop_session() -> Optional[ProfileSession]:
+    """Останавливает текущую сессию и возвращает ее (для отправки частичного отчета)."""
+    global _session
+    session, _session = _session, None
+    return session
+
+
+def _finish_tracemalloc(session: ProfileSession):
+    if session.started_tracemalloc and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def _categorize(filename: str) -> str:
+    normalized = filename.replace("\\", "/")
+    for title, fragments in TIME_CATEGORIES:
+        if any(f"/{fragment}/" in normalized or normalized.startswith(f"{fragment}/") for fragment in fragments):
+            return title
+    return "Прочее"
+
+
+def build_report(session: ProfileSession, snapshot) -> str:
+    """Текстовый отчет: профилированные апдейты, сводка по категориям, pstats и места аллокаций."""
+    out = io.StringIO()
+    out.write(f"Профилирование от {session.started_at.strftime('%d.%m.%Y %H:%M:%S')}\n")
+    out.write(f"Цель: {session.describe()}\n")
+    out.write(f"Профилировано апдейтов: {len(session.updates)}\n\n")
+
+    for item in session.updates:
+        out.write(f"- {item['handler']} (пользователь {item['user_id']}): {item['duration'] * 1000:.1f} мс\n")
+
+    if not session.updates:
+        out.write("Ни один апдейт не попал под условия профилирования.\n")
+        return out.getvalue()
+
+    stats = pstats.Stats(session.profile, stream=out)
+
+    # Собственное время функций по категориям
+    categories = defaultdict(float)
+    total = 0.0
+    for (filename, _, _), (_, _, own_time, _, _) in stats.stats.items():
+        categories[_categorize(filename)] += own_time
+        total += own_time
+    out.write("\nСобственное время по категориям:\n")
+    for title, seconds in sorted(categories.items(), key=lambda item: item[1], reverse=True):
+        share = seconds / total * 100 if total else 0
+        out.write(f"  {title}: {seconds * 1000:.1f} мс ({share:.0f}%)\n")
+
+    out.write("\n=== Топ по накопленному времени ===\n")
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(40)
+    out.write("\n=== Топ по собственному времени ===\n")
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(25)
+
+    out.write("\n=== Топ мест аллокаций памяти (относительно начала сессии) ===\n")
+    for stat in snapshot.compare_to(session.baseline, "lineno")[:25]:
+        out.write(f"{stat}\n")
+
+    return out.getvalue()
+
+
+async def send_report(bot, session: ProfileSession):
+    snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else session.baseline
+    _finish_tracemalloc(session)
+    report = build_report(session, snapshot)
+    filename = f"profile_{session.started_at.strftime('%Y%m%d_%H%M%S')}.txt"
+    await bot.send_document(
+        session.requested_by,
+        BufferedInputFile(report.encode("utf-8"), filename=filename),
+        caption=f"📊 Профилирование завершено: {len(session.updates)} апдейт(ов), {session.describe()}"
+    )
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Внутренний middleware: профилирует апдейты, подходящие под активную сессию."""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        global _session
+        session = _session
+        handler_object = data.get("handler")
+        if session is None or session.busy or session.remaining <= 0 or handler_object is None:
+            return await handler(event, data)
+
+        name = handler_name(handler_object.callback)
+        from_user = data.get("event_from_user")
+        user_id = from_user.id if from_user else None
+        if not session.matches(user_id, name):
+            return await handler(event, data)
+
+        # Профилируем по одному апдейту за раз: cProfile охватывает весь поток
+        session.busy = True
+        session.remaining -= 1
+        started_at = time.perf_counter()
+        session.profile.enable()
+        try:
+            return await handler(event, data)
+        finally:
+            session.profile.disable()
+            session.busy = False
+            session.updates.append({
+                "handler": name,
+                "user_id": user_id,
+                "duration": time.perf_counter() - started_at,
+            })
+            if session.remaining <= 0 and _session is session:
+                _session = None
+                try:
+                    await send_report(data["bot"], session)
+                except Exception as e:
+                    logging.error(f"Ошибка отправки отчета профилирования: {e}", exc_info=True)
+
+
+def setup_profiler(dp):
+    """Подключает middleware профилирования к диспетчеру (действует на все роутеры)."""
+    dp.message.middleware(ProfilingMiddleware())
+    dp.callback_query.middleware(ProfilingMiddleware())
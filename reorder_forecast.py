@@ -0,0 +1,284 @@
+"""Прогноз закупки материалов в Китае по фактическому расходу.
+
+История расхода загружается в pandas тремя запросами: операции производства
+и брака из operations (пленка, панели, стыки, клей) и отгруженные строки
+заказов (стыки и клей, по которым операции не пишутся). По каждой позиции
+векторно считаются средний расход в день, на сколько дней хватит остатка и
+сколько заказать, чтобы покрыть срок поставки, страховой запас и
+REORDER_COVER_DAYS после прихода. Остатки берутся из снимка stock_cache, а
+результат хранится до следующего изменения склада (версия stock_cache).
+"""
+import json
+import math
+import os
+import threading
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING, List, NamedTuple, Optional, Tuple
+
+import stock_cache
+from database import get_db
+from models import Operation, Order, OrderJoint, OrderGlue, OrderStatus
+
+# pandas загружается при первом расчете прогноза, а не при старте бота
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Срок поставки из Китая, дни
+CHINA_LEAD_TIME_DAYS = int(os.getenv("CHINA_LEAD_TIME_DAYS", "45"))
+# Страховой запас на случай задержки или всплеска спроса, дни
+SAFETY_STOCK_DAYS = int(os.getenv("SAFETY_STOCK_DAYS", "14"))
+# На сколько дней расхода должно хватать после прихода заказа
+REORDER_COVER_DAYS = int(os.getenv("REORDER_COVER_DAYS", "60"))
+# За какой период берется история расхода, дни
+FORECAST_WINDOW_DAYS = int(os.getenv("FORECAST_WINDOW_DAYS", "90"))
+# Короче этого история не считается: иначе первые дни работы дают завышенный расход
+MIN_HISTORY_DAYS = 7
+
+MATERIAL_FILM = "film"
+MATERIAL_PANEL = "panel"
+MATERIAL_JOINT = "joint"
+MATERIAL_GLUE = "glue"
+
+# Прежние фиксированные пороги остаются нижней границей для позиций без истории расхода
+MIN_STOCK = {MATERIAL_FILM: 30, MATERIAL_PANEL: 150, MATERIAL_JOINT: 100, MATERIAL_GLUE: 100}
+UNITS = {MATERIAL_FILM: "м", MATERIAL_PANEL: "шт.", MATERIAL_JOINT: "шт.", MATERIAL_GLUE: "шт."}
+
+PRODUCTION_TYPES = ("production", "PRODUCTION")
+DEFECT_TYPES = ("panel_defect_subtract", "film_defect", "joint_defect", "glue_defect")
+
+_COLUMNS = ["day", "sku", "amount"]
+
+
+class ForecastRow(NamedTuple):
+    material: str
+    label: str
+    on_hand: float
+    daily_burn: float
+    days_of_cover: float  # math.inf — расхода не было
+    suggested: float  # сколько заказать в единицах позиции
+    rolls: int  # для пленки — рулонов к заказу
+    needs_reorder: bool
+
+
+class Forecast(NamedTuple):
+    rows: List[ForecastRow]
+    history_days: int
+    built_at: datetime
+
+
+def panel_sku(thickness) -> str:
+    return f"{MATERIAL_PANEL}:{float(thickness)}"
+
+
+def film_sku(code) -> str:
+    return f"{MATERIAL_FILM}:{code}"
+
+
+def joint_sku(joint_type, color, thickness) -> str:
+    type_value = getattr(joint_type, "value", joint_type)
+    return f"{MATERIAL_JOINT}:{type_value}:{color}:{float(thickness)}"
+
+
+def _load_details(raw) -> dict:
+    try:
+        return json.loads(raw) if raw else {}
+    except (TypeError, ValueError):
+        return {}
+
+
+def operations_consumption(operations: "pd.DataFrame", film_consumption: dict) -> "pd.DataFrame":
+    """Расход по позициям из операций производства и брака: столбцы day, sku, amount."""
+    import pandas as pd
+
+    if operations.empty:
+        return pd.DataFrame(columns=_COLUMNS)
+    details = pd.json_normalize(operations["details"].map(_load_details).tolist())
+    details.index = operations.index
+
+    def column(name: str) -> "pd.Series":
+        if name in details:
+            return details[name]
+        return pd.Series(None, index=operations.index, dtype=object)
+
+    kind = operations["operation_type"]
+    quantity = operations["quantity"].astype(float)
+    frames = []
+
+    # Производство расходует панели и пленку; у заказов на производство расход пленки не записан
+    production = kind.isin(PRODUCTION_TYPES)
+    thickness = column("panel_thickness")
+    frames.append(pd.DataFrame({
+        "day": operations["day"], "sku": thickness.map(lambda t: panel_sku(t) if pd.notna(t) else None),
+        "amount": quantity,
+    })[production | (kind == "panel_defect_subtract")])
+
+    film_color = column("film_color")
+    meters = pd.to_numeric(column("film_consumption"), errors="coerce")
+    meters = meters.fillna(quantity * film_color.map(film_consumption).astype(float))
+    frames.append(pd.DataFrame({
+        "day": operations["day"], "sku": film_color.map(lambda code: film_sku(code) if pd.notna(code) else None),
+        "amount": meters,
+    })[production])
+    frames.append(pd.DataFrame({
+        "day": operations["day"], "sku": column("film_code").map(lambda code: film_sku(code) if pd.notna(code) else None),
+        "amount": quantity,
+    })[kind == "film_defect"])
+
+    joints = kind == "joint_defect"
+    if joints.any():
+        frames.append(pd.DataFrame({
+            "day": operations["day"],
+            "sku": [
+                joint_sku(joint_type, color, joint_thickness) if pd.notna(color) else None
+                for joint_type, color, joint_thickness in zip(
+                    column("joint_type"), column("joint_color"), column("joint_thickness"))
+            ],
+            "amount": quantity,
+        })[joints])
+    frames.append(pd.DataFrame({"day": operations["day"], "sku": MATERIAL_GLUE, "amount": quantity})[kind == "glue_defect"])
+
+    result = pd.concat(frames, ignore_index=True)
+    return result.dropna(subset=["sku", "amount"])
+
+
+def load_history(db, since: datetime, film_consumption: dict) -> "pd.DataFrame":
+    """История расхода за период: операции и отгруженные стыки и клей."""
+    import pandas as pd
+
+    operations = pd.DataFrame(
+        db.query(Operation.timestamp, Operation.operation_type, Operation.quantity, Operation.details)
+        .filter(Operation.operation_type.in_(PRODUCTION_TYPES + DEFECT_TYPES), Operation.timestamp >= since)
+        .all(),
+        columns=["day", "operation_type", "quantity", "details"],
+    )
+    shipped_joints = pd.DataFrame(
+        db.query(Order.completed_at, OrderJoint.joint_type, OrderJoint.joint_color, OrderJoint.joint_thickness,
+                 OrderJoint.joint_quantity - OrderJoint.returned_quantity)
+        .join(Order, Order.id == OrderJoint.order_id)
+        .filter(Order.status == OrderStatus.COMPLETED, Order.completed_at >= since)
+        .all(),
+        columns=["day", "joint_type", "color", "thickness", "amount"],
+    )
+    shipped_glue = pd.DataFrame(
+        db.query(Order.completed_at, OrderGlue.quantity - OrderGlue.returned_quantity)
+        .join(Order, Order.id == OrderGlue.order_id)
+        .filter(Order.status == OrderStatus.COMPLETED, Order.completed_at >= since)
+        .all(),
+        columns=["day", "amount"],
+    )
+
+    frames = [operations_consumption(operations, film_consumption)]
+    if not shipped_joints.empty:
+        shipped_joints["sku"] = [
+            joint_sku(*values) for values in zip(shipped_joints["joint_type"], shipped_joints["color"], shipped_joints["thickness"])
+        ]
+        frames.append(shipped_joints[_COLUMNS].copy())
+    if not shipped_glue.empty:
+        shipped_glue["sku"] = MATERIAL_GLUE
+        frames.append(shipped_glue[_COLUMNS].copy())
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=_COLUMNS)
+    # Время операций хранится без часового пояса (UTC), время выполнения заказа — с поясом
+    for frame in frames:
+        frame["day"] = pd.to_datetime(frame["day"], utc=True)
+    history = pd.concat(frames, ignore_index=True)
+    history["amount"] = history["amount"].astype(float)
+    return history
+
+
+def stock_frame(snapshot: stock_cache.StockSnapshot) -> "pd.DataFrame":
+    """Остатки материалов из снимка: sku, материал, название, остаток, метраж рулона."""
+    import pandas as pd
+
+    rows = [
+        (film_sku(film.code), MATERIAL_FILM, f"{film.code} пленка", film.meters, film.meters_per_roll)
+        for film in snapshot.films.values()
+    ]
+    rows += [
+        (panel_sku(panel.thickness), MATERIAL_PANEL, f"Панели {panel.thickness} мм", panel.quantity, 0.0)
+        for panel in snapshot.panels
+    ]
+    rows += [
+        (joint_sku(joint.type, joint.color, joint.thickness), MATERIAL_JOINT,
+         f"Стык {stock_cache.JOINT_TYPE_NAMES.get(joint.type, joint.type)} {joint.color} {joint.thickness} мм",
+         joint.on_hand, 0.0)
+        for joints in snapshot.joints.values() for joint in joints
+    ]
+    rows.append((MATERIAL_GLUE, MATERIAL_GLUE, "Клей", snapshot.glue.on_hand, 0.0))
+    return pd.DataFrame(rows, columns=["sku", "material", "label", "on_hand", "meters_per_roll"])
+
+
+def forecast(stock: "pd.DataFrame", history: "pd.DataFrame", now: datetime) -> Tuple["pd.DataFrame", int]:
+    """Векторный расчет по всем позициям: расход в день, запас в днях и объем заказа."""
+    import pandas as pd
+
+    if history.empty:
+        history_days = FORECAST_WINDOW_DAYS
+    else:
+        span = (pd.Timestamp(now, tz="UTC") - history["day"].min()).days
+        history_days = int(min(max(span, MIN_HISTORY_DAYS), FORECAST_WINDOW_DAYS))
+
+    burn = history.groupby("sku")["amount"].sum().clip(lower=0) / history_days
+    result = stock.copy()
+    result["daily_burn"] = result["sku"].map(burn).fillna(0.0).astype(float)
+    result["on_hand"] = result["on_hand"].astype(float)
+
+    has_burn = result["daily_burn"] > 0
+    result["days_of_cover"] = (result["on_hand"] / result["daily_burn"].where(has_burn)).fillna(math.inf)
+    reorder_point = result["daily_burn"] * (CHINA_LEAD_TIME_DAYS + SAFETY_STOCK_DAYS)
+    target = result["daily_burn"] * (CHINA_LEAD_TIME_DAYS + SAFETY_STOCK_DAYS + REORDER_COVER_DAYS)
+    minimum = result["material"].map(MIN_STOCK).astype(float)
+
+    result["needs_reorder"] = (has_burn & (result["on_hand"] <= reorder_point)) | (~has_burn & (result["on_hand"] < minimum))
+    suggested = (target.where(has_burn, minimum) - result["on_hand"]).clip(lower=0)
+    result["suggested"] = suggested.where(result["needs_reorder"], 0.0).apply(math.ceil).astype(float)
+    per_roll = result["meters_per_roll"].where(result["meters_per_roll"] > 0)
+    result["rolls"] = (result["suggested"] / per_roll).fillna(0).apply(math.ceil).astype(int)
+    return result.sort_values(["needs_reorder", "days_of_cover", "label"], ascending=[False, True, True]), history_days
+
+
+def build_forecast(db, snapshot: stock_cache.StockSnapshot, now: Optional[datetime] = None) -> Forecast:
+    now = now or datetime.utcnow()
+    film_consumption = {code: film.panel_consumption for code, film in snapshot.films.items()}
+    history = load_history(db, now - timedelta(days=FORECAST_WINDOW_DAYS), film_consumption)
+    result, history_days = forecast(stock_frame(snapshot), history, now)
+    rows = [
+        ForecastRow(row.material, row.label, row.on_hand, row.daily_burn, row.days_of_cover,
+                    row.suggested, row.rolls, bool(row.needs_reorder))
+        for row in result.itertuples(index=False)
+    ]
+    return Forecast(rows, history_days, now)
+
+
+_lock = threading.Lock()
+_cached: Optional[Tuple[Tuple[int, date], Forecast]] = None
+
+
+def get_forecast() -> Forecast:
+    """Прогноз из кэша; пересчитывается после изменения склада и раз в сутки."""
+    global _cached
+    key = (stock_cache.version(), date.today())
+    cached = _cached
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with _lock:
+        if _cached is None or _cached[0] != key:
+            snapshot = stock_cache.get_snapshot()
+            db = next(get_db())
+            try:
+                _cached = ((snapshot.version, date.today()), build_forecast(db, snapshot))
+            finally:
+                db.close()
+    return _cached[1]
+
+
+def format_row(row: ForecastRow) -> str:
+    unit = UNITS[row.material]
+    text = f"- {row.label}: {row.on_hand:.0f} {unit}"
+    if row.daily_burn > 0:
+        text += f", расход {row.daily_burn:.1f} {unit}/день, хватит на {row.days_of_cover:.0f} дн."
+    else:
+        text += ", расхода не было"
+    order = f"{row.rolls} рул. ({row.suggested:.0f} м)" if row.material == MATERIAL_FILM and row.rolls else f"{row.suggested:.0f} {unit}"
+    return f"{text} → заказать {order}"
@@ -0,0 +1,292 @@
+"""Планировщик фоновой подготовки отчетов и рассылки сводок.
+
+Задача в цикле событий раз в SCHEDULER_POLL_SECONDS выбирает из таблицы
+scheduled_reports отчеты, у которых наступило next_run_at, и сразу переносит
+их на следующий запуск (условным UPDATE, поэтому при нескольких процессах отчет
+готовит только один). Сам расчет идет в отдельном потоке, готовый текст
+сохраняется в scheduled_reports.content, и кнопки отчетов отдают его без
+пересчета. Сводки за день и неделю рассылаются подписанным супер-админам.
+
+Расчет ставится на REPORT_HOUR_UTC — время низкой нагрузки.
+"""
+import asyncio
+import html
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func, update
+
+import analytics
+import reorder_forecast
+import stock_cache
+from database import get_db
+from models import CompletedOrder, CompletedOrderStatus, ReportSubscription, ScheduledReport, User
+
+# Час (UTC), в который готовятся отчеты
+REPORT_HOUR_UTC = int(os.getenv("REPORT_HOUR_UTC", "3"))
+# День недели еженедельной сводки: 0 — понедельник
+WEEKLY_DIGEST_WEEKDAY = int(os.getenv("WEEKLY_DIGEST_WEEKDAY", "0"))
+# Как часто проверяется расписание, секунды
+SCHEDULER_POLL_SECONDS = float(os.getenv("SCHEDULER_POLL_SECONDS", "60"))
+
+DAILY_DIGEST = "daily_digest"
+WEEKLY_DIGEST = "weekly_digest"
+DIGEST_TITLES = {DAILY_DIGEST: "Сводка за сутки", WEEKLY_DIGEST: "Сводка за неделю"}
+DIGEST_SECTIONS = ("stock", "sales", "production", "defects", "returns")
+MAX_MESSAGE_LENGTH = 4000
+
+
+def next_daily(after: datetime) -> datetime:
+    """Ближайший момент REPORT_HOUR_UTC строго после after."""
+    candidate = after.replace(hour=REPORT_HOUR_UTC, minute=0, second=0, microsecond=0)
+    if candidate <= after:
+        candidate += timedelta(days=1)
+    return candidate
+
+
+def next_weekly(after: datetime) -> datetime:
+    candidate = next_daily(after)
+    while candidate.weekday() != WEEKLY_DIGEST_WEEKDAY:
+        candidate += timedelta(days=1)
+    return candidate
+
+
+def analytics_key(period_days: int) -> str:
+    return f"analytics_{period_days}"
+
+
+def _stock_section(snapshot: stock_cache.StockSnapshot, forecast: reorder_forecast.Forecast) -> str:
+    products = [line for lines in snapshot.products.values() for line in lines]
+    panels = ", ".join(f"{panel.thickness} мм — {panel.quantity}" for panel in snapshot.panels) or "нет"
+    joints = sum(joint.on_hand for lines in snapshot.joints.values() for joint in lines)
+    reorder = sum(1 for row in forecast.rows if row.needs_reorder)
+    return (
+        f"📦 <b>Склад</b>\n"
+        f"Готовая продукция: {sum(line.on_hand for line in products)} шт. "
+        f"(в резерве {sum(line.reserved for line in products)})\n"
+        f"Пленка: {sum(film.meters for film in snapshot.films.values()):.0f} м\n"
+        f"Пустые панели: {panels}\n"
+        f"Стыки: {joints} шт., клей: {snapshot.glue.on_hand} шт.\n"
+        f"К заказу в Китай: {reorder} поз."
+    )
+
+
+def _sales_section(report: analytics.AnalyticsReport) -> str:
+    managers = report.managers
+    top = ", ".join(
+        f"{html.escape(row.color)} ({row.panels:.0f})" for row in report.top_colors.head(3).itertuples()
+    ) or "—"
+    return (
+        f"💰 <b>Продажи</b>\n"
+        f"Заказов: {int(managers['orders'].sum())}, панелей: {int(managers['panels'].sum())}, "
+        f"стыков: {int(managers['joints'].sum())}, клея: {int(managers['glue'].sum())}\n"
+        f"Топ цветов: {top}"
+    )
+
+
+def _production_section(report: analytics.AnalyticsReport) -> str:
+    mix = report.thickness_mix
+    by_thickness = ", ".join(
+        f"{row.thickness:g} мм — {row.produced:.0f}" for row in mix.itertuples() if row.produced
+    )
+    text = f"🏭 <b>Производство</b>\nПроизведено панелей: {mix['produced'].sum():.0f}"
+    return f"{text} ({by_thickness})" if by_thickness else text
+
+
+def _defects_section(report: analytics.AnalyticsReport) -> str:
+    rows = [row for row in report.defects.itertuples() if row.defect]
+    if not rows:
+        return "⚠️ <b>Брак</b>\nБрака не было"
+    return "⚠️ <b>Брак</b>\n" + "\n".join(
+        f"{row.material}: {row.defect:.0f} ({row.rate * 100:.1f}%)" for row in rows
+    )
+
+
+def build_digest(period_days: int) -> str:
+    """Разделы сводки за период в JSON: склад, продажи, производство, брак, возвраты."""
+    db = next(get_db())
+    try:
+        report = analytics.build_report(db, period_days)
+        returns = db.query(func.count(CompletedOrder.id)).filter(
+            CompletedOrder.status == CompletedOrderStatus.RETURN_REQUESTED.value
+        ).scalar() or 0
+    finally:
+        db.close()
+    sections = {
+        "stock": _stock_section(stock_cache.get_snapshot(), reorder_forecast.get_forecast()),
+        "sales": _sales_section(report),
+        "production": _production_section(report),
+        "defects": _defects_section(report),
+        "returns": f"↩️ <b>Возвраты</b>\nОжидают решения: {returns}",
+    }
+    return json.dumps(sections, ensure_ascii=False)
+
+
+def build_analytics(period_days: int) -> str:
+    return analytics.format_report(analytics.get_report(period_days))
+
+
+class Job(NamedTuple):
+    key: str
+    build: Callable[[], str]  # выполняется в отдельном потоке
+    next_run: Callable[[datetime], datetime]
+    deliver: bool = False
+
+
+JOBS: Dict[str, Job] = {
+    job.key: job for job in [
+        Job(DAILY_DIGEST, lambda: build_digest(1), next_daily, deliver=True),
+        Job(WEEKLY_DIGEST, lambda: build_digest(7), next_weekly, deliver=True),
+    ] + [
+        Job(analytics_key(days), lambda days=days: build_analytics(days), next_daily)
+        for days in analytics.PERIODS
+    ]
+}
+
+
+def render_digest(key: str, content: str, prepared_at: Optional[datetime],
+                  sections: Tuple[str, ...] = DIGEST_SECTIONS) -> str:
+    """Текст сводки (parse_mode HTML) из сохраненных разделов."""
+    stored = json.loads(content)
+    header = f"🗞 <b>{DIGEST_TITLES[key]}</b>"
+    if prepared_at:
+        header += f" (на {prepared_at.strftime('%d.%m.%Y %H:%M')} UTC)"
+    text = "\n\n".join([header] + [stored[name] for name in sections if name in stored])
+    return text[:MAX_MESSAGE_LENGTH]
+
+
+def ensure_schedule(now: Optional[datetime] = None):
+    """Создает строки расписания для новых отчетов; существующие не трогает."""
+    now = now or datetime.utcnow()
+    db = next(get_db())
+    try:
+        existing = {key for (key,) in db.query(ScheduledReport.key)}
+        for job in JOBS.values():
+            if job.key not in existing:
+                db.add(ScheduledReport(key=job.key, next_run_at=job.next_run(now)))
+        db.commit()
+    finally:
+        db.close()
+
+
+def claim_due(now: Optional[datetime] = None) -> List[str]:
+    """Отчеты, время которых наступило; каждый сразу переносится на следующий запуск.
+
+    Пропущенные за время простоя запуски не копятся: отчет готовится один раз,
+    следующий — по расписанию после текущего момента.
+    """
+    now = now or datetime.utcnow()
+    db = next(get_db())
+    try:
+        claimed = []
+        due = db.query(ScheduledReport.key, ScheduledReport.next_run_at) \
+            .filter(ScheduledReport.next_run_at <= now).all()
+        for key, next_run_at in due:
+            job = JOBS.get(key)
+            if job is None:
+                continue
+            result = db.execute(
+                update(ScheduledReport)
+                .where(ScheduledReport.key == key, ScheduledReport.next_run_at == next_run_at)
+                .values(next_run_at=job.next_run(now))
+            )
+            if result.rowcount == 1:
+                claimed.append(key)
+        db.commit()
+        return claimed
+    finally:
+        db.close()
+
+
+def store(key: str, content: str, prepared_at: datetime):
+    db = next(get_db())
+    try:
+        db.execute(
+            update(ScheduledReport).where(ScheduledReport.key == key)
+            .values(content=content, last_run_at=prepared_at)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def run_job(key: str) -> Tuple[str, datetime]:
+    """Готовит отчет и сохраняет его; возвращает (содержимое, момент подготовки)."""
+    prepared_at = datetime.utcnow()
+    content = JOBS[key].build()
+    store(key, content, prepared_at)
+    return content, prepared_at
+
+
+def get_stored(key: str) -> Tuple[str, datetime]:
+    """Сохраненный отчет; если его еще нет (первый запуск), готовит сразу."""
+    db = next(get_db())
+    try:
+        row = db.query(ScheduledReport.content, ScheduledReport.last_run_at) \
+            .filter(ScheduledReport.key == key).first()
+    finally:
+        db.close()
+    if row and row.content:
+        return row.content, row.last_run_at
+    return run_job(key)
+
+
+def load_subscribers(key: str) -> List[int]:
+    db = next(get_db())
+    try:
+        return [
+            telegram_id for (telegram_id,) in db.query(User.telegram_id)
+            .join(ReportSubscription, ReportSubscription.user_id == User.id)
+            .filter(ReportSubscription.report_key == key)
+        ]
+    finally:
+        db.close()
+
+
+class ReportScheduler:
+    def __init__(self, poll_seconds: float = SCHEDULER_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot):
+        self._task = asyncio.get_running_loop().create_task(self._run(bot))
+        logging.info(f"Планировщик отчетов запущен (подготовка в {REPORT_HOUR_UTC}:00 UTC)")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self, bot):
+        scheduled = False
+        while True:
+            try:
+                if not scheduled:
+                    await asyncio.to_thread(ensure_schedule)
+                    scheduled = True
+                for key in await asyncio.to_thread(claim_due):
+                    await self._run_job(bot, key)
+            except Exception as e:
+                logging.error(f"Ошибка планировщика отчетов: {e}", exc_info=True)
+            await asyncio.sleep(self.poll_seconds)
+
+    async def _run_job(self, bot, key: str):
+        try:
+            content, prepared_at = await asyncio.to_thread(run_job, key)
+        except Exception as e:
+            logging.error(f"Не удалось подготовить отчет {key}: {e}", exc_info=True)
+            return
+        logging.info(f"Отчет {key} подготовлен")
+        if not JOBS[key].deliver:
+            return
+        text = render_digest(key, content, prepared_at)
+        for telegram_id in await asyncio.to_thread(load_subscribers, key):
+            try:
+                await bot.send_message(chat_id=telegram_id, text=text, parse_mode="HTML")
+            except Exception as e:
+                logging.warning(f"Не удалось отправить сводку {key} пользователю {telegram_id}: {e}")
+
+
+scheduler = ReportScheduler()
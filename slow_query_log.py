@@ -0,0 +1,165 @@
+"""Журнал медленных SQL-запросов.
+
+Запросы дольше порога попадают в кольцевой буфер в памяти и в таблицу
+slow_queries. Запись в таблицу и EXPLAIN выполняются в отдельном потоке,
+чтобы не задерживать цикл событий бота еще сильнее. Тот же поток удаляет из
+таблицы записи старше SLOW_QUERY_RETENTION_DAYS.
+"""
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event
+
+from metrics import current_handler_name, normalize_statement
+from models import SlowQuery
+
+# Порог в миллисекундах, начиная с которого запрос считается медленным
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "500"))
+# Выполнять EXPLAIN (ANALYZE, BUFFERS) для медленных SELECT-запросов
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "0") == "1"
+SLOW_QUERY_BUFFER_SIZE = int(os.getenv("SLOW_QUERY_BUFFER_SIZE", "200"))
+# Сколько дней хранятся записи в таблице slow_queries
+SLOW_QUERY_RETENTION_DAYS = int(os.getenv("SLOW_QUERY_RETENTION_DAYS", "14"))
+# Как часто поток записи удаляет устаревшие записи, секунды
+RETENTION_CHECK_SECONDS = 3600
+
+MAX_PARAMETERS_LENGTH = 1000
+
+# Кольцевой буфер последних медленных запросов
+captures = deque(maxlen=SLOW_QUERY_BUFFER_SIZE)
+_captures_lock = threading.Lock()
+
+_queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=1000)
+_worker_local = threading.local()
+
+
+def _format_parameters(parameters) -> Optional[str]:
+    if not parameters:
+        return None
+    text = repr(parameters)
+    if len(text) > MAX_PARAMETERS_LENGTH:
+        text = text[:MAX_PARAMETERS_LENGTH] + "…"
+    return text
+
+
+# SELECT ... FOR UPDATE/SHARE: повтор под EXPLAIN ANALYZE ждал бы блокировок исходной транзакции
+_LOCKING_READ = re.compile(r"\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b", re.IGNORECASE)
+
+
+def _is_explainable(statement: str, executemany: bool) -> bool:
+    # EXPLAIN ANALYZE повторно выполняет запрос, поэтому только для чтения
+    return not executemany and statement.lstrip().upper().startswith("SELECT")
+
+
+def _explain_prefix(statement: str) -> str:
+    """Для блокирующих чтений — только план, без выполнения запроса."""
+    return "EXPLAIN " if _LOCKING_READ.search(statement) else "EXPLAIN (ANALYZE, BUFFERS) "
+
+
+def install(engine):
+    """Подключает трассировку медленных запросов к движку и запускает фоновый поток записи."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("slow_query_start")
+        if not starts:
+            return
+        duration_ms = (time.perf_counter() - starts.pop()) * 1000
+        # Запросы самого журнала (EXPLAIN и запись) не трассируем
+        if duration_ms < SLOW_QUERY_THRESHOLD_MS or getattr(_worker_local, "active", False):
+            return
+
+        capture = {
+            "captured_at": datetime.utcnow(),
+            "duration_ms": duration_ms,
+            "statement": statement,
+            "raw_parameters": parameters,
+            "parameters": _format_parameters(parameters),
+            "handler": current_handler_name(),
+            "explain": None,
+            "explainable": SLOW_QUERY_EXPLAIN and _is_explainable(statement, executemany),
+        }
+        with _captures_lock:
+            captures.append(capture)
+        logging.warning(
+            f"Медленный запрос {duration_ms:.0f} мс (обработчик: {capture['handler']}): "
+            f"{normalize_statement(statement, 500)}"
+        )
+        try:
+            _queue.put_nowait(capture)
+        except queue.Full:
+            logging.warning("Очередь журнала медленных запросов переполнена, запись пропущена")
+
+    worker = threading.Thread(target=_worker, args=(engine,), name="slow-query-log", daemon=True)
+    worker.start()
+
+
+def _delete_expired(engine):
+    cutoff = datetime.utcnow() - timedelta(days=SLOW_QUERY_RETENTION_DAYS)
+    try:
+        with engine.begin() as conn:
+            conn.execute(SlowQuery.__table__.delete().where(SlowQuery.captured_at < cutoff))
+    except Exception as e:
+        logging.error(f"Ошибка очистки журнала медленных запросов: {e}")
+
+
+def _worker(engine):
+    _worker_local.active = True
+    last_cleanup = None
+    while True:
+        capture = _queue.get()
+        try:
+            if capture["explainable"]:
+                capture["explain"] = _explain(engine, capture)
+            with engine.begin() as conn:
+                conn.execute(SlowQuery.__table__.insert().values(
+                    captured_at=capture["captured_at"],
+                    duration_ms=capture["duration_ms"],
+                    statement=capture["statement"],
+                    parameters=capture["parameters"],
+                    handler=capture["handler"],
+                    explain=capture["explain"],
+                ))
+        except Exception as e:
+            logging.error(f"Ошибка записи медленного запроса: {e}")
+        finally:
+            # Исходные параметры нужны только для EXPLAIN
+            capture.pop("raw_parameters", None)
+        if last_cleanup is None or time.monotonic() - last_cleanup >= RETENTION_CHECK_SECONDS:
+            last_cleanup = time.monotonic()
+            _delete_expired(engine)
+
+
+def _explain(engine, capture) -> Optional[str]:
+    try:
+        with engine.connect() as conn:
+            # EXPLAIN ANALYZE выполняет запрос, поэтому транзакция всегда откатывается
+            transaction = conn.begin()
+            try:
+                result = conn.exec_driver_sql(
+                    _explain_prefix(capture["statement"]) + capture["statement"], capture["raw_parameters"] or ()
+                )
+                return "\n".join(row[0] for row in result)
+            finally:
+                transaction.rollback()
+    except Exception as e:
+        logging.warning(f"Не удалось получить EXPLAIN для медленного запроса: {e}")
+        return None
+
+
+def recent_captures(limit: int = 20) -> List[Dict[str, Any]]:
+    """Последние захваченные запросы из кольцевого буфера (новые первыми)."""
+    with _captures_lock:
+        items = list(captures)
+    return list(reversed(items))[:limit]
@@ -0,0 +1,67 @@
+"""Вспомогательные функции запуска бота: замер фаз и проверка схемы БД."""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ALEMBIC_INI = os.path.join(BASE_DIR, "alembic.ini")
+
+
+class StartupTimer:
+    """Замеряет длительность фаз запуска и печатает итоговый отчет."""
+
+    def __init__(self, started_at: Optional[float] = None):
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self._last_mark = self.started_at
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, name: str):
+        """Фиксирует фазу, длившуюся с предыдущей отметки."""
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last_mark))
+        self._last_mark = now
+
+    @contextmanager
+    def phase(self, name: str):
+        """Замеряет фазу, выполняемую внутри блока with."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started_at))
+            self._last_mark = time.perf_counter()
+
+    def add(self, name: str, duration: float):
+        """Добавляет фазу, длительность которой измерена отдельно (например, в параллельной задаче)."""
+        self.phases.append((name, duration))
+
+    def report(self) -> str:
+        lines = ["Отчет о запуске:"]
+        for name, duration in self.phases:
+            lines.append(f"  {name:<40} {duration * 1000:8.0f} мс")
+        lines.append(f"  {'Всего':<40} {(time.perf_counter() - self.started_at) * 1000:8.0f} мс")
+        return "\n".join(lines)
+
+
+def schema_is_current(engine) -> bool:
+    """Проверяет, что ревизия БД совпадает с головой миграций Alembic."""
+    try:
+        from alembic.config import Config
+        from alembic.runtime.migration import MigrationContext
+        from alembic.script import ScriptDirectory
+
+        config = Config(ALEMBIC_INI)
+        # Путь в alembic.ini относительный, поэтому задаем его от каталога проекта
+        config.set_main_option("script_location", os.path.join(BASE_DIR, "alembic"))
+        script = ScriptDirectory.from_config(config)
+        heads = set(script.get_heads())
+        with engine.connect() as conn:
+            current = set(MigrationContext.configure(conn).get_current_heads())
+        if current != heads:
+            logging.info(f"Ревизия БД {sorted(current)} не совпадает с головой миграций {sorted(heads)}")
+        return current == heads
+    except Exception as e:
+        logging.warning(f"Не удалось сверить ревизию БД с миграциями Alembic: {e}")
+        return False
@@ -17,11 +17,13 @@ class ProductionStates(StatesGroup):
     
     # Состояния для прихода клея
     waiting_for_glue_quantity = State()
+    waiting_for_income_file = State()  # Импорт прихода из CSV/XLSX
     
     # Состояния для производства
     waiting_for_production_panel_thickness = State()
     waiting_for_production_film_color = State()
     waiting_for_production_quantity = State()
+    waiting_for_production_batch = State()  # Пакетный ввод: несколько строк за раз
     
     # Состояния для брака
     waiting_for_defect_type = State()
@@ -35,6 +37,7 @@ class ProductionStates(StatesGroup):
     waiting_for_defect_film_thickness = State()
     waiting_for_defect_film_meters = State()
     waiting_for_defect_glue_quantity = State()
+    waiting_for_defect_batch = State()  # Пакетный брак: список материалов одним сообщением
     
     # Состояния для брака готовой продукции
     waiting_for_defect_finished_product_thickness = State()
@@ -151,6 +154,9 @@ class SalesStates(StatesGroup):
     # Состояние для работы с забронированными заказами
     waiting_for_reserved_order_selection = State()
     
+    # Поиск заказов клиента по телефону или адресу
+    waiting_for_search_query = State()
+    
 class AdminStates(StatesGroup):
     waiting_for_user_id = State()
     waiting_for_role = State()
@@ -0,0 +1,580 @@
+"""Складские движения и резервирование под заказы.
+
+Резерв хранится в таблице stock_reservations (заказ × позиция склада), поэтому
+остаток на складе при бронировании не меняется, а доступное количество
+считается как на складе − зарезервировано одним агрегатом по индексу.
+Списание и возврат выполняются пакетно: один UPDATE на таблицу.
+
+Перед проверкой остатков строки склада блокируются (SELECT ... FOR UPDATE)
+в каноническом порядке (тип позиции, id), поэтому параллельные бронирования
+и отгрузки не перепродают товар и не взаимоблокируются. Транзакцию целиком
+выполняет run_with_retry, повторяя ее при дедлоке, ошибке сериализации
+или истечении lock_timeout.
+"""
+import asyncio
+import logging
+import os
+import random
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, TypeVar
+
+from sqlalchemy import case, delete, func, insert, literal, text, tuple_, update
+from sqlalchemy.exc import DBAPIError
+
+from models import (
+    FinishedProduct, Film, Joint, Glue, Order, OrderCompletion, OrderStatus, StockReservation,
+    OrderItem, OrderJoint, OrderGlue,
+)
+
+# Сколько ждать блокировку строки склада, прежде чем повторить транзакцию, миллисекунды
+STOCK_LOCK_TIMEOUT_MS = int(os.getenv("STOCK_LOCK_TIMEOUT_MS", "3000"))
+# Сколько раз выполнять транзакцию при конфликте блокировок
+STOCK_RETRY_ATTEMPTS = int(os.getenv("STOCK_RETRY_ATTEMPTS", "5"))
+STOCK_RETRY_BASE_DELAY = 0.05
+
+# serialization_failure, deadlock_detected, lock_not_available
+RETRYABLE_SQLSTATES = {"40001", "40P01", "55P03"}
+
+T = TypeVar("T")
+
+SKU_FINISHED_PRODUCT = "finished_product"
+SKU_JOINT = "joint"
+SKU_GLUE = "glue"
+
+SKU_MODELS = {
+    SKU_FINISHED_PRODUCT: FinishedProduct,
+    SKU_JOINT: Joint,
+    SKU_GLUE: Glue,
+}
+
+SkuKey = Tuple[str, int]
+
+# Типы строк заказа (для возвратов)
+LINE_ITEM = "item"
+LINE_JOINT = "joint"
+LINE_GLUE = "glue"
+
+LINE_MODELS = {
+    LINE_ITEM: OrderItem,
+    LINE_JOINT: OrderJoint,
+    LINE_GLUE: OrderGlue,
+}
+
+LineKey = Tuple[str, int]
+
+
+class StockLine(NamedTuple):
+    """Потребность заказа в одной позиции склада."""
+    sku_type: str
+    sku_id: int
+    quantity: int
+    label: str
+
+    @property
+    def key(self) -> SkuKey:
+        return (self.sku_type, self.sku_id)
+
+
+def product_label(color, thickness) -> str:
+    return f"{color} ({thickness} мм)"
+
+
+def joint_label(joint_type, color, thickness) -> str:
+    type_name = joint_type.name.capitalize() if hasattr(joint_type, "name") else str(joint_type)
+    return f"Стык {type_name} ({thickness} мм, {color})"
+
+
+def set_lock_timeout(db, timeout_ms: int = STOCK_LOCK_TIMEOUT_MS):
+    """Ограничивает ожидание блокировок в текущей транзакции."""
+    db.execute(text(f"SET LOCAL lock_timeout = {int(timeout_ms)}"))
+
+
+def lock_order(db, order_id: int) -> bool:
+    """Блокирует строку заказа, чтобы смена статуса не выполнялась дважды параллельно."""
+    set_lock_timeout(db)
+    return db.query(Order.id).filter(Order.id == order_id).with_for_update().scalar() is not None
+
+
+def lock_orders(db, order_ids: Iterable[int]) -> List[int]:
+    """Блокирует строки нескольких заказов в порядке id; возвращает ID найденных заказов."""
+    set_lock_timeout(db)
+    rows = db.query(Order.id).filter(Order.id.in_(list(order_ids))).order_by(Order.id).with_for_update().all()
+    return [order_id for order_id, in rows]
+
+
+def lock_stock(db, keys: Iterable[SkuKey]):
+    """Блокирует строки склада в каноническом порядке: по типу позиции, затем по id.
+
+    Одинаковый порядок захвата во всех транзакциях исключает взаимные блокировки.
+    """
+    ids_by_type = defaultdict(set)
+    for sku_type, sku_id in keys:
+        ids_by_type[sku_type].add(sku_id)
+    if not ids_by_type:
+        return
+    set_lock_timeout(db)
+    for sku_type in sorted(ids_by_type):
+        model = SKU_MODELS[sku_type]
+        db.query(model.id).filter(
+            model.id.in_(ids_by_type[sku_type])
+        ).order_by(model.id).with_for_update().all()
+
+
+def is_retryable(error: Exception) -> bool:
+    """Конфликт блокировок, после которого транзакцию можно просто повторить."""
+    return getattr(getattr(error, "orig", None), "pgcode", None) in RETRYABLE_SQLSTATES
+
+
+async def run_with_retry(db, operation: Callable[..., T], attempts: int = STOCK_RETRY_ATTEMPTS) -> T:
+    """Выполняет operation(db) и коммит как одну транзакцию, повторяя ее при конфликте блокировок.
+
+    После отката объекты сессии устаревают, поэтому operation должна сама
+    заново читать заказ и остатки.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            result = operation(db)
+            db.commit()
+            return result
+        except DBAPIError as e:
+            db.rollback()
+            if not is_retryable(e) or attempt >= attempts:
+                raise
+            delay = STOCK_RETRY_BASE_DELAY * 2 ** (attempt - 1) * (0.5 + random.random())
+            logging.warning(
+                f"Конфликт блокировок склада ({e.orig.pgcode}), попытка {attempt}/{attempts}, "
+                f"повтор через {delay * 1000:.0f} мс"
+            )
+            await asyncio.sleep(delay)
+
+
+def resolve_order_lines(db, order) -> Tuple[List[StockLine], List[str]]:
+    """Сопоставляет позиции заказа с записями склада.
+
+    Возвращает список потребностей и список позиций, которых на складе нет вовсе.
+    """
+    return resolve_orders_lines(db, [order])[order.id]
+
+
+class SkuIndex(NamedTuple):
+    """Соответствие строк заказов записям склада."""
+    product_ids: Dict[Tuple[str, float], int]
+    joint_ids: Dict[Tuple[object, str, float], int]
+    glue_id: Optional[int]
+
+    def product(self, item) -> Optional[int]:
+        return self.product_ids.get((item.color, item.thickness))
+
+    def joint(self, joint) -> Optional[int]:
+        return self.joint_ids.get((joint.joint_type, joint.joint_color, joint.joint_thickness))
+
+
+def build_sku_index(db, products, joints, with_glue: bool) -> SkuIndex:
+    """Один запрос на каждую таблицу склада для всех переданных строк заказов."""
+    product_ids = {}
+    if products:
+        rows = db.query(FinishedProduct.id, Film.code, FinishedProduct.thickness).join(
+            Film, FinishedProduct.film_id == Film.id
+        ).filter(
+            Film.code.in_({item.color for item in products})
+        ).order_by(FinishedProduct.id).all()
+        for product_id, code, thickness in rows:
+            product_ids.setdefault((code, thickness), product_id)
+
+    joint_ids = {}
+    if joints:
+        rows = db.query(Joint.id, Joint.type, Joint.color, Joint.thickness).filter(
+            Joint.color.in_({joint.joint_color for joint in joints})
+        ).order_by(Joint.id).all()
+        for joint_id, joint_type, color, thickness in rows:
+            joint_ids.setdefault((joint_type, color, thickness), joint_id)
+
+    glue_id = db.query(Glue.id).order_by(Glue.id).limit(1).scalar() if with_glue else None
+    return SkuIndex(product_ids, joint_ids, glue_id)
+
+
+def resolve_orders_lines(db, orders) -> Dict[int, Tuple[List[StockLine], List[str]]]:
+    """То же для нескольких заказов: не более одного запроса на каждую таблицу склада."""
+    index = build_sku_index(
+        db,
+        [item for order in orders for item in order.products if item.quantity],
+        [joint for order in orders for joint in order.joints if joint.joint_quantity],
+        any(glue.quantity for order in orders for glue in order.glues),
+    )
+
+    result = {}
+    for order in orders:
+        lines: List[StockLine] = []
+        missing: List[str] = []
+        for item in order.products:
+            if not item.quantity:
+                continue
+            label = product_label(item.color, item.thickness)
+            product_id = index.product(item)
+            if product_id is None:
+                missing.append(label)
+            else:
+                lines.append(StockLine(SKU_FINISHED_PRODUCT, product_id, item.quantity, label))
+
+        for joint in order.joints:
+            if not joint.joint_quantity:
+                continue
+            label = joint_label(joint.joint_type, joint.joint_color, joint.joint_thickness)
+            joint_id = index.joint(joint)
+            if joint_id is None:
+                missing.append(label)
+            else:
+                lines.append(StockLine(SKU_JOINT, joint_id, joint.joint_quantity, label))
+
+        glue_quantity = sum(glue.quantity for glue in order.glues)
+        if glue_quantity > 0:
+            if index.glue_id is None:
+                missing.append("Клей")
+            else:
+                lines.append(StockLine(SKU_GLUE, index.glue_id, glue_quantity, "Клей"))
+
+        result[order.id] = (merge_lines(lines), missing)
+    return result
+
+
+def merge_lines(lines: Iterable[StockLine]) -> List[StockLine]:
+    """Объединяет повторяющиеся позиции (например, две строки заказа одного цвета)."""
+    merged: Dict[SkuKey, StockLine] = {}
+    for line in lines:
+        existing = merged.get(line.key)
+        if existing:
+            merged[line.key] = existing._replace(quantity=existing.quantity + line.quantity)
+        else:
+            merged[line.key] = line
+    return list(merged.values())
+
+
+def on_hand_quantities(db, keys: Iterable[SkuKey]) -> Dict[SkuKey, int]:
+    """Остатки на складе по позициям: по одному запросу на тип позиции."""
+    ids_by_type = defaultdict(set)
+    for sku_type, sku_id in keys:
+        ids_by_type[sku_type].add(sku_id)
+
+    result: Dict[SkuKey, int] = {}
+    for sku_type, ids in ids_by_type.items():
+        model = SKU_MODELS[sku_type]
+        for sku_id, quantity in db.query(model.id, model.quantity).filter(model.id.in_(ids)):
+            result[(sku_type, sku_id)] = quantity or 0
+    return result
+
+
+def reserved_quantities(db, keys: Iterable[SkuKey], exclude_order_ids: Iterable[int] = ()) -> Dict[SkuKey, int]:
+    """Зарезервированное количество по позициям одним агрегатом по индексу (sku_type, sku_id)."""
+    keys = list(set(keys))
+    if not keys:
+        return {}
+    query = db.query(
+        StockReservation.sku_type, StockReservation.sku_id, func.sum(StockReservation.quantity)
+    ).filter(
+        tuple_(StockReservation.sku_type, StockReservation.sku_id).in_(keys)
+    )
+    exclude_order_ids = list(exclude_order_ids)
+    if exclude_order_ids:
+        query = query.filter(StockReservation.order_id.notin_(exclude_order_ids))
+    rows = query.group_by(StockReservation.sku_type, StockReservation.sku_id).all()
+    return {(sku_type, sku_id): int(total or 0) for sku_type, sku_id, total in rows}
+
+
+def available_quantities(db, keys: Iterable[SkuKey], exclude_order_ids: Iterable[int] = ()) -> Dict[SkuKey, int]:
+    """Доступное количество = на складе − зарезервировано (без учета резерва указанных заказов)."""
+    keys = list(set(keys))
+    on_hand = on_hand_quantities(db, keys)
+    reserved = reserved_quantities(db, keys, exclude_order_ids)
+    return {key: on_hand.get(key, 0) - reserved.get(key, 0) for key in keys}
+
+
+def available_quantity(db, key: SkuKey) -> int:
+    """Доступно по одной позиции: на складе минус резерв заказов."""
+    return available_quantities(db, [key]).get(key, 0)
+
+
+def find_shortages(db, lines: List[StockLine], exclude_order_ids: Iterable[int] = ()) -> List[str]:
+    """Описания позиций, которых не хватает для указанных потребностей."""
+    available = available_quantities(db, [line.key for line in lines], exclude_order_ids)
+    return shortages_against(lines, available)
+
+
+def shortages_against(lines: List[StockLine], available: Dict[SkuKey, int]) -> List[str]:
+    shortages = []
+    for line in lines:
+        if available.get(line.key, 0) < line.quantity:
+            shortages.append(f"- {line.label}: нужно {line.quantity}, доступно {max(available.get(line.key, 0), 0)}")
+    return shortages
+
+
+def reserve_order(db, order) -> List[str]:
+    """Резервирует позиции заказа одной пакетной вставкой.
+
+    Возвращает список нехваток; если он не пуст, резерв не создается.
+    Коммит выполняет вызывающий код.
+    """
+    lines, missing = resolve_order_lines(db, order)
+    lock_stock(db, [line.key for line in lines])
+    shortages = [f"- {label}: нет на складе" for label in missing]
+    shortages += find_shortages(db, lines, exclude_order_ids=[order.id])
+    if shortages:
+        return shortages
+
+    # Повторное бронирование заменяет прежний резерв заказа
+    release_order(db, order.id)
+    if lines:
+        db.execute(insert(StockReservation), [
+            {"order_id": order.id, "sku_type": line.sku_type, "sku_id": line.sku_id, "quantity": line.quantity}
+            for line in lines
+        ])
+    return []
+
+
+def release_order(db, order_id: int) -> int:
+    """Снимает весь резерв заказа одним DELETE. Возвращает количество удаленных строк."""
+    return release_orders(db, [order_id])
+
+
+def release_orders(db, order_ids: Iterable[int]) -> int:
+    """Снимает резерв нескольких заказов одним DELETE."""
+    order_ids = list(order_ids)
+    if not order_ids:
+        return 0
+    result = db.execute(delete(StockReservation).where(StockReservation.order_id.in_(order_ids)))
+    return result.rowcount or 0
+
+
+def increment_column(db, model, column, deltas: Dict[int, int]):
+    """UPDATE ... SET column = column + CASE id ... одним запросом для всех строк."""
+    deltas = {row_id: delta for row_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    # Значения приводятся к типу колонки: метры пленки пишутся в БД миллиметрами
+    deltas = {row_id: literal(delta, column.type) for row_id, delta in deltas.items()}
+    db.execute(
+        update(model)
+        .where(model.id.in_(deltas.keys()))
+        .values({column: column + case(deltas, value=model.id, else_=literal(0, column.type))})
+        .execution_options(synchronize_session=False)
+    )
+    # Загруженные в сессию объекты должны перечитать значение из БД
+    for instance in list(db.identity_map.values()):
+        if isinstance(instance, model):
+            db.expire(instance, [column.key])
+
+
+def apply_stock_deltas(db, deltas: Dict[SkuKey, int]):
+    """Применяет изменения остатков пакетно: один UPDATE ... CASE на каждую таблицу."""
+    deltas_by_type = defaultdict(dict)
+    for (sku_type, sku_id), delta in deltas.items():
+        if delta:
+            deltas_by_type[sku_type][sku_id] = deltas_by_type[sku_type].get(sku_id, 0) + delta
+
+    for sku_type, model_deltas in deltas_by_type.items():
+        model = SKU_MODELS[sku_type]
+        increment_column(db, model, model.quantity, model_deltas)
+
+
+def add_finished_products(db, produced: Dict[Tuple[int, float], int]) -> Dict[Tuple[int, float], int]:
+    """Добавляет готовую продукцию по (film_id, толщина): один UPDATE для существующих
+    записей и одна пакетная вставка для новых. Возвращает остатки до изменения."""
+    produced = {key: quantity for key, quantity in produced.items() if quantity}
+    if not produced:
+        return {}
+    existing = {
+        (film_id, thickness): (product_id, quantity or 0)
+        for product_id, film_id, thickness, quantity in db.query(
+            FinishedProduct.id, FinishedProduct.film_id, FinishedProduct.thickness, FinishedProduct.quantity
+        ).filter(tuple_(FinishedProduct.film_id, FinishedProduct.thickness).in_(list(produced)))
+        .order_by(FinishedProduct.id).with_for_update()
+    }
+    increment_column(db, FinishedProduct, FinishedProduct.quantity, {
+        existing[key][0]: quantity for key, quantity in produced.items() if key in existing
+    })
+    new_products = [
+        {"film_id": film_id, "thickness": thickness, "quantity": quantity}
+        for (film_id, thickness), quantity in produced.items() if (film_id, thickness) not in existing
+    ]
+    if new_products:
+        db.execute(insert(FinishedProduct), new_products)
+    return {key: existing.get(key, (None, 0))[1] for key in produced}
+
+
+def ship_order(db, order) -> List[str]:
+    """Списывает позиции заказа со склада и снимает его резерв.
+
+    Проверяет, что с учетом резервов других заказов всего хватает;
+    при нехватке ничего не меняет и возвращает список нехваток.
+    """
+    lines, missing = resolve_order_lines(db, order)
+    lock_stock(db, [line.key for line in lines])
+    shortages = [f"- {label}: нет на складе" for label in missing]
+    shortages += find_shortages(db, lines, exclude_order_ids=[order.id])
+    if shortages:
+        return shortages
+
+    apply_stock_deltas(db, {line.key: -line.quantity for line in lines})
+    release_order(db, order.id)
+    return []
+
+
+def ship_orders(db, orders) -> Tuple[List[int], Dict[int, List[str]]]:
+    """Пакетно списывает несколько заказов.
+
+    Строки склада блокируются один раз для всех заказов; заказы принимаются по очереди,
+    пока хватает остатка. Списание выполняется одним UPDATE на таблицу по суммам
+    позиций, резерв принятых заказов снимается одним DELETE.
+    Возвращает ID отгружаемых заказов и нехватки по отклоненным.
+    """
+    resolved = resolve_orders_lines(db, orders)
+    keys = {line.key for lines, _ in resolved.values() for line in lines}
+    lock_stock(db, keys)
+    available = available_quantities(db, keys, exclude_order_ids=[order.id for order in orders])
+
+    shipped: List[int] = []
+    rejected: Dict[int, List[str]] = {}
+    deltas: Dict[SkuKey, int] = defaultdict(int)
+    for order in orders:
+        lines, missing = resolved[order.id]
+        shortages = [f"- {label}: нет на складе" for label in missing] + shortages_against(lines, available)
+        if shortages:
+            rejected[order.id] = shortages
+            continue
+        for line in lines:
+            available[line.key] -= line.quantity
+            deltas[line.key] -= line.quantity
+        shipped.append(order.id)
+
+    apply_stock_deltas(db, deltas)
+    release_orders(db, shipped)
+    return shipped, rejected
+
+
+def complete_orders(db, order_ids: Iterable[int], warehouse_user_id: int):
+    """Отмечает заказы выполненными: один UPDATE статуса и пакетная вставка order_completions.
+
+    Позиции заказов не копируются — выполненный заказ остается в orders.
+    """
+    order_ids = list(order_ids)
+    if not order_ids:
+        return
+    completed_at = datetime.utcnow()
+    db.execute(
+        update(Order)
+        .where(Order.id.in_(order_ids))
+        .values(status=OrderStatus.COMPLETED, completed_at=completed_at)
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(insert(OrderCompletion), [
+        {"order_id": order_id, "warehouse_user_id": warehouse_user_id, "completed_at": completed_at}
+        for order_id in order_ids
+    ])
+
+
+def order_lines(order) -> List[Tuple[str, object]]:
+    """Строки заказа в постоянном порядке: на эту нумерацию ссылается частичный возврат."""
+    return (
+        [(LINE_ITEM, item) for item in sorted(order.items, key=lambda line: line.id)]
+        + [(LINE_JOINT, joint) for joint in sorted(order.joints, key=lambda line: line.id)]
+        + [(LINE_GLUE, glue) for glue in sorted(order.glues, key=lambda line: line.id)]
+    )
+
+
+def line_label(kind: str, line) -> str:
+    if kind == LINE_ITEM:
+        return product_label(line.color, line.thickness)
+    if kind == LINE_JOINT:
+        return joint_label(line.joint_type, line.joint_color, line.joint_thickness)
+    return "Клей"
+
+
+def returnable_quantity(line) -> int:
+    """Сколько по строке еще можно вернуть."""
+    return line.quantity - (line.returned_quantity or 0)
+
+
+def _create_missing_sku(db, kind: str, line) -> Optional[SkuKey]:
+    """Создает запись склада для возвращаемой позиции, которой на складе уже нет."""
+    if kind == LINE_ITEM:
+        film_id = db.query(Film.id).filter(Film.code == line.color).scalar()
+        if film_id is None:
+            return None
+        record = FinishedProduct(film_id=film_id, thickness=line.thickness, quantity=0)
+        sku_type = SKU_FINISHED_PRODUCT
+    elif kind == LINE_JOINT:
+        record = Joint(type=line.joint_type, color=line.joint_color, thickness=line.joint_thickness, quantity=0)
+        sku_type = SKU_JOINT
+    else:
+        record = Glue(quantity=0)
+        sku_type = SKU_GLUE
+    db.add(record)
+    db.flush()
+    return (sku_type, record.id)
+
+
+def return_order_lines(db, order, quantities: Optional[Dict[LineKey, int]] = None) -> Tuple[List[str], bool]:
+    """Возвращает позиции выполненного заказа на склад.
+
+    quantities задает количество по строкам ((тип строки, id) -> шт.); без него
+    возвращается весь еще не возвращенный остаток. Уже возвращенное повторно не
+    обрабатывается. Записи склада сопоставляются одним запросом на таблицу,
+    остатки и returned_quantity обновляются одним UPDATE на таблицу.
+    Возвращает описание движений и признак, что заказ возвращен полностью.
+    """
+    lines = order_lines(order)
+    to_return = []
+    for kind, line in lines:
+        remaining = returnable_quantity(line)
+        quantity = remaining if quantities is None else min(quantities.get((kind, line.id), 0), remaining)
+        if quantity > 0:
+            to_return.append((kind, line, quantity))
+
+    index = build_sku_index(
+        db,
+        [line for kind, line, _ in to_return if kind == LINE_ITEM],
+        [line for kind, line, _ in to_return if kind == LINE_JOINT],
+        any(kind == LINE_GLUE for kind, _, _ in to_return),
+    )
+
+    deltas: Dict[SkuKey, int] = defaultdict(int)
+    returned: Dict[str, Dict[int, int]] = defaultdict(dict)
+    # Записи, созданные для отсутствующих позиций: строки с той же позицией склада
+    # используют уже созданную запись (иначе повтор нарушит уникальность стыков)
+    created: Dict[tuple, Optional[SkuKey]] = {}
+    details = []
+    for kind, line, quantity in to_return:
+        label = line_label(kind, line)
+        if kind == LINE_ITEM:
+            sku_id = index.product(line)
+            key = (SKU_FINISHED_PRODUCT, sku_id) if sku_id is not None else None
+            identity = (kind, line.color, line.thickness)
+        elif kind == LINE_JOINT:
+            sku_id = index.joint(line)
+            key = (SKU_JOINT, sku_id) if sku_id is not None else None
+            identity = (kind, line.joint_type, line.joint_color, line.joint_thickness)
+        else:
+            key = (SKU_GLUE, index.glue_id) if index.glue_id is not None else None
+            identity = (kind,)
+        if key is None:
+            if identity not in created:
+                created[identity] = _create_missing_sku(db, kind, line)
+            key = created[identity]
+            if key is None:
+                logging.warning(f"Пленка {line.color} не найдена при возврате заказа {order.id}")
+                details.append(f"{label}: пленка не найдена, на склад не возвращено")
+                continue
+        deltas[key] += quantity
+        returned[kind][line.id] = quantity
+        details.append(f"{label}: +{quantity}")
+
+    # Считаем до UPDATE: после него returned_quantity строк перечитывается из БД
+    fully_returned = all(
+        returnable_quantity(line) - returned[kind].get(line.id, 0) <= 0 for kind, line in lines
+    )
+
+    apply_stock_deltas(db, deltas)
+    for kind, line_deltas in returned.items():
+        model = LINE_MODELS[kind]
+        increment_column(db, model, model.returned_quantity, line_deltas)
+    return details, fully_returned
@@ -0,0 +1,213 @@
+"""Снимок складских остатков в памяти для быстрых справок.
+
+Снимок собирается несколькими агрегирующими запросами (готовая продукция,
+пленка, панели, стыки, клей и резервы) и хранится до изменения склада: после
+commit сессии, которая меняла складские таблицы или резервы, номер версии
+увеличивается и снимок перестраивается при следующем обращении. Изменения из
+других процессов подхватываются не позже чем через STOCK_CACHE_TTL_SECONDS.
+"""
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from itertools import chain
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from database import get_db
+from models import Film, Panel, Joint, Glue, FinishedProduct, StockReservation, Order, JointType
+from stock import SKU_FINISHED_PRODUCT, SKU_JOINT, SKU_GLUE
+
+STOCK_CACHE_TTL_SECONDS = int(os.getenv("STOCK_CACHE_TTL_SECONDS", "60"))
+
+STOCK_MODELS = (Film, Panel, Joint, Glue, FinishedProduct, StockReservation)
+STOCK_TABLES = frozenset(model.__table__ for model in STOCK_MODELS)
+
+JOINT_TYPE_NAMES = {
+    JointType.BUTTERFLY: "Бабочка",
+    JointType.SIMPLE: "Простой",
+    JointType.CLOSING: "Замыкающий",
+}
+
+
+class ProductStock(NamedTuple):
+    film_code: str
+    thickness: float
+    on_hand: int
+    reserved: int
+
+    @property
+    def available(self) -> int:
+        return self.on_hand - self.reserved
+
+
+class FilmStock(NamedTuple):
+    code: str
+    meters: float
+    possible_panels: int
+    meters_per_roll: float = 0.0
+    panel_consumption: float = 0.0
+
+
+class PanelStock(NamedTuple):
+    thickness: float
+    quantity: int
+
+
+class JointStock(NamedTuple):
+    type: JointType
+    color: str
+    thickness: float
+    on_hand: int
+    reserved: int
+
+    @property
+    def available(self) -> int:
+        return self.on_hand - self.reserved
+
+
+class GlueStock(NamedTuple):
+    on_hand: int
+    reserved: int
+
+    @property
+    def available(self) -> int:
+        return self.on_hand - self.reserved
+
+
+class StockSnapshot(NamedTuple):
+    version: int
+    built_at: float
+    products: Dict[str, List[ProductStock]]  # по коду пленки
+    films: Dict[str, FilmStock]  # по коду пленки
+    panels: List[PanelStock]
+    joints: Dict[str, List[JointStock]]  # по цвету
+    glue: GlueStock
+
+
+def build_snapshot(db, version: int = 0) -> StockSnapshot:
+    """Собирает снимок: по одному запросу на таблицу склада и один агрегат резервов."""
+    reserved = defaultdict(int)
+    rows = db.query(
+        StockReservation.sku_type, StockReservation.sku_id, func.sum(StockReservation.quantity)
+    ).group_by(StockReservation.sku_type, StockReservation.sku_id)
+    for sku_type, sku_id, total in rows:
+        reserved[(sku_type, sku_id)] = int(total or 0)
+
+    products = defaultdict(list)
+    rows = db.query(
+        FinishedProduct.id, Film.code, FinishedProduct.thickness, FinishedProduct.quantity
+    ).join(Film, FinishedProduct.film_id == Film.id)
+    for product_id, code, thickness, quantity in rows:
+        products[code].append(ProductStock(
+            code, thickness, quantity or 0, reserved[(SKU_FINISHED_PRODUCT, product_id)]
+        ))
+
+    films = {}
+    rows = db.query(Film.code, Film.total_remaining, Film.possible_panels, Film.panel_consumption, Film.meters_per_roll)
+    for code, meters, possible, consumption, meters_per_roll in rows:
+        films[code] = FilmStock(code, meters or 0, possible or 0, meters_per_roll or 0.0, consumption or 0.0)
+
+    panels = [
+        PanelStock(thickness, quantity or 0)
+        for thickness, quantity in db.query(Panel.thickness, Panel.quantity).order_by(Panel.thickness)
+    ]
+
+    joints = defaultdict(list)
+    rows = db.query(Joint.id, Joint.type, Joint.color, Joint.thickness, Joint.quantity)
+    for joint_id, joint_type, color, thickness, quantity in rows:
+        joints[color].append(JointStock(
+            joint_type, color, thickness, quantity or 0, reserved[(SKU_JOINT, joint_id)]
+        ))
+
+    glue_on_hand = glue_reserved = 0
+    for glue_id, quantity in db.query(Glue.id, Glue.quantity):
+        glue_on_hand += quantity or 0
+        glue_reserved += reserved[(SKU_GLUE, glue_id)]
+
+    for lines in chain(products.values(), joints.values()):
+        lines.sort(key=lambda line: tuple(str(part) for part in line[:3]))
+
+    return StockSnapshot(
+        version=version,
+        built_at=time.time(),
+        products=dict(products),
+        films=films,
+        panels=panels,
+        joints=dict(joints),
+        glue=GlueStock(glue_on_hand, glue_reserved),
+    )
+
+
+_lock = threading.Lock()
+_version = 0
+_snapshot: Optional[StockSnapshot] = None
+_loaded_at = 0.0
+
+
+def version() -> int:
+    """Номер версии склада: увеличивается после каждого commit с изменением остатков."""
+    return _version
+
+
+def invalidate():
+    """Помечает снимок устаревшим (например, после изменения склада в обход ORM)."""
+    global _version
+    _version += 1
+
+
+def get_snapshot() -> StockSnapshot:
+    """Текущий снимок; при смене версии или по TTL перестраивается из БД."""
+    global _snapshot, _loaded_at
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == _version and time.monotonic() - _loaded_at < STOCK_CACHE_TTL_SECONDS:
+        return snapshot
+    with _lock:
+        if _snapshot is None or _snapshot.version != _version or time.monotonic() - _loaded_at >= STOCK_CACHE_TTL_SECONDS:
+            # Версию фиксируем до запросов: commit во время сборки снова сделает снимок устаревшим
+            current = _version
+            db = next(get_db())
+            try:
+                _snapshot = build_snapshot(db, current)
+            finally:
+                db.close()
+            _loaded_at = time.monotonic()
+            logging.debug(f"Снимок остатков перестроен (версия {current})")
+    return _snapshot
+
+
+def _mark_changed(session):
+    session.info["stock_changed"] = True
+
+
+@event.listens_for(Session, "after_flush")
+def _track_flush(session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        # Удаление заказа каскадом удаляет его резервы
+        if isinstance(obj, STOCK_MODELS) or (isinstance(obj, Order) and obj in session.deleted):
+            _mark_changed(session)
+            return
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_bulk_statements(orm_execute_state):
+    # Пакетные UPDATE/INSERT/DELETE (stock.increment_column, резервирование) идут мимо flush
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    if table in STOCK_TABLES or table is Order.__table__:
+        _mark_changed(orm_execute_state.session)
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_version_on_commit(session):
+    if session.info.pop("stock_changed", False):
+        invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_on_rollback(session):
+    session.info.pop("stock_changed", None)
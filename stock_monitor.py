@@ -0,0 +1,202 @@
+"""Фоновый контроль низких остатков склада.
+
+Задача раз в STOCK_MONITOR_INTERVAL секунд сверяет номер версии stock_cache и,
+если склад изменился, берет новый снимок остатков и проверяет пороги только у
+позиций, чей остаток изменился. Позиция, опустившаяся ниже порога, попадает в
+очередь уведомлений; очередь отправляется одним сообщением супер-админам и
+производству через LOW_STOCK_DEBOUNCE_SECONDS после первой записи, чтобы серия
+операций давала одно уведомление. Повтор по той же позиции — не раньше, чем
+через LOW_STOCK_REPEAT_HOURS, либо после того, как остаток поднимался выше порога.
+
+Пороги хранятся в таблице stock_thresholds (команда /threshold); без записи
+действуют прежние пороги reorder_forecast.MIN_STOCK.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import stock_cache
+from database import get_db
+from models import StockThreshold, User, UserRole
+from reorder_forecast import (
+    MATERIAL_FILM, MATERIAL_PANEL, MATERIAL_JOINT, MATERIAL_GLUE, MIN_STOCK, UNITS,
+    film_sku, panel_sku, joint_sku,
+)
+
+# Как часто проверяется версия склада, секунды
+STOCK_MONITOR_INTERVAL = float(os.getenv("STOCK_MONITOR_INTERVAL", "5"))
+# Сколько секунд копятся уведомления перед отправкой
+LOW_STOCK_DEBOUNCE_SECONDS = float(os.getenv("LOW_STOCK_DEBOUNCE_SECONDS", "120"))
+# Через сколько часов можно повторить уведомление по позиции, которая так и не пополнилась
+LOW_STOCK_REPEAT_HOURS = float(os.getenv("LOW_STOCK_REPEAT_HOURS", "24"))
+
+ALERT_ROLES = (UserRole.SUPER_ADMIN, UserRole.PRODUCTION)
+MAX_MESSAGE_LENGTH = 4000
+
+
+class Level(NamedTuple):
+    material: str
+    label: str
+    quantity: float
+
+
+class Alert(NamedTuple):
+    sku: str
+    level: Level
+    threshold: float
+
+
+def stock_levels(snapshot: stock_cache.StockSnapshot) -> Dict[str, Level]:
+    """Остаток каждой позиции материалов: пленка в метрах, стыки и клей — доступно с учетом резерва."""
+    levels = {
+        film_sku(film.code): Level(MATERIAL_FILM, f"{film.code} пленка", float(film.meters))
+        for film in snapshot.films.values()
+    }
+    for panel in snapshot.panels:
+        sku = panel_sku(panel.thickness)
+        previous = levels[sku].quantity if sku in levels else 0.0
+        levels[sku] = Level(MATERIAL_PANEL, f"Панели {panel.thickness} мм", previous + panel.quantity)
+    for joints in snapshot.joints.values():
+        for joint in joints:
+            label = f"Стык {stock_cache.JOINT_TYPE_NAMES.get(joint.type, joint.type)} {joint.color} {joint.thickness} мм"
+            levels[joint_sku(joint.type, joint.color, joint.thickness)] = Level(
+                MATERIAL_JOINT, label, float(joint.available)
+            )
+    levels[MATERIAL_GLUE] = Level(MATERIAL_GLUE, "Клей", float(snapshot.glue.available))
+    return levels
+
+
+def default_sku(material: str) -> str:
+    """Ключ порога, общего для всех позиций материала."""
+    return f"{material}:*"
+
+
+def resolve_threshold(sku: str, material: str, thresholds: Dict[str, float]) -> float:
+    if sku in thresholds:
+        return thresholds[sku]
+    return thresholds.get(default_sku(material), MIN_STOCK[material])
+
+
+def load_thresholds() -> Dict[str, float]:
+    db = next(get_db())
+    try:
+        return {sku: threshold for sku, threshold in db.query(StockThreshold.sku, StockThreshold.threshold)}
+    finally:
+        db.close()
+
+
+def load_recipients() -> List[int]:
+    db = next(get_db())
+    try:
+        return [telegram_id for (telegram_id,) in db.query(User.telegram_id).filter(User.role.in_(ALERT_ROLES))]
+    finally:
+        db.close()
+
+
+def format_alerts(alerts: List[Alert]) -> str:
+    lines = ["⚠️ Низкий остаток на складе:", ""]
+    for alert in sorted(alerts, key=lambda item: (item.level.material, item.level.label)):
+        unit = UNITS[alert.level.material]
+        lines.append(f"- {alert.level.label}: {alert.level.quantity:g} {unit} (порог {alert.threshold:g} {unit})")
+    text = "\n".join(lines)
+    if len(text) > MAX_MESSAGE_LENGTH:
+        text = text[:MAX_MESSAGE_LENGTH] + "\n…"
+    return text
+
+
+class StockMonitor:
+    """Состояние позиций между проверками и очередь уведомлений."""
+
+    def __init__(self, interval: float = STOCK_MONITOR_INTERVAL, debounce: float = LOW_STOCK_DEBOUNCE_SECONDS,
+                 repeat_hours: float = LOW_STOCK_REPEAT_HOURS):
+        self.interval = interval
+        self.debounce = debounce
+        self.repeat = repeat_hours * 3600
+        self._levels: Dict[str, Level] = {}
+        self._low: Dict[str, float] = {}  # позиция ниже порога -> время последнего уведомления
+        self._pending: Dict[str, Alert] = {}
+        self._pending_since: Optional[float] = None
+        self._thresholds: Optional[Dict[str, float]] = None
+        self._snapshot: Optional[stock_cache.StockSnapshot] = None
+        self._checked_version: Optional[int] = None
+        self._checked_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot):
+        self._task = asyncio.get_running_loop().create_task(self._run(bot))
+        logging.info(f"Контроль низких остатков запущен (проверка раз в {self.interval:g} с)")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def reload_thresholds(self):
+        """Перечитать пороги при следующей проверке и заново оценить все позиции."""
+        self._thresholds = None
+
+    async def _run(self, bot):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check(bot)
+            except Exception as e:
+                logging.error(f"Ошибка контроля низких остатков: {e}", exc_info=True)
+
+    async def check(self, bot):
+        full = self._thresholds is None
+        if full:
+            self._thresholds = await asyncio.to_thread(load_thresholds)
+        # Снимок запрашиваем при смене версии или по TTL — чтобы увидеть изменения других процессов
+        stale = time.monotonic() - self._checked_at >= stock_cache.STOCK_CACHE_TTL_SECONDS
+        if full or stale or stock_cache.version() != self._checked_version:
+            snapshot = await asyncio.to_thread(stock_cache.get_snapshot)
+            self._checked_version, self._checked_at = snapshot.version, time.monotonic()
+            if full or snapshot is not self._snapshot:
+                self._snapshot = snapshot
+                self.evaluate(stock_levels(snapshot), full)
+
+        if self._pending and time.monotonic() - self._pending_since >= self.debounce:
+            await self.flush(bot)
+
+    def evaluate(self, levels: Dict[str, Level], full: bool = False) -> List[str]:
+        """Проверяет пороги позиций, остаток которых изменился; возвращает проверенные позиции."""
+        for sku in set(self._levels) - set(levels):
+            self._low.pop(sku, None)
+            self._pending.pop(sku, None)
+        changed = [sku for sku, level in levels.items() if full or self._levels.get(sku) != level]
+        self._levels = levels
+
+        now = time.monotonic()
+        for sku in changed:
+            level = levels[sku]
+            threshold = resolve_threshold(sku, level.material, self._thresholds or {})
+            if level.quantity >= threshold:
+                self._low.pop(sku, None)
+                self._pending.pop(sku, None)
+                continue
+            if sku in self._pending or sku not in self._low or now - self._low[sku] >= self.repeat:
+                if not self._pending:
+                    self._pending_since = now
+                self._pending[sku] = Alert(sku, level, threshold)
+            self._low.setdefault(sku, now)
+        return changed
+
+    async def flush(self, bot):
+        alerts = list(self._pending.values())
+        self._pending.clear()
+        self._pending_since = None
+        now = time.monotonic()
+        for alert in alerts:
+            self._low[alert.sku] = now
+
+        text = format_alerts(alerts)
+        for telegram_id in await asyncio.to_thread(load_recipients):
+            try:
+                await bot.send_message(chat_id=telegram_id, text=text)
+            except Exception as e:
+                logging.warning(f"Не удалось отправить уведомление о низком остатке {telegram_id}: {e}")
+
+
+monitor = StockMonitor()
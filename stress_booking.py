@@ -0,0 +1,152 @@
+"""Нагрузочная проверка бронирования: много параллельных бронирований одной позиции склада.
+
+Создает тестовую пленку с ограниченным остатком готовой продукции и набор заказов
+со статусом NEW, бронирует их параллельно через stock.run_with_retry и проверяет,
+что суммарный резерв не превышает остаток. После проверки тестовые данные удаляются.
+
+Запуск: python stress_booking.py --bookers 32 --orders 200 --stock 500 --quantity 3
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func
+
+import stock
+from database import SessionLocal
+from models import User, UserRole, Film, FinishedProduct, Order, OrderItem, OrderStatus, StockReservation
+
+TEST_FILM_CODE = "STRESS-TEST"
+TEST_TELEGRAM_ID = -1
+
+
+def prepare(args):
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.telegram_id == TEST_TELEGRAM_ID).first()
+        if not user:
+            user = User(telegram_id=TEST_TELEGRAM_ID, username="stress_test", role=UserRole.SALES_MANAGER)
+            db.add(user)
+        film = Film(code=TEST_FILM_CODE, panel_consumption=3.0, meters_per_roll=50.0, total_remaining=0)
+        db.add(film)
+        db.flush()
+        product = FinishedProduct(film_id=film.id, quantity=args.stock, thickness=0.5)
+        db.add(product)
+        db.flush()
+
+        order_ids = []
+        for _ in range(args.orders):
+            order = Order(manager_id=user.id, status=OrderStatus.NEW.value, customer_phone="stress")
+            db.add(order)
+            db.flush()
+            db.add(OrderItem(order_id=order.id, quantity=args.quantity, color=TEST_FILM_CODE, thickness=0.5))
+            order_ids.append(order.id)
+        db.commit()
+        return product.id, order_ids
+    finally:
+        db.close()
+
+
+def book_order(order_id: int):
+    """Бронирует один заказ так же, как sales.confirm_booking. Возвращает (результат, попыток)."""
+    attempts = 0
+
+    def book(db):
+        nonlocal attempts
+        attempts += 1
+        stock.lock_order(db, order_id)
+        order = db.query(Order).filter(Order.id == order_id).first()
+        if order.status != OrderStatus.NEW:
+            return "skipped"
+        if stock.reserve_order(db, order):
+            db.rollback()
+            return "shortage"
+        order.status = OrderStatus.RESERVED.value
+        return "booked"
+
+    db = SessionLocal()
+    try:
+        return asyncio.run(stock.run_with_retry(db, book)), attempts
+    except Exception as e:
+        return f"error: {e.__class__.__name__}", attempts
+    finally:
+        db.close()
+
+
+def verify(product_id: int, order_ids):
+    db = SessionLocal()
+    try:
+        on_hand = db.query(FinishedProduct.quantity).filter(FinishedProduct.id == product_id).scalar()
+        reserved = db.query(func.coalesce(func.sum(StockReservation.quantity), 0)).filter(
+            StockReservation.sku_type == stock.SKU_FINISHED_PRODUCT,
+            StockReservation.sku_id == product_id
+        ).scalar()
+        reserved_orders = db.query(func.count(Order.id)).filter(
+            Order.id.in_(order_ids),
+            Order.status == OrderStatus.RESERVED
+        ).scalar()
+        return on_hand, int(reserved), reserved_orders
+    finally:
+        db.close()
+
+
+def cleanup(order_ids):
+    db = SessionLocal()
+    try:
+        db.query(StockReservation).filter(StockReservation.order_id.in_(order_ids)).delete(synchronize_session=False)
+        db.query(OrderItem).filter(OrderItem.order_id.in_(order_ids)).delete(synchronize_session=False)
+        db.query(Order).filter(Order.id.in_(order_ids)).delete(synchronize_session=False)
+        film_ids = db.query(Film.id).filter(Film.code == TEST_FILM_CODE)
+        db.query(FinishedProduct).filter(FinishedProduct.film_id.in_(film_ids)).delete(synchronize_session=False)
+        db.query(Film).filter(Film.code == TEST_FILM_CODE).delete(synchronize_session=False)
+        db.query(User).filter(User.telegram_id == TEST_TELEGRAM_ID).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка параллельного бронирования")
+    parser.add_argument("--bookers", type=int, default=16, help="количество параллельных потоков")
+    parser.add_argument("--orders", type=int, default=100, help="количество заказов")
+    parser.add_argument("--stock", type=int, default=150, help="остаток готовой продукции")
+    parser.add_argument("--quantity", type=int, default=2, help="количество в каждом заказе")
+    args = parser.parse_args()
+
+    product_id, order_ids = prepare(args)
+    try:
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.bookers) as pool:
+            results = list(pool.map(book_order, order_ids))
+        elapsed = time.perf_counter() - started_at
+
+        outcomes = {}
+        for outcome, _ in results:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        retries = sum(attempts - 1 for _, attempts in results)
+        on_hand, reserved, reserved_orders = verify(product_id, order_ids)
+        expected_booked = min(args.orders, args.stock // args.quantity)
+
+        print(f"Заказов: {args.orders}, потоков: {args.bookers}, за {elapsed:.2f} с ({args.orders / elapsed:.1f} заказов/с)")
+        print(f"Результаты: {outcomes}, повторов транзакций: {retries}")
+        print(f"Остаток: {on_hand}, зарезервировано: {reserved} ({reserved_orders} заказов)")
+
+        ok = True
+        if reserved > on_hand:
+            print(f"❌ Перепродажа: зарезервировано {reserved} при остатке {on_hand}")
+            ok = False
+        if reserved != reserved_orders * args.quantity:
+            print("❌ Резерв не совпадает с количеством забронированных заказов")
+            ok = False
+        if reserved_orders != expected_booked:
+            print(f"❌ Забронировано {reserved_orders} заказов, ожидалось {expected_booked}")
+            ok = False
+        if ok:
+            print("✅ Перепродаж нет, все возможные заказы забронированы")
+    finally:
+        cleanup(order_ids)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import analytics  # noqa: E402
+
+NOW = datetime(2026, 10, 19, 12, 0)
+
+
+def empty_frames(operations: pd.DataFrame) -> analytics.Frames:
+    """Выборки в том виде, в каком их строит load_frames из пустых .all()."""
+    production, defects = analytics.split_operations(operations, {"R-101": 3.0})
+    return analytics.make_frames(
+        pd.DataFrame([], columns=["order_id", "manager_id", "day", "color", "thickness", "panels"]),
+        pd.DataFrame([], columns=["manager_id", "day", "amount"]),
+        pd.DataFrame([], columns=["manager_id", "day", "amount"]),
+        production,
+        defects,
+    )
+
+
+def test_report_without_completed_orders():
+    operations = pd.DataFrame(
+        [(NOW - timedelta(days=1), "production", 10,
+          json.dumps({"film_color": "R-101", "panel_thickness": 0.5, "film_consumption": 30.0}))],
+        columns=["day", "operation_type", "quantity", "details"],
+    )
+    for period in analytics.PERIODS:
+        report = analytics.compute(empty_frames(operations), NOW, period)
+        assert report.top_colors.empty
+        assert report.managers.empty
+        assert report.thickness_mix["produced"].sum() == 10
+        assert "Выполненных заказов за период нет." in analytics.format_report(report)
+
+
+def test_report_without_any_data():
+    operations = pd.DataFrame([], columns=["day", "operation_type", "quantity", "details"])
+    report = analytics.compute(empty_frames(operations), NOW, 7)
+    assert report.top_colors.empty
+    assert report.thickness_mix.empty
+    assert (report.defects["rate"] == 0).all()
+    assert "Выполненных заказов за период нет." in analytics.format_report(report)